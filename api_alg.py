@@ -1,13 +1,16 @@
 #!/usr/env python
 # -*- coding: utf8 -*-
 
-""" MAC tool v1.0.0 2010-0604 """
+""" MAC tool v1.0.0 2010-0604
+
+The functions take & return hexdigits, they are thin wrappers of api_crypto, which works on
+binary strings: chained computations should call api_crypto directly.
+"""
 
 import binascii
-import pyDes
-import string
-import ctypes
 import random
+import multiprocessing
+import api_crypto
 
 MODE_SHIFT_Right = 1
 MODE_SHIFT_Left = 0
@@ -15,6 +18,10 @@ MODE_SHIFT_Left = 0
 a2b_hex = binascii.a2b_hex
 b2a_hex = binascii.b2a_hex
 
+INVERT = api_crypto.INVERT
+
+BULK_POOL_THRESHOLD = 200000 # number of cards from which the bulk diversification uses a process pool
+
 
 def Bits2Ascii(bits):
     ''' '''
@@ -78,44 +85,19 @@ def ShiftBits(asc, bits, mode, pad='0'):
     if pad != '0' and pad != '1':
         return
 
-    ascBits = Ascii2Bits(asc)
-
-    if mode == MODE_SHIFT_Right:
-        ascBits = (bits*pad) + ascBits +(8-bits)*pad
-    else:
-        ascBits = ascBits[bits:] + (bits*pad)
-
-    newasc =  Bits2Ascii(ascBits)
-    return newasc
+    out = api_crypto.shiftbits(a2b_hex(asc), bits, mode == MODE_SHIFT_Left, int(pad))
+    return b2a_hex(out).upper()
 
 
 def XorStr(s1, s2):
-    s1 = s1.upper()
-    s2 = s2.upper()
-
+    # s1 XOR s2, s2 may be longer
     bin1 = a2b_hex(s1)
     bin2 = a2b_hex(s2)
 
-    out = ''
-    for i,x in enumerate(bin1):
-        y1 = (ctypes.c_ubyte(~ord(x)).value) &0xFF
-        y2 = (ctypes.c_ubyte(~ord(bin2[i])).value) &0xFF
-        y = chr( y1^y2 )
-        out += y
-
-    text = b2a_hex(out)
-
-    return text.upper()
+    return b2a_hex(api_crypto.xor(bin1, bin2[:len(bin1)])).upper()
 
 def NotStr(s):
-    bin = a2b_hex(s)
-    s1 = ''
-    for x in bin:
-        y = chr((ctypes.c_ubyte(~ord(x)).value) &0xFF)
-        s1 += y
-
-    text = b2a_hex(s1)
-    return text.upper()
+    return b2a_hex(api_crypto.invert(a2b_hex(s))).upper()
 
 
 def DES_MAC_Precheck(icv, datain, key):
@@ -274,12 +256,10 @@ def DES_Encrypt(datain, key, ecb_mode, icv=None):
     k = a2b_hex(key)
 
     if ecb_mode:
-        cpu = pyDes.des(k, pyDes.ECB)
-        dataout = cpu.encrypt(d)
+        dataout = api_crypto.encrypt(api_crypto.DES, k, d)
     else:
         i = a2b_hex(icv)
-        cpu = pyDes.des(k, pyDes.CBC, i)
-        dataout = cpu.encrypt(d)
+        dataout = api_crypto.encrypt(api_crypto.DES, k, d, api_crypto.MODE_CBC, i)
 
     return b2a_hex(dataout).upper()
 
@@ -297,12 +277,10 @@ def DES_Decrypt(datain, key, ecb_mode, icv=None):
     k = a2b_hex(key)
 
     if ecb_mode:
-        cpu = pyDes.des(k, pyDes.ECB)
-        dataout = cpu.decrypt(d)
+        dataout = api_crypto.decrypt(api_crypto.DES, k, d)
     else:
         i = a2b_hex(icv)
-        cpu = pyDes.des(k, pyDes.CBC, i)
-        dataout = cpu.decrypt(d)
+        dataout = api_crypto.decrypt(api_crypto.DES, k, d, api_crypto.MODE_CBC, i)
 
     return b2a_hex(dataout).upper()
 
@@ -320,12 +298,10 @@ def TDES_Encrypt(datain, key, ecb_mode=True, icv=None):
     k = a2b_hex(key)
 
     if ecb_mode:
-        cpu = pyDes.triple_des(k, pyDes.ECB)
-        dataout = cpu.encrypt(d)
+        dataout = api_crypto.encrypt(api_crypto.TDES, k, d)
     else:
         i = a2b_hex(icv)
-        cpu = pyDes.triple_des(k, pyDes.CBC, i)
-        dataout = cpu.encrypt(d)
+        dataout = api_crypto.encrypt(api_crypto.TDES, k, d, api_crypto.MODE_CBC, i)
 
     return b2a_hex(dataout).upper()
 
@@ -343,69 +319,36 @@ def TDES_Decrypt(datain, key, ecb_mode=True, icv=None):
     k = a2b_hex(key)
 
     if ecb_mode:
-        cpu = pyDes.triple_des(k, pyDes.ECB)
-        dataout = cpu.decrypt(d)
+        dataout = api_crypto.decrypt(api_crypto.TDES, k, d)
     else:
         i = a2b_hex(icv)
-        cpu = pyDes.triple_des(k, pyDes.CBC, i)
-        dataout = cpu.decrypt(d)
+        dataout = api_crypto.decrypt(api_crypto.TDES, k, d, api_crypto.MODE_CBC, i)
 
     return b2a_hex(dataout).upper()
 
 
 def PBOC_TDES_MAC32(text, key, iv='00'*8):
 
-    t = a2b_hex(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-
-    t = t +suffix
-    ld = len(t)
-    if ld%8:
-        padding = ld%8
-        t = t[:(-1*padding)]
+    t = api_crypto.padm2(a2b_hex(text))
 
     k = a2b_hex(key)
 
     iv = a2b_hex(iv)
 
-    keyA = k[:8]
-    keyB = k[8:]
-
-    desKeyA = pyDes.des(keyA, pyDes.CBC, iv, None)
-    desKeyB = pyDes.des(keyB, pyDes.ECB, None, None)
-    desKeyA1 = pyDes.des(keyA, pyDes.ECB, None, None)
-
-    cipher = desKeyA.encrypt(t)
-    last8 = cipher[-8:]
-    last8d = desKeyB.decrypt(last8)
-    last8de = desKeyA1.encrypt(last8d)
-
-    mac = last8de[:4]
+    mac = api_crypto.retailmac(k, t, iv)[:4]
 
     return b2a_hex(mac).upper()
 
 
 def PBOC_SDES_MAC32(text, key, iv='00'*8):
 
-    t = a2b_hex(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-
-    t = t +suffix
-    ld = len(t)
-    if ld%8:
-        padding = ld%8
-        t = t[:(-1*padding)]
+    t = api_crypto.padm2(a2b_hex(text))
 
     k = a2b_hex(key)
 
     iv = a2b_hex(iv)
 
-    desKeyA = pyDes.des(k, pyDes.CBC, iv, None)
-    
-    cipher = desKeyA.encrypt(t)
-    last8 = cipher[-8:]
-
-    mac = last8[:4]
+    mac = api_crypto.cbcmac(api_crypto.DES, k, t, iv)[:4]
 
     return b2a_hex(mac).upper()
 
@@ -423,14 +366,10 @@ def PBOC_TDES_Encrypt(plaintext, key):
     pt = chr(ld) +pt
 
     if len(pt)%8 != 0:
-        pt = pt +"\x80\x00\x00\x00\x00\x00\x00\x00"
-        l = len(pt) -(len(pt)%8)
-        pt = pt[:l]
+        pt = api_crypto.padm2(pt)
 
 
-    fun = pyDes.triple_des(k, pyDes.ECB, None, None)
-
-    cipher = fun.encrypt(pt)
+    cipher = api_crypto.encrypt(api_crypto.TDES, k, pt)
 
     return b2a_hex(cipher).upper()
 
@@ -442,31 +381,15 @@ def SDES_MAC_Right(text, key, iv='00'*0x08):
 
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
-
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    descpu = pyDes.des(key, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
-
-    l = len(cipher)
-    last8e = cipher[l-8:]
+    last8e = api_crypto.cbcmac(api_crypto.DES, key, newtext, iv)
 
     mac = last8e[:4]
 
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
-
-    return ciphertext
+    return b2a_hex(mac).upper()
 
 
 def SDES_MAC_Left(text, key, iv='00'*0x08):
@@ -474,31 +397,15 @@ def SDES_MAC_Left(text, key, iv='00'*0x08):
 
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
-
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    descpu = pyDes.des(key, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
+    last8e = api_crypto.cbcmac(api_crypto.DES, key, newtext, iv)
 
-    l = len(cipher)
-    last8e = cipher[l-8:]
-
-    mac = last8e[:8]
-
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
+    mac = last8e[:4]
 
-    return ciphertext[:8]
+    return b2a_hex(mac).upper()
 
 
 def SDES_MAC(text, key, iv='00'*0x08):
@@ -506,68 +413,27 @@ def SDES_MAC(text, key, iv='00'*0x08):
 
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
-
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    descpu = pyDes.des(key, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
-
-    l = len(cipher)
-    last8e = cipher[l-8:]
+    last8e = api_crypto.cbcmac(api_crypto.DES, key, newtext, iv)
 
     mac = last8e[:8]
 
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
-
-    return ciphertext
+    return b2a_hex(mac).upper()
 
 
 def TDES_MAC_Right(text, key, iv='00'*8):
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    keyL = key[:8]
-
-    keyR = key[8:]
-
-    descpu = pyDes.des(keyL, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
-
-    l = len(cipher)
-    last8e = cipher[l-8:]
+    mac = api_crypto.retailmac(key, newtext, iv)[:4]
 
-    descpu1 = pyDes.des(keyR, pyDes.ECB, None, None)
-    last8ed = descpu1.decrypt(last8e)
-
-    descpu2 = pyDes.des(keyL, pyDes.ECB, None, None)
-    last8ede = descpu2.encrypt(last8ed)
-
-    mac = last8ede[:4]
-
-    #ciphertext = "".join(map("%.2X"%ord(x), mac))
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
+    ciphertext = b2a_hex(mac).upper()
 
     return ciphertext 
 
@@ -575,50 +441,13 @@ def TDES_MAC_Right(text, key, iv='00'*8):
 def TDES_MAC(text, key, iv='00'*8):
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    if len(key) == 16: # TDES with 2 keys
-        keyL = key[:8]
-        keyM = None
-        keyR = key[8:]
-    else: # 24, TDES with 3 keys
-        keyL = key[0:8]
-        keyM = key[8:16]
-        keyR = key[16:]
-
-    descpu = pyDes.des(keyL, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
-
-    l = len(cipher)
-    last8e = cipher[l-8:]
-
-    if keyM: # TDES with 3 keys
-        descpu1 = pyDes.des(keyM, pyDes.ECB, None, None)
-        last8ed = descpu1.decrypt(last8e)
-
-        descpu2 = pyDes.des(keyR, pyDes.ECB, None, None)
-        last8ede = descpu2.encrypt(last8ed)
-    else:
-        descpu1 = pyDes.des(keyR, pyDes.ECB, None, None)
-        last8ed = descpu1.decrypt(last8e)
-
-        descpu2 = pyDes.des(keyL, pyDes.ECB, None, None)
-        last8ede = descpu2.encrypt(last8ed)
-
-    mac = last8ede
+    mac = api_crypto.retailmac(key, newtext, iv) # TDES with 2 or 3 keys
 
-    #ciphertext = "".join(map("%.2X"%ord(x), mac))
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
+    ciphertext = b2a_hex(mac).upper()
 
     return ciphertext # 
 
@@ -626,35 +455,15 @@ def TDES_MAC(text, key, iv='00'*8):
 def TDES_MAC_Unusual(text, key, iv='00'*8):
     iv = a2b_hex(iv)
 
-    text = a2b_hex(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-    newtext = text+suffix
-    l = len(newtext)
-    l = l - (l%8)
-    newtext = newtext[:l]
+    newtext = api_crypto.padm2(a2b_hex(text))
 
     key = a2b_hex(key)
 
-    keyL = key[:8]
+    last8e = api_crypto.cbcmac(api_crypto.DES, key[:8], newtext, iv)
 
-    keyR = key[8:]
+    mac = api_crypto.encrypt(api_crypto.TDES, key, last8e)
 
-    descpu = pyDes.des(keyL, pyDes.CBC, iv, None)
-
-    cipher = descpu.encrypt(newtext)
-
-    l = len(cipher)
-    last8e = cipher[l-8:]
-
-    tdescpu = pyDes.triple_des(key, pyDes.ECB, None, None)
-    last8et = tdescpu.encrypt(last8e)
-
-    mac = last8et
-
-    #ciphertext = "".join(map("%.2X"%ord(x), mac))
-    ciphertext = ""
-    for x in mac:
-        ciphertext += "%.2X"%ord(x)
+    ciphertext = b2a_hex(mac).upper()
 
     return ciphertext # 
 
@@ -670,17 +479,12 @@ def Get3DESLevel1SubKey(key, factor1):
         return str(x)+" : " +str(len(x)) +" : [Error] Should be 32"
 
     f1 = a2b_hex(factor1)
-    f1Xor = ''.join( map(lambda x:chr(0xFF^ord(x)), f1) )
 
     keyhex = a2b_hex(key)
 
-    cpu = pyDes.triple_des(keyhex, pyDes.ECB, None, None)
+    subkey1 = api_crypto.encrypt(api_crypto.TDES, keyhex, f1+api_crypto.invert(f1))
 
-    subkey1 = cpu.encrypt(f1)+cpu.encrypt(f1Xor)
-
-    subkey1text = ''.join( map(lambda x:"%.2X"%ord(x), subkey1) )
-
-    return subkey1text
+    return b2a_hex(subkey1).upper()
 
 
 def Get3DESLevel2SubKey(key, factor1, factor2):
@@ -697,31 +501,142 @@ def Get3DESLevel2SubKey(key, factor1, factor2):
         return str(x)+" : " +str(len(x)) +" : [Error] Should be 32"
 
     factor1 = a2b_hex(factor1)
-    factor1Xor = ""
-    for x in factor1:
-        factor1Xor += (chr(0xFF^ord(x)))
-
     factor2 = a2b_hex(factor2)
-    factor2Xor = ""
-    for x in factor2:
-        factor2Xor += (chr(0xFF^ord(x)))
 
     keyhex = a2b_hex(key)
 
-    cpu = pyDes.triple_des(keyhex, pyDes.ECB, None, None)
+    subkey1 = api_crypto.encrypt(api_crypto.TDES, keyhex, factor1+api_crypto.invert(factor1))
 
-    subkey1 = cpu.encrypt(factor1) + cpu.encrypt(factor1Xor)
+    subkey2 = api_crypto.encrypt(api_crypto.TDES, subkey1, factor2+api_crypto.invert(factor2))
 
-    cpu = pyDes.triple_des(subkey1, pyDes.ECB, None, None)
+    return b2a_hex(subkey2).upper()
 
-    subkey2 = cpu.encrypt(factor2) + cpu.encrypt(factor2Xor)
 
-    subkey2text = ""
-    for x in subkey2:
-        subkey2text += "%.2X"%ord(x)
+def DiversifyKeys(cpu, factors):
+    ''' Diversify a list of 8 bytes factors with one TDES-ECB cipher object, in a single call.
 
+        Returns a list of 16 bytes subkeys: E(factor) + E(~factor)
+    '''
+    data = ''.join([f + f.translate(INVERT) for f in factors])
+    cipher = cpu.encrypt(data)
+    return [cipher[i:i+16] for i in range(0, len(cipher), 16)]
+
+
+def CheckFactors(key, factors):
+    ''' Raise ValueError if the key is not 32 hexdigits or any factor not 16 hexdigits,
+        returns the binary key & factors.
+    '''
+    if len(key) != 32:
+        raise ValueError('%s : %d : [Error] Should be 32' % (key, len(key)))
+    for x in factors:
+        if len(x) != 16:
+            raise ValueError('%s : %d : [Error] Should be 16' % (x, len(x)))
+    return a2b_hex(key), a2b_hex(''.join(factors))
+
+
+def SubKeysToHex(subkeys):
+    text = b2a_hex(''.join(subkeys)).upper()
+    return [text[i:i+32] for i in range(0, len(text), 32)]
+
+
+def Level1SubKeys(args):
+    ''' Level 1 diversification of a chunk, key & factors binary, run by a worker process '''
+    key, factors = args
+    return SubKeysToHex(DiversifyKeys(api_crypto.newcipher(api_crypto.TDES, key), factors))
+
+
+def Level2SubKeys(args):
+    ''' Level 2 diversification of a chunk, key & factors binary, run by a worker process '''
+    key, factors1, factors2 = args
+    cpu = api_crypto.newcipher(api_crypto.TDES, key)
+    unique = list(set(factors1)) # factor1 is often shared
+    level1 = dict(zip(unique, DiversifyKeys(cpu, unique)))
+    cpus = {}
+    subkeys = []
+    for f1, f2 in zip(factors1, factors2):
+        cpu = cpus.get(f1)
+        if cpu is None:
+            cpu = cpus[f1] = api_crypto.newcipher(api_crypto.TDES, level1[f1])
+        subkeys.append(cpu.encrypt(f2 + f2.translate(INVERT)))
+    return SubKeysToHex(subkeys)
+
+
+def RunBulk(func, chunks, processes):
+    ''' Run func on each chunk, in a process pool if processes > 1, returns the joined results '''
+    if processes > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(func, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(func, chunks)
+    return [x for lst in results for x in lst]
+
+
+def GetProcesses(n, processes):
+    if processes is None:
+        processes = multiprocessing.cpu_count() if n >= BULK_POOL_THRESHOLD else 1
+    return max(1, processes)
+
+
+def Get3DESLevel1SubKeys(key, factors, processes=None):
+    ''' Bulk Get3DESLevel1SubKey(), one key schedule for all the cards.
+
+        key: string, master key, 32 hexdigits
+        factors: list of string, 16 hexdigits each, like ICCIDs
+        processes: number of worker processes, None for all CPUs if more than
+                   BULK_POOL_THRESHOLD cards, else 1. The calling script must be protected
+                   by "if __name__ == '__main__':" on Windows.
+
+        Returns a list of subkeys as hexdigits, in the order of factors.
+        Raise ValueError if the length of key or any factor is wrong.
+    '''
+    k, f = CheckFactors(key, factors)
+    f = [f[i:i+8] for i in range(0, len(f), 8)]
+    processes = GetProcesses(len(f), processes)
+    size = max(1000, (len(f)+processes-1)/processes)
+    return RunBulk(Level1SubKeys, [(k, f[i:i+size]) for i in range(0, len(f), size)], processes)
+
+
+def Get3DESLevel2SubKeys(key, factors1, factors2, processes=None):
+    ''' Bulk Get3DESLevel2SubKey().
+
+        key: string, master key, 32 hexdigits
+        factors1: list of string, 16 hexdigits each, or a string for all the cards
+        factors2: list of string, 16 hexdigits each
+        processes: see Get3DESLevel1SubKeys()
+
+        Returns a list of subkeys as hexdigits, in the order of factors2.
+        Raise ValueError if the length of key or any factor is wrong.
+    '''
+    if isinstance(factors1, basestring):
+        factors1 = [factors1]*len(factors2)
+    if len(factors1) != len(factors2):
+        raise ValueError('%d factor1 for %d factor2' % (len(factors1), len(factors2)))
+    k, f = CheckFactors(key, list(factors1)+list(factors2))
+    f = [f[i:i+8] for i in range(0, len(f), 8)]
+    f1, f2 = f[:len(factors1)], f[len(factors1):]
+    processes = GetProcesses(len(f2), processes)
+    size = max(1000, (len(f2)+processes-1)/processes)
+    return RunBulk(Level2SubKeys, [(k, f1[i:i+size], f2[i:i+size]) for i in range(0, len(f2), size)], processes)
+
+
+def BenchmarkSubKeys(n=100000, processes=None):
+    ''' Returns the throughput of Get3DESLevel2SubKey() & Get3DESLevel2SubKeys(), in cards/s '''
+    import time
+    key = '11111111111111111111111111111111'
+    factors = ['%.16X' % (0x8986001234567890+i) for i in range(n)]
+    m = min(n, 200)
+    t0 = time.time()
+    lst = [Get3DESLevel2SubKey(key, '1111111111111111', x) for x in factors[:m]]
+    t1 = time.time()
+    bulk = Get3DESLevel2SubKeys(key, '1111111111111111', factors, processes)
+    t2 = time.time()
+    assert bulk[:m] == lst
+    return m/(t1-t0), n/(t2-t1)
 
-    return subkey2text
 
 def zyt_create_file(key, fileheader, rand='', apduheader='84E00001'):
 
@@ -868,5 +783,17 @@ if __name__ == '__main__':
         print s
         print 'error in XorStr()'
 
+    factors = [f, '1111111111111111', '0000000000000000']
+    subkeys = Get3DESLevel1SubKeys('74832174819274982147298749475847', factors, processes=2)
+    if subkeys != [Get3DESLevel1SubKey('74832174819274982147298749475847', x) for x in factors]:
+        print 'error in Get3DESLevel1SubKeys()'
+
+    subkeys = Get3DESLevel2SubKeys(k, [f1, f1, f2], [f2, f1, f2])
+    if subkeys != [Get3DESLevel2SubKey(k, x, y) for x, y in [(f1, f2), (f1, f1), (f2, f2)]] or subkeys[0] != subkey:
+        print 'error in Get3DESLevel2SubKeys()'
+
+    single, bulk = BenchmarkSubKeys()
+    print 'Get3DESLevel2SubKey(): %d cards/s, Get3DESLevel2SubKeys(): %d cards/s' % (single, bulk)
+
     print 'KeyAlgMac self test finished!'
 
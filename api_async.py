@@ -0,0 +1,272 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with asynchronous reader access.
+
+Every api_pcsc call blocks until the card answers, so driving many readers used to mean one
+thread per card. Here each reader gets its own executor, a ReaderWorker thread bound to its
+session, and every call returns at once a Job, a future of the result:
+
+    pool = api_async.AsyncPool.fromreaders()
+    jobs = [x.send('00A4040000') for x in pool]
+    for response, sw in api_async.gather(jobs, timeout=5):
+        ...
+
+Module-level APIs run on the executor of a reader too, through a proxy of the module:
+
+    gp = session.wrap(api_gp)
+    gp.card().result()
+    gp.auth().result()
+    job = gp.upload(pathtocap, aid)
+
+One thread, e.g. the UI, can then coordinate dozens of readers with wait(), gather() &
+as_completed(), with timeouts & cancellation. Commands to the same reader are run in order.
+
+Python 2 has no asyncio, the Jobs are the futures of this module, see api_pcsc.Job.
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import time, logging, unittest, threading, Queue
+import api_pcsc
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+FIRST_COMPLETED = 'first-completed'
+ALL_COMPLETED = 'all-completed'
+
+
+#-------------------------------------------------------------------------------
+# define API
+
+class AsyncModule(object):
+    ''' A proxy of a module, its functions are run on the executor of a session & return a Job.
+    '''
+
+    def __init__(self, session, module):
+        self.session = session
+        self.module = module
+
+    def __getattr__(self, name):
+        func = getattr(self.module, name)
+        if not callable(func):
+            return func
+        def call(*args, **kwargs):
+            return self.session.call(func, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+
+class AsyncSession(object):
+    ''' The asynchronous facade of a ReaderSession, all methods return a Job at once.
+    '''
+
+    def __init__(self, session=None):
+        ''' session: a ReaderSession or a reader name, '' for the first reader found
+        '''
+        self.session = session if isinstance(session, api_pcsc.ReaderSession) else api_pcsc.ReaderSession(session or '')
+        self.worker = api_pcsc.ReaderWorker(self.session)
+        self.worker.start()
+
+    def __str__(self):
+        return str(self.session)
+
+    def call(self, func, *args, **kwargs):
+        ''' Run func(*args, **kwargs) on the executor of this reader, returns a Job.
+        '''
+        return self.worker.call(func, *args, **kwargs)
+
+    def wrap(self, module):
+        ''' Returns an AsyncModule of module, like wrap(api_gp).
+        '''
+        return AsyncModule(self, module)
+
+    def connect(self, name='', cold=True):
+        return self.call(self.session.connect, name, cold)
+
+    def reset(self, cold=True):
+        return self.call(self.session.reset, cold)
+
+    def disconnect(self, cold=True):
+        return self.call(self.session.disconnect, cold)
+
+    def send(self, apdu, expectData='', expectSW='', info='', name=''):
+        return self.call(self.session.send, apdu, expectData, expectSW, info, name)
+
+    def sendcommand(self, cla, ins, p1, p2, data='', le=None, expectData='', expectSW='', info='', name=''):
+        return self.call(self.session.sendcommand, cla, ins, p1, p2, data, le, expectData, expectSW, info, name)
+
+    def send_batch(self, script):
+        return self.call(self.session.send_batch, script)
+
+    def close(self, disconnect=True):
+        ''' Stop the executor after the jobs already submitted, disconnect the reader if
+            disconnect is True.
+        '''
+        if disconnect:
+            self.disconnect()
+        self.worker.stop()
+        self.worker.join()
+
+
+class AsyncPool(list):
+    ''' A list of AsyncSession, one per reader.
+    '''
+
+    def __init__(self, sessions):
+        ''' sessions: a list of AsyncSession, ReaderSession or reader names.
+        '''
+        list.__init__(self, [x if isinstance(x, AsyncSession) else AsyncSession(x) for x in sessions])
+
+    @classmethod
+    def fromreaders(cls, names=None):
+        ''' Create a pool of the readers in names, or all readers attached.
+        '''
+        names = names if names else [str(x) for x in api_pcsc.getreaderlist()]
+        return cls(names)
+
+    def call(self, func, *args, **kwargs):
+        ''' Run func(*args, **kwargs) on every reader, returns a list of Job.
+        '''
+        return [x.call(func, *args, **kwargs) for x in self]
+
+    def close(self, disconnect=True):
+        for x in self:
+            x.close(disconnect)
+
+
+def wait(jobs, timeout=None, return_when=ALL_COMPLETED):
+    ''' Wait for the jobs, until all or the first of them finished, or timeout in seconds.
+
+        Returns a tuple of 2 lists: (done, not done)
+    '''
+    jobs = list(jobs)
+    event = threading.Event()
+    if return_when == FIRST_COMPLETED:
+        callback = lambda job: event.set()
+    else:
+        lock, left = threading.Lock(), [len(jobs)]
+        def callback(job):
+            with lock:
+                left[0] -= 1
+                if not left[0]:
+                    event.set()
+    if not jobs:
+        event.set()
+    for job in jobs:
+        job.add_done_callback(callback)
+    event.wait(timeout)
+    return [x for x in jobs if x.done.is_set()], [x for x in jobs if not x.done.is_set()]
+
+
+def gather(jobs, timeout=None, cancel=True):
+    ''' Returns the results of the jobs, in order, once all finished.
+
+        Raises the first exception of the jobs, or PCSCException on timeout. The jobs not
+        finished yet are then cancelled if cancel is True.
+    '''
+    jobs = list(jobs)
+    deadline = time.time()+timeout if timeout is not None else None
+    try:
+        return [x.result(max(0, deadline-time.time()) if deadline else None) for x in jobs]
+    except Exception:
+        if cancel:
+            for x in jobs:
+                x.cancel()
+        raise
+
+
+def as_completed(jobs, timeout=None):
+    ''' Yields the jobs as they finish.
+
+        Raises PCSCException if not all finished within timeout in seconds.
+    '''
+    jobs = list(jobs)
+    queue = Queue.Queue()
+    for job in jobs:
+        job.add_done_callback(queue.put)
+    deadline = time.time()+timeout if timeout is not None else None
+    for i in range(len(jobs)):
+        try:
+            # a timeout, even a huge one, keeps the wait interruptible by Ctrl+C
+            yield queue.get(True, max(0, deadline-time.time()) if deadline else 3600*24*365)
+        except Queue.Empty:
+            raise api_pcsc.PCSCException('Timeout! %d of %d jobs not finished in %s seconds' % (len(jobs)-i, len(jobs), timeout))
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def setUp(self):
+        import api_virtualcard
+        self.cards = [api_virtualcard.createusim() for i in range(8)]
+        self.old = api_pcsc.settransport(api_virtualcard.createtransport(*self.cards))
+        self.pool = AsyncPool.fromreaders()
+
+    def tearDown(self):
+        self.pool.close()
+        api_pcsc.settransport(self.old)
+
+    def test_pool(self):
+        ''' 8个虚拟读卡器并发：连接、发送APDU、按完成顺序取结果 '''
+        atrs = gather([x.connect() for x in self.pool], timeout=5)
+        self.assertEqual(len(set(atrs)), 1)
+        jobs = []
+        for x in self.pool:
+            jobs.append(x.send('00A40004022FE2', expectSW='9000'))
+            jobs.append(x.send('00B000000A', expectSW='9000'))
+        self.assertEqual([sw for r, sw in gather(jobs, timeout=5)], ['9000']*16)
+        self.assertEqual(jobs[1].result()[0], '982520506196020013F3')
+
+        jobs = [x.send('00B0000001', expectSW='9000') for x in self.pool]
+        self.assertEqual(sorted(as_completed(jobs, timeout=5)), sorted(jobs))
+        self.assertEqual(sum(x.count for x in self.cards), 8*4) # SELECT & GET RESPONSE
+
+        job = self.pool[0].send('00A40004026F99', expectSW='9000')
+        self.assertRaises(api_pcsc.PCSCException, job.result, 5)
+        self.assertEqual(self.pool[0].session.lastapdu['sw'], '6A82')
+
+    def test_cancel(self):
+        ''' 等待超时、取消尚未执行的任务 '''
+        session = self.pool[0]
+        gate = threading.Event()
+        blocked = session.call(gate.wait)
+        pending = session.send('00A4040000')
+        done, notdone = wait([blocked, pending], timeout=0.05, return_when=FIRST_COMPLETED)
+        self.assertEqual((done, notdone), ([], [blocked, pending]))
+        self.assertRaises(api_pcsc.PCSCException, gather, [blocked, pending], 0.05)
+        self.assertTrue(pending.cancelled)
+        self.assertFalse(blocked.cancel())
+        gate.set()
+        self.assertTrue(blocked.result(5))
+        self.assertRaises(api_pcsc.PCSCException, pending.result)
+        self.assertEqual(wait([blocked, pending], 5), ([blocked, pending], []))
+
+    def test_gp(self):
+        ''' 通过api_gp的代理，在各读卡器的执行线程中认证 '''
+        import api_gp
+        jobs = []
+        for x in self.pool[:4]:
+            gp = x.wrap(api_gp)
+            x.connect()
+            gp.card()
+            jobs.append(gp.auth())
+        gather(jobs, timeout=5)
+        self.assertTrue(all(x.cardmanager.session for x in self.cards[:4]))
+        self.assertFalse(any(x.cardmanager.session for x in self.cards[4:]))
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
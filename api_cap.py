@@ -13,7 +13,9 @@ Copyright 2015 XH Smart Card Co,.Ltd
 Author: atr@china-xinghan.com
 """
 
-import binascii, time, os, zipfile, re, unittest
+import binascii, struct, collections, bisect, hashlib, threading, time, os, zipfile, re, logging, unittest
+import api_tlv
+import api_config
 
 
 b2a = binascii.b2a_hex
@@ -49,6 +51,12 @@ pat_u1not0 = '(?!00)\w{2}' # regular expression, 2-hexdigits of 'u1' but not '00
 pat_u2 = '\w{4}' # regular expression, 4-hexdigits of 'u2'
 pat_u2not0 = '(?!0000)\w{4}' # regular expression, 4-hexdigits of 'u2' but not '0000' allowed
 
+MANIFEST = 'META-INF/MANIFEST.MF'
+
+U1 = struct.Struct('>B')
+U2 = struct.Struct('>H')
+U4 = struct.Struct('>I')
+
 
 def sliceHex(s, width, extra='[\w]*'):
     ''' Slice a string according to the width
@@ -84,11 +92,11 @@ class TLV(object):
              tlv: hex-digit string, like '80020102'
              width: a tuple, indicate the width of 'Tag' & 'Length' fields.
         '''
-        a2b(tlv) # check if all hex-digit & even length
+        data = a2b(tlv) # check if all hex-digit & even length
 
         self.tlv = tlv.upper()
 
-        if len(tlv) < sum(width)*2:
+        if len(data) < sum(width):
             raise ValueError("Too short: No enough fields for 'Tag' & 'Length'")
         else:
             L1 = width[0] * 2
@@ -97,13 +105,13 @@ class TLV(object):
             self.tag = self.tlv[:L1]
             self.length = self.tlv[L1:(L1+L2)]
 
-            L3 = int(self.length, 16) * 2
-
-            if len(self.tlv[(L1+L2):]) < L3:
+            try:
+                value = next(api_tlv.iterfixed(data, width[0], width[1]))[1]
+            except api_tlv.TLVException:
                 raise ValueError("Too short: No enough fields for 'Value'")
-            else:
-                self.value = self.tlv[(L1+L2):(L1+L2+L3)]
-                self.extra = self.tlv[(L1+L2+L3):] # normally 'extra' is an empty string
+            L3 = len(value) * 2
+            self.value = self.tlv[(L1+L2):(L1+L2+L3)]
+            self.extra = self.tlv[(L1+L2+L3):] # normally 'extra' is an empty string
 
             # setup alias (another name)
             self.t = self.tag
@@ -129,27 +137,90 @@ class Component(object):
     ''' Abstract class of 'Commponent' in CAP File .
 
          see Chapter 6.1 Component Model, JCVM spec
+
+         The component is kept binary, a memoryview of the bytes read from the CAP file, no copy
+         made. The fields are decoded at their offsets with struct, 'items' & 'tlv', the hex
+         view of the fields, are built only when asked.
     '''
 
+    items_name = ('tag', 'size')
+    pattern = '%s%s'%(pat_u1, pat_u2not0)
+
     def __init__(self, data):
-        ''' data: a string, example: '010011DECAFFED010204000107A000000333CDD0'
+        ''' data: a string of hexdigits, example: '010011DECAFFED010204000107A000000333CDD0', or
+                  the bytes of the component: a memoryview, a bytearray, see also frombytes()
 
                 header_component {
                 u1 tag
                 u2 size
                 }
         '''
-        self.items_name = ('tag', 'size')
-        self.pattern = '%s%s'%(pat_u1, pat_u2not0)
+        if isinstance(data, basestring):
+            data = memoryview(a2b(data)) # check if all hex-digit & even length
+        elif not isinstance(data, memoryview):
+            data = memoryview(data)
+        if len(data) < 3:
+            raise ValueError("Too short: No enough fields for 'Tag' & 'Length'")
+
+        self.data = data
+        try:
+            tag, self.info = next(api_tlv.iterfixed(data, 1, 2)) # the value, a memoryview too
+        except api_tlv.TLVException:
+            raise ValueError("Too short: No enough fields for 'Value'")
+        self.length = len(self.info)
+
+        self.tag = '%.2X' % tag
+        self.size = '%.4X' % self.length
+        self._items = None
+        try:
+            self.decode()
+        except struct.error:
+            raise CAPException('Too short: No enough fields for %s component' % self.__class__.__name__)
+
+    @classmethod
+    def frombytes(cls, data, *args):
+        ''' Returns the component of the bytes, a str read from the CAP file '''
+        return cls(memoryview(data), *args)
+
+    def decode(self):
+        ''' Check the fields at their offsets, raise CAPException if too short. Overridden by
+            the components to decode.
+        '''
+        pass
+
+    def fields(self):
+        ''' Returns the values of items_name, hexdigits. Overridden by the components to decode.
+        '''
+        return [self.tag, self.size]
+
+    @property
+    def items(self):
+        ''' A dictionary of items_name & hexdigits, built at the first access '''
+        if self._items is None:
+            self._items = dict(zip(self.items_name, self.fields()))
+        return self._items
+
+    @property
+    def tlv(self):
+        return TLV(str(self), width=(1,2))
+
+    def hexat(self, offset, length=None):
+        ''' Returns the hexdigits of info[offset:offset+length], up to the end if length is None '''
+        end = len(self.info) if length is None else offset+length
+        return b2a(self.info[offset:end]).upper()
 
-        self.tlv = TLV(data, width=(1,2))
-        self.tag = self.tlv.t
-        self.size = self.tlv.length
-        self.items = dict(zip(self.items_name, (self.tag, self.size)))
+    def u1(self, offset):
+        return U1.unpack_from(self.info, offset)[0]
+
+    def u2(self, offset):
+        return U2.unpack_from(self.info, offset)[0]
+
+    def u4(self, offset):
+        return U4.unpack_from(self.info, offset)[0]
 
 
     def __str__(self):
-        return str(self.tlv)
+        return b2a(self.data[:3+self.length]).upper()
 
 
     def dump(self):
@@ -167,13 +238,25 @@ class Component(object):
         return ''
 
 
+    def check(self):
+        ''' Check the fields against the JCVM spec, binary. Overridden by the components to
+            decode.
+
+             returns True or False
+        '''
+        return self.length > 0
+
+
     def selfcheck(self, pattern=None):
         ''' Check if 'Component' compatibility with the JCVM spec.
 
+             pattern: a regular expression to match the hexdigits of the component, the binary
+                      check() if omitted
+
              returns True or False
         '''
         if not pattern:
-            pattern = self.pattern
+            return self.check()
 
         m = re.match(pattern, str(self))
 
@@ -187,6 +270,26 @@ class Header(Component):
          see Chapter 6.3 Header Component, JCVM spec
     '''
 
+    items_name = (
+            'tag',
+            'size',
+            'magic',
+            'minor_version',
+            'major_version',
+            'flags',
+            'package_info_minor_version',
+            'package_info_major_version',
+            'package_info_AID_length',
+            'package_info_AID',
+            'package_name_info_name_length',
+            'package_name_info_name',
+            )
+
+    # pattern = '01(?!0000)\w{4}(DECAFFED01020|DECAFFED02020)[0-7]\d{2}\w{2,}$'
+    pattern = '01' +pat_u2not0 +'(DECAFFED01020|DECAFFED02020)[0-7]\d{2}\w{2,}$'
+
+    MAGIC = 0xDECAFFED
+
 
     def __init__(self, data):
         ''' data: a string, example: '010011DECAFFED010204000107A000000333CDD0'
@@ -204,42 +307,31 @@ class Header(Component):
         '''
         Component.__init__(self, data)
 
-        self.items_name = (
-                'tag',
-                'size',
-                'magic',
-                'minor_version',
-                'major_version',
-                'flags',
-                'package_info_minor_version',
-                'package_info_major_version',
-                'package_info_AID_length',
-                'package_info_AID',
-                'package_name_info_name_length',
-                'package_name_info_name',
-                )
-
-        # pattern = '01(?!0000)\w{4}(DECAFFED01020|DECAFFED02020)[0-7]\d{2}\w{2,}$'
-        self.pattern = '01' +pat_u2not0 +'(DECAFFED01020|DECAFFED02020)[0-7]\d{2}\w{2,}$'
-
-        lst = sliceHex(self.tlv.v, (4,1,1,1, 1,1,1)) # from 'magic' to 'package_info_AID_length', & extra
-        if lst:
-            aidlgth = int(lst[-2], 16)
-            extra = lst[-1]
-            aid, extra = sliceHex(extra, (aidlgth,)) # 'aid'
-            if not aid:
-                raise CAPException("Too short: No enough fields for Header component (AID)")
-            if extra:
-                name_lgth = extra[:2]
-                name = extra[2:]
-            else:
-                name_lgth = ''
-                name = ''
-        else:
+
+    def decode(self):
+        if len(self.info) < 10: # from 'magic' to 'package_info_AID_length'
             raise CAPException('Too short: No enough fields for Header component')
+        self.aidlength = self.u1(9)
+        if len(self.info) < 10+self.aidlength or not self.aidlength:
+            raise CAPException("Too short: No enough fields for Header component (AID)")
+        self.magic = self.u4(0)
+        self.minor, self.major, self.flags = self.u1(4), self.u1(5), self.u1(6)
+        self.version = (self.u1(8), self.u1(7)) # package major & minor
+        self.aid = self.hexat(10, self.aidlength)
+
+
+    def fields(self):
+        i = 10+self.aidlength
+        if len(self.info) > i:
+            name_lgth, name = self.hexat(i, 1), self.hexat(i+1)
+        else:
+            name_lgth, name = '', ''
+        return [self.tag, self.size, self.hexat(0, 4)] + [self.hexat(j, 1) for j in range(4, 10)] + [self.aid, name_lgth, name]
 
-        lst_attr = [self.tag, self.size] + list(lst[:-1]) +[aid, name_lgth, name]
-        self.items = dict(zip(self.items_name, lst_attr))
+
+    def check(self):
+        return (self.tag=='01' and self.length > 0 and self.magic==self.MAGIC
+                and (self.major, self.minor) in ((2, 1), (2, 2)) and self.flags < 8)
 
 
     def comment(self):
@@ -260,6 +352,23 @@ class Directory(Component):
 
          see Chapter 6.4 Directory Component, JCVM spec
     '''
+
+    items_name = (
+            'tag',
+            'size',
+            'component_sizes',
+            'image_size',
+            'array_init_count',
+            'array_init_size',
+            'import_count',
+            'applet_count',
+            'custom_count',
+            'custom_components',
+            )
+
+    pattern = '02' +pat_u2not0 +pat_u2not0*2 +pat_u2 +pat_u2not0*6 +pat_u2 +pat_u2not0 +pat_u2 +'\w{14,18}' +'\w?$'
+
+
     def __init__(self, data):
         ''' data: a string, example: '02001F0011001F000C001E00B200540285000A004000000184000000000000030100'
 
@@ -276,39 +385,32 @@ class Directory(Component):
         '''
         Component.__init__(self, data)
 
-        self.items_name = (
-                'tag',
-                'size',
-                'component_sizes',
-                'image_size',
-                'array_init_count',
-                'array_init_size',
-                'import_count',
-                'applet_count',
-                'custom_count',
-                'custom_components',
-                )
-
-        self.pattern = '02' +pat_u2not0 +pat_u2not0*2 +pat_u2 +pat_u2not0*6 +pat_u2 +pat_u2not0 +pat_u2 +'\w{14,18}' +'\w?$'
-
-
-        lst = sliceHex(self.tlv.v, (24, 2, 2)) # component_sizes image_size array_init_count, extra
-        if lst:
-            array_init_count = int(lst[-2], 16)
-            extra = lst[-1]
-            try:
-                array_init_size, import_count, applet_count, custom_count, custom_components = sliceHex(extra, (2,1,1,1,))
-            except ValueError as e:
-                if not array_init_count:
-                    array_init_size = ''
-                    import_count, applet_count, custom_count, custom_components = sliceHex(extra, (1,1,1,))
-                else:
-                    raise CAPException(str(e))
-        else:
+
+    def decode(self):
+        n = len(self.info)
+        if n < 28: # component_sizes image_size array_init_count
             raise CAPException('Too short: No enough fields for Directory component')
+        self.component_sizes = [self.u2(i) for i in range(0, 24, 2)]
+        self.array_init_count = self.u2(26)
+        if n >= 28+5:
+            self.counts = 30 # offset of 'import_count', after 'array_init_size'
+        elif not self.array_init_count and n >= 28+3:
+            self.counts = 28 # no 'array_init_size'
+        else:
+            raise CAPException('No enough fields for slice operation')
+
+
+    def fields(self):
+        i = self.counts
+        array_init_size = self.hexat(28, 2) if i==30 else ''
+        return [self.tag, self.size, self.hexat(0, 24), self.hexat(24, 2), self.hexat(26, 2), array_init_size,
+                self.hexat(i, 1), self.hexat(i+1, 1), self.hexat(i+2, 1), self.hexat(i+3)]
 
-        lst_attr = [self.tag, self.size] +list(lst[:-1]) +[array_init_size, import_count, applet_count, custom_count, custom_components]
-        self.items = dict(zip(self.items_name, lst_attr))
+
+    def check(self):
+        sizes = self.component_sizes
+        return (self.tag=='02' and self.length > 0 and all(sizes[:2]) and all(sizes[3:9]) and sizes[10] > 0
+                and 7 <= len(self.info)-24 <= 9)
 
 
     def comment(self):
@@ -330,6 +432,17 @@ class Applet(Component):
 
          see Chapter 6.5 Applet Component, JCVM spec
     '''
+
+    items_name = (
+            'tag',
+            'size',
+            'count',
+            'applets',
+            )
+
+    pattern = '03' +pat_u2not0 +pat_u1not0*2 +'\w{9,}$' # 9 = 5 + 4, shortest AID & a u2
+
+
     def __init__(self, data):
         ''' data: a string, example: '03000C0108A000000333CDD0000141'
 
@@ -345,24 +458,37 @@ class Applet(Component):
         '''
         Component.__init__(self, data)
 
-        self.items_name = (
-                'tag',
-                'size',
-                'count',
-                'applets',
-                )
 
-        self.pattern = '03' +pat_u2not0 +pat_u1not0*2 +'\w{9,}$' # 9 = 5 + 4, shortest AID & a u2
+    def decode(self):
+        if len(self.info) < 1:
+            raise CAPException('Too short: No enough fields for Applet component')
+        self.count = self.u1(0)
 
 
-        lst = sliceHex(self.tlv.v, (1,)) # 'count', 'applets'
-        if lst:
-            pass
-        else:
-            raise CAPException('Too short: No enough fields for Applet component')
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 1), self.hexat(1)]
 
-        lst_attr = [self.tag, self.size] +list(lst)
-        self.items = dict(zip(self.items_name, lst_attr))
+
+    def applets(self):
+        ''' Returns a list of (AID as hexdigits, install_method_offset), raise CAPException if too
+            short.
+        '''
+        lst, i = [], 1
+        try:
+            for j in range(self.count):
+                n = self.u1(i)
+                if i+1+n+2 > len(self.info):
+                    raise struct.error
+                lst.append((self.hexat(i+1, n), self.u2(i+1+n)))
+                i += 1+n+2
+        except struct.error:
+            raise CAPException("Too short: No enough fields for 'applets' item in Applet component")
+        return lst
+
+
+    def check(self):
+        return (self.tag=='03' and self.length > 0 and self.count > 0 and len(self.info) >= 1+1+5+2
+                and self.u1(1) > 0)
 
 
     def comment(self):
@@ -397,6 +523,17 @@ class Import(Component):
 
          see Chapter 6.6 Import Component, JCVM spec
     '''
+
+    items_name = (
+            'tag',
+            'size',
+            'count',
+            'packages',
+            )
+
+    pattern = '04' +pat_u2not0 +pat_u1 +'\w*$' # tag, size, count, packages (optional)
+
+
     def __init__(self, data):
         ''' data: a string, example: '04001E03000106A000000333CD030107A0000000620101000107A0000000620001'
 
@@ -409,24 +546,35 @@ class Import(Component):
         '''
         Component.__init__(self, data)
 
-        self.items_name = (
-                'tag',
-                'size',
-                'count',
-                'packages',
-                )
 
-        self.pattern = '04' +pat_u2not0 +pat_u1 +'\w*$' # tag, size, count, packages (optional)
+    def decode(self):
+        if len(self.info) < 1:
+            raise CAPException('Too short: No enough fields for Import component')
+        self.count = self.u1(0)
 
 
-        lst = sliceHex(self.tlv.v, (1,)) # 'count', 'packages'
-        if lst:
-            pass
-        else:
-            raise CAPException('Too short: No enough fields for Import component')
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 1), self.hexat(1)]
+
+
+    def packages(self):
+        ''' Returns a list of (AID as hexdigits, major, minor), raise CAPException if too short.
+        '''
+        lst, i = [], 1
+        try:
+            for j in range(self.count):
+                n = self.u1(i+2)
+                if i+3+n > len(self.info):
+                    raise struct.error
+                lst.append((self.hexat(i+3, n), self.u1(i+1), self.u1(i)))
+                i += 3+n
+        except struct.error:
+            raise CAPException("Too short: No enough fields for 'packages' item in Import component")
+        return lst
+
 
-        lst_attr = [self.tag, self.size] +list(lst)
-        self.items = dict(zip(self.items_name, lst_attr))
+    def check(self):
+        return self.tag=='04' and self.length > 0
 
 
     def comment(self):
@@ -522,6 +670,17 @@ class ConstantPool(Component):
 
          see Chapter 6.7 ConstantPool Component, JCVM spec
     '''
+
+    items_name = (
+            'tag',
+            'size',
+            'count',
+            'constant_pool',
+            )
+
+    pattern = '05' +pat_u2not0 +pat_u1 +'\w*$' # tag, size, count, constant_pool (optional)
+
+
     def __init__(self, data):
         ''' data: a string, example: '0500AE002B0280000002000E0302000E0102000E0202000E00028002010280020003000E08018107000680000006810300068001000180000003800619068003000680040003810A060180030003810302060001E606000009038000010100240003800820068110010380081C06810701018008000100020001000E00040024180600003C0381070103810A080400240B068007000180040003810A010380070404000209060001C80380061406800800'
 
@@ -534,24 +693,27 @@ class ConstantPool(Component):
         '''
         Component.__init__(self, data)
 
-        self.items_name = (
-                'tag',
-                'size',
-                'count',
-                'constant_pool',
-                )
 
-        self.pattern = '05' +pat_u2not0 +pat_u1 +'\w*$' # tag, size, count, constant_pool (optional)
+    def decode(self):
+        if len(self.info) < 2:
+            raise CAPException('Too short: No enough fields for ConstantPool component')
+        self.count = self.u2(0)
 
 
-        lst = sliceHex(self.tlv.v, (2,)) # 'count', 'constant_pool'
-        if lst:
-            pass
-        else:
-            raise CAPException('Too short: No enough fields for ConstantPool component')
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 2), self.hexat(2)]
+
 
-        lst_attr = [self.tag, self.size] +list(lst)
-        self.items = dict(zip(self.items_name, lst_attr))
+    def entry(self, index):
+        ''' Returns the cp_info at index, a tuple: (tag, the 3 bytes of info as binary) '''
+        i = 2+4*index
+        if index >= self.count or i+4 > len(self.info):
+            raise CAPException('No cp_info %d in ConstantPool component' % index)
+        return self.u1(i), self.info[i+1:i+4].tobytes()
+
+
+    def check(self):
+        return self.tag=='05' and self.length > 0 and len(self.info)==2+4*self.count
 
 
     def comment(self):
@@ -575,66 +737,1459 @@ class ConstantPool(Component):
 
 
 
+#----------------------------------------------------------------------------
+# Class, Method, StaticField, RefLocation, Export, Descriptor & Debug components
+
+CLASS_INTERFACE = 0x8 # flags of interface_info & class_info, Class component
+CLASS_SHAREABLE = 0x4
+CLASS_REMOTE = 0x2
+
+METHOD_EXTENDED = 0x8 # flags of method_header_info, Method component
+METHOD_ABSTRACT = 0x4
+
+ACC_PUBLIC = 0x01 # access_flags of Descriptor component
+ACC_PRIVATE = 0x02
+ACC_PROTECTED = 0x04
+ACC_STATIC = 0x08
+ACC_FINAL = 0x10
+ACC_ABSTRACT = 0x40
+ACC_INIT = 0x80
+ACC_INTERFACE = 0x40 # access_flags of class_descriptor_info
+
+dit_types = { # nibbles of type_descriptor, see 6.8.1 Type Descriptor, JCVM spec
+    0x1: 'V',
+    0x2: 'Z',
+    0x3: 'B',
+    0x4: 'S',
+    0x5: 'I',
+    0x6: 'L', # followed by a class_ref, 4 nibbles
+    0xA: '[Z',
+    0xB: '[B',
+    0xC: '[S',
+    0xD: '[I',
+    0xE: '[L', # followed by a class_ref, 4 nibbles
+    }
+
+dit_primitive_types = { # type of field_descriptor_info, high bit set
+    0x8002: 'Z',
+    0x8003: 'B',
+    0x8004: 'S',
+    0x8005: 'I',
+    }
+
+
+def typedescriptor(data, offset):
+    ''' Returns the nibbles of the type_descriptor at offset & the offset following it.
+
+         data: the info item of a component, a memoryview
+
+            type_descriptor {
+                u1 nibble_count
+                u1 type[(nibble_count+1)/2]
+            }
+    '''
+    count = U1.unpack_from(data, offset)[0]
+    end = offset+1+(count+1)//2
+    if end > len(data):
+        raise CAPException('Too short: No enough fields for type_descriptor at %d' % offset)
+    nibbles = []
+    for c in data[offset+1:end].tobytes():
+        nibbles.extend((ord(c)>>4, ord(c)&0x0F))
+    return nibbles[:count], end
+
+
+def typenames(nibbles, classname=None):
+    ''' Returns the types of the nibbles of a type_descriptor, a list like ['S', '[B', 'Lclass@0002;'].
+
+         classname: a function returning the name of a class_ref, hexdigits if omitted
+    '''
+    lst, i = [], 0
+    while i < len(nibbles):
+        x = nibbles[i]
+        if x not in dit_types:
+            raise CAPException('Unknown type %X in type_descriptor' % x)
+        name = dit_types[x]
+        i += 1
+        if name.endswith('L'):
+            if i+4 > len(nibbles):
+                raise CAPException('Too short: No enough nibbles for class_ref in type_descriptor')
+            ref = (nibbles[i]<<12) | (nibbles[i+1]<<8) | (nibbles[i+2]<<4) | nibbles[i+3]
+            name += (classname(ref) if classname else '%.4X' % ref) + ';'
+            i += 4
+        lst.append(name)
+    return lst
+
+
+def signature(types):
+    ''' Returns the signature of a method of types, its parameters then the return one, like '(S[B)V' '''
+    return '(%s)%s' % (''.join(types[:-1]), types[-1]) if types else ''
+
+
+dit_bytecodes = { # opcode: (mnemonic, operands), see Chapter 7 Java Card Virtual Machine Instruction Set
+    # operands, b: s1, B: u1, h: s2, H: u2, i: s4, j: s1 branch, J: s2 branch,
+    #           c: u1 index of constant pool, C: u2 index of constant pool, switch: see disassemble()
+    0x00: ('nop', ''),
+    0x01: ('aconst_null', ''),
+    0x02: ('sconst_m1', ''),
+    0x03: ('sconst_0', ''),
+    0x04: ('sconst_1', ''),
+    0x05: ('sconst_2', ''),
+    0x06: ('sconst_3', ''),
+    0x07: ('sconst_4', ''),
+    0x08: ('sconst_5', ''),
+    0x09: ('iconst_m1', ''),
+    0x0A: ('iconst_0', ''),
+    0x0B: ('iconst_1', ''),
+    0x0C: ('iconst_2', ''),
+    0x0D: ('iconst_3', ''),
+    0x0E: ('iconst_4', ''),
+    0x0F: ('iconst_5', ''),
+    0x10: ('bspush', 'b'),
+    0x11: ('sspush', 'h'),
+    0x12: ('bipush', 'b'),
+    0x13: ('sipush', 'h'),
+    0x14: ('iipush', 'i'),
+    0x15: ('aload', 'B'),
+    0x16: ('sload', 'B'),
+    0x17: ('iload', 'B'),
+    0x18: ('aload_0', ''),
+    0x19: ('aload_1', ''),
+    0x1A: ('aload_2', ''),
+    0x1B: ('aload_3', ''),
+    0x1C: ('sload_0', ''),
+    0x1D: ('sload_1', ''),
+    0x1E: ('sload_2', ''),
+    0x1F: ('sload_3', ''),
+    0x20: ('iload_0', ''),
+    0x21: ('iload_1', ''),
+    0x22: ('iload_2', ''),
+    0x23: ('iload_3', ''),
+    0x24: ('aaload', ''),
+    0x25: ('baload', ''),
+    0x26: ('saload', ''),
+    0x27: ('iaload', ''),
+    0x28: ('astore', 'B'),
+    0x29: ('sstore', 'B'),
+    0x2A: ('istore', 'B'),
+    0x2B: ('astore_0', ''),
+    0x2C: ('astore_1', ''),
+    0x2D: ('astore_2', ''),
+    0x2E: ('astore_3', ''),
+    0x2F: ('sstore_0', ''),
+    0x30: ('sstore_1', ''),
+    0x31: ('sstore_2', ''),
+    0x32: ('sstore_3', ''),
+    0x33: ('istore_0', ''),
+    0x34: ('istore_1', ''),
+    0x35: ('istore_2', ''),
+    0x36: ('istore_3', ''),
+    0x37: ('aastore', ''),
+    0x38: ('bastore', ''),
+    0x39: ('sastore', ''),
+    0x3A: ('iastore', ''),
+    0x3B: ('pop', ''),
+    0x3C: ('pop2', ''),
+    0x3D: ('dup', ''),
+    0x3E: ('dup2', ''),
+    0x3F: ('dup_x', 'B'),
+    0x40: ('swap_x', 'B'),
+    0x41: ('sadd', ''),
+    0x42: ('iadd', ''),
+    0x43: ('ssub', ''),
+    0x44: ('isub', ''),
+    0x45: ('smul', ''),
+    0x46: ('imul', ''),
+    0x47: ('sdiv', ''),
+    0x48: ('idiv', ''),
+    0x49: ('srem', ''),
+    0x4A: ('irem', ''),
+    0x4B: ('sneg', ''),
+    0x4C: ('ineg', ''),
+    0x4D: ('sshl', ''),
+    0x4E: ('ishl', ''),
+    0x4F: ('sshr', ''),
+    0x50: ('ishr', ''),
+    0x51: ('sushr', ''),
+    0x52: ('iushr', ''),
+    0x53: ('sand', ''),
+    0x54: ('iand', ''),
+    0x55: ('sor', ''),
+    0x56: ('ior', ''),
+    0x57: ('sxor', ''),
+    0x58: ('ixor', ''),
+    0x59: ('sinc', 'Bb'),
+    0x5A: ('iinc', 'Bb'),
+    0x5B: ('s2b', ''),
+    0x5C: ('s2i', ''),
+    0x5D: ('i2b', ''),
+    0x5E: ('i2s', ''),
+    0x5F: ('icmp', ''),
+    0x60: ('ifeq', 'j'),
+    0x61: ('ifne', 'j'),
+    0x62: ('iflt', 'j'),
+    0x63: ('ifge', 'j'),
+    0x64: ('ifgt', 'j'),
+    0x65: ('ifle', 'j'),
+    0x66: ('ifnull', 'j'),
+    0x67: ('ifnonnull', 'j'),
+    0x68: ('if_acmpeq', 'j'),
+    0x69: ('if_acmpne', 'j'),
+    0x6A: ('if_scmpeq', 'j'),
+    0x6B: ('if_scmpne', 'j'),
+    0x6C: ('if_scmplt', 'j'),
+    0x6D: ('if_scmpge', 'j'),
+    0x6E: ('if_scmpgt', 'j'),
+    0x6F: ('if_scmple', 'j'),
+    0x70: ('goto', 'j'),
+    0x71: ('jsr', 'J'),
+    0x72: ('ret', 'B'),
+    0x73: ('stableswitch', 'switch'),
+    0x74: ('itableswitch', 'switch'),
+    0x75: ('slookupswitch', 'switch'),
+    0x76: ('ilookupswitch', 'switch'),
+    0x77: ('areturn', ''),
+    0x78: ('sreturn', ''),
+    0x79: ('ireturn', ''),
+    0x7A: ('return', ''),
+    0x7B: ('getstatic_a', 'C'),
+    0x7C: ('getstatic_b', 'C'),
+    0x7D: ('getstatic_s', 'C'),
+    0x7E: ('getstatic_i', 'C'),
+    0x7F: ('putstatic_a', 'C'),
+    0x80: ('putstatic_b', 'C'),
+    0x81: ('putstatic_s', 'C'),
+    0x82: ('putstatic_i', 'C'),
+    0x83: ('getfield_a', 'c'),
+    0x84: ('getfield_b', 'c'),
+    0x85: ('getfield_s', 'c'),
+    0x86: ('getfield_i', 'c'),
+    0x87: ('putfield_a', 'c'),
+    0x88: ('putfield_b', 'c'),
+    0x89: ('putfield_s', 'c'),
+    0x8A: ('putfield_i', 'c'),
+    0x8B: ('invokevirtual', 'C'),
+    0x8C: ('invokespecial', 'C'),
+    0x8D: ('invokestatic', 'C'),
+    0x8E: ('invokeinterface', 'BCB'),
+    0x8F: ('new', 'C'),
+    0x90: ('newarray', 'B'),
+    0x91: ('anewarray', 'C'),
+    0x92: ('arraylength', ''),
+    0x93: ('athrow', ''),
+    0x94: ('checkcast', 'BC'),
+    0x95: ('instanceof', 'BC'),
+    0x96: ('sinc_w', 'Bh'),
+    0x97: ('iinc_w', 'Bh'),
+    0x98: ('ifeq_w', 'J'),
+    0x99: ('ifne_w', 'J'),
+    0x9A: ('iflt_w', 'J'),
+    0x9B: ('ifge_w', 'J'),
+    0x9C: ('ifgt_w', 'J'),
+    0x9D: ('ifle_w', 'J'),
+    0x9E: ('ifnull_w', 'J'),
+    0x9F: ('ifnonnull_w', 'J'),
+    0xA0: ('if_acmpeq_w', 'J'),
+    0xA1: ('if_acmpne_w', 'J'),
+    0xA2: ('if_scmpeq_w', 'J'),
+    0xA3: ('if_scmpne_w', 'J'),
+    0xA4: ('if_scmplt_w', 'J'),
+    0xA5: ('if_scmpge_w', 'J'),
+    0xA6: ('if_scmpgt_w', 'J'),
+    0xA7: ('if_scmple_w', 'J'),
+    0xA8: ('goto_w', 'J'),
+    0xA9: ('getfield_a_w', 'C'),
+    0xAA: ('getfield_b_w', 'C'),
+    0xAB: ('getfield_s_w', 'C'),
+    0xAC: ('getfield_i_w', 'C'),
+    0xAD: ('getfield_a_this', 'c'),
+    0xAE: ('getfield_b_this', 'c'),
+    0xAF: ('getfield_s_this', 'c'),
+    0xB0: ('getfield_i_this', 'c'),
+    0xB1: ('putfield_a_w', 'C'),
+    0xB2: ('putfield_b_w', 'C'),
+    0xB3: ('putfield_s_w', 'C'),
+    0xB4: ('putfield_i_w', 'C'),
+    0xB5: ('putfield_a_this', 'c'),
+    0xB6: ('putfield_b_this', 'c'),
+    0xB7: ('putfield_s_this', 'c'),
+    0xB8: ('putfield_i_this', 'c'),
+    0xFE: ('impdep1', ''),
+    0xFF: ('impdep2', ''),
+    }
+
+Instruction = collections.namedtuple('Instruction', 'offset opcode mnemonic operands')
+
+dit_operands = {'b':'b', 'B':'B', 'h':'h', 'H':'H', 'i':'i', 'j':'b', 'J':'h', 'c':'B', 'C':'H'}
+
+
+def compilebytecodes(bytecodes):
+    ''' Returns a dictionary, opcode: (mnemonic, operands, struct of operands, offsets & sizes of the
+        indexes of constant pool following the opcode), None as struct for the switches.
+    '''
+    dit = {}
+    for opcode, (mnemonic, operands) in bytecodes.items():
+        if operands == 'switch':
+            dit[opcode] = (mnemonic, operands, None, ())
+            continue
+        refs, i = [], 1
+        for x in operands:
+            size = struct.calcsize('>' + dit_operands[x])
+            if x in 'cC':
+                refs.append((i, size))
+            i += size
+        dit[opcode] = (mnemonic, operands, struct.Struct('>' + ''.join([dit_operands[x] for x in operands])), tuple(refs))
+    return dit
+
+dit_opcodes = compilebytecodes(dit_bytecodes)
+
+
+def disassemble(code, start=0, end=None):
+    ''' Returns the instructions of the bytecodes code[start:end], a list of Instruction, offsets
+        into code. Raise CAPException on an unknown opcode or if the operands are truncated.
+
+         code: the info item of Method component, a memoryview or a string
+
+         The operands of the switches are: default, low, high, offsets... for stableswitch &
+         itableswitch, default, npairs, match, offset... for slookupswitch & ilookupswitch.
+    '''
+    end = len(code) if end is None else end
+    lst, i = [], start
+    while i < end:
+        opcode = U1.unpack_from(code, i)[0]
+        x = dit_opcodes.get(opcode)
+        if x is None:
+            raise CAPException('Unknown bytecode %.2X at %d' % (opcode, i))
+        mnemonic, operands, st, refs = x
+        try:
+            if st is not None:
+                size = 1+st.size
+                if i+size > end:
+                    raise struct.error
+                values = st.unpack_from(code, i+1)
+            elif opcode in (0x73, 0x74): # stableswitch, itableswitch
+                fmt = '>hhh' if opcode == 0x73 else '>hii'
+                values = struct.unpack_from(fmt, code, i+1)
+                count = values[2]-values[1]+1
+                size = 1+struct.calcsize(fmt)+2*count
+                if count < 0 or i+size > end:
+                    raise struct.error
+                values += struct.unpack_from('>%dh' % count, code, i+1+struct.calcsize(fmt))
+            else: # slookupswitch, ilookupswitch
+                values = struct.unpack_from('>hH', code, i+1)
+                pair = '>hh' if opcode == 0x75 else '>ih'
+                size = 5+struct.calcsize(pair)*values[1]
+                if i+size > end:
+                    raise struct.error
+                values += struct.unpack_from('>' + pair[1:]*values[1], code, i+5)
+        except struct.error:
+            raise CAPException('Too short: No enough operands for %s at %d' % (mnemonic, i))
+        lst.append(Instruction(i, opcode, mnemonic, values))
+        i += size
+    return lst
+
+
+PRIMITIVE_ARRAY_TYPES = (10, 11, 12, 13) # T_BOOLEAN, T_BYTE, T_SHORT, T_INT
+
+def hasdummyindex(x):
+    ''' True if the index of constant pool of the Instruction is a dummy 0: checkcast & instanceof
+        of a primitive array. With T_REFERENCE (14) it is a real CONSTANT_Classref.
+    '''
+    return x.opcode in (0x94, 0x95) and x.operands[0] in PRIMITIVE_ARRAY_TYPES
+
+
+def cpoffsets(instructions):
+    ''' Returns the offsets of the indexes of constant pool in the instructions, 2 sets: of the u1
+        indexes & of the u2 ones, the same as the ones of RefLocation component.
+    '''
+    byte, byte2 = set(), set()
+    for x in instructions:
+        refs = dit_opcodes[x.opcode][3]
+        if hasdummyindex(x):
+            continue
+        for i, size in refs:
+            (byte if size == 1 else byte2).add(x.offset+i)
+    return byte, byte2
+
+
+
+class Class(Component):
+    ''' Abstract class of 'Class Component' .
+
+         see Chapter 6.8 Class Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'signature_pool_length',
+            'signature_pool',
+            'classes',
+            )
+
+    pattern = '06' +pat_u2not0 +'\w{2,}$'
+
+
+    def __init__(self, data, minor=2):
+        ''' data: a string, example: '06000E000000800307000407010000003C'
+            minor: minor_version of the CAP file, no signature_pool before 2.2
+
+            class_component {
+                u1 tag
+                u2 size
+                u2 signature_pool_length # 2.2
+                type_descriptor signature_pool[] # 2.2
+                interface_info interfaces[]
+                class_info classes[]
+            }
+        '''
+        self.minor = minor
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        i, n = 0, len(self.info)
+        self.signature_pool = []
+        if self.minor >= 2:
+            end = 2+self.u2(0)
+            i = 2
+            while i < end:
+                nibbles, i = typedescriptor(self.info, i)
+                self.signature_pool.append(nibbles)
+            if i != end:
+                raise CAPException('Wrong signature_pool_length in Class component')
+        self.start = i # offset of the first interface_info or class_info
+        self.classes = [] # interface_info & class_info, in order
+        self.offsets = {} # offset : interface_info or class_info
+        while i < n:
+            x, i = self.entry(i)
+            self.classes.append(x)
+            self.offsets[x['offset']] = x
+
+
+    def entry(self, i):
+        ''' Decode the interface_info or class_info at offset i.
+
+             returns (a dictionary, the offset following it)
+        '''
+        info = self.info
+        b = self.u1(i)
+        flags, count = b>>4, b&0x0F
+        x = {'offset' : i, 'flags' : flags, 'interface' : bool(flags & CLASS_INTERFACE)}
+        if x['interface']:
+            x['superinterfaces'] = list(struct.unpack_from('>%dH' % count, info, i+1))
+            j = i+1+2*count
+            if flags & CLASS_REMOTE and self.minor >= 2:
+                j, x['name'] = self.utf8(j)
+        else:
+            x['super'] = self.u2(i+1)
+            (x['declared_instance_size'], x['first_reference_token'], x['reference_count'], x['public_method_table_base'],
+                    public, x['package_method_table_base'], package) = struct.unpack_from('>7B', info, i+3)
+            j = i+10
+            x['public_virtual_method_table'] = list(struct.unpack_from('>%dH' % public, info, j))
+            j += 2*public
+            x['package_virtual_method_table'] = list(struct.unpack_from('>%dH' % package, info, j))
+            j += 2*package
+            x['interfaces'] = []
+            for k in range(count):
+                ref, c = self.u2(j), self.u1(j+2)
+                x['interfaces'].append((ref, list(struct.unpack_from('>%dB' % c, info, j+3))))
+                j += 3+c
+            if flags & CLASS_REMOTE and self.minor >= 2:
+                c = self.u1(j)
+                remote = {'methods' : [struct.unpack_from('>HHB', info, j+1+5*k) for k in range(c)]}
+                j, remote['hash_modifier'] = self.utf8(j+1+5*c)
+                j, remote['class_name'] = self.utf8(j)
+                c = self.u1(j)
+                remote['interfaces'] = list(struct.unpack_from('>%dH' % c, info, j+1))
+                j += 1+2*c
+                x['remote'] = remote
+        if j > len(info):
+            raise CAPException('Too short: No enough fields for the class at %d in Class component' % i)
+        return x, j
+
+
+    def utf8(self, offset):
+        ''' Returns (the offset following it, the string of u1 length & u1 bytes[length] at offset) '''
+        n = self.u1(offset)
+        return offset+1+n, self.info[offset+1:offset+1+n].tobytes()
+
+
+    def fields(self):
+        if self.minor >= 2:
+            pool = [self.hexat(0, 2), self.hexat(2, self.start-2)]
+        else:
+            pool = ['', '']
+        return [self.tag, self.size] + pool + [self.hexat(self.start)]
+
+
+    def check(self):
+        return self.tag=='06' and self.length > 0 and bool(self.classes)
+
+
+
+class Method(Component):
+    ''' Abstract class of 'Method Component' .
+
+         see Chapter 6.9 Method Component, JCVM spec
+
+         The methods can't be told apart without the Descriptor component, see Package.
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'handler_count',
+            'exception_handlers',
+            'methods',
+            )
+
+    pattern = '07' +pat_u2not0 +pat_u1 +'\w{4,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '07000D000210188C00138D000B87017A'
+
+            method_component {
+                u1 tag
+                u2 size
+                u1 handler_count
+                exception_handler_info exception_handlers[handler_count]
+                method_info methods[]
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        count = self.u1(0)
+        self.start = 1+8*count # offset of the first method_info
+        if self.start > len(self.info):
+            raise CAPException("Too short: No enough fields for 'exception_handlers' item in Method component")
+        self.exception_handlers = []
+        for k in range(count):
+            start, bitfield, handler, catch = struct.unpack_from('>4H', self.info, 1+8*k)
+            self.exception_handlers.append({
+                    'start_offset' : start,
+                    'stop_bit' : bool(bitfield & 0x8000),
+                    'active_length' : bitfield & 0x7FFF,
+                    'handler_offset' : handler,
+                    'catch_type_index' : catch,
+                    })
+
+
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 1), self.hexat(1, self.start-1), self.hexat(self.start)]
+
+
+    def header(self, offset):
+        ''' Returns the method_header_info or extended_method_header_info at offset, a dictionary.
+        '''
+        try:
+            b = self.u1(offset)
+            flags = b>>4
+            if flags & METHOD_EXTENDED:
+                max_stack, nargs, max_locals = struct.unpack_from('>3B', self.info, offset+1)
+                size = 4
+            else:
+                c = self.u1(offset+1)
+                max_stack, nargs, max_locals, size = b&0x0F, c>>4, c&0x0F, 2
+        except struct.error:
+            raise CAPException('Too short: No enough fields for the method header at %d' % offset)
+        return {
+                'offset' : offset,
+                'flags' : flags,
+                'max_stack' : max_stack,
+                'nargs' : nargs,
+                'max_locals' : max_locals,
+                'size' : size,
+                'abstract' : bool(flags & METHOD_ABSTRACT),
+                }
+
+
+    def instructions(self, start, end=None):
+        ''' Returns the instructions from start to end, offsets into the info item, see disassemble() '''
+        return disassemble(self.info, start, end)
+
+
+    def check(self):
+        return self.tag=='07' and self.length > 0 and self.start < len(self.info)
+
+
+    def comment(self):
+        ''' Returns helpful comments on some complicate items
+        '''
+        lst = ['handler at %(start_offset)04X+%(active_length)d -> %(handler_offset)04X, catch %(catch_type_index)d, stop %(stop_bit)s' % x
+                for x in self.exception_handlers]
+        return '\n'.join(['%d exception handlers' % len(lst)] + lst)
+
+
+
+class StaticField(Component):
+    ''' Abstract class of 'StaticField Component' .
+
+         see Chapter 6.10 Static Field Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'image_size',
+            'reference_count',
+            'array_init_count',
+            'array_init',
+            'default_value_count',
+            'non_default_value_count',
+            'non_default_values',
+            )
+
+    pattern = '08' +pat_u2not0 +'\w{20,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '08000A00000000000000000000'
+
+            static_field_component {
+                u1 tag
+                u2 size
+                u2 image_size
+                u2 reference_count
+                u2 array_init_count
+                array_init_info array_init[array_init_count] {u1 type, u2 count, u1 values[count]}
+                u2 default_value_count
+                u2 non_default_value_count
+                u1 non_default_values[non_default_values_count]
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        self.image_size, self.reference_count, count = struct.unpack_from('>3H', self.info, 0)
+        self.array_init = [] # (type, values, binary)
+        i = 6
+        for k in range(count):
+            t, n = struct.unpack_from('>BH', self.info, i)
+            self.array_init.append((t, self.info[i+3:i+3+n].tobytes()))
+            i += 3+n
+        self.counts = i # offset of 'default_value_count'
+        self.default_value_count, n = struct.unpack_from('>2H', self.info, i)
+        self.non_default_values = self.info[i+4:i+4+n]
+        if i+4+n != len(self.info):
+            raise CAPException("Wrong 'non_default_value_count' in StaticField component")
+
+
+    def fields(self):
+        i = self.counts
+        return [self.tag, self.size, self.hexat(0, 2), self.hexat(2, 2), self.hexat(4, 2), self.hexat(6, i-6),
+                self.hexat(i, 2), self.hexat(i+2, 2), self.hexat(i+4)]
+
+
+    def check(self):
+        return (self.tag=='08' and self.length > 0
+                and self.image_size == 2*self.reference_count + self.default_value_count + len(self.non_default_values))
+
+
+
+class RefLocation(Component):
+    ''' Abstract class of 'RefLocation Component' .
+
+         see Chapter 6.11 Reference Location Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'byte_index_count',
+            'offsets_to_byte_indices',
+            'byte2_index_count',
+            'offsets_to_byte2_indices',
+            )
+
+    pattern = '09' +pat_u2not0 +'\w{8,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '0900150003214B0B000E04040A070509071E060903080B0B'
+
+            reference_location_component {
+                u1 tag
+                u2 size
+                u2 byte_index_count
+                u1 offsets_to_byte_indices[byte_index_count]
+                u2 byte2_index_count
+                u1 offsets_to_byte2_indices[byte2_index_count]
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        n = self.u2(0)
+        self.offsets_to_byte_indices = self.info[2:2+n]
+        self.counts = 2+n # offset of 'byte2_index_count'
+        m = self.u2(2+n)
+        self.offsets_to_byte2_indices = self.info[4+n:4+n+m]
+        if 4+n+m != len(self.info):
+            raise CAPException("Wrong 'byte2_index_count' in RefLocation component")
+
+
+    def fields(self):
+        i = self.counts
+        return [self.tag, self.size, self.hexat(0, 2), self.hexat(2, i-2), self.hexat(i, 2), self.hexat(i+2)]
+
+
+    @staticmethod
+    def indices(offsets):
+        ''' Returns the offsets into the info item of Method component of offsets, each one from the
+            previous one, 255 to skip 255 bytes.
+        '''
+        lst, i = [], 0
+        for c in offsets.tobytes():
+            i += ord(c)
+            if c != '\xFF':
+                lst.append(i)
+        return lst
+
+
+    def byte_indices(self):
+        ''' Returns the offsets of the u1 indexes of constant pool in Method component '''
+        return self.indices(self.offsets_to_byte_indices)
+
+
+    def byte2_indices(self):
+        ''' Returns the offsets of the u2 indexes of constant pool in Method component '''
+        return self.indices(self.offsets_to_byte2_indices)
+
+
+    def check(self):
+        return self.tag=='09' and self.length > 0
+
+
+
+class Export(Component):
+    ''' Abstract class of 'Export Component' .
+
+         see Chapter 6.12 Export Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'class_count',
+            'class_exports',
+            )
+
+    pattern = '0A' +pat_u2not0 +pat_u1not0 +'\w{8,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '0A00050100020000'
+
+            export_component {
+                u1 tag
+                u2 size
+                u1 class_count
+                class_export_info {
+                    u2 class_offset
+                    u1 static_field_count
+                    u1 static_method_count
+                    u2 static_field_offsets[static_field_count]
+                    u2 static_method_offsets[static_method_count]
+                } class_exports[class_count]
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        self.classes = []
+        i = 1
+        for k in range(self.u1(0)):
+            offset, fields, methods = struct.unpack_from('>HBB', self.info, i)
+            i += 4
+            self.classes.append({
+                    'class_offset' : offset,
+                    'static_field_offsets' : list(struct.unpack_from('>%dH' % fields, self.info, i)),
+                    'static_method_offsets' : list(struct.unpack_from('>%dH' % methods, self.info, i+2*fields)),
+                    })
+            i += 2*(fields+methods)
+        if i != len(self.info):
+            raise CAPException("Wrong 'class_count' in Export component")
+
+
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 1), self.hexat(1)]
+
+
+    def check(self):
+        return self.tag=='0A' and self.length > 0 and bool(self.classes)
+
+
+
+class Descriptor(Component):
+    ''' Abstract class of 'Descriptor Component' .
+
+         see Chapter 6.13 Descriptor Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'class_count',
+            'classes',
+            'types',
+            )
+
+    pattern = '0B' +pat_u2not0 +pat_u1 +'\w{4,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '0B00DC0100010002000007000300000002000038...'
+
+            descriptor_component {
+                u1 tag
+                u2 size
+                u1 class_count
+                class_descriptor_info {
+                    u1 token
+                    u1 access_flags
+                    class_ref this_class_ref
+                    u1 interface_count
+                    u2 field_count
+                    u2 method_count
+                    class_ref interfaces[interface_count]
+                    field_descriptor_info fields[field_count] {u1 token, u1 access_flags, u1 field_ref[3], u2 type}
+                    method_descriptor_info methods[method_count] {u1 token, u1 access_flags, u2 method_offset,
+                        u2 type_offset, u2 bytecode_count, u2 exception_handler_count, u2 exception_handler_index}
+                } classes[class_count]
+                type_descriptor_info types {
+                    u2 constant_pool_count
+                    u2 constant_pool_types[constant_pool_count]
+                    type_descriptor type_desc[]
+                }
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        info = self.info
+        self.classes = []
+        i = 1
+        for k in range(self.u1(0)):
+            token, access, ref, interfaces, fields, methods = struct.unpack_from('>BBHBHH', info, i)
+            i += 9
+            x = {
+                    'token' : token,
+                    'access_flags' : access,
+                    'this_class_ref' : ref,
+                    'interfaces' : list(struct.unpack_from('>%dH' % interfaces, info, i)),
+                    'fields' : [],
+                    'methods' : [],
+                    }
+            i += 2*interfaces
+            for j in range(fields):
+                token, access = struct.unpack_from('>BB', info, i)
+                x['fields'].append({
+                        'token' : token,
+                        'access_flags' : access,
+                        'field_ref' : info[i+2:i+5].tobytes(),
+                        'type' : self.u2(i+5),
+                        })
+                i += 7
+            for j in range(methods):
+                values = struct.unpack_from('>BBHHHHH', info, i)
+                x['methods'].append(dict(zip(('token', 'access_flags', 'method_offset', 'type_offset', 'bytecode_count',
+                        'exception_handler_count', 'exception_handler_index'), values)))
+                i += 12
+            self.classes.append(x)
+
+        self.types = i # offset of type_descriptor_info
+        count = self.u2(i)
+        self.constant_pool_types = list(struct.unpack_from('>%dH' % count, info, i+2))
+        self.type_desc = {} # offset into type_descriptor_info : nibbles
+        j = i+2+2*count
+        while j < len(info):
+            nibbles, end = typedescriptor(info, j)
+            self.type_desc[j-i] = nibbles
+            j = end
+
+
+    def type(self, offset):
+        ''' Returns the nibbles of the type_descriptor at offset into type_descriptor_info '''
+        if offset not in self.type_desc:
+            raise CAPException('No type_descriptor at %d in Descriptor component' % offset)
+        return self.type_desc[offset]
+
+
+    def fields(self):
+        return [self.tag, self.size, self.hexat(0, 1), self.hexat(1, self.types-1), self.hexat(self.types)]
+
+
+    def check(self):
+        return self.tag=='0B' and self.length > 0
+
+
+
+class Debug(Component):
+    ''' Abstract class of 'Debug Component' .
+
+         see Chapter 6.14 Debug Component, JCVM spec
+    '''
+
+    items_name = (
+            'tag',
+            'size',
+            'string_count',
+            'strings_table',
+            'package_name_index',
+            'class_count',
+            'classes',
+            )
+
+    pattern = '0C' +pat_u2not0 +pat_u2not0 +'\w{8,}$'
+
+
+    def __init__(self, data):
+        ''' data: a string, example: '0C041C00220017636F6D2F78682F6465732F7465...'
+
+            debug_component {
+                u1 tag
+                u2 size
+                u2 string_count
+                utf8_info strings_table[string_count]
+                u2 package_name_index
+                u2 class_count
+                class_debug_info classes[class_count]
+            }
+        '''
+        Component.__init__(self, data)
+
+
+    def decode(self):
+        info = self.info
+        self.strings = []
+        i = 2
+        for k in range(self.u2(0)):
+            n = self.u2(i)
+            self.strings.append(info[i+2:i+2+n].tobytes())
+            i += 2+n
+        if i > len(info):
+            raise CAPException("Too short: No enough fields for 'strings_table' item in Debug component")
+        self.counts = i # offset of 'package_name_index'
+        self.package_name = self.string(self.u2(i))
+        self.classes = []
+        i += 4
+        for k in range(self.u2(i-2)):
+            x, i = self.classinfo(i)
+            self.classes.append(x)
+        if i != len(info):
+            raise CAPException("Wrong 'class_count' in Debug component")
+
+
+    def string(self, index):
+        ''' Returns the string at index of strings_table '''
+        if index >= len(self.strings):
+            raise CAPException('No string %d in Debug component' % index)
+        return self.strings[index]
+
+
+    def classinfo(self, i):
+        ''' Decode the class_debug_info at offset i.
+
+             returns (a dictionary, the offset following it)
+
+            class_debug_info {
+                u2 name_index
+                u2 access_flags
+                u2 location
+                u2 superclass_name_index
+                u2 source_file_index
+                u1 interface_count
+                u2 field_count
+                u2 method_count
+                u2 interface_names_indexes[interface_count]
+                field_debug_info fields[field_count] {u2 name_index, u2 descriptor_index, u2 access_flags, u4 contents}
+                method_debug_info methods[method_count] {u2 name_index, u2 descriptor_index, u2 access_flags,
+                    u2 location, u1 header_size, u2 body_size, u2 variable_count, u2 line_count,
+                    variable_info variable_table[variable_count] {u1 index, u2 name_index, u2 descriptor_index,
+                        u2 start_pc, u2 length}
+                    line_info line_table[line_count] {u2 start_pc, u2 end_pc, u2 source_line}}
+            }
+        '''
+        info, string = self.info, self.string
+        name, access, location, superclass, source, interfaces, fields, methods = struct.unpack_from('>HHHHHBHH', info, i)
+        i += 15
+        x = {
+                'name' : string(name),
+                'access_flags' : access,
+                'location' : location,
+                'superclass' : string(superclass),
+                'source_file' : string(source),
+                'interfaces' : [string(j) for j in struct.unpack_from('>%dH' % interfaces, info, i)],
+                'fields' : [],
+                'methods' : [],
+                }
+        i += 2*interfaces
+        for k in range(fields):
+            name, descriptor, access, contents = struct.unpack_from('>HHHI', info, i)
+            x['fields'].append({'name' : string(name), 'descriptor' : string(descriptor), 'access_flags' : access, 'contents' : contents})
+            i += 10
+        for k in range(methods):
+            name, descriptor, access, location, header, body, variables, lines = struct.unpack_from('>HHHHBHHH', info, i)
+            i += 15
+            x['methods'].append({
+                    'name' : string(name),
+                    'descriptor' : string(descriptor),
+                    'access_flags' : access,
+                    'location' : location,
+                    'header_size' : header,
+                    'body_size' : body,
+                    'variables' : [struct.unpack_from('>BHHHH', info, i+9*j) for j in range(variables)],
+                    'lines' : [struct.unpack_from('>HHH', info, i+9*variables+6*j) for j in range(lines)],
+                    })
+            i += 9*variables + 6*lines
+        return x, i
+
+
+    def fields(self):
+        i = self.counts
+        return [self.tag, self.size, self.hexat(0, 2), self.hexat(2, i-2), self.hexat(i, 2), self.hexat(i+2, 2), self.hexat(i+4)]
+
+
+    def check(self):
+        return self.tag=='0C' and self.length > 0
+
+
+    def comment(self):
+        ''' Returns helpful comments on some complicate items
+        '''
+        lst = ['package %s' % self.package_name]
+        for x in self.classes:
+            lst.append('class %s @%.4X' % (x['name'], x['location']))
+            lst.extend(['    %s%s @%.4X' % (m['name'], m['descriptor'], m['location']) for m in x['methods']])
+        return '\n'.join(lst)
+
+
+
+class Package(object):
+    ''' The components of a CAP file decoded, the references among them resolved: the entries of
+        constant pool, the classes & the methods by their offsets, named after the Debug component
+        if any, 'class@0002' & 'method1' if not.
+
+            pkg = CAPFile(path).package()
+            pkg.methodat(0x0123)['name'] # 'process', the method including 0x0123 of Method component
+            pkg.resolve(3) # 'javacard/framework/class3.method1', the entry 3 of constant pool
+            print pkg.listing(0x0120)
+
+         The methods are indexed once, in a single pass over the Descriptor component, they are
+         disassembled only when asked.
+    '''
+
+    def __init__(self, components):
+        ''' components: a dictionary, component name : Component
+        '''
+        self.components = components
+        for name in ('Header', 'Import', 'ConstantPool', 'Class', 'Method', 'Descriptor'):
+            if name not in components:
+                raise CAPException('%s component not found' % name)
+        self.cp = components['ConstantPool']
+        self.method = components['Method']
+        self.descriptor = components['Descriptor']
+        self.debug = components.get('Debug')
+        self.packages = [x[0] for x in components['Import'].packages()]
+        self.index()
+
+
+    def index(self):
+        ''' Build the dictionaries of classes, fields & methods, by offset & token '''
+        self.classnames = {} # class offset : name
+        self.fieldnames = {} # (class offset, token), or static field offset : name
+        self.virtuals = {} # (class offset, token) : method
+        self.methods = {} # offset : method, a dictionary
+        names = {} # method offset : (name, descriptor) of Debug
+
+        if self.debug:
+            for x in self.debug.classes:
+                self.classnames[x['location']] = x['name']
+                for m in x['methods']:
+                    names[m['location']] = (m['name'], m['descriptor'])
+                for f in x['fields']:
+                    name = '%s.%s' % (x['name'], f['name'])
+                    if not f['access_flags'] & ACC_STATIC:
+                        self.fieldnames[(x['location'], f['contents'] & 0xFF)] = name
+                    elif not (f['access_flags'] & ACC_FINAL and f['descriptor'] in 'ZBSI'): # not a constant
+                        self.fieldnames[f['contents'] & 0xFFFF] = name
+
+        for x in self.descriptor.classes:
+            ref = x['this_class_ref']
+            self.classnames.setdefault(ref, 'class@%.4X' % ref)
+            classname = self.classnames[ref]
+            for f in x['fields']:
+                if not f['access_flags'] & ACC_STATIC:
+                    self.fieldnames.setdefault((ref, f['token']), '%s.field%d' % (classname, f['token']))
+                elif f['field_ref'][0] == '\x00':
+                    offset = U2.unpack_from(f['field_ref'], 1)[0]
+                    self.fieldnames.setdefault(offset, '%s.field%d' % (classname, f['token']))
+            for m in x['methods']:
+                offset = m['method_offset']
+                if m['access_flags'] & ACC_INIT:
+                    name = '<init>'
+                else:
+                    name = 'method%d' % m['token']
+                name, descriptor = names.get(offset) or (name, signature(typenames(self.descriptor.type(m['type_offset']), self.classname)))
+                method = dict(m, name=name, classname=classname, descriptor=descriptor, header=None, end=offset)
+                if not m['access_flags'] & (ACC_STATIC | ACC_INIT):
+                    self.virtuals[(ref, m['token'])] = method
+                if offset:
+                    method['header'] = header = self.method.header(offset)
+                    method['end'] = offset + header['size'] + m['bytecode_count']
+                    self.methods[offset] = method
+        self.offsets = sorted(self.methods)
+
+
+    def packagename(self, token):
+        ''' Returns the name of the imported package token, like 'javacard/framework', its AID if unknown '''
+        if token >= len(self.packages):
+            return 'package%d' % token
+        return dit_known_pkg.get(self.packages[token], self.packages[token])
+
+
+    def classname(self, ref):
+        ''' Returns the name of class_ref, u2 '''
+        if ref & 0x8000:
+            return '%s/class%d' % (self.packagename((ref>>8) & 0x7F), ref & 0xFF)
+        return self.classnames.get(ref, 'class@%.4X' % ref)
+
+
+    def methodname(self, offset):
+        ''' Returns the name of the method at offset, like 'com/xh/Test.process' '''
+        m = self.methods.get(offset)
+        return '%s.%s' % (m['classname'], m['name']) if m else 'method@%.4X' % offset
+
+
+    def resolve(self, index):
+        ''' Returns the name of the entry index of constant pool, like 'javacard/framework/class3.method1'.
+        '''
+        tag, ref = self.cp.entry(index)
+        b0, b1, b2 = [ord(c) for c in ref]
+        if tag == 1: # CONSTANT_Classref
+            return self.classname(b0<<8 | b1)
+        if tag == 2: # CONSTANT_InstanceFieldref
+            ref = b0<<8 | b1
+            return self.fieldnames.get((ref, b2)) or '%s.field%d' % (self.classname(ref), b2)
+        if tag in (3, 4): # CONSTANT_VirtualMethodref, CONSTANT_SuperMethodref
+            ref = b0<<8 | b1
+            m = self.virtuals.get((ref, b2))
+            return '%s.%s' % (self.classname(ref), m['name'] if m else 'method%d' % b2)
+        if tag in (5, 6): # CONSTANT_StaticFieldref, CONSTANT_StaticMethodref
+            if b0 & 0x80:
+                return '%s/class%d.%s%d' % (self.packagename(b0 & 0x7F), b1, 'field' if tag == 5 else 'method', b2)
+            offset = b1<<8 | b2
+            if tag == 5:
+                return self.fieldnames.get(offset, 'field@%.4X' % offset)
+            return self.methodname(offset)
+        raise CAPException('Unknown tag %d of constant pool entry %d' % (tag, index))
+
+
+    def methodat(self, offset):
+        ''' Returns the method including offset into the info item of Method component, a dictionary
+            of its method_descriptor_info, plus 'name', 'classname', 'descriptor' (Debug component),
+            'header' & 'end'. None if not found.
+        '''
+        i = bisect.bisect_right(self.offsets, offset) - 1
+        if i >= 0:
+            m = self.methods[self.offsets[i]]
+            if offset < m['end']:
+                return m
+        return None
+
+
+    def disassemble(self, offset):
+        ''' Returns the instructions of the method at offset, a list of Instruction '''
+        m = self.methods.get(offset)
+        if m is None:
+            raise CAPException('No method at %.4X of Method component' % offset)
+        if m['header']['abstract']:
+            return []
+        return self.method.instructions(offset + m['header']['size'], m['end'])
+
+
+    def listing(self, offset):
+        ''' Returns the disassembly of the method at offset, a multi-line string, the references
+            resolved & the branches as offsets into Method component.
+        '''
+        m = self.methods.get(offset)
+        lines = ['%s.%s%s' % (m['classname'], m['name'], m['descriptor'] or '') if m else '']
+        for x in self.disassemble(offset):
+            operands = dit_opcodes[x.opcode][1]
+            comment = ''
+            if operands == 'switch':
+                targets = x.operands[:1] + (x.operands[3:] if x.opcode in (0x73, 0x74) else x.operands[3::2])
+                comment = '-> ' + ' '.join(['%.4X' % (x.offset + y) for y in targets])
+            elif operands in ('j', 'J'):
+                comment = '-> %.4X' % (x.offset + x.operands[0])
+            else:
+                refs = [i for i, y in enumerate(operands) if y in 'cC']
+                if refs and not hasdummyindex(x):
+                    comment = self.resolve(x.operands[refs[0]])
+            lines.append('%.4X: %-16s %-12s %s' % (x.offset, x.mnemonic, ' '.join([str(y) for y in x.operands]), comment and '// ' + comment))
+        return '\n'.join([x.rstrip() for x in lines])
+
+
+    def verify(self):
+        ''' Check the methods cover Method component & the indexes of constant pool found in their
+            bytecodes are the ones of RefLocation component, raise CAPException if not.
+        '''
+        end = self.method.start
+        byte, byte2 = set(), set()
+        for offset in self.offsets:
+            if offset != end:
+                raise CAPException('Gap or overlap at %.4X of Method component' % offset)
+            a, b = cpoffsets(self.disassemble(offset))
+            byte |= a
+            byte2 |= b
+            end = self.methods[offset]['end']
+        if end != len(self.method.info):
+            raise CAPException('%d bytes after the last method of Method component' % (len(self.method.info)-end))
+        ref = self.components.get('RefLocation')
+        if ref and (byte, byte2) != (set(ref.byte_indices()), set(ref.byte2_indices())):
+            raise CAPException('The indexes of constant pool differ from RefLocation component')
+        return True
+
+
+
+def loadfile(data):
+    ''' Returns the components of a Load File, the components concatenated like in a Load File
+        Data Block, binary: a dictionary, name: Component. Raise CAPException if malformed.
+    '''
+    view, components, i = memoryview(data), {}, 0
+    try:
+        for tag, info in api_tlv.iterfixed(view, 1, 2):
+            if not 1 <= tag <= len(list_component):
+                raise CAPException('Unknown component tag %.2X at %d' % (tag, i))
+            name = list_component[tag-1]
+            if name in components:
+                raise CAPException('%s component found twice' % name)
+            cls = dit_component_class[name]
+            args = (components['Header'].minor,) if cls is Class and 'Header' in components else ()
+            try:
+                components[name] = cls(view[i:i+3+len(info)], *args)
+            except ValueError, e:
+                raise CAPException('%s component: %s' % (name, e))
+            i += 3+len(info)
+    except api_tlv.TLVException, e:
+        raise CAPException(str(e))
+    return components
+
+
+
+class CAPArchive(object):
+    ''' A CAP file read once: the names of its members, the bytes of the components & the manifest,
+        parsed at the first use & kept, like the package AID & name, the hashes of the components &
+        the components decoded. See CAPRegistry.
+    '''
+
+    def __init__(self, path, key=None):
+        ''' path: the path of the CAP file
+            key: (mtime, size) of the file, os.stat() if omitted
+        '''
+        if key is None:
+            st = os.stat(path)
+            key = (st.st_mtime, st.st_size)
+        self.path = path
+        self.key = key
+        jar = zipfile.ZipFile(path, 'r')
+        try:
+            self.names = jar.namelist()
+            self.index = dict([(x.filename, x) for x in jar.infolist()]) # name : ZipInfo
+            self.members = dict([(x, jar.read(x)) for x in self.names if x.endswith('.cap') or x == MANIFEST]) # name : bytes
+        finally:
+            jar.close()
+        self.lock = threading.Lock()
+        self.cache = {} # manifests, package AID & name, hashes, components decoded & Package
+
+
+    def read(self, name):
+        ''' Return the bytes of the member name, raise KeyError if not found, like ZipFile.read().
+        '''
+        if name in self.members:
+            return self.members[name]
+        if name not in self.index:
+            raise KeyError('There is no item named %r in the archive' % name)
+        jar = zipfile.ZipFile(self.path, 'r')
+        try:
+            return jar.read(name)
+        finally:
+            jar.close()
+
+
+    def cached(self, key, func, *args):
+        ''' Return the value of key in cache, func(*args) computed at the first call.
+        '''
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+        value = func(*args)
+        with self.lock:
+            return self.cache.setdefault(key, value)
+
+
+    def digest(self, names, hashalg='sha1'):
+        ''' Return the hash of the bytes of the members names, in order, hexdigits.
+        '''
+        def compute():
+            h = hashlib.new(hashalg)
+            for name in names:
+                h.update(self.members[name])
+            return b2a(h.digest()).upper()
+        return self.cached(('digest', tuple(names), hashalg), compute)
+
+
+
+class CAPRegistry(object):
+    ''' The CAP files of the process, each one read & parsed once, keyed by path, modification time
+        & size: read again if changed on disk. CAPFile gets its archive from REGISTRY.
+
+            archive = api_cap.REGISTRY.get(path)
+
+        An archive holds the bytes of all the components: at most size archives are kept, the
+        least recently used one dropped first, none if 0, the ones of removed files at the next
+        read. REGISTRY keeps the 'capregistry' of [api_cap] in config.ini, 16 if not set.
+    '''
+
+    def __init__(self, size=16):
+        self.size = size
+        self.lock = threading.Lock()
+        self.archives = collections.OrderedDict() # absolute path : CAPArchive, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, path):
+        ''' Return the CAPArchive of path, read if not yet or if the file changed.
+        '''
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        with self.lock:
+            archive = self.archives.pop(path, None)
+            if archive is not None and archive.key == key:
+                self.hits += 1
+                self.archives[path] = archive
+                return archive
+        archive = CAPArchive(path, key)
+        with self.lock:
+            self.misses += 1
+            for x in [x for x in self.archives if not os.path.exists(x)]:
+                del self.archives[x]
+            self.archives.pop(path, None)
+            if self.size:
+                while len(self.archives) >= self.size:
+                    self.evictions += 1
+                    self.archives.popitem(last=False)
+                self.archives[path] = archive
+        return archive
+
+
+    def discard(self, path=None):
+        ''' Forget the archive of path, all if omitted.
+        '''
+        with self.lock:
+            if path is None:
+                self.archives.clear()
+            else:
+                self.archives.pop(os.path.abspath(path), None)
+
+
+REGISTRY = CAPRegistry(api_config.CONFIG.getint(__name__, 'capregistry') if api_config.CONFIG.has_option(__name__, 'capregistry') else 16)
+
+
+
 class CAPFile(object):
     ''' Abstract of 'CAP File' .
+
+         The archive is read & parsed once per process, see CAPRegistry, so that a CAP file can
+         be opened as often as wished.
     '''
-    def __init__(self, path):
-        self.jar = zipfile.ZipFile(path, 'r')
+    def __init__(self, path, registry=None):
+        ''' path: the path of the CAP file
+            registry: a CAPRegistry, REGISTRY if omitted
+        '''
+        self.archive = (registry or REGISTRY).get(path)
         self.path = path
-        self.size = os.path.getsize(path)
-        self.mtime = time.strftime('%Y%m%d-%H:%M:%S', time.localtime(os.path.getmtime(path)))
+        mtime, self.size = self.archive.key
+        self.mtime = time.strftime('%Y%m%d-%H:%M:%S', time.localtime(mtime))
+        self.zipfile = None
+
+
+    @property
+    def jar(self):
+        ''' The ZipFile of the CAP file, opened at the first access '''
+        if self.zipfile is None:
+            self.zipfile = zipfile.ZipFile(self.path, 'r')
+        return self.zipfile
 
 
     def close(self):
         ''' Close the archive file. You must call close() before exiting your program or essential records will not be written.
         '''
-        self.jar.close()
+        if self.zipfile is not None:
+            self.zipfile.close()
+            self.zipfile = None
         return
 
 
     def namelist(self):
         ''' Return a list of archive members by name.
         '''
-        return self.jar.namelist()
+        return list(self.archive.names)
 
 
-    def manifest(self, name='META-INF/MANIFEST.MF'):
+    def manifest(self, name=MANIFEST):
         ''' Return the content of META-INF/MANIFEST.MF .
 
              returns a dictionary (empty if manifest not found).
         '''
-        if name in self.jar.namelist():
-            mf = self.jar.read(name)
-            return dict([line.split(': ') for line in mf.split('\r\n') if line and ': ' in line])
-        else:
-            return dict()
+        def parse():
+            if name in self.archive.index:
+                mf = self.archive.read(name)
+                return dict([line.split(': ') for line in mf.split('\r\n') if line and ': ' in line])
+            else:
+                return dict()
+        return dict(self.archive.cached(('manifest', name), parse))
 
     def getPackageAID(self, tag='Java-Card-Package-AID'):
         ''' 
         '''
-        mf = self.manifest()
-        if tag in mf:
-            aid = mf[tag]
-        elif 'AID' in mf:
-            aid = mf['AID']
-        else:
-            aid = ''
+        def parse():
+            mf = self.manifest()
+            if tag in mf:
+                aid = mf[tag]
+            elif 'AID' in mf:
+                aid = mf['AID']
+            else:
+                aid = ''
 
-        return aid.replace('0x', '').replace(':','').upper()
+            return aid.replace('0x', '').replace(':','').upper()
+        return self.archive.cached(('aid', tag), parse)
 
     def getPackageName(self, tag='Java-Card-Package-Name'):
         ''' 
         '''
-        mf = self.manifest()
-        if tag in mf:
-            return mf[tag]
-        elif 'Name' in mf:
-            return mf['Name']
-        else:
-            name = self.jar.namelist()[0] # 'com/company/javacard/lib_zyt/javacard/Header.cap'
-            d = os.path.dirname(name) # 'com/company/javacard/lib_zyt/javacard'
-            pkg = os.path.dirname(d) # 'com/company/javacard/lib_zyt/javacard'
-            return pkg
+        def parse():
+            mf = self.manifest()
+            if tag in mf:
+                return mf[tag]
+            elif 'Name' in mf:
+                return mf['Name']
+            else:
+                name = self.archive.names[0] # 'com/company/javacard/lib_zyt/javacard/Header.cap'
+                d = os.path.dirname(name) # 'com/company/javacard/lib_zyt/javacard'
+                pkg = os.path.dirname(d) # 'com/company/javacard/lib_zyt/javacard'
+                return pkg
+        return self.archive.cached(('name', tag), parse)
 
 
     def readCap(self, name, directory=r'/javacard/', suffix='.cap'):
@@ -647,33 +2202,100 @@ class CAPFile(object):
         fullpath = pkg +directory +name +suffix
 
 
-        if fullpath in self.jar.namelist():
-            return b2a(self.jar.read(fullpath)).upper()
+        if fullpath in self.archive.index:
+            return b2a(self.archive.read(fullpath)).upper()
         else:
             return '%s not found in the CAP file'%fullpath
 
 
+    def readCapBytes(self, name, directory=r'/javacard/', suffix='.cap'):
+        ''' Return the bytes of the file name in the archive, binary, None if not found.
+        '''
+        p = self.capPaths([name], directory, suffix)
+        return self.archive.read(p[0]) if p else None
+
+
+    def component(self, name, directory=r'/javacard/', suffix='.cap'):
+        ''' Return the component name, like 'Header', decoded at the first call over the bytes read
+            from the archive, no copy made. A Component if no class of name in dit_component_class.
+
+             raise CAPException if not found in the CAP file
+        '''
+        def decode():
+            data = self.readCapBytes(name, directory, suffix)
+            if data is None:
+                raise CAPException('%s not found in the CAP file' % name)
+            cls = dit_component_class.get(name, Component)
+            args = (self.component('Header').minor,) if cls is Class else ()
+            return cls.frombytes(data, *args)
+        return self.archive.cached(name, decode)
+
+
+    def package(self):
+        ''' Return the Package of the components, decoded at the first call.
+        '''
+        return self.archive.cached('Package', lambda: Package(dict(self.components())))
+
+
+    def components(self, lst=list_component):
+        ''' Yield (name, component) of the components in the list found in the CAP file.
+        '''
+        for name in lst:
+            if self.capPaths([name]):
+                yield name, self.component(name)
+
+
     def readAllCap(self, lst, directory=r'/javacard/', suffix='.cap'):
         ''' Return all bytes of the files in the list.
         '''
+        caps = ''.join([self.archive.read(p) for p in self.capPaths(lst, directory, suffix)])
+
+        return b2a(caps).upper()
+
+
+    def capPaths(self, lst, directory=r'/javacard/', suffix='.cap'):
+        ''' Return the paths in the archive of the files in the list, those found only.
+        '''
         pkg = self.getPackageName()
         if '.' in pkg:
             pkg = pkg.replace('.', '/')
 
-        paths = [''.join([pkg, directory, f, suffix]) for f in lst]
-        namelist = self.jar.namelist()
-        caps = ''.join([self.jar.read(p) for p in paths if p in namelist])
+        index = self.archive.index
+        return [p for p in [''.join([pkg, directory, f, suffix]) for f in lst] if p in index]
 
-        return b2a(caps).upper()
 
+    def sizeofCap(self, lst, directory=r'/javacard/', suffix='.cap'):
+        ''' Return the number of bytes of the files in the list, without reading them.
+        '''
+        return sum([self.archive.index[p].file_size for p in self.capPaths(lst, directory, suffix)])
+
+
+    def iterCap(self, lst, directory=r'/javacard/', suffix='.cap', chunksize=0x1000):
+        ''' Yield the bytes of the files in the list, binary, chunksize bytes at most each time:
+            the ones of readAllCap(), read lazily.
+        '''
+        for p in self.capPaths(lst, directory, suffix):
+            data = self.archive.read(p)
+            for i in range(0, len(data), chunksize):
+                yield data[i:i+chunksize]
+
+
+    def digest(self, lst, hashalg='sha1', directory=r'/javacard/', suffix='.cap'):
+        ''' Return the hash of the bytes of the files in the list, the ones of readAllCap(),
+            hexdigits, computed once per archive.
 
-    def readManifest(self, name='META-INF/MANIFEST.MF'):
+             hashalg: a hashlib algorithm
+        '''
+        return self.archive.digest(self.capPaths(lst, directory, suffix), hashalg)
+
+
+    def readManifest(self, name=MANIFEST):
         ''' Return the bytes of the file name in the archive.
 
              returns a string
         '''
         try:
-            return self.jar.read(name)
+            return self.archive.read(name)
         except KeyError, e:
             return str(e)
 
@@ -684,6 +2306,13 @@ dit_component_class = { # component name & class
     'Applet':Applet,
     'Import':Import,
     'ConstantPool':ConstantPool,
+    'Class':Class,
+    'Method':Method,
+    'StaticField':StaticField,
+    'RefLocation':RefLocation,
+    'Export':Export,
+    'Descriptor':Descriptor,
+    'Debug':Debug,
     }
 
 #----------------------------------------------------------------------------
@@ -700,6 +2329,181 @@ class TestModule(unittest.TestCase):
         self.assertTrue(cap.readManifest()=='"There is no item named \'META-INF/MANIFEST.MF\' in the archive"')
         self.assertTrue(cap.getPackageName()=='net/sourceforge/globalplatform/jc/helloworld')
 
+    def test_binary(self):
+        ''' 用cos_testsuites下的cap文件验证二进制解析与16进制字符串解析的结果一致 '''
+        import glob
+        paths = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', '*.cap'))
+        self.assertTrue(paths)
+        t0, t1 = 0, 0
+        for path in paths:
+            cap = CAPFile(path)
+            names = [name for name, x in cap.components()]
+            self.assertEqual(names, [x for x in list_component if cap.capPaths([x])])
+            for name, cls in dit_component_class.items():
+                data = cap.readCapBytes(name)
+                if data is None:
+                    continue
+                args = (cap.component('Header').minor,) if cls is Class else ()
+                t = time.time()
+                x = cls(b2a(data), *args)
+                items = x.items
+                t0 += time.time()-t
+                t = time.time()
+                y = cap.component(name)
+                t1 += time.time()-t
+                self.assertTrue(y is cap.component(name))
+                self.assertEqual(str(y), b2a(data).upper())
+                self.assertEqual(y.items, items)
+                self.assertTrue(y.selfcheck())
+                self.assertEqual(y.selfcheck(y.pattern), x.selfcheck(x.pattern))
+            header = cap.component('Header')
+            self.assertEqual(header.aid, header.items['package_info_AID'])
+            self.assertEqual(header.version, (int(header.items['package_info_major_version'], 16), int(header.items['package_info_minor_version'], 16)))
+            cp = cap.component('ConstantPool')
+            if cp.count:
+                self.assertEqual(b2a(chr(cp.entry(0)[0])+cp.entry(0)[1]).upper(), cp.items['constant_pool'][:8])
+            cap.close()
+        logging.info('%d CAP files, hexdigits: %.4fs, binary: %.4fs', len(paths), t0, t1)
+
+    def test_registry(self):
+        ''' CAP文件只读取、解析一次，文件修改后自动重新读取 '''
+        import tempfile, shutil, hashlib
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, 'arrayCopy.cap')
+            shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap'), path)
+            registry = CAPRegistry()
+            a, b = CAPFile(path, registry), CAPFile(os.path.join(d, '.', 'arrayCopy.cap'), registry)
+            self.assertTrue(a.archive is b.archive)
+            self.assertEqual((registry.misses, registry.hits), (1, 1))
+            self.assertEqual(a.size, os.path.getsize(path))
+
+            lst = ['Header', 'Directory', 'Import', 'Applet', 'Class', 'Method', 'StaticField', 'ConstantPool', 'RefLocation']
+            self.assertEqual(a.getPackageName(), 'xh/perfomance/arrayCopy')
+            self.assertEqual(a.manifest(), {})
+            data = a2b(a.readAllCap(lst))
+            self.assertEqual(''.join(a.iterCap(lst, chunksize=100)), data)
+            self.assertEqual(a.sizeofCap(lst), len(data))
+            self.assertEqual(a.digest(lst), b2a(hashlib.sha1(data).digest()).upper())
+            self.assertEqual(b.digest(lst, 'sha256'), b2a(hashlib.sha256(data).digest()).upper())
+            self.assertTrue(b.component('Method') is a.component('Method'))
+            self.assertTrue(b.package() is a.package())
+            self.assertEqual(a.readManifest(), '"There is no item named \'META-INF/MANIFEST.MF\' in the archive"')
+            self.assertTrue(a.zipfile is None and b.zipfile is None) # all from the registry
+
+            jar = zipfile.ZipFile(path, 'a')
+            jar.writestr(MANIFEST, 'Manifest-Version: 1.0\r\nJava-Card-Package-AID: 0xa0:0x00:0x00:0x03:0x33\r\n')
+            jar.close()
+            c = CAPFile(path, registry)
+            self.assertFalse(c.archive is a.archive)
+            self.assertEqual(registry.misses, 2)
+            self.assertEqual((a.getPackageAID(), c.getPackageAID()), ('', 'A000000333'))
+
+            t = os.path.getmtime(path)
+            os.utime(path, (t+10, t+10))
+            self.assertFalse(CAPFile(path, registry).archive is c.archive)
+            self.assertTrue(CAPFile(path, registry).archive is registry.get(path))
+            registry.discard(path)
+            self.assertEqual(registry.archives, {})
+            os.remove(path)
+            self.assertRaises(OSError, CAPFile, path, registry)
+
+            # bounded, least recently used dropped first, removed files at the next read
+            registry = CAPRegistry(2)
+            paths = [os.path.join(d, '%d.cap' % i) for i in range(4)]
+            for x in paths:
+                shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap'), x)
+            for x in paths[:2] + paths[:1] + paths[2:3]:
+                registry.get(x)
+            self.assertEqual(registry.archives.keys(), [paths[0], paths[2]])
+            self.assertEqual((registry.hits, registry.misses, registry.evictions), (1, 3, 1))
+            os.remove(paths[0])
+            registry.get(paths[3])
+            self.assertEqual(registry.archives.keys(), [paths[2], paths[3]])
+            self.assertEqual(registry.evictions, 1)
+            registry = CAPRegistry(0)
+            self.assertFalse(registry.get(paths[3]) is registry.get(paths[3]))
+            self.assertEqual(len(registry.archives), 0)
+        finally:
+            shutil.rmtree(d)
+
+    def test_errors(self):
+        ''' 组件长度不足、非16进制字符、AID长度为0等错误 '''
+        self.assertRaises(TypeError, Component, 'ZZ0001')
+        self.assertRaises(ValueError, Component, '01')
+        self.assertRaises(ValueError, Component, '010005DECAFF')
+        self.assertRaises(CAPException, Header, '010004DECAFFED')
+        self.assertRaises(CAPException, Header, '01000ADECAFFED0102040001' + '00')
+        header = Header.frombytes(a2b('010011DECAFFED010204000107A000000333CDD0'))
+        self.assertEqual((header.aid, header.flags), ('A000000333CDD0', 4))
+        self.assertTrue(header.selfcheck())
+        self.assertFalse(Header('010011DECAFFEE010204000107A000000333CDD0').selfcheck())
+        self.assertEqual(Applet('03000C0108A000000333CDD0000141').applets(), [('A000000333CDD000', 0x141)])
+        self.assertRaises(CAPException, Applet('0300090205A0000003330141').applets)
+
+    def test_decoder(self):
+        ''' 用cos_testsuites下的cap文件验证全部组件的解析、方法索引、常量池引用及字节码反汇编 '''
+        import glob
+        paths = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', '*.cap'))
+        for path in paths:
+            cap = CAPFile(path)
+            pkg = cap.package()
+            self.assertTrue(pkg is cap.package())
+            self.assertTrue(pkg.verify()) # the methods cover Method component, the same indexes as RefLocation
+            for name, x in cap.components():
+                self.assertTrue(x.selfcheck(), '%s %s' % (path, name))
+                self.assertEqual(''.join([x.items[y] for y in x.items_name]), str(x))
+            for aid, offset in cap.component('Applet').applets():
+                m = pkg.methodat(offset)
+                self.assertEqual((m['method_offset'], m['descriptor']), (offset, '([BSB)V'))
+                self.assertTrue(m is pkg.methodat(m['end']-1))
+                if pkg.debug:
+                    self.assertEqual(m['name'], 'install')
+            for offset in pkg.offsets:
+                m = pkg.methods[offset]
+                if pkg.debug and 'L' not in m['descriptor']: # no class of imported packages
+                    self.assertEqual(m['descriptor'], signature(typenames(pkg.descriptor.type(m['type_offset']))))
+            self.assertEqual(len(pkg.listing(pkg.offsets[-1]).splitlines()), len(pkg.disassemble(pkg.offsets[-1]))+1)
+            cap.close()
+
+        cap = CAPFile(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap'))
+        pkg = cap.package()
+        self.assertEqual(pkg.methodname(pkg.offsets[0]), 'xh/perfomance/arrayCopy/TestCase_Performace_arrayCopy.<init>')
+        self.assertEqual(pkg.methodat(0), None)
+        listing = pkg.listing(pkg.offsets[0]).splitlines()
+        self.assertEqual(listing[0], 'xh/perfomance/arrayCopy/TestCase_Performace_arrayCopy.<init>()V')
+        self.assertEqual(listing[2], '0004: invokespecial    19           // javacard/framework/class3.method0')
+        self.assertTrue(listing[-2].endswith('// xh/perfomance/arrayCopy/TestCase_Performace_arrayCopy.rng'))
+
+        # throughput: all components & the index of methods of a CAP file
+        t, count = time.time(), 0
+        while time.time()-t < 0.5:
+            for path in paths:
+                cap = CAPFile(path)
+                cap.package()
+                cap.close()
+                count += 1
+        logging.info('%.0f CAP files decoded per second', count/(time.time()-t))
+
+    def test_disassemble(self):
+        ''' 字节码反汇编：switch、宽跳转、常量池索引位置、非法操作码及截断的操作数 '''
+        code = a2b('1D' '73FFF6000000010004000A' '75FFF00002FFFF0005007F0010' '8E0300010294000007' 'A8FFE0' '7A')
+        lst = disassemble(code)
+        self.assertEqual([x.mnemonic for x in lst], ['sload_1', 'stableswitch', 'slookupswitch', 'invokeinterface', 'checkcast', 'goto_w', 'return'])
+        self.assertEqual(lst[1].operands, (-10, 0, 1, 4, 10))
+        self.assertEqual(lst[2].operands, (-16, 2, -1, 5, 127, 16))
+        self.assertEqual(lst[3].operands, (3, 1, 2))
+        self.assertEqual([x.offset for x in lst], [0, 1, 12, 25, 30, 34, 37])
+        self.assertEqual(cpoffsets(lst), (set(), set([27, 32])))
+        self.assertEqual(cpoffsets(disassemble(a2b('940B0000'))), (set(), set()))
+        self.assertEqual(cpoffsets(disassemble(a2b('940E0007' '950E0003'))), (set(), set([2, 6]))) # Foo[]
+        self.assertRaises(CAPException, disassemble, a2b('1DBA'))
+        self.assertRaises(CAPException, disassemble, a2b('8D00'))
+        self.assertRaises(CAPException, disassemble, a2b('73FFF600050003')) # high < low
+        self.assertRaises(CAPException, disassemble, a2b('8D00017A'), 0, 2)
+        self.assertEqual(typenames([0x6, 0x8, 0x1, 0x0, 0xA, 0xB, 0x1]), ['L810A;', '[B', 'V'])
+        self.assertEqual(signature(typenames([0x4, 0xB, 0x1])), '(S[B)V')
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
@@ -0,0 +1,806 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with block ciphers.
+
+The module is the single crypto provider of the tool: DES/3DES/AES in ECB/CBC mode, ISO/IEC
+9797-1 padding method 1 & 2, CBC-MAC (MAC algorithm 1), the retail MAC (MAC algorithm 3) and
+CMAC (NIST SP 800-38B). api_alg & api_gp compute their MACs, cryptograms & session keys here.
+
+The ciphers come from a backend, chosen at import time: 'backend' in the [api_crypto] section
+of config.ini, 'auto' (default) for the fastest one installed:
+
+    pycrypto: PyCrypto, in C
+    pydes: pyDes, pure Python, orders of magnitude slower, always available, no AES
+
+An algorithm the backend can't do is taken from the first backend that can.
+
+All functions take binary strings or bytearrays & return binary strings, so that chained
+computations, e.g. SCP02 session keys, cryptograms & C-MACs, never go through hexdigits. The
+hexdigits wrappers are in api_alg.
+
+Cipher contexts (the key schedules) are kept in a bounded LRU cache, keyed by algorithm, mode &
+key, so that MACing hundreds of APDUs with the same session key pays the key setup once. Its
+size is 'ciphercache' in the [api_crypto] section, 0 to disable. A CBC context is reused for
+any ICV: its chaining state is tracked & the first block adjusted, see CachedCipher.
+
+Big payloads, flash images or CAP files, can be MACed as they are read, in constant memory,
+with the hashlib-style CBCMAC & RetailMAC:
+
+    mac = api_crypto.RetailMAC(key)
+    for block in iter(lambda: f.read(0x10000), ''):
+        mac.update(block)
+    mac.digest()
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import logging, unittest, binascii, collections, threading, timeit, string, struct
+import pyDes
+import api_config
+
+#-------------------------------------------------------------------------------
+# define own Exception class
+class CryptoException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+class WipedCipherException(CryptoException):
+    ''' A CachedCipher used after the cache wiped it, get the key's context from the cache again '''
+
+
+#-------------------------------------------------------------------------------
+# import utility
+a2b = binascii.a2b_hex
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+DES = 'DES'
+TDES = 'TDES'
+AES = 'AES'
+
+BLOCK_SIZES = {DES : 8, TDES : 8, AES : 16}
+KEY_LENGTHS = {DES : (8,), TDES : (16, 24), AES : (16, 24, 32)}
+CMAC_RB = {8 : 0x1B, 16 : 0x87} # the constant of CMAC subkeys, per block size
+
+MODE_ECB = 'ECB'
+MODE_CBC = 'CBC'
+
+ZERO_ICV = '\x00'*8
+
+PAD_NONE = 0 # data already padded
+PAD_M1 = 1 # ISO/IEC 9797-1 padding method 1
+PAD_M2 = 2 # ISO/IEC 9797-1 padding method 2
+
+BLOCK = struct.Struct('>Q') # a DES block as an integer
+BLOCK16 = struct.Struct('>QQ') # an AES block as 2 integers
+
+INVERT = string.maketrans(''.join(map(chr, range(256))), ''.join([chr(0xFF^x) for x in range(256)]))
+
+
+#-------------------------------------------------------------------------------
+# define backends
+
+class PyCryptoBackend(object):
+    ''' PyCrypto, raise ImportError if not installed '''
+
+    name = 'pycrypto'
+    chaining = True # a CBC object goes on from the last block of the previous call
+    algorithms = (DES, TDES, AES)
+
+    def __init__(self):
+        from Crypto.Cipher import DES as des, DES3 as des3, AES as aes
+        self.des, self.des3, self.aes = des, des3, aes
+
+    def new(self, alg, key, mode=MODE_ECB, iv=None):
+        cls = {DES : self.des, TDES : self.des3, AES : self.aes}[alg]
+        m = cls.MODE_ECB if mode == MODE_ECB else cls.MODE_CBC
+        try:
+            return cls.new(key, m, iv) if mode == MODE_CBC else cls.new(key, m)
+        except ValueError:
+            # degenerated 3DES key, rejected by some versions: K1==K2 is DES with K3, K2==K3 DES with K1
+            k1, k2, k3 = key[:8], key[8:16], key[16:] or key[:8]
+            if alg != TDES or (k1 != k2 and k2 != k3):
+                raise
+        return self.new(DES, k3 if k1 == k2 else k1, mode, iv)
+
+    def wipe(self, cipher):
+        pass # the key schedule is inside the C object, freed but not overwritten on deallocation
+
+
+class PyDesBackend(object):
+    ''' pyDes, pure Python '''
+
+    name = 'pydes'
+    chaining = False # a CBC object always starts from the ICV given at creation
+    algorithms = (DES, TDES)
+
+    def new(self, alg, key, mode=MODE_ECB, iv=None):
+        cls = pyDes.des if alg == DES else pyDes.triple_des
+        return cls(key, pyDes.ECB if mode == MODE_ECB else pyDes.CBC, iv, None)
+
+    def wipe(self, cipher):
+        ''' Overwrite the subkeys in place '''
+        lst = [getattr(cipher, '_triple_des__key%d' % i, None) for i in (1, 2, 3)]
+        for x in [cipher] + [x for x in lst if x]:
+            for k in getattr(x, 'Kn', []):
+                k[:] = [0]*len(k)
+
+
+BACKENDS = collections.OrderedDict() # name : backend, the fastest first
+
+for cls in (PyCryptoBackend, PyDesBackend):
+    try:
+        BACKENDS[cls.name] = cls()
+    except ImportError:
+        Logger.debug('crypto backend %s not available' % cls.name)
+
+BACKEND = None # see setbackend()
+
+def getbackend(alg=None):
+    ''' Returns the backend, or the one doing alg: the backend if it can, or the first one that can '''
+    if alg is None or alg in BACKEND.algorithms:
+        return BACKEND
+    for x in BACKENDS.values():
+        if alg in x.algorithms:
+            return x
+    raise CryptoException('%s not supported by the crypto backends: %s' % (alg, ', '.join(BACKENDS)))
+
+def setbackend(name='auto'):
+    ''' Select the backend of all functions, by name, 'auto' for the fastest one.
+
+        Returns the previous backend.
+    '''
+    global BACKEND
+    old = BACKEND
+    if name == 'auto':
+        BACKEND = BACKENDS.values()[0]
+    elif name in BACKENDS:
+        BACKEND = BACKENDS[name]
+    else:
+        raise CryptoException('Crypto backend %s not available! %s' % (name, ', '.join(BACKENDS)))
+    CACHE.clear()
+    return old
+
+
+def xorblock(a, b):
+    if len(a) == 8 and len(b) == 8:
+        return BLOCK.pack(BLOCK.unpack(a)[0] ^ BLOCK.unpack(b)[0])
+    if len(a) == 16 and len(b) == 16:
+        x, y = BLOCK16.unpack(a), BLOCK16.unpack(b)
+        return BLOCK16.pack(x[0] ^ y[0], x[1] ^ y[1])
+    return ''.join([chr(ord(x)^ord(y)) for x, y in zip(a, b)])
+
+
+class CachedCipher(object):
+    ''' A cipher context of the cache, encrypt & decrypt with any ICV.
+
+        A backend CBC object started from some ICV & may go on from the last block of the
+        previous call: its current chaining block is tracked as 'state', & the first block of
+        data adjusted by state XOR icv.
+
+        The backend objects keep their working state (pyDes: L, R, final), so every call, ECB
+        too, holds the lock. A context wiped by the cache drops its key: any later use, by a
+        thread still holding it, raises WipedCipherException.
+    '''
+
+    def __init__(self, backend, alg, key, mode):
+        self.backend = backend
+        self.alg = alg
+        self.key = key
+        self.mode = mode
+        self.size = BLOCK_SIZES[alg]
+        self.lock = threading.Lock()
+        self.subkeys = None # of CMAC, see cmac()
+        self.open()
+
+    def open(self):
+        ''' Create the backend object, the chaining block reset '''
+        self.state = '\x00'*self.size
+        self.cipher = self.backend.new(self.alg, self.key, self.mode, self.state if self.mode == MODE_CBC else None)
+
+    def encrypt(self, data, iv=None):
+        n = self.size
+        with self.lock:
+            if self.cipher is None:
+                raise WipedCipherException('%s context wiped!' % self.alg)
+            if self.mode == MODE_ECB:
+                return self.cipher.encrypt(data)
+            if iv != self.state:
+                data = xorblock(data[:n], xorblock(self.state, iv)) + data[n:]
+            out = self.cipher.encrypt(data)
+            if self.backend.chaining:
+                self.state = out[-n:]
+        return out
+
+    def decrypt(self, data, iv=None):
+        n = self.size
+        with self.lock:
+            if self.cipher is None:
+                raise WipedCipherException('%s context wiped!' % self.alg)
+            if self.mode == MODE_ECB:
+                return self.cipher.decrypt(data)
+            out = self.cipher.decrypt(data)
+            if iv != self.state:
+                out = xorblock(out[:n], xorblock(self.state, iv)) + out[n:]
+            if self.backend.chaining:
+                self.state = data[-n:]
+        return out
+
+    def wipe(self):
+        with self.lock:
+            if self.cipher is not None:
+                self.backend.wipe(self.cipher)
+                self.cipher = self.key = self.subkeys = None
+                self.state = '\x00'*self.size
+
+
+class CipherCache(object):
+    ''' A bounded LRU cache of CachedCipher, keyed by (algorithm, mode, key). Thread safe.
+
+        An evicted or invalidated context is wiped: it drops its key & CMAC subkeys, pyDes
+        subkeys are overwritten with zeros. PyCrypto keeps its key schedule inside the C object,
+        out of reach: it is only freed, not overwritten, once the last reference goes. The cache
+        itself still holds the keys of its live entries, in its dict keys too.
+    '''
+
+    def __init__(self, size=64):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, alg, key, mode=MODE_ECB):
+        ''' Returns the CachedCipher of the key, created if not cached '''
+        k = (alg, mode, key)
+        with self.lock:
+            x = self.entries.pop(k, None)
+            if x is None:
+                self.misses += 1
+                x = CachedCipher(getbackend(alg), alg, key, mode)
+                if self.size and len(self.entries) >= self.size:
+                    self.evictions += 1
+                    self.entries.popitem(last=False)[1].wipe()
+            else:
+                self.hits += 1
+            if self.size:
+                self.entries[k] = x
+            return x
+
+    def invalidate(self, key):
+        ''' Remove & wipe all contexts of a key, e.g. a session key no longer used '''
+        with self.lock:
+            for k in [k for k in self.entries if k[2] == key]:
+                self.entries.pop(k).wipe()
+
+    def clear(self):
+        ''' Remove & wipe all contexts, the counters are reset too '''
+        with self.lock:
+            for x in self.entries.values():
+                x.wipe()
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def resize(self, size):
+        with self.lock:
+            self.size = size
+            while len(self.entries) > size:
+                self.evictions += 1
+                self.entries.popitem(last=False)[1].wipe()
+
+    def stats(self):
+        return {'size' : len(self.entries), 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+CACHE = CipherCache(api_config.CONFIG.getint(__name__, 'ciphercache') if api_config.CONFIG.has_option(__name__, 'ciphercache') else 64)
+
+setbackend(api_config.CONFIG.get(__name__, 'backend') if api_config.CONFIG.has_option(__name__, 'backend') else 'auto')
+
+
+#-------------------------------------------------------------------------------
+# define API
+
+def newcipher(alg, key, mode=MODE_ECB, iv=None):
+    ''' Returns a cipher object of the backend, with encrypt(data) & decrypt(data).
+
+        alg: DES, TDES or AES
+        key: binary, 8 bytes for DES, 16 or 24 for TDES, 16, 24 or 32 for AES
+        mode: MODE_ECB or MODE_CBC
+        iv: binary, a block, 8 bytes or 16 for AES, for MODE_CBC
+    '''
+    if len(key) not in KEY_LENGTHS[alg]:
+        raise CryptoException('Invalid %s key length %d!' % (alg, len(key)))
+    if mode == MODE_CBC and (not iv or len(iv) != BLOCK_SIZES[alg]):
+        raise CryptoException('Invalid ICV %r!' % iv)
+    return getbackend(alg).new(alg, key, mode, iv)
+
+
+def getcipher(alg, key, mode=MODE_ECB):
+    ''' Returns the CachedCipher of a key, its encrypt(data, iv) & decrypt(data, iv) accept any
+        ICV in CBC mode. See newcipher().
+    '''
+    if len(key) not in KEY_LENGTHS[alg]:
+        raise CryptoException('Invalid %s key length %d!' % (alg, len(key)))
+    return CACHE.get(alg, key, mode)
+
+
+def usecipher(alg, key, mode, name, *args):
+    ''' Calls the method name of the cached context. If another thread got it wiped in
+        between, with a context of its own, out of the cache.
+    '''
+    try:
+        return getattr(getcipher(alg, key, mode), name)(*args)
+    except WipedCipherException:
+        cipher = CachedCipher(getbackend(alg), alg, key, mode)
+        try:
+            return getattr(cipher, name)(*args)
+        finally:
+            cipher.wipe()
+
+
+def tobytes(data):
+    ''' Returns a bytearray, or any buffer, as a binary string '''
+    return data if type(data) is str else bytes(data)
+
+
+def encrypt(alg, key, data, mode=MODE_ECB, iv=None):
+    ''' Returns data encrypted, its length must be a multiple of the block, see newcipher(). '''
+    if type(data) is not str or type(key) is not str or (iv and type(iv) is not str):
+        data, key, iv = tobytes(data), tobytes(key), iv and tobytes(iv)
+    n = BLOCK_SIZES[alg]
+    if len(data) % n:
+        raise CryptoException('Invalid data length %d, should be %d*N!' % (len(data), n))
+    if mode == MODE_CBC and (not iv or len(iv) != n):
+        raise CryptoException('Invalid ICV %r!' % iv)
+    return usecipher(alg, key, mode, 'encrypt', data, iv)
+
+
+def decrypt(alg, key, data, mode=MODE_ECB, iv=None):
+    ''' Returns data decrypted, its length must be a multiple of the block, see newcipher(). '''
+    if type(data) is not str or type(key) is not str or (iv and type(iv) is not str):
+        data, key, iv = tobytes(data), tobytes(key), iv and tobytes(iv)
+    n = BLOCK_SIZES[alg]
+    if len(data) % n:
+        raise CryptoException('Invalid data length %d, should be %d*N!' % (len(data), n))
+    if mode == MODE_CBC and (not iv or len(iv) != n):
+        raise CryptoException('Invalid ICV %r!' % iv)
+    return usecipher(alg, key, mode, 'decrypt', data, iv)
+
+
+def xor(a, b):
+    ''' Returns a XOR b, of the same length '''
+    if len(a) != len(b):
+        raise CryptoException('XOR of %d & %d bytes!' % (len(a), len(b)))
+    if not a:
+        return ''
+    x = int(binascii.b2a_hex(a), 16) ^ int(binascii.b2a_hex(b), 16)
+    return binascii.a2b_hex('%0*x' % (2*len(a), x))
+
+
+def invert(data):
+    ''' Returns NOT data, every bit inverted '''
+    return tobytes(data).translate(INVERT)
+
+
+def shiftbits(data, bits, left=True, pad=0):
+    ''' Returns data shifted by 1 to 7 bits, the bits shifted in are 'pad', 0 or 1.
+
+        To the left, the data keeps its length, the leftmost bits are lost. To the right, a byte
+        is added so that no bit is lost, its rightmost bits are 'pad' too:
+
+            shiftbits('\x12\x34\x56\x78', 5) == '\x46\x8A\xCF\x00'
+            shiftbits('\x12\x34\x56\x78', 5, False) == '\x00\x91\xA2\xB3\xC0'
+    '''
+    if not 0 < bits < 8 or pad not in (0, 1):
+        raise CryptoException('Invalid shift of %r bits, pad %r!' % (bits, pad))
+    n = len(data)
+    x = int(binascii.b2a_hex(data), 16) if n else 0
+    if left:
+        x = (x << bits) & ((1 << 8*n)-1)
+        if pad:
+            x |= (1 << bits)-1
+    else:
+        x <<= 8-bits
+        n += 1
+        if pad:
+            x |= (((1 << bits)-1) << (8*n-bits)) | ((1 << (8-bits))-1)
+    return binascii.a2b_hex('%0*x' % (2*n, x)) if n else ''
+
+
+def padm1(data, size=8):
+    ''' ISO/IEC 9797-1 padding method 1, binary zeroes up to a multiple of size, at least a block '''
+    return tobytes(data) + '\x00' * (-len(data) % size if data else size)
+
+
+def padm2(data, size=8):
+    ''' ISO/IEC 9797-1 padding method 2, '80' then binary zeroes up to a multiple of size '''
+    data = tobytes(data) + '\x80'
+    return data + '\x00' * (-len(data) % size)
+
+
+def unpadm2(data, size=8):
+    ''' Remove the padding method 2, raise CryptoException if not padded '''
+    x = data.rstrip('\x00')
+    if not x.endswith('\x80') or len(data)-len(x) >= size:
+        raise CryptoException('Invalid padding method 2!')
+    return x[:-1]
+
+
+def cbcmac(alg, key, data, iv=ZERO_ICV):
+    ''' ISO/IEC 9797-1 MAC algorithm 1, the last block of CBC, data already padded. With TDES,
+        the 'Full Triple DES' MAC of GlobalPlatform.
+    '''
+    return encrypt(alg, key, data, MODE_CBC, iv)[-8:]
+
+
+def retailmac(key, data, iv=ZERO_ICV):
+    ''' ISO/IEC 9797-1 MAC algorithm 3, a.k.a. retail MAC, or 'Single DES Plus Final Triple DES'
+        of GlobalPlatform: DES-CBC with K1, then decrypt with K2 & encrypt with K3 (K1 if a 16
+        bytes key) the last block. Data already padded.
+    '''
+    if len(data) % 8 or not data:
+        raise CryptoException('Invalid data length %d, should be 8*N!' % len(data))
+    data, key, iv = tobytes(data), tobytes(key), tobytes(iv)
+    h = encrypt(DES, key[:8], data[:-8], MODE_CBC, iv)[-8:] if len(data) > 8 else iv
+    return encrypt(TDES, key, xorblock(h, data[-8:]))
+
+
+def cmacsubkeys(alg, key):
+    ''' Returns the subkeys (K1, K2) of CMAC, computed once per cached key '''
+    cipher = getcipher(alg, key)
+    subkeys = cipher.subkeys
+    if subkeys is None:
+        n = BLOCK_SIZES[alg]
+        lst = []
+        x = int(binascii.b2a_hex(usecipher(alg, key, MODE_ECB, 'encrypt', '\x00'*n)), 16)
+        for i in range(2):
+            x <<= 1
+            if x >> 8*n:
+                x = (x & ((1 << 8*n)-1)) ^ CMAC_RB[n]
+            lst.append(binascii.a2b_hex('%0*x' % (2*n, x)))
+        subkeys = tuple(lst)
+        with cipher.lock:
+            if cipher.cipher is not None: # not kept by a wiped context
+                cipher.subkeys = subkeys
+    return subkeys
+
+
+def cmac(alg, key, data):
+    ''' NIST SP 800-38B CMAC, a.k.a. OMAC1, RFC 4493 for AES. Returns a full block, to be
+        truncated by the caller. Data not padded.
+    '''
+    key, data = tobytes(key), tobytes(data)
+    k1, k2 = cmacsubkeys(alg, key)
+    n = BLOCK_SIZES[alg]
+    r = len(data) % n
+    if data and not r:
+        head, last = data[:-n], xorblock(data[-n:], k1)
+    else:
+        head, last = data[:len(data)-r], xorblock(padm2(data[len(data)-r:], n), k2)
+    h = encrypt(alg, key, head, MODE_CBC, '\x00'*n)[-n:] if head else '\x00'*n
+    return usecipher(alg, key, MODE_ECB, 'encrypt', xorblock(h, last))
+
+
+class CBCMAC(object):
+    ''' ISO/IEC 9797-1 MAC algorithm 1, like hashlib: update() as data comes, digest() at any time.
+
+        Only the chaining block & less than 2 blocks of data are kept between calls.
+    '''
+
+    digest_size = 8
+    block_size = 8
+
+    def __init__(self, alg, key, data='', iv=ZERO_ICV, padding=PAD_M2):
+        ''' alg: DES or TDES
+            key: binary
+            data: binary, the first data to MAC
+            iv: binary, 8 bytes
+            padding: PAD_M2 (default), PAD_M1, or PAD_NONE if data is padded already
+        '''
+        key = tobytes(key)
+        self.alg, self.key, self.padding = alg, key, padding
+        self.chain = (alg, key) # the cipher of all blocks but the last
+        self.state = tobytes(iv)
+        self.buffer = ''
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        buf = self.buffer + tobytes(data)
+        n = len(buf) - len(buf) % 8
+        if self.padding != PAD_M2 and n == len(buf):
+            n -= 8 # may be the last block, not padded
+        if n > 0:
+            self.state = encrypt(self.chain[0], self.chain[1], buf[:n], MODE_CBC, self.state)[-8:]
+            buf = buf[n:]
+        self.buffer = buf
+
+    def final(self, state, last):
+        ''' Returns the MAC from the chaining block & the last block '''
+        return encrypt(self.alg, self.key, xorblock(state, last))
+
+    def digest(self):
+        ''' Returns the MAC of the data so far, binary, the object can still be updated '''
+        last = {PAD_M1 : padm1, PAD_M2 : padm2}.get(self.padding, str)(self.buffer)
+        if not last or len(last) % 8:
+            raise CryptoException('Invalid data length, should be 8*N!')
+        state = self.state
+        if len(last) > 8:
+            state = encrypt(self.chain[0], self.chain[1], last[:-8], MODE_CBC, state)[-8:]
+        return self.final(state, last[-8:])
+
+    def hexdigest(self):
+        return binascii.b2a_hex(self.digest()).upper()
+
+    def copy(self):
+        x = object.__new__(self.__class__)
+        x.__dict__.update(self.__dict__)
+        return x
+
+
+class RetailMAC(CBCMAC):
+    ''' ISO/IEC 9797-1 MAC algorithm 3, see retailmac() & CBCMAC.
+    '''
+
+    def __init__(self, key, data='', iv=ZERO_ICV, padding=PAD_M2):
+        CBCMAC.__init__(self, TDES, key, '', iv, padding)
+        self.chain = (DES, self.key[:8])
+        if data:
+            self.update(data)
+
+
+#-------------------------------------------------------------------------------
+# known answers: (function, arguments, result as hexdigits)
+KAT = [
+        # FIPS 81
+        (encrypt, (DES, a2b('0123456789ABCDEF'), a2b('4E6F772069732074')), '3FA40E8A984D4815'),
+        (encrypt, (DES, a2b('0123456789ABCDEF'), a2b('4E6F77206973207468652074696D6520666F7220616C6C20'),
+            MODE_CBC, a2b('1234567890ABCDEF')), 'E5C7CDDE872BF27C43E934008C389C0F683788499A7C05F6'),
+        (decrypt, (DES, a2b('0123456789ABCDEF'), a2b('E5C7CDDE872BF27C43E934008C389C0F683788499A7C05F6'),
+            MODE_CBC, a2b('1234567890ABCDEF')), '4E6F77206973207468652074696D6520666F7220616C6C20'),
+        # SP 800-67, 3 keys
+        (encrypt, (TDES, a2b('0123456789ABCDEF23456789ABCDEF01456789ABCDEF0123'), a2b('5468652071756663')), 'A826FD8CE53B855F'),
+        # api_alg self test, PBOC_TDES_Encrypt & Get3DESLevel1SubKey, 2 keys
+        (encrypt, (TDES, a2b('74832174819274982147298749475847'), a2b('0080000000000000')), '5504224C647CF703'),
+        (encrypt, (TDES, a2b('74832174819274982147298749475847'), a2b('74832174819274988B7CDE8B7E6D8B67')), '0F591D96D2A1BB4499D8A17DAFE0C637'),
+        (decrypt, (TDES, a2b('74832174819274982147298749475847'), a2b('5504224C647CF703')), '0080000000000000'),
+        # degenerated key
+        (encrypt, (TDES, a2b('11'*16), a2b('00'*8)), '82E13665B4624DF5'),
+        # api_alg self test, SDES_MAC_Right, TDES_MAC_Right & PBOC_TDES_MAC32
+        (cbcmac, (DES, a2b('7483217481927498'), padm2(a2b('0F591D96D2A1BB4499D8A17DAFE0C637')), a2b('7483217481927498')), '423BC334'),
+        (retailmac, (a2b('94832174819274987483217481927499'), padm2(a2b('0F591D96D2A1BB4499D8A17DAFE0C637'))), '6D6979E6'),
+        (retailmac, (a2b('514602B602261D21514602B602261D21'), padm2(a2b('514602B602261D20')), a2b('514602B602261D22')), '10D82B28'),
+        # FIPS 197, C.1
+        (encrypt, (AES, a2b('000102030405060708090A0B0C0D0E0F'), a2b('00112233445566778899AABBCCDDEEFF')), '69C4E0D86A7B0430D8CDB78070B4C55A'),
+        (decrypt, (AES, a2b('000102030405060708090A0B0C0D0E0F'), a2b('69C4E0D86A7B0430D8CDB78070B4C55A')), '00112233445566778899AABBCCDDEEFF'),
+        # SP 800-38A, F.2.1 CBC-AES128.Encrypt, 2 blocks
+        (encrypt, (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C'), a2b('6BC1BEE22E409F96E93D7E117393172AAE2D8A571E03AC9C9EB76FAC45AF8E51'),
+            MODE_CBC, a2b('000102030405060708090A0B0C0D0E0F')), '7649ABAC8119B246CEE98E9B12E9197D5086CB9B507219EE95DB113A917678B2'),
+        # RFC 4493, AES-CMAC
+        (lambda alg, key: ''.join(cmacsubkeys(alg, key)), (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C')), 'FBEED618357133667C85E08F7236A8DEF7DDAC306AE266CCF90BC11EE46D513B'),
+        (cmac, (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C'), ''), 'BB1D6929E95937287FA37D129B756746'),
+        (cmac, (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C'), a2b('6BC1BEE22E409F96E93D7E117393172A')), '070A16B46B4D4144F79BDD9DD04A287C'),
+        (cmac, (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C'), a2b('6BC1BEE22E409F96E93D7E117393172AAE2D8A571E03AC9C9EB76FAC45AF8E5130C81C46A35CE411')),
+            'DFA66747DE9AE63030CA32611497C827'),
+        (cmac, (AES, a2b('2B7E151628AED2A6ABF7158809CF4F3C'), a2b('6BC1BEE22E409F96E93D7E117393172AAE2D8A571E03AC9C9EB76FAC45AF8E51'
+            '30C81C46A35CE411E5FBC1191A0A52EFF69F2445DF4F9B17AD2B417BE66C3710')), '51F0BEBF7E3B9D92FC49741779363CFE'),
+        ]
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def setUp(self):
+        self.old = getbackend()
+        self.size = CACHE.size
+
+    def tearDown(self):
+        setbackend(self.old.name)
+        CACHE.resize(self.size)
+
+    def test_kat(self):
+        ''' 所有后端的已知答案测试 '''
+        self.assertTrue('pydes' in BACKENDS)
+        aes = any(AES in x.algorithms for x in BACKENDS.values())
+        for name in BACKENDS:
+            setbackend(name)
+            for func, args, result in KAT:
+                if args[0] == AES and not aes:
+                    continue
+                x = binascii.b2a_hex(func(*args)).upper()
+                self.assertEqual(x[:len(result)], result, (name, func.__name__, x, result))
+
+    def test_padding(self):
+        ''' ISO/IEC 9797-1填充方法1、2 '''
+        self.assertEqual(padm1(''), '\x00'*8)
+        self.assertEqual(padm1('\x11'*8), '\x11'*8)
+        self.assertEqual(padm1('\x11'*9), '\x11'*9+'\x00'*7)
+        self.assertEqual(padm2(''), '\x80'+'\x00'*7)
+        self.assertEqual(padm2('\x11'*8), '\x11'*8+'\x80'+'\x00'*7)
+        for i in range(17):
+            self.assertEqual(unpadm2(padm2('\x11'*i)), '\x11'*i)
+        self.assertRaises(CryptoException, unpadm2, '\x11'*8)
+        self.assertRaises(CryptoException, encrypt, DES, '\x11'*8, '\x11'*7)
+        self.assertRaises(CryptoException, newcipher, TDES, '\x11'*8)
+        self.assertRaises(CryptoException, setbackend, 'openssl')
+        self.assertEqual(padm2('\x11', 16), '\x11\x80'+'\x00'*14)
+        self.assertEqual(unpadm2(padm2('\x11'*8, 16), 16), '\x11'*8)
+        self.assertRaises(CryptoException, encrypt, AES, '\x11'*16, '\x11'*8)
+
+    def test_bytes(self):
+        ''' XOR、取反、移位，bytearray输入 '''
+        a, b = a2b('5DEDC06EA93F7579'), a2b('3B6676248EBFB9A9')
+        self.assertEqual(xor(a, b), a2b('668BB64A2780CCD0'))
+        self.assertEqual(xor(bytearray(a), b), xor(a, b))
+        self.assertEqual(xor('\x00\x01', '\x00\x00'), '\x00\x01')
+        self.assertEqual(xor('', ''), '')
+        self.assertRaises(CryptoException, xor, a, b[:7])
+        self.assertEqual(invert('\x62\x00'), '\x9D\xFF')
+        self.assertEqual(invert(bytearray('\x62')), '\x9D')
+
+        x = a2b('12345678')
+        self.assertEqual(shiftbits(x, 5), a2b('468ACF00'))
+        self.assertEqual(shiftbits(x, 5, False), a2b('0091A2B3C0'))
+        self.assertEqual(shiftbits(x, 5, True, 1), a2b('468ACF1F'))
+        self.assertEqual(shiftbits(x, 5, False, 1), a2b('F891A2B3C7'))
+        self.assertEqual(shiftbits('\x80', 1), '\x00')
+        self.assertRaises(CryptoException, shiftbits, x, 8)
+
+        key, data = bytearray(range(16)), bytearray(range(24))
+        self.assertEqual(encrypt(TDES, key, data, MODE_CBC, bytearray(8)), encrypt(TDES, str(key), str(data), MODE_CBC, ZERO_ICV))
+        self.assertEqual(retailmac(key, padm2(data)), retailmac(str(key), padm2(str(data))))
+        self.assertEqual(RetailMAC(key, data).digest(), retailmac(key, padm2(data)))
+
+    def test_cache(self):
+        ''' 密钥上下文缓存：任意ICV的CBC、LRU淘汰与擦除、失效、命中计数 '''
+        import random
+        r = lambda n: ''.join([chr(random.randrange(256)) for i in range(n)])
+        for name in BACKENDS:
+            setbackend(name)
+            for i in range(50):
+                alg, key = random.choice([(DES, r(8)), (TDES, r(16)), (TDES, r(24))])
+                data, iv = r(8*random.randrange(1, 5)), r(8)
+                for x in range(2): # the 2nd time from the cache
+                    self.assertEqual(encrypt(alg, key, data, MODE_CBC, iv), newcipher(alg, key, MODE_CBC, iv).encrypt(data))
+                    self.assertEqual(decrypt(alg, key, data, MODE_CBC, iv), newcipher(alg, key, MODE_CBC, iv).decrypt(data))
+
+        setbackend('pydes')
+        CACHE.resize(2)
+        keys = [chr(i)*8 for i in range(3)]
+        for k in keys:
+            encrypt(DES, k, '\x00'*8)
+        encrypt(DES, keys[1], '\x00'*8)
+        self.assertEqual(CACHE.stats(), {'size' : 2, 'hits' : 1, 'misses' : 3, 'evictions' : 1})
+        x = CACHE.entries[(DES, MODE_ECB, keys[2])]
+        cipher = x.cipher
+        CACHE.invalidate(keys[2])
+        self.assertEqual((len(CACHE), x.cipher, x.key), (1, None, None))
+        self.assertFalse(any(any(k) for k in cipher.Kn))
+        self.assertRaises(WipedCipherException, x.encrypt, '\x00'*8)
+        self.assertRaises(WipedCipherException, x.decrypt, '\x00'*8)
+        self.assertEqual(encrypt(DES, keys[2], '\x00'*8), newcipher(DES, keys[2]).encrypt('\x00'*8)) # a new context
+        CACHE.resize(0)
+        encrypt(DES, keys[2], '\x00'*8)
+        self.assertEqual(len(CACHE), 0)
+
+        # contexts shared by threads, evicted & invalidated while in use
+        import threading, api_alg
+        key = '404142434445464748494A4B4C4D4E4F'
+        data = [binascii.b2a_hex(r(8*random.randrange(1, 6))) for i in range(20)]
+        expected = [api_alg.TDES_MAC(x, key) for x in data]
+        errors = []
+        def worker(k):
+            try:
+                for i in range(100):
+                    j = (i+k) % len(data)
+                    if api_alg.TDES_MAC(data[j], key) != expected[j]:
+                        errors.append('wrong MAC')
+                    if k == 0 and i % 5 == 0:
+                        CACHE.invalidate(a2b(key))
+                    encrypt(DES, r(8), '\x00'*8) # evictions
+            except Exception, e:
+                errors.append(repr(e))
+        for name in BACKENDS:
+            setbackend(name)
+            CACHE.resize(4)
+            threads = [threading.Thread(target=worker, args=(k,)) for k in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+
+    def test_benchmark(self):
+        ''' 同一密钥重复计算MAC：缓存前后每次MAC的耗时 '''
+        import api_alg
+        key, data = '94832174819274987483217481927499', '0F591D96D2A1BB44' # a C-MAC, the key setup dominates
+        results = {}
+        for name in BACKENDS:
+            setbackend(name)
+            for size in (0, 64):
+                CACHE.clear()
+                CACHE.resize(size)
+                n = 2000 if name == 'pycrypto' else 30
+                t = min(timeit.repeat(lambda: api_alg.TDES_MAC(data, key), number=n, repeat=3))
+                results[(name, size)] = t*1e6/n
+                stats = CACHE.stats()
+                Logger.info('%s, cache of %d: %r' % (name, size, stats))
+                if size: # the DES & TDES contexts of the key, created once
+                    self.assertEqual((stats['misses'], stats['evictions']), (2, 0))
+                    self.assertTrue(stats['hits'] > 0)
+                else:
+                    self.assertEqual((stats['size'], stats['hits']), (0, 0))
+            Logger.info('%s, TDES_MAC: %.1f us without cache, %.1f us with cache' % (name, results[(name, 0)], results[(name, 64)]))
+
+    def test_mac(self):
+        ''' 分段update()的MAC与一次计算的结果一致，只保留不到2个分组的数据 '''
+        import random
+        r = lambda n: ''.join([chr(random.randrange(256)) for i in range(n)])
+        for i in range(200):
+            key, iv, data = r(16), r(8), r(random.randrange(0, 100))
+            padding = random.choice([PAD_NONE, PAD_M1, PAD_M2])
+            if padding == PAD_NONE:
+                data = padm1(data)
+            padded = {PAD_M1 : padm1, PAD_M2 : padm2}.get(padding, str)(data)
+            lst = [RetailMAC(key, iv=iv, padding=padding), CBCMAC(TDES, key, iv=iv, padding=padding), CBCMAC(DES, key[:8], iv=iv, padding=padding)]
+            j = 0
+            while j < len(data):
+                n = random.randrange(1, 20)
+                for x in lst:
+                    x.update(data[j:j+n])
+                    self.assertTrue(len(x.buffer) <= 8)
+                j += n
+            self.assertEqual(lst[0].digest(), retailmac(key, padded, iv))
+            self.assertEqual(lst[1].digest(), cbcmac(TDES, key, padded, iv))
+            self.assertEqual(lst[2].digest(), cbcmac(DES, key[:8], padded, iv))
+
+        mac = RetailMAC(binascii.a2b_hex('514602B602261D21514602B602261D21'), iv=binascii.a2b_hex('514602B602261D22'))
+        x = mac.copy()
+        mac.update(binascii.a2b_hex('514602B602261D20'))
+        self.assertEqual(mac.hexdigest()[:8], '10D82B28')
+        self.assertEqual(x.digest(), retailmac(x.key, padm2(''), x.state))
+        self.assertRaises(CryptoException, CBCMAC(DES, '\x11'*8, '\x11', padding=PAD_NONE).digest)
+
+    def test_alg(self):
+        ''' api_alg、api_gp的MAC与会话密钥在各后端下结果一致 '''
+        import api_alg, api_gp
+        lst = []
+        for name in BACKENDS:
+            setbackend(name)
+            lst.append([
+                api_alg.TDES_MAC('0F591D96D2A1BB4499D8A17DAFE0C637', '0123456789ABCDEF23456789ABCDEF01456789ABCDEF0123'),
+                api_alg.TDES_MAC_Unusual('0F591D96D2A1BB4499D8A17DAFE0C637', '94832174819274987483217481927499'),
+                api_alg.SDES_MAC_Left('0F591D96D2A1BB44', '7483217481927498'),
+                api_alg.PBOC_SDES_MAC32('0F591D96D2A1BB44', '7483217481927498'),
+                api_alg.DES_Decrypt('3FA40E8A984D4815', '0123456789ABCDEF', True),
+                api_alg.Get3DESLevel2SubKey('11'*16, '1111111111111111', '2111111111111111'),
+                api_gp.getCMACSkey(api_gp.KEY404F, '0001'),
+                api_gp.generateCMAC('8482000010'+'11'*8, api_gp.KEY404F),
+                ])
+        self.assertEqual(lst[0][4], '4E6F772069732074')
+        self.assertEqual(lst[0][5], 'C3697E7CE603FA11A391196CA7B7F967')
+        for x in lst[1:]:
+            self.assertEqual(x, lst[0])
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
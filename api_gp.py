@@ -14,6 +14,7 @@ Author: atr@china-xinghan.com
 
 Reference Document: 
     1. GlobalPlatform, Card Specification Version 2.1.1, March 2003
+    2. GlobalPlatform, Card Specification Version 2.2, Amendment D, Secure Channel Protocol '03', Version 1.1
 
 """
 
@@ -22,13 +23,21 @@ Reference Document:
 import binascii
 import logging
 import unittest
+import timeit
+import struct
+import hashlib
+import json
+import os
+import tempfile
 
 import api_pcsc
 import api_general
 import api_alg
 import api_cap
 
-from Crypto.Cipher import DES
+import api_crypto
+import api_tlv
+import api_config
 
 a2b = api_pcsc.a2b
 
@@ -44,12 +53,34 @@ def LogMessage(msg, level=logging.DEBUG):
 hexlen = api_general.hexLen
 lv = api_general.lv
 
+#-------------------------------------------------------------------------------
+# define own Exception class
+class GPException(api_pcsc.PCSCException):
+    ''' A GP error, e.g. a wrong card cryptogram. A PCSCException, so that the scripts catching
+        the card errors catch it too.
+    '''
+    pass
+
 #-------------------------------------------------------------------------------
 # define global variable
 
 CardManagerAID = 'A000000003000000' 
 KEY404F = '404142434445464748494A4B4C4D4E4F'
 
+# SCP02 session key derivation constants, binary
+SCP02_CMAC = '\x01\x01'
+SCP02_RMAC = '\x01\x02'
+SCP02_ENC = '\x01\x82'
+SCP02_DEK = '\x01\x81'
+
+# SCP03 data derivation constants, binary, 4.1.5 of [2]
+SCP03_CARD_CRYPTOGRAM = '\x00'
+SCP03_HOST_CRYPTOGRAM = '\x01'
+SCP03_CARD_CHALLENGE = '\x02'
+SCP03_ENC = '\x04'
+SCP03_MAC = '\x06'
+SCP03_RMAC = '\x07'
+
 GP_List = [
     'Header',
     'Directory',
@@ -64,6 +95,17 @@ GP_List = [
     'Descriptor',
     ]
 
+# LOAD block size, command data bytes: the first one tried if the card supports extended Lc,
+# and the smallest one tried when the card answers '6700'
+LOAD_EXTENDED = 0x800
+LOAD_MIN = 0x10
+
+# P1 of GET STATUS, 11.4.2.1 of [1]
+GS_ISD = 0x80
+GS_APPS = 0x40 # applications, including security domains
+GS_LOADFILES = 0x20
+GS_MODULES = 0x10 # executable load files & their executable modules
+
 #-------------------------------------------------------------------------------
 # define API
 
@@ -94,16 +136,92 @@ def select(aid, expectData='', expectSW='9000', info='', name='GP, Select AID',
 
 def card (aid=CardManagerAID, apduheader='00A40400', expectData='', expectSW='9000', info='', name='GP, /card'):
     ''' Resets the inserted card, requests the ATR and selects the CardManager (default=GlobalPlatform CardManager)
-        via the default logical channel (zero).
+        via the default logical channel (zero). The reset is warm if the session asks so,
+        see api_pcsc.setkeepconnection().
 
         Returns a tuple: (response_data, sw1sw2). 
     '''
-    api_pcsc.reset()
+    api_pcsc.reset(cold=not api_pcsc.getsession().warmReset)
     ret, sw = select(aid, expectData=expectData, expectSW=expectSW, info=info, name=name, header=apduheader)
     LogMessage('Select Card Manager, Response: %s' % ret)
     return ret, sw
 
 
+def scp02sessionkey(key, constant, seq):
+    ''' E.4.1  DES Session Keys, binary
+
+        key: static key, 16 bytes
+        constant: SCP02_CMAC, SCP02_RMAC, SCP02_ENC or SCP02_DEK
+        seq: Sequence Counter, 2 bytes
+
+        The binary functions scp02...() are chained without hexdigits, the hexdigits functions
+        below are wrappers of them.
+    '''
+    return api_crypto.encrypt(api_crypto.TDES, key, constant+seq+'\x00'*12, api_crypto.MODE_CBC, api_crypto.ZERO_ICV)
+
+
+def scp02cryptogram(skey, data):
+    ''' E.4.2.1  Authentication Cryptogram, binary: Full Triple DES MAC of data padded, ICV of zeroes
+
+        skey: S-ENC session key
+        data: host challenge + seq + card challenge for the card cryptogram,
+              seq + card challenge + host challenge for the host cryptogram
+    '''
+    return api_crypto.cbcmac(api_crypto.TDES, skey, api_crypto.padm2(data))
+
+
+def scp02cmac(skey, apdu, icv=api_crypto.ZERO_ICV):
+    ''' E.4.4  C-MAC, binary: retail MAC of the command padded, without the C-MAC & Le '''
+    return api_crypto.retailmac(skey, api_crypto.padm2(apdu), icv)
+
+
+def scp02extauth(sk_enc, sk_cmac, seq, cardchallenge, hostchallenge, level='\x00'):
+    ''' Returns the EXTERNAL AUTHENTICATE command, binary, with the host cryptogram & C-MAC.
+
+        sk_enc, sk_cmac: S-ENC & C-MAC session keys
+        Other parameters binary, see extauth().
+    '''
+    pt = '\x84\x82' + level + '\x00\x10' + scp02cryptogram(sk_enc, seq + cardchallenge + hostchallenge)
+    return pt + scp02cmac(sk_cmac, pt)
+
+
+def scp03kdf(key, constant, context, bits):
+    ''' 4.1.5 Data Derivation Scheme of [2], binary: NIST SP 800-108 KDF in counter mode,
+        AES-CMAC as the PRF.
+
+        key: AES key
+        constant: one of SCP03_...
+        context: host challenge + card challenge
+        bits: the length of the derived data, in bits
+    '''
+    out = ''
+    for i in range(1, (bits+127)/128+1):
+        x = '\x00'*11 + constant + '\x00' + struct.pack('>H', bits) + chr(i) + context
+        out += api_crypto.cmac(api_crypto.AES, key, x)
+    return out[:bits/8]
+
+
+def scp03sessionkeys(enc, mac, context):
+    ''' 6.2.1 AES Session Keys of [2], binary. Returns {'enc', 'mac', 'rmac'}, of the length of
+        the static keys.
+    '''
+    return {
+            'enc' : scp03kdf(enc, SCP03_ENC, context, 8*len(enc)),
+            'mac' : scp03kdf(mac, SCP03_MAC, context, 8*len(mac)),
+            'rmac' : scp03kdf(mac, SCP03_RMAC, context, 8*len(mac)),
+            }
+
+
+def scp03cryptogram(smac, constant, context):
+    ''' 6.2.2.2 & 6.2.2.3 of [2], the card or host cryptogram, binary, 8 bytes '''
+    return scp03kdf(smac, constant, context, 64)
+
+
+def scp03counter(n):
+    ''' The encryption counter as an AES block, 6.2.6 of [2] '''
+    return '\x00'*8 + struct.pack('>Q', n)
+
+
 def computerSCP02skey(constant, seq, key, padding='00'*12, icv='00'*8):
     '''
     # DES session keys are created using the static Secure Channel key(s), the Secure Channel Sequence Counter, a 
@@ -116,6 +234,8 @@ def computerSCP02skey(constant, seq, key, padding='00'*12, icv='00'*8):
     # E.4.1  DES Session Keys
     # The DES operation used to generate these keys is always triple DES in CBC mode.
     '''
+    if padding=='00'*12 and icv=='00'*8:
+        return b2a(scp02sessionkey(a2b(key), a2b(constant), a2b(seq)))
     return api_alg.TDES_Encrypt(constant+seq+padding, key, ecb_mode=False, icv=icv)
 
 
@@ -165,36 +285,7 @@ def iso9797_1_M1_T3(text, key, icv='00'*8):
         If the resultant data block length is a multiple of 8, no further padding is required. 
         Append binary zeroes to the right of the data block until the data block length is a multiple of 8.
     """
-    t = a2b(text)
-    suffix = '\x80\x00\x00\x00\x00\x00\x00\x00'
-
-    t = t +suffix
-    ld = len(t)
-    if ld%8:
-        padding = ld%8
-        t = t[:(-1*padding)]
-
-    k = a2b(key)
-
-    icv = a2b(icv)
-
-    keyA = k[:8]
-    keyB = k[8:]
-
-    #desKeyA = pyDes.des(keyA, pyDes.CBC, icv, None)
-    #desKeyB = pyDes.des(keyB, pyDes.ECB, None, None)
-    #desKeyA1 = pyDes.des(keyA, pyDes.ECB, None, None)
-
-    desKeyA = DES.new(keyA, DES.MODE_CBC, icv)
-    desKeyB = DES.new(keyB, DES.MODE_ECB, icv)
-    desKeyA1 = DES.new(keyA, DES.MODE_ECB, icv)
-
-    cipher = desKeyA.encrypt(t)
-    last8 = cipher[-8:]
-    last8d = desKeyB.decrypt(last8)
-    mac = desKeyA1.encrypt(last8d)
-
-    return b2a(mac).upper()
+    return b2a(scp02cmac(a2b(key), a2b(text), a2b(icv)))
 
 
 def generateCMAC(apdu, skey, icv='00'*8):
@@ -240,8 +331,7 @@ def verifyCardCryptogram(host, seq, card, cryptogram, skey, icv='00'*8):
 
     # The signature method, using the S-ENC session key and an ICV of binary zeroes, is applied across this 24-byte 
     # block and the resulting 8-byte signature is the card cryptogram.
-    cipher = api_alg.TDES_Encrypt(pt, skey, ecb_mode=False, icv=icv)
-    mac = cipher[-16:]
+    mac = b2a(api_crypto.cbcmac(api_crypto.TDES, a2b(skey), a2b(pt), a2b(icv)))
 
     if mac!=cryptogram:
         LogMessage('Card %s != %s' % (cryptogram, mac))
@@ -265,8 +355,7 @@ def computeHostCryptogram(skey, seq, hostchallenge, cardchallenge, icv='00'*8, p
 
     # The signature method, using the S-ENC session key and an ICV of binary zeroes, is applied across this 24-byte 
     # block and the resulting 8-byte signature is the host cryptogram.
-    cipher = api_alg.TDES_Encrypt(pt, skey, ecb_mode=False, icv=icv)
-    mac = cipher[-16:]
+    mac = b2a(api_crypto.cbcmac(api_crypto.TDES, a2b(skey), a2b(pt), a2b(icv)))
 
     return mac
 
@@ -300,8 +389,10 @@ def initupdate (key_version_number='00', host_challenge='', s_enc='', apduheader
     ret = a2b(response_data)
     kdiv, kver, scpid, seq, cardchallenge, cardcryptogram = [b2a(ret[a:b]) for a,b in ((0,10), (10,11), (11,12), (12,14), (14,20), (20,28))]
     if s_enc:
-        sk_enc = getEncryptSkey(s_enc, seq)
-        verifyCardCryptogram(r, seq, cardchallenge, cardcryptogram, sk_enc)
+        sk_enc = scp02sessionkey(a2b(s_enc), SCP02_ENC, ret[12:14])
+        mac = scp02cryptogram(sk_enc, a2b(r) + ret[12:20])
+        if mac!=ret[20:28]:
+            LogMessage('Card %s != %s' % (cardcryptogram, b2a(mac)))
 
     t = (kdiv, kver, scpid, seq, cardchallenge, cardcryptogram, r)
     LogMessage('Init-update, (kdiv, kver, scpid, seq, cardchallenge, cardcryptogram, hostchallenge): %s' % str(t).upper())
@@ -314,28 +405,229 @@ def extauth (s_enc, s_mac, seq, cardchallenge, hostchallenge, level='00', expect
         See <E.5.2  EXTERNAL AUTHENTICATE Command> of [1].
     '''
 
-    sk_enc = getEncryptSkey(s_enc, seq)
-    sk_cmac = getCMACSkey(s_mac, seq)
-    hostcryptogram = computeHostCryptogram(sk_enc, seq, hostchallenge, cardchallenge)
-
-    header = '8482%s0010' % level
-    pt = header + hostcryptogram
-    cmac = generateCMAC(pt, sk_cmac)
-    apdu = pt + cmac
+    seq = a2b(seq)
+    sk_enc = scp02sessionkey(a2b(s_enc), SCP02_ENC, seq)
+    sk_cmac = scp02sessionkey(a2b(s_mac), SCP02_CMAC, seq)
+    apdu = b2a(scp02extauth(sk_enc, sk_cmac, seq, a2b(cardchallenge), a2b(hostchallenge), a2b(level)))
 
     return api_pcsc.send(apdu, expectSW=expectSW, info=info, name=name)
 
 
 def auth(keyver='00', s_enc=KEY404F, s_mac=KEY404F, level='00'):
-    ''' A shortway to do 'init-update' & 'ext-auth' .
+    ''' A shortway to do 'init-update' & 'ext-auth', through a SecureChannel: SCP02 or SCP03,
+        as the card answers.
+
+        Raise GPException if the card cryptogram is wrong.
     '''
-    ret, sw = initupdate(key_version_number=keyver, host_challenge='FF'*8, s_enc=s_enc)
-    kdiv, kver, scpid, seq, cardchallenge, cardcryptogram, hostchallenge = ret
+    return SecureChannel(s_enc, s_mac, keyver=keyver, level=level).open('FF'*8)
+
 
-    return extauth(s_enc, s_mac, seq, cardchallenge, hostchallenge, level)
+class SecureChannel(object):
+    ''' SCP02 or SCP03 secure channel, the host side, see Appendix E of [1] & [2]. The protocol is
+        the one of the INITIALIZE UPDATE response.
 
+        SCP02: the 4 session keys of a Sequence Counter are derived once & kept, so that a
+        handshake, INITIALIZE UPDATE & EXTERNAL AUTHENTICATE, costs a single derivation pass, &
+        none if the channel is opened again with the same counter. The ICV of each C-MAC is the
+        previous C-MAC, encrypted if 'i' asks so (i=15, 55). R-MAC is not supported.
 
-def installforload(aid, securitydomainaid=CardManagerAID, datablockhash='', param='', token='', header='80E60200'):
+        SCP03: AES session keys derived from the challenges (NIST SP 800-108 KDF, AES-CMAC),
+        C-MAC & R-MAC chained by the MAC chaining value, C-DECRYPTION & R-ENCRYPTION with the
+        encryption counter.
+
+        The commands are then wrapped with the security level of EXTERNAL AUTHENTICATE:
+
+            channel = api_gp.SecureChannel(level='03') # C-MAC & C-DECRYPTION
+            channel.open()
+            channel.send('80E400000A4F08A000000003000000')
+    '''
+
+    def __init__(self, enc=KEY404F, mac=KEY404F, dek=KEY404F, keyver='00', level='00', i=0x15):
+        ''' enc, mac, dek: static keys, hexdigits, 16 bytes for SCP02, 16, 24 or 32 for SCP03
+            keyver: key version number, '00' for the first one
+            level: security level of EXTERNAL AUTHENTICATE, '00', '01' C-MAC, '03' C-MAC &
+                   C-DECRYPTION, with SCP03 also '11' & '13' R-MAC, '33' R-MAC & R-ENCRYPTION
+            i: the 'i' parameter of SCP02, the one of the card with SCP03
+        '''
+        self.keys = (a2b(enc), a2b(mac), a2b(dek))
+        self.keyver = keyver
+        self.level = int(level, 16)
+        self.i = i
+        self.derived = {} # SCP02 Sequence Counter, binary : session keys
+        self.close()
+
+    def close(self):
+        ''' Forget the session, the derived keys are kept '''
+        self.scp = None
+        self.seq = None
+        self.skeys = None
+        self.challenges = None
+        self.icv = None # SCP02: the last C-MAC, SCP03: the MAC chaining value
+        self.counter = 0 # SCP03 encryption counter
+        self.opened = False
+
+    def sessionkeys(self, seq):
+        ''' Returns the SCP02 session keys of a Sequence Counter (binary), derived once:
+            {'cmac', 'rmac', 'enc', 'dek'}, binary
+        '''
+        x = self.derived.get(seq)
+        if x is None:
+            enc, mac, dek = self.keys
+            x = self.derived[seq] = {
+                    'cmac' : scp02sessionkey(mac, SCP02_CMAC, seq),
+                    'rmac' : scp02sessionkey(mac, SCP02_RMAC, seq),
+                    'enc' : scp02sessionkey(enc, SCP02_ENC, seq),
+                    'dek' : scp02sessionkey(dek, SCP02_DEK, seq),
+                    }
+        return x
+
+    def initupdate(self, hostchallenge=''):
+        ''' Send INITIALIZE UPDATE & verify the card cryptogram, raise GPException if wrong.
+
+            Returns the response data, hexdigits.
+        '''
+        self.close()
+        host = a2b(hostchallenge or api_general.randhex(8))
+        response, sw = api_pcsc.send('8050%s0008' % self.keyver + b2a(host), expectSW='9000', name='GP, INITIALIZE-UPDATE')
+        ret = a2b(response)
+        scp = ord(ret[11]) if len(ret)>11 else None
+        if scp==0x02 and len(ret)==28:
+            seq, card, cryptogram = ret[12:14], ret[14:20], ret[20:28]
+            skeys = self.sessionkeys(seq)
+            expected = scp02cryptogram(skeys['enc'], host + seq + card)
+        elif scp==0x03 and len(ret) in (29, 32):
+            self.i = ord(ret[12])
+            seq, card, cryptogram = ret[29:32], ret[13:21], ret[21:29]
+            skeys = scp03sessionkeys(self.keys[0], self.keys[1], host + card)
+            expected = scp03cryptogram(skeys['mac'], SCP03_CARD_CRYPTOGRAM, host + card)
+        else:
+            raise GPException('Invalid INITIALIZE UPDATE response, or SCP not supported: %s' % response)
+        if expected!=cryptogram:
+            raise GPException('Wrong card cryptogram %s, wrong keys?' % b2a(cryptogram))
+        self.scp, self.seq, self.skeys, self.challenges = scp, seq, skeys, (host, card)
+        return response
+
+    def extauth(self):
+        ''' Send EXTERNAL AUTHENTICATE, after initupdate() '''
+        if not self.skeys:
+            raise GPException('INITIALIZE UPDATE first!')
+        host, card = self.challenges
+        if self.scp==0x02:
+            apdu = scp02extauth(self.skeys['enc'], self.skeys['cmac'], self.seq, card, host, chr(self.level))
+            self.icv = apdu[-8:]
+        else:
+            pt = '\x84\x82' + chr(self.level) + '\x00\x10' + scp03cryptogram(self.skeys['mac'], SCP03_HOST_CRYPTOGRAM, host + card)
+            self.icv = api_crypto.cmac(api_crypto.AES, self.skeys['mac'], '\x00'*16 + pt)
+            apdu = pt + self.icv[:8]
+            self.counter = 1
+        ret = api_pcsc.send(b2a(apdu), expectSW='9000', name='GP, EXTERNAL AUTHENTICATE')
+        self.opened = True
+        return ret
+
+    def open(self, hostchallenge=''):
+        ''' INITIALIZE UPDATE & EXTERNAL AUTHENTICATE, returns the response of the latter '''
+        self.initupdate(hostchallenge)
+        return self.extauth()
+
+    def wrap(self, apdu):
+        ''' Returns the command, hexdigits, with the C-MAC & data encrypted as the security level
+            asks. See E.4.4 & E.4.6 of [1], 6.2.4 & 6.2.6 of [2].
+        '''
+        if not self.opened:
+            raise GPException('Secure channel not open!')
+        if not self.level & 0x01:
+            return apdu
+        fields = api_pcsc.splitapdu(apdu)
+        if fields is None:
+            raise GPException('Invalid APDU: %s' % apdu)
+        lc, data, le = fields
+        if not data and len(lc)==2: # case 1 or 2, P3 is Le
+            lc, le = '', lc
+        data = a2b(data)
+        cla = '%.2X' % (int(apdu[:2], 16) | 0x04)
+
+        if self.scp==0x02:
+            # C-MAC on the modified header & plain data, then encryption
+            extended = len(lc)==6 or len(data)+8>0xFF
+            lcfield = ('00%.4X' if extended else '%.2X') % (len(data)+8)
+            icv = self.icv
+            if self.i & 0x10:
+                icv = api_crypto.encrypt(api_crypto.DES, self.skeys['cmac'][:8], icv)
+            self.icv = mac = scp02cmac(self.skeys['cmac'], a2b(cla + apdu[2:8] + lcfield) + data, icv)
+            if self.level & 0x02 and data:
+                data = api_crypto.encrypt(api_crypto.TDES, self.skeys['enc'], api_crypto.padm2(data), api_crypto.MODE_CBC, api_crypto.ZERO_ICV)
+        else:
+            # encryption, then C-MAC on the modified header & encrypted data
+            if self.level & 0x02:
+                if data:
+                    icv = api_crypto.encrypt(api_crypto.AES, self.skeys['enc'], scp03counter(self.counter))
+                    data = api_crypto.encrypt(api_crypto.AES, self.skeys['enc'], api_crypto.padm2(data, 16), api_crypto.MODE_CBC, icv)
+                self.counter += 1
+            extended = len(lc)==6 or len(data)+8>0xFF
+            lcfield = ('00%.4X' if extended else '%.2X') % (len(data)+8)
+            self.icv = api_crypto.cmac(api_crypto.AES, self.skeys['mac'], self.icv + a2b(cla + apdu[2:8] + lcfield) + data)
+            mac = self.icv[:8]
+
+        if extended and len(le)==2:
+            le = '%.4X' % (int(le, 16) or 0x100)
+        lcfield = ('00%.4X' if extended else '%.2X') % (len(data)+8)
+        return cla + apdu[2:8] + lcfield + b2a(data + mac) + le
+
+    def unwrap(self, response, sw):
+        ''' Returns the response data, hexdigits, R-MAC checked & removed, decrypted, as the
+            security level asks: SCP03 only. Raise GPException if the R-MAC is wrong.
+
+            An error status word, all but 9000, 62xx & 63xx, comes without R-MAC, 6.2.5 of [2].
+        '''
+        if self.scp!=0x03 or not self.level & 0x10 or not (sw=='9000' or sw[:2] in ('62', '63')):
+            return response
+        data = a2b(response)
+        if len(data)<8:
+            raise GPException('No R-MAC in the response!')
+        data, rmac = data[:-8], data[-8:]
+        if api_crypto.cmac(api_crypto.AES, self.skeys['rmac'], self.icv + data + a2b(sw))[:8]!=rmac:
+            raise GPException('Wrong R-MAC %s!' % b2a(rmac))
+        if self.level & 0x20 and data:
+            icv = api_crypto.encrypt(api_crypto.AES, self.skeys['enc'], '\x80' + scp03counter(self.counter-1)[1:])
+            try:
+                data = api_crypto.unpadm2(api_crypto.decrypt(api_crypto.AES, self.skeys['enc'], data, api_crypto.MODE_CBC, icv), 16)
+            except api_crypto.CryptoException, e:
+                raise GPException('Wrong R-ENCRYPTION: %s' % e)
+        return b2a(data)
+
+    def room(self, limit):
+        ''' Returns the largest number of plain data bytes whose wrapped command data, padded,
+            encrypted & with the C-MAC as the security level asks, fits in limit bytes.
+        '''
+        if self.level & 0x01:
+            limit -= 8
+        if self.level & 0x02:
+            size = 8 if self.scp==0x02 else 16
+            limit = limit//size*size - 1 # at least one byte of padding
+        return limit
+
+    def send(self, apdu, expectData='', expectSW='9000', info='', name=''):
+        ''' Wrap the command, send it & unwrap the response, see api_pcsc.send() '''
+        session = api_pcsc.getsession()
+        response, sw = session.send(self.wrap(apdu), expectSW=expectSW, info=info, name=name)
+        response = self.unwrap(response, sw)
+        session.check(response, sw, expectData, '', info, name)
+        return response, sw
+
+    def encrypt(self, data):
+        ''' Encrypt sensitive data, e.g. keys of PUT KEY: with the DEK session key (TDES-ECB) for
+            SCP02, E.3.3 of [1], the static DEK (AES-CBC, ICV of zeroes) for SCP03.
+
+            data: hexdigits, a multiple of the block
+        '''
+        if not self.skeys:
+            raise GPException('Secure channel not open!')
+        if self.scp==0x02:
+            return b2a(api_crypto.encrypt(api_crypto.TDES, self.skeys['dek'], a2b(data)))
+        return b2a(api_crypto.encrypt(api_crypto.AES, self.keys[2], a2b(data), api_crypto.MODE_CBC, '\x00'*16))
+
+
+def installforload(aid, securitydomainaid=CardManagerAID, datablockhash='', param='', token='', header='80E60200', channel=None):
     ''' 9.5.2.3.1  Data Field for INSTALL [for load]
 
         Mandatory  1  Length of Load File AID 
@@ -348,37 +640,102 @@ def installforload(aid, securitydomainaid=CardManagerAID, datablockhash='', para
         Conditional  0-n  Load parameters field 
         Mandatory  1  Length of Load Token 
         Conditional 0-n  Load Token
+
+        channel: a SecureChannel opened to wrap the command, None to send it as it is
     '''
     lst = (aid, securitydomainaid, datablockhash, param, token)
     data = ''.join(map(lv, lst))
     apdu = header + lv(data)
 
-    return api_pcsc.send(apdu, expectData='00', expectSW='9000', info='', name='INSTALL for load')
+    send = channel.send if channel else api_pcsc.send
+    return send(apdu, expectData='00', expectSW='9000', info='', name='INSTALL for load')
 
 
-def upload(pathtocap, aid, blocksize=250, clains='80E8'):
-    ''' Upload a cap file.
-    
-        will send INSTALL for load & LOAD Command
+def loadfiledatablock(cap, chunksize=0x1000):
+    ''' Yields the Load File Data Block of a CAPFile, binary, read lazily: the 'C4' tag & length
+        first, then the components of GP_List, chunksize bytes at most each time.
     '''
-    caps = a2b( api_cap.CAPFile(pathtocap).readAllCap(GP_List) )
-    lgth = len(caps)
-    c4 = a2b('C4' + getBERTLVlengthfield(lgth)) + caps
-    lgth = len(c4)
+    yield a2b('C4' + getBERTLVlengthfield(cap.sizeofCap(GP_List)))
+    for chunk in cap.iterCap(GP_List, chunksize=chunksize):
+        yield chunk
 
-    blocks = [c4[i:i+blocksize] for i in range(0, lgth, blocksize)]
-    assert len(''.join(blocks))==lgth
-    assert len(blocks)<=0x100
-    apdus = [''.join([clains, '00%.2X'%i, '%.2X'%len(b), b2a(b)]) for i,b in enumerate(blocks)]
-    
-    lastblock = apdus[-1]
-    apdus[-1] = '80E880' +lastblock[6:]
 
-    installforload(aid)
+def loadfilehash(cap, hashalg='sha1'):
+    ''' Returns the Load File Data Block Hash of a CAPFile, hexdigits, over the components, C.2
+        of [1]. Computed once per CAP file, see api_cap.CAPRegistry.
+
+        hashalg: a hashlib algorithm, 'sha1' for GP 2.1.1 & 2.2
+    '''
+    return cap.digest(GP_List, hashalg)
 
-    for apdu in apdus[:-1]:
-        api_pcsc.send(apdu, expectData='', expectSW='9000', name='LOAD')
-    api_pcsc.send(apdus[-1], expectData='00', expectSW='9000', name='LOAD')
+
+def upload(pathtocap, aid, blocksize=None, clains='80E8', hashalg='', channel=None):
+    ''' Upload a cap file.
+    
+        will send INSTALL for load & LOAD Command. The Load File Data Block is read from the
+        CAP file lazily & each LOAD command built from the binary block just before it is sent.
+
+        blocksize: command data bytes per LOAD command, None for the largest the card accepts:
+                   LOAD_EXTENDED if it supports extended Lc (see
+                   api_pcsc.ReaderSession.getcapabilities), otherwise 255. Halved, down to
+                   LOAD_MIN, each time the card answers '6700', the block is then sent again.
+        hashalg: '' for no Load File Data Block Hash in INSTALL for load, or a hashlib
+                 algorithm like 'sha1', see loadfilehash()
+        channel: a SecureChannel opened to wrap the commands, None to send them as they are
+
+        Returns a dict: {'size' : bytes loaded, 'blocks' : number of LOAD commands, 'blocksize'
+        : the last one, 'seconds' : time of the LOAD commands, 'rate' : bytes per second, 'hash'
+        : hexdigits or ''}
+    '''
+    session = api_pcsc.getsession()
+    extended = session.getcapabilities()['extended']
+    if blocksize is None:
+        blocksize = LOAD_EXTENDED if extended else 0xFF
+    elif blocksize>0xFF and not extended:
+        LogMessage('Extended APDU not supported, LOAD block size %d reduced to 255' % blocksize, logging.WARNING)
+        blocksize = 0xFF
+
+    cap = api_cap.CAPFile(pathtocap)
+    try:
+        datablockhash = loadfilehash(cap, hashalg) if hashalg else ''
+        installforload(aid, datablockhash=datablockhash, channel=channel)
+
+        send = channel.send if channel else session.send
+        chunks = loadfiledatablock(cap)
+        buf, eof, size, i = '', False, 0, 0
+        t0 = timeit.default_timer()
+        while True:
+            n = channel.room(blocksize) if channel else blocksize
+            while len(buf)<=n and not eof: # one byte more than the block, to tell the last one
+                chunk = next(chunks, None)
+                if chunk is None:
+                    eof = True
+                else:
+                    buf += chunk
+            last = eof and len(buf)<=n
+            apdu = api_pcsc.buildapdu(clains[:2], clains[2:], '80' if last else '00', '%.2X' % (i & 0xFF), b2a(buf[:n]))
+            state = (channel.icv, channel.counter) if channel else None
+            response, sw = send(apdu, expectSW='', name='LOAD')
+            if sw=='6700' and blocksize>LOAD_MIN:
+                if channel: # rejected before the secure messaging
+                    channel.icv, channel.counter = state
+                blocksize = 0xFF if blocksize>0xFF else max(blocksize//2, LOAD_MIN)
+                LogMessage('LOAD block of %d bytes rejected, block size reduced to %d' % (n, blocksize), logging.WARNING)
+                continue
+            session.check(response, sw, '00' if last else '', '9000', '', 'LOAD')
+            size += len(buf[:n])
+            buf, i = buf[n:], i+1
+            if i==0x100:
+                LogMessage('More than 256 LOAD blocks, block number wrapped to 00', logging.WARNING)
+            if last:
+                break
+        seconds = timeit.default_timer()-t0
+    finally:
+        cap.close()
+
+    rate = size/seconds if seconds else 0
+    LogMessage('LOAD: %d bytes, %d blocks, block size %d, %.3f s, %d bytes/s' % (size, i, blocksize, seconds, rate), logging.INFO)
+    return {'size' : size, 'blocks' : i, 'blocksize' : blocksize, 'seconds' : seconds, 'rate' : rate, 'hash' : datablockhash}
 
 
 def installforinstall(loadfileaid, moduleaid, appletaid, privileges='00', param='', token='', header='80E60400'):
@@ -434,6 +791,225 @@ def deleteaid(aid, related=False, expectSW='9000'):
     return api_pcsc.send(apdu, expectSW=expectSW, info='', name='Delete AID')
 
 
+def parsestatus(data, p1, tlv=False):
+    ''' Parse the response data of GET STATUS, 11.4.3 of [1].
+
+        data: hexdigits, the responses concatenated
+        p1: the P1 of the command, GS_ISD, GS_APPS, GS_LOADFILES or GS_MODULES
+        tlv: True for the 'E3' templates of P2='02', False for the legacy format of P2='00'
+
+        Returns a list of dict: {'aid', 'lifecycle', 'privileges', 'modules' : a list of AID,
+        'version' : '' unless the card tells, 'elf' : the load file of an application, '' unless
+        the card tells}, all hexdigits
+    '''
+    lst = []
+    if tlv:
+        for t, l, v in api_tlv.unpacktlvs(data) if data else []:
+            if t!='E3':
+                raise GPException('Invalid GET STATUS response: %s' % data)
+            x = {'aid' : '', 'lifecycle' : '', 'privileges' : '', 'modules' : [], 'version' : '', 'elf' : ''}
+            for t, l, v in api_tlv.unpacktlvs(v) if v else []:
+                if t=='4F':
+                    x['aid'] = v
+                elif t=='9F70':
+                    x['lifecycle'] = v[:2]
+                elif t=='C5':
+                    x['privileges'] = v
+                elif t=='C4':
+                    x['elf'] = v
+                elif t=='CE':
+                    x['version'] = v
+                elif t=='84':
+                    x['modules'].append(v)
+            lst.append(x)
+        return lst
+
+    b, i = a2b(data), 0
+    try:
+        while i<len(b):
+            n = ord(b[i])
+            x = {'aid' : b2a(b[i+1:i+1+n]), 'lifecycle' : b2a(b[i+1+n]), 'privileges' : b2a(b[i+2+n]), 'modules' : [], 'version' : '', 'elf' : ''}
+            i += 3+n
+            if p1==GS_MODULES:
+                count, i = ord(b[i]), i+1
+                for j in range(count):
+                    n = ord(b[i])
+                    x['modules'].append(b2a(b[i+1:i+1+n]))
+                    i += 1+n
+            if i>len(b):
+                raise IndexError
+            lst.append(x)
+    except IndexError:
+        raise GPException('Invalid GET STATUS response: %s' % data)
+    return lst
+
+
+def getstatus(p1=GS_APPS, aid='', tlv=None):
+    ''' GET STATUS, 11.4 of [1]: the ISD, the applications, the load files, or the load files &
+        their modules, those whose AID begins with aid.
+
+        tlv: True for the 'E3' templates (GP 2.2), False for the legacy format, None to try the
+             former first & fall back on the latter if the card refuses P2
+
+        Returns a list of dict, see parsestatus(), [] if nothing found ('6A88').
+    '''
+    session = api_pcsc.getsession()
+    for fmt in ((True, False) if tlv is None else (tlv,)):
+        data, p2 = '', 0x02 if fmt else 0x00
+        while True:
+            apdu = '80F2%.2X%.2X' % (p1, p2) + lv('4F' + lv(aid)) + '00'
+            response, sw = session.send(apdu, expectSW='', name='GP, GET STATUS')
+            if sw not in ('9000', '6310'):
+                break
+            data += response
+            if sw=='9000':
+                return parsestatus(data, p1, fmt)
+            p2 |= 0x01 # next occurrence
+        if sw=='6A88':
+            return []
+        if sw!='6A86': # P2 not supported
+            break
+    session.check(response, sw, '', '9000', '', 'GP, GET STATUS')
+    return []
+
+
+def cardid():
+    ''' Returns an identifier of the card connected, hexdigits: the CPLC data (GET DATA '9F7F'),
+        unique to the chip, or '' if the card doesn't answer it. The ATR is not: cards of the
+        same product share it.
+    '''
+    response, sw = api_pcsc.send('80CA9F7F00', expectSW='', name='GP, GET DATA CPLC')
+    if sw=='9000' and response[:6]=='9F7F2A':
+        return response[6:]
+    return ''
+
+
+class DeployCache(object):
+    ''' Records of the CAP files deployed by deploy(), per card & load file AID: the hash of the
+        Load File Data Block & the install parameters, kept in memory & in a JSON file if any,
+        so that another run of the suites knows them too. DEPLOYCACHE, the default one, is kept
+        in the 'deploycache' file of [api_gp] in config.ini, ~/.svs/deploycache.json if not set,
+        none if empty.
+
+        The file is read on first use, an unreadable or corrupt one is ignored: the cache starts
+        empty. It is written to a temporary file, renamed then.
+    '''
+
+    def __init__(self, path=''):
+        self.path = path
+        self._records = None
+
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        records = json.load(f)
+                    if isinstance(records, dict):
+                        self._records = records
+                    else:
+                        LogMessage('Deploy cache %s ignored, not a JSON object' % self.path, logging.WARNING)
+                except (IOError, ValueError), e:
+                    LogMessage('Deploy cache %s ignored, %s' % (self.path, e), logging.WARNING)
+        return self._records
+
+    def get(self, card, aid):
+        return self.records.get(card, {}).get(aid)
+
+    def set(self, card, aid, record):
+        self.records.setdefault(card, {})[aid] = record
+        self.save()
+
+    def discard(self, card, aid):
+        if self.records.get(card, {}).pop(aid, None) is not None:
+            self.save()
+
+    def save(self):
+        if self.path:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            fd, tmp = tempfile.mkstemp('.tmp', os.path.basename(self.path), folder or '.')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.records, f, indent=2, sort_keys=True)
+                if os.name == 'nt' and os.path.exists(self.path): # no atomic replace by rename on Windows
+                    os.remove(self.path)
+                os.rename(tmp, self.path)
+            finally:
+                if os.path.exists(tmp): # not renamed
+                    os.remove(tmp)
+
+
+DEPLOYCACHE = DeployCache(os.path.expanduser(api_config.CONFIG.get(__name__, 'deploycache')
+        if api_config.CONFIG.has_option(__name__, 'deploycache') else os.path.join('~', '.svs', 'deploycache.json')))
+
+
+def capheader(cap):
+    ''' Returns the Header component of a CAPFile, an api_cap.Header '''
+    return cap.component('Header')
+
+
+def capversion(cap):
+    ''' Returns the package version of a CAPFile, hexdigits, major & minor like '0100', from the
+        Header component.
+    '''
+    items = capheader(cap).items
+    return items['package_info_major_version'] + items['package_info_minor_version']
+
+
+def deploy(pathtocap, instanceaid, pkgaid='', appletaid='', privileges='00', param='', cache=None, force=False):
+    ''' Upload & install a CAP file unless the card has it already: the same load file AID,
+        version & module, the instance, & the record in cache of the same Load File Data Block
+        hash & install parameters. Otherwise delete the load file & related applications, upload
+        & install, like the setUpClass() of the testsuites did every time. A card without CPLC
+        data can't be told from another one, see cardid(): it is deployed every time. The card
+        must be authenticated already, see auth().
+
+        pkgaid: the load file AID, the one of the manifest, or of the Header component, if omitted
+        cache: a DeployCache, DEPLOYCACHE if omitted
+        force: True to deploy anyway
+
+        Returns True if deployed, False if skipped.
+    '''
+    cache = DEPLOYCACHE if cache is None else cache
+    cap = api_cap.CAPFile(pathtocap)
+    try:
+        pkgaid = (pkgaid or cap.getPackageAID() or capheader(cap).items['package_info_AID']).upper()
+        record = {
+                'hash' : loadfilehash(cap),
+                'version' : capversion(cap),
+                'instance' : instanceaid.upper(),
+                'module' : (appletaid or instanceaid).upper(),
+                'privileges' : privileges.upper(),
+                'param' : param.upper(),
+                }
+    finally:
+        cap.close()
+
+    cid = cardid()
+    if cid and not force and cache.get(cid, pkgaid)==record:
+        loadfiles = [x for x in getstatus(GS_MODULES, pkgaid) if x['aid']==pkgaid]
+        apps = [x for x in getstatus(GS_APPS, record['instance']) if x['aid']==record['instance']]
+        if (loadfiles and apps
+                and loadfiles[0]['version'] in ('', record['version'])
+                and record['module'] in loadfiles[0]['modules']
+                and apps[0]['elf'] in ('', pkgaid)):
+            LogMessage('%s already deployed, version %s, hash %s' % (pkgaid, record['version'], record['hash']), logging.INFO)
+            return False
+
+    if cid:
+        cache.discard(cid, pkgaid)
+    deleteaid(pkgaid, True, expectSW='') # omit delete result
+    upload(pathtocap, pkgaid)
+    install(instanceaid, pkgaid, appletaid, privileges, param)
+    if cid:
+        cache.set(cid, pkgaid, record)
+    return True
+
+
 #-------------------------------------------------------------------------------
 class TestModule(unittest.TestCase):
     ''' 本模块的单元测试 '''
@@ -451,6 +1027,284 @@ class TestModule(unittest.TestCase):
         upload(cap, pkg)
         install(instance, pkg, applet)
 
+    def test_securechannel(self):
+        ''' 在虚拟卡上建立SCP02安全通道：会话密钥只派生一次、C-MAC（ICV加密）、C-DECRYPTION '''
+        import api_virtualcard
+        vcard = api_virtualcard.createusim()
+        old = api_pcsc.settransport(api_virtualcard.createtransport(vcard))
+        oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        try:
+            api_pcsc.connectreader()
+            delete = '80E40000' + lv('4F' + lv('D0D1D2D3D4D501'))
+            for level in ('01', '03'):
+                card()
+                channel = SecureChannel(level=level)
+                channel.open()
+                self.assertEqual(len(channel.derived), 1)
+                self.assertTrue(channel.sessionkeys(channel.seq) is channel.skeys)
+                for i in range(3): # ICV chaining
+                    channel.send(delete, expectSW='6A88')
+                self.assertRaises(api_pcsc.PCSCException, api_pcsc.send, delete, expectSW='6A88') # no C-MAC
+                self.assertEqual(api_pcsc.getsession().lastapdu['sw'], '6982')
+
+            card()
+            channel = SecureChannel(level='03')
+            channel.open()
+            apdu = channel.wrap(delete)
+            self.assertEqual(apdu[:10], '84E4000018') # 9 bytes encrypted in 16, C-MAC
+            api_pcsc.send(apdu, expectSW='6A88')
+            self.assertEqual(channel.wrap('80CA006600')[:10], '84CA006608')
+            self.assertEqual(channel.wrap('80CA006600')[-2:], '00')
+            self.assertEqual(len(channel.encrypt('11'*16)), 32)
+
+            card()
+            self.assertRaises(GPException, SecureChannel(enc='00'*16).open)
+            self.assertRaises(GPException, SecureChannel().wrap, delete)
+        finally:
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+
+    def test_scp03(self):
+        ''' 在虚拟卡上建立SCP03安全通道：auth()按卡的响应选择协议，C-MAC、C-DECRYPTION、R-MAC、R-ENCRYPTION '''
+        import api_virtualcard
+        vcard = api_virtualcard.createusim()
+        vcard.cardmanager = api_virtualcard.CardManager(scp=0x03)
+        old = api_pcsc.settransport(api_virtualcard.createtransport(vcard))
+        oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        try:
+            api_pcsc.connectreader()
+            card()
+            auth(level='01')
+            self.assertTrue(vcard.cardmanager.session['authenticated'])
+
+            delete = '80E40000' + lv('4F' + lv('D0D1D2D3D4D501'))
+            load = '80E60200' + lv(''.join(map(lv, ('D0D1D2D3D4D501', CardManagerAID, '', '', ''))))
+            for level in ('01', '03', '11', '13', '33'):
+                card()
+                channel = SecureChannel(level=level)
+                channel.open()
+                self.assertEqual((channel.scp, channel.i), (0x03, 0x60))
+                for i in range(3): # MAC chaining & encryption counter
+                    channel.send(delete, expectSW='6A88')
+                self.assertEqual(channel.send(load, expectData='00'), ('00', '9000'))
+                if level=='33':
+                    self.assertEqual(len(api_pcsc.getsession().lastapdu['response']), 2*(16+8)) # encrypted, R-MAC
+                self.assertEqual(channel.counter, 5 if int(level, 16) & 0x02 else 1)
+                self.assertRaises(api_pcsc.PCSCException, api_pcsc.send, delete, expectSW='6A88') # no C-MAC
+                self.assertEqual(api_pcsc.getsession().lastapdu['sw'], '6982')
+
+            card()
+            channel = SecureChannel(level='13')
+            channel.open()
+            apdu = channel.wrap(delete)
+            self.assertEqual(apdu[:10], '84E4000018') # 9 bytes encrypted in 16, C-MAC
+            api_pcsc.send(apdu, expectSW='6A88')
+            response, sw = api_pcsc.send(channel.wrap(load), expectSW='9000')
+            self.assertEqual(channel.unwrap(response, sw), '00')
+            channel.icv = '\x00'*16 # out of sync
+            self.assertRaises(GPException, channel.unwrap, response, sw)
+            self.assertEqual(len(channel.encrypt('11'*16)), 32)
+
+            card()
+            self.assertRaises(GPException, auth, s_mac='00'*16) # the cryptograms use S-MAC only
+        finally:
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+
+    def test_upload(self):
+        ''' 在虚拟卡上流式下载CAP：按卡的能力选择块大小、扩展APDU被拒绝后减小、装载文件哈希、安全通道 '''
+        import os, api_virtualcard
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        cap = api_cap.CAPFile(path)
+        pkg = cap.getPackageAID()
+        data = a2b(cap.readAllCap(GP_List))
+        self.assertEqual(''.join(cap.iterCap(GP_List, chunksize=100)), data)
+        self.assertEqual(cap.sizeofCap(GP_List), len(data))
+        self.assertEqual(''.join(loadfiledatablock(cap)), a2b('C4' + getBERTLVlengthfield(len(data))) + data)
+        self.assertEqual(loadfilehash(cap), b2a(hashlib.sha1(data).digest()))
+        cap.close()
+        size = len(data) + 4 # C4 82 xxxx
+
+        old = api_pcsc.gettransport()
+        oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        try:
+            for atr, extended, blocksize, level, expected in (
+                    (api_virtualcard.DEFAULT_ATR, False, None, '', 0xFF),
+                    (api_virtualcard.EXTENDED_ATR, True, None, '', LOAD_EXTENDED),
+                    (api_virtualcard.EXTENDED_ATR, False, None, '', 0xFF), # '6700', then 255
+                    (api_virtualcard.DEFAULT_ATR, False, 0x10, '01', 0x10)): # 8 bytes per block
+                vcard = api_virtualcard.VirtualCard(atr, t0=not extended and atr==api_virtualcard.DEFAULT_ATR, extended=extended)
+                api_pcsc.settransport(api_virtualcard.createtransport(vcard))
+                api_pcsc.connectreader()
+                card()
+                channel = None
+                if level:
+                    channel = SecureChannel(level=level)
+                    channel.open()
+                else:
+                    auth()
+                n = channel.room(expected) if channel else expected
+                ret = upload(path, pkg, blocksize, hashalg='sha1', channel=channel)
+                self.assertEqual(vcard.cardmanager.packages[pkg]['data'], data)
+                self.assertEqual((ret['size'], ret['blocks'], ret['blocksize']), (size, (size+n-1)//n, expected))
+                self.assertEqual(ret['hash'], b2a(hashlib.sha1(data).digest()))
+                self.assertTrue(ret['rate']>0)
+
+            card()
+            auth()
+            self.assertRaises(api_pcsc.PCSCException, upload, path, pkg) # already loaded
+            del vcard.cardmanager.packages[pkg]
+            card()
+            auth()
+            installforload(pkg, datablockhash='00'*20)
+            self.assertRaises(api_pcsc.PCSCException, api_pcsc.send, '80E88000' + lv('C401' + '00'), expectSW='9000')
+        finally:
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+
+    def test_deploy(self):
+        ''' 在虚拟卡上解析GET STATUS（E3模板、旧格式、6310分段），CAP未变化时跳过删除、下载、安装 '''
+        import os, tempfile, api_virtualcard
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        cap = api_cap.CAPFile(path)
+        pkg, version = capheader(cap).items['package_info_AID'], capversion(cap)
+        module = api_virtualcard.getmodules(a2b(cap.readAllCap(GP_List)))[0]
+        cap.close()
+        instance = pkg + '01'
+        fd, cachepath = tempfile.mkstemp('.json')
+        os.close(fd)
+
+        with open(cachepath, 'w') as f:
+            f.write('{"truncated')
+        cache = DeployCache(cachepath) # read on first use, corrupt: empty
+        self.assertEqual(cache.get('card', pkg), None)
+        cache.set('card', pkg, {'hash' : '00'})
+        self.assertEqual(DeployCache(cachepath).get('card', pkg), {'hash' : '00'})
+        self.assertEqual([x for x in os.listdir(os.path.dirname(cachepath)) if x.startswith(os.path.basename(cachepath))], [os.path.basename(cachepath)])
+        os.remove(cachepath)
+
+        old = api_pcsc.gettransport()
+        oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        try:
+            for tlvstatus in (True, False):
+                vcard = api_virtualcard.createusim()
+                vcard.cardmanager = cm = api_virtualcard.CardManager(tlvstatus=tlvstatus)
+                api_pcsc.settransport(api_virtualcard.createtransport(vcard))
+                api_pcsc.connectreader()
+                card()
+                auth()
+                cache = DeployCache(cachepath)
+                self.assertEqual(getstatus(GS_MODULES), [])
+                self.assertTrue(deploy(path, instance, appletaid=module, cache=cache))
+                self.assertEqual(cm.applets[instance]['module'], module)
+
+                x = getstatus(GS_MODULES)[0]
+                self.assertEqual((x['aid'], x['lifecycle'], x['modules']), (pkg, '01', [module]))
+                self.assertEqual(x['version'], version if tlvstatus else '')
+                x = getstatus(GS_APPS, instance)[0]
+                self.assertEqual((x['aid'], x['lifecycle'], x['elf']), (instance, '07', pkg if tlvstatus else ''))
+                self.assertEqual(getstatus(GS_ISD)[0]['aid'], CardManagerAID)
+                self.assertEqual(getstatus(GS_LOADFILES, pkg, tlv=False)[0]['modules'], [])
+
+                loaded = cm.packages[pkg]
+                self.assertFalse(deploy(path, instance, pkg, module, cache=DeployCache(cachepath))) # from the file
+                self.assertTrue(cm.packages[pkg] is loaded) # no DELETE, LOAD, INSTALL
+                self.assertTrue(deploy(path, instance, pkg, module, privileges='04', cache=cache))
+                self.assertEqual(cm.applets[instance]['privileges'], '04')
+                del cm.applets[instance]
+                self.assertTrue(deploy(path, instance, pkg, module, privileges='04', cache=cache))
+                self.assertTrue(deploy(path, instance, pkg, module, privileges='04', cache=cache, force=True))
+
+                cplc, cm.cplc = cm.cplc, '' # no CPLC, no identifier: deployed every time
+                self.assertEqual(cardid(), '')
+                self.assertTrue(deploy(path, instance, pkg, module, privileges='04', cache=cache))
+                self.assertTrue(deploy(path, instance, pkg, module, privileges='04', cache=cache))
+                self.assertEqual(cache.records.keys(), [cplc])
+                cm.cplc = cplc
+
+                # more than 256 bytes, '6310' & next occurrence
+                instances = [pkg + '%.2X' % i for i in range(0x10, 0x30)]
+                for x in instances:
+                    install(x, pkg, module)
+                response, sw = api_pcsc.send('80F24002024F0000', expectSW='') if tlvstatus else api_pcsc.send('80F24000024F0000', expectSW='')
+                self.assertEqual(sw, '6310')
+                self.assertEqual([x['aid'] for x in getstatus(GS_APPS, pkg)], [instance] + instances)
+
+                card()
+                self.assertRaises(api_pcsc.PCSCException, getstatus) # not authenticated
+                self.assertEqual(cardid(), cm.cplc)
+                os.remove(cachepath)
+        finally:
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+            if os.path.exists(cachepath):
+                os.remove(cachepath)
+
+    def test_scp03kdf(self):
+        ''' SCP03会话密钥与认证密文：AES-CMAC的RFC 4493向量，及固定的SCP03向量 '''
+        # RFC 4493, 4. Test Vectors
+        key = a2b('2B7E151628AED2A6ABF7158809CF4F3C')
+        for m, x in (('', 'BB1D6929E95937287FA37D129B756746'),
+                ('6BC1BEE22E409F96E93D7E117393172A', '070A16B46B4D4144F79BDD9DD04A287C'),
+                ('6BC1BEE22E409F96E93D7E117393172AAE2D8A571E03AC9C9EB76FAC45AF8E5130C81C46A35CE411', 'DFA66747DE9AE63030CA32611497C827')):
+            self.assertEqual(b2a(api_crypto.cmac(api_crypto.AES, key, a2b(m))), x)
+
+        # Amendment D, 6.2.1 & 6.2.2.2-3: derivation data '00'*11 | constant | '00' | L | i | host
+        # challenge | card challenge, computed with the CMAC of OpenSSL, not this module
+        host, card = 'A1B2C3D4E5F60718', '1122334455667788'
+        vectors = (
+            ('404142434445464748494A4B4C4D4E4F', '505152535455565758595A5B5C5D5E5F',
+                'B3B81A830F9ED2074E1DF033D118F6A3', '7B135478547BE0C8F0E48EC120F3D506', '516DB79E47EC3C17A8106F4074CAC80F',
+                '56B1FCAE1B7B8B79', 'AD317A749334B578'),
+            ('404142434445464748494A4B4C4D4E4F505152535455565758595A5B5C5D5E5F',
+                '606162636465666768696A6B6C6D6E6F707172737475767778797A7B7C7D7E7F',
+                '032BD7FC4E10A471B1B2377954F1CB5BAEEFB61A21A76CD4119E2BEB8C26238D',
+                '98C0E065077C47F22D49A8C16B1703C2202928A16D74993479B38982F4948CDE',
+                '9F12033B5B44F87DCAF1E4E2AC8A45058237B1482B2EC91D63C9D54A1D5A7579',
+                '4D55BC7F17A77254', 'C5DED0343C7C562C'),
+            )
+        context = a2b(host + card)
+        for enc, mac, senc, smac, srmac, cardcryptogram, hostcryptogram in vectors:
+            skeys = scp03sessionkeys(a2b(enc), a2b(mac), context)
+            self.assertEqual((b2a(skeys['enc']), b2a(skeys['mac']), b2a(skeys['rmac'])), (senc, smac, srmac))
+            self.assertEqual(b2a(scp03cryptogram(skeys['mac'], SCP03_CARD_CRYPTOGRAM, context)), cardcryptogram)
+            self.assertEqual(b2a(scp03cryptogram(skeys['mac'], SCP03_HOST_CRYPTOGRAM, context)), hostcryptogram)
+
+    def test_scp02(self):
+        ''' SCP02二进制接口与十六进制接口结果一致，比较认证计算的耗时 '''
+        s_enc, s_mac, seq = KEY404F, '4F4E4D4C4B4A49484746454443424140', '002A'
+        host, card = api_general.randhex(8), api_general.randhex(6)
+
+        def hexchain():
+            sk_enc = getEncryptSkey(s_enc, seq)
+            sk_cmac = getCMACSkey(s_mac, seq)
+            cryptogram = api_alg.TDES_Encrypt(host + seq + card + '80' + '00'*7, sk_enc, ecb_mode=False, icv='00'*8)[-16:]
+            pt = '84820100' + '10' + computeHostCryptogram(sk_enc, seq, host, card)
+            return cryptogram, pt + generateCMAC(pt, sk_cmac)
+
+        b_enc, b_mac, b_seq, b_host, b_card = map(a2b, (s_enc, s_mac, seq, host, card))
+        def bytechain():
+            sk_enc = scp02sessionkey(b_enc, SCP02_ENC, b_seq)
+            sk_cmac = scp02sessionkey(b_mac, SCP02_CMAC, b_seq)
+            cryptogram = scp02cryptogram(sk_enc, b_host + b_seq + b_card)
+            pt = '\x84\x82\x01\x00\x10' + scp02cryptogram(sk_enc, b_seq + b_card + b_host)
+            return cryptogram, pt + scp02cmac(sk_cmac, pt)
+
+        cryptogram, apdu = hexchain()
+        self.assertEqual((cryptogram, apdu), tuple(map(b2a, bytechain())))
+        sk_enc, sk_cmac = scp02sessionkey(b_enc, SCP02_ENC, b_seq), scp02sessionkey(b_mac, SCP02_CMAC, b_seq)
+        self.assertEqual(apdu, b2a(scp02extauth(sk_enc, sk_cmac, b_seq, b_card, b_host, '\x01')))
+        self.assertEqual(computerSCP02skey('0182', seq, s_enc), b2a(scp02sessionkey(b_enc, SCP02_ENC, b_seq)))
+
+        n = 2000
+        t1 = min(timeit.repeat(hexchain, number=n, repeat=3))
+        t2 = min(timeit.repeat(bytechain, number=n, repeat=3))
+        LogMessage('SCP02 authentication, hexdigits: %.1f us, binary: %.1f us' % (t1*1e6/n, t2*1e6/n), logging.INFO)
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
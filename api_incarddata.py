@@ -62,13 +62,12 @@ class ApplicationTemplate(object):
 
             tlv: 61184F10A0000000871002FF86FF0289060100FF50045553494D 
         '''
-        t, l, v = unpacktlv(tlv)
-        assert t=='61'
-        length = int(l, 16)
+        node = api_tlv.decodeone(api_tlv.a2b(tlv))
+        assert node.tag=='61'
+        length = len(node.value)
         assert length>=3 and length<=127
-        dit = unpacktlvs2dict(v)
-        self.aid = dit['4F'][2]
-        self.label = dit['50'][2]
+        self.aid = node['4F'].hex()
+        self.label = node['50'].hex()
 
 #----------------------------------------------------------------------------
 class FileControlInformation(object):
@@ -85,15 +84,14 @@ class FileControlInformation(object):
 
             tlv: 62268205422100260283022F00A50AC00100CD02FF00CA01848A01058B032F06018002004C8801F0
         '''
-        t, l, v = unpacktlv(tlv)
-        assert t=='62'
-        dit = unpacktlvs2dict(v)
-        self.parsefiledescriptor(dit['82'])
-        self.parsefileidentifier(dit['83'])
-        self.parsefilesize(dit['80'])
+        node = api_tlv.decodeone(api_tlv.a2b(tlv))
+        assert node.tag=='62'
+        self.parsefiledescriptor(node['82'].triple())
+        self.parsefileidentifier(node['83'].triple())
+        self.parsefilesize(node['80'].triple())
         for x in ('8B', '8C', 'AB'):
-            if x in dit:
-                self.parsesecureattribute(dit[x])
+            if x in node:
+                self.parsesecureattribute(node[x].triple())
                 break
 
     def parsefiledescriptor(self, tlv):
@@ -0,0 +1,305 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with APDU latency metrics.
+
+The module keeps wall-clock latency histograms per CLA INS & per APDU name, recorded by the
+api_pcsc sessions. Each kind of APDU has 3 histograms:
+
+    card: the time of the command itself, i.e. the first transmit
+    retry: the time of the automatic GET RESPONSE / 6Cxx round trips, if any
+    host: the time spent in send() outside the card, checks, logging ...
+
+Histograms are log-linear like HdrHistogram, recording a value costs a few integer operations
+& the memory is bounded whatever the number of APDUs, so the metrics can be left on. They can be
+queried at runtime, or dumped as JSON/CSV at the end of a suite:
+
+    api_metrics.METRICS.dumpjson(r'.\\metrics.json')
+
+Values are recorded in microseconds, reported in milliseconds like api_pcsc.
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import csv, json, math, random, logging, unittest, threading, tempfile, os
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+#-------------------------------------------------------------------------------
+# define API
+
+class Histogram(object):
+    ''' A log-linear histogram of non-negative integers, like HdrHistogram.
+
+        Values below 2*10**precision are counted exactly, the bigger ones in buckets whose width
+        doubles with each power of 2, so that 'precision' significant decimal digits are kept.
+    '''
+
+    def __init__(self, precision=2):
+        ''' precision: the number of significant decimal digits, 1 to 5
+        '''
+        n = 1
+        while (1<<n) < 2*10**precision:
+            n += 1
+        self.subbits = n
+        self.subcount = 1<<n
+        self.half = self.subcount>>1
+        self.reset()
+
+    def reset(self):
+        self.counts = {} # bucket index : count
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def index(self, value):
+        ''' Returns the bucket index of value '''
+        if value<self.subcount:
+            return value
+        shift = value.bit_length()-self.subbits
+        return self.subcount + (shift-1)*self.half + (value>>shift) - self.half
+
+    def bounds(self, index):
+        ''' Returns the lowest & highest value of a bucket '''
+        if index<self.subcount:
+            return index, index
+        shift, sub = divmod(index-self.subcount, self.half)
+        shift, sub = shift+1, sub+self.half
+        return sub<<shift, ((sub+1)<<shift)-1
+
+    def record(self, value, n=1):
+        ''' Count value n times '''
+        value = int(value) if value>0 else 0
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0)+n
+        if not self.count or value<self.min:
+            self.min = value
+        if value>self.max:
+            self.max = value
+        self.count += n
+        self.total += value*n
+
+    def merge(self, other):
+        ''' Add the counts of another histogram of the same precision '''
+        assert other.subbits==self.subbits
+        for i, n in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0)+n
+        if other.count:
+            self.min = min(self.min, other.min) if self.count else other.min
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return float(self.total)/self.count if self.count else 0.0
+
+    def percentile(self, p):
+        ''' Returns the value below which p percent of values fall, the highest equivalent value
+            of its bucket like HdrHistogram.
+        '''
+        if not self.count:
+            return 0
+        target = max(1, int(math.ceil(p*self.count/100.0)))
+        n = 0
+        for i in sorted(self.counts):
+            n += self.counts[i]
+            if n>=target:
+                return min(self.bounds(i)[1], self.max)
+        return self.max
+
+    def buckets(self):
+        ''' Returns a list of (lowest, highest, count), sorted '''
+        return [self.bounds(i)+(self.counts[i],) for i in sorted(self.counts)]
+
+    def todict(self, scale=0.001):
+        ''' Returns count, min, max, mean & percentiles, values multiplied by scale (us to ms) '''
+        dit = {
+                'count' : self.count,
+                'min' : self.min*scale,
+                'max' : self.max*scale,
+                'mean' : self.mean()*scale,
+                }
+        for p in PERCENTILES:
+            dit['p%s' % ('%g' % p).replace('.', '')] = self.percentile(p)*scale
+        return dit
+
+
+class APDUStats(object):
+    ''' The histograms of one kind of APDU, see the module document. '''
+
+    def __init__(self, precision=2):
+        self.card = Histogram(precision)
+        self.retry = Histogram(precision)
+        self.host = Histogram(precision)
+
+    def todict(self):
+        return {'card' : self.card.todict(), 'retry' : self.retry.todict(), 'host' : self.host.todict(), }
+
+
+class Metrics(object):
+    ''' APDU metrics, per CLA INS & per name. Thread safe, shared by all sessions by default.
+    '''
+
+    def __init__(self, precision=2):
+        self.precision = precision
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.ins = {} # 'CLA INS' as hexdigits, like '00A4' : APDUStats
+            self.names = {} # APDU name : APDUStats
+
+    def record(self, header, name, card, retry=None, host=None):
+        ''' Record the latency of an APDU, in ms.
+
+            header: CLA INS as hexdigits, like '00A4'
+            name: APDU name, may be empty
+            card: the time of the first transmit
+            retry: the time of the GET RESPONSE / 6Cxx round trips, None if not any
+            host: the time spent outside the card, None if unknown
+        '''
+        card = int(card*1000)
+        retry = int(retry*1000) if retry is not None else None
+        host = int(host*1000) if host is not None else None
+        with self.lock:
+            for table, key in ((self.ins, header), (self.names, name)):
+                if not key:
+                    continue
+                x = table.get(key)
+                if x is None:
+                    x = table[key] = APDUStats(self.precision)
+                x.card.record(card)
+                if retry is not None:
+                    x.retry.record(retry)
+                if host is not None:
+                    x.host.record(host)
+
+    def get(self, header='', name=''):
+        ''' Returns the APDUStats of a CLA INS or a name, None if never recorded '''
+        with self.lock:
+            return self.ins.get(header) if header else self.names.get(name)
+
+    def snapshot(self):
+        ''' Returns {'ins' : {CLA INS : stats}, 'name' : {name : stats}}, stats as APDUStats.todict() '''
+        with self.lock:
+            return {
+                    'ins' : dict((k, v.todict()) for k, v in self.ins.items()),
+                    'name' : dict((k, v.todict()) for k, v in self.names.items()),
+                    }
+
+    def rows(self):
+        ''' Returns a list of flat rows, one per (key, histogram), for CSV or a report '''
+        lst = []
+        keys = ['count', 'min', 'mean'] + ['p%s' % ('%g' % p).replace('.', '') for p in PERCENTILES] + ['max']
+        snapshot = self.snapshot()
+        for kind in ('ins', 'name'):
+            for key in sorted(snapshot[kind]):
+                stats = snapshot[kind][key]
+                for x in ('card', 'retry', 'host'):
+                    dit = stats[x]
+                    if dit['count']:
+                        lst.append([kind, key, x] + [dit[k] for k in keys])
+        return [['kind', 'key', 'time'] + keys] + lst
+
+    def dumpjson(self, path):
+        with open(path, 'wb') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+    def dumpcsv(self, path):
+        with open(path, 'wb') as f:
+            w = csv.writer(f)
+            for row in self.rows():
+                w.writerow([x.encode('utf-8') if isinstance(x, unicode) else x for x in row])
+
+    def report(self):
+        ''' Returns a text table, latency in ms '''
+        rows = self.rows()
+        lst = ['%-5s %-24s %-6s ' % tuple(rows[0][:3]) + ' '.join(['%9s' % x for x in rows[0][3:]])]
+        for row in rows[1:]:
+            lst.append('%-5s %-24s %-6s %9d ' % tuple(row[:4]) + ' '.join(['%9.3f' % x for x in row[4:]]))
+        return '\n'.join(lst)
+
+
+METRICS = Metrics() # recorded by api_pcsc sessions by default
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def test_histogram(self):
+        ''' 百分位数的相对误差应小于1% '''
+        h = Histogram(2)
+        lst = [int(random.expovariate(1.0/5000)) for i in range(20000)] + [0, 3600*1000*1000]
+        for x in lst:
+            h.record(x)
+        lst.sort()
+        for p in (50, 90, 99, 99.9, 100):
+            exact = lst[int(math.ceil(p*len(lst)/100.0))-1]
+            self.assertTrue(abs(h.percentile(p)-exact) <= exact*0.01, (p, h.percentile(p), exact))
+        self.assertEqual((h.min, h.max, h.count), (0, 3600*1000*1000, len(lst)))
+        self.assertTrue(len(h.counts) < 2000)
+
+        h1 = Histogram(2)
+        h1.record(7, 3)
+        h1.merge(h)
+        self.assertEqual(h1.count, h.count+3)
+        self.assertEqual(h1.percentile(0.001), 0)
+
+    def test_send(self):
+        ''' 在虚拟卡上统计send()的耗时，导出JSON/CSV '''
+        import api_pcsc, api_virtualcard
+        old = api_pcsc.settransport(api_virtualcard.createtransport())
+        session = api_pcsc.ReaderSession()
+        metrics = Metrics()
+        session.setmetrics(metrics)
+        oldsession = api_pcsc.bindsession(session)
+        try:
+            api_pcsc.connectreader()
+            for i in range(100):
+                api_pcsc.send('00A40004022FE2', name='select EF_ICCID')
+                api_pcsc.send('00B000000A')
+            api_pcsc.send_batch(['00B000000A']*10)
+        finally:
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+
+        a4, b0 = metrics.get('00A4'), metrics.get('00B0')
+        self.assertEqual((a4.card.count, a4.retry.count, a4.host.count), (100, 100, 100))
+        self.assertEqual((b0.card.count, b0.retry.count, b0.host.count), (110, 0, 100))
+        self.assertEqual(metrics.get(name='select EF_ICCID').card.count, 100)
+        Logger.info('\n' + metrics.report())
+
+        path = tempfile.mktemp()
+        try:
+            metrics.dumpjson(path)
+            with open(path, 'rb') as f:
+                dit = json.load(f)
+            self.assertEqual(dit['ins']['00A4']['card']['count'], 100)
+            metrics.dumpcsv(path)
+            with open(path, 'rb') as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(len(rows), 1+3+2+3)
+        finally:
+            os.remove(path)
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
@@ -0,0 +1,478 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with reader & card monitoring.
+
+The module provides a background monitor which keeps a live table of readers & cards, and
+fires events when a reader is attached/detached or a card is inserted/removed. Test runs can
+start as soon as a card is seated, instead of after connectreader() scanning all readers.
+
+Built on the semantics of SCardGetStatusChange, through a backend so that it can be tested
+without any reader, see ScriptedBackend.
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import time, logging, unittest, threading, traceback, collections, Queue
+import smartcard.scard
+import api_pcsc
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+SCARD_STATE_UNAWARE = 0x0000
+SCARD_STATE_IGNORE = 0x0001
+SCARD_STATE_CHANGED = 0x0002
+SCARD_STATE_UNKNOWN = 0x0004
+SCARD_STATE_UNAVAILABLE = 0x0008
+SCARD_STATE_EMPTY = 0x0010
+SCARD_STATE_PRESENT = 0x0020
+SCARD_STATE_MUTE = 0x0200
+
+PNP_NOTIFICATION = r'\\?PnP?\Notification'
+
+# SCardGetStatusChange errors, as unsigned
+SCARD_E_CANCELLED = 0x80100002
+SCARD_E_INVALID_HANDLE = 0x80100003
+SCARD_E_UNKNOWN_READER = 0x80100009
+SCARD_E_TIMEOUT = 0x8010000A
+SCARD_E_NO_SERVICE = 0x8010001D
+SCARD_E_SERVICE_STOPPED = 0x8010001E
+
+READER_ADDED = 'reader-added'
+READER_REMOVED = 'reader-removed'
+CARD_INSERTED = 'card-inserted'
+CARD_REMOVED = 'card-removed'
+
+MonitorEvent = collections.namedtuple('MonitorEvent', 'kind reader atr time')
+
+
+def ispresent(eventstate):
+    ''' Returns True if a powerable card is present, according to the event state. '''
+    return bool(eventstate & SCARD_STATE_PRESENT) and not (eventstate & SCARD_STATE_MUTE)
+
+
+class MonitorException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+#-------------------------------------------------------------------------------
+class Backend(object):
+    ''' Abstract backend of ReaderMonitor.
+    '''
+
+    def listreaders(self):
+        ''' Returns a list of reader names. '''
+        raise NotImplementedError
+
+    def getstatuschange(self, states, timeout):
+        ''' Blocks until the state of any reader differs from states, or timeout.
+
+            states: a list of (reader, currentstate) tuples
+            timeout: in milliseconds
+
+            Returns a list of (reader, eventstate, atr) tuples of the readers changed, empty
+            if timeout. atr is a hexdigits string, empty if no card.
+        '''
+        raise NotImplementedError
+
+    def cancel(self):
+        ''' Wakes up a blocking getstatuschange(). '''
+        pass
+
+
+class PCSCBackend(Backend):
+    ''' Backend of PC/SC, via smartcard.scard.
+
+        The PnP pseudo reader is watched for readers plugged, unless the system reports it
+        unknown. A reader removed while waiting is left to the next listreaders(); if the
+        service stops, the context is established again on the next call.
+    '''
+
+    def __init__(self):
+        self.hcontext = None
+        self.establish()
+        self.pnp = SCARD_STATE_UNAWARE # state of the PnP pseudo reader, None if not supported
+
+    def establish(self):
+        hresult, hcontext = smartcard.scard.SCardEstablishContext(smartcard.scard.SCARD_SCOPE_USER)
+        if hresult != smartcard.scard.SCARD_S_SUCCESS:
+            raise MonitorException('Failed to establish context: %s' % smartcard.scard.SCardGetErrorMessage(hresult))
+        self.hcontext = hcontext
+
+    def listreaders(self):
+        if self.hcontext is None:
+            self.establish()
+        hresult, readers = smartcard.scard.SCardListReaders(self.hcontext, [])
+        if hresult != smartcard.scard.SCARD_S_SUCCESS:
+            return [] # SCARD_E_NO_READERS_AVAILABLE
+        return list(readers)
+
+    def pnpsupported(self):
+        ''' Returns False if the system doesn't know the PnP pseudo reader '''
+        hresult, newstates = smartcard.scard.SCardGetStatusChange(self.hcontext, 0, [(PNP_NOTIFICATION, SCARD_STATE_UNAWARE)])
+        if hresult & 0xFFFFFFFF == SCARD_E_UNKNOWN_READER:
+            return False
+        return not (hresult == smartcard.scard.SCARD_S_SUCCESS and newstates and newstates[0][1] & SCARD_STATE_UNKNOWN)
+
+    def getstatuschange(self, states, timeout):
+        if self.hcontext is None:
+            self.establish()
+        lst = list(states)
+        if self.pnp is not None:
+            lst.append((PNP_NOTIFICATION, self.pnp))
+        if not lst:
+            time.sleep(timeout/1000.0)
+            return []
+
+        hresult, newstates = smartcard.scard.SCardGetStatusChange(self.hcontext, timeout, lst)
+        error = hresult & 0xFFFFFFFF
+        if error in (SCARD_E_TIMEOUT, SCARD_E_CANCELLED):
+            return []
+        elif error == SCARD_E_UNKNOWN_READER:
+            if self.pnp is not None and not self.pnpsupported(): # not supported by all systems
+                Logger.info('PnP notification not supported, readers plugged are found by polling')
+                self.pnp = None
+            return [] # or a reader removed, see listreaders()
+        elif error in (SCARD_E_NO_SERVICE, SCARD_E_SERVICE_STOPPED, SCARD_E_INVALID_HANDLE):
+            smartcard.scard.SCardReleaseContext(self.hcontext)
+            self.hcontext = None
+            raise MonitorException('Failed to get status change, the context is established again: %s' % smartcard.scard.SCardGetErrorMessage(hresult))
+        elif hresult != smartcard.scard.SCARD_S_SUCCESS:
+            raise MonitorException('Failed to get status change: %s' % smartcard.scard.SCardGetErrorMessage(hresult))
+
+        changes = []
+        for x in newstates:
+            reader, eventstate, atr = x[0], x[1], (x[2] if len(x)>2 else [])
+            if reader == PNP_NOTIFICATION:
+                self.pnp = None if eventstate & SCARD_STATE_UNKNOWN else eventstate & ~SCARD_STATE_CHANGED
+            elif eventstate & SCARD_STATE_CHANGED:
+                changes.append((reader, eventstate, api_pcsc.tohexstring(atr) if ispresent(eventstate) else ''))
+        return changes
+
+    def cancel(self):
+        if self.hcontext is not None:
+            smartcard.scard.SCardCancel(self.hcontext)
+
+
+class ScriptedBackend(Backend):
+    ''' A fake backend which replays a script of snapshots, for testing without any reader.
+
+        snapshots: a list of dictionaries, {reader: atr}. atr is a hexdigits string, or None if
+                   no card in the reader. Each getstatuschange() moves to the next snapshot.
+    '''
+
+    def __init__(self, snapshots, delay=0.0):
+        self.snapshots = collections.deque(snapshots)
+        self.current = self.snapshots.popleft() if self.snapshots else {}
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def insert(self, reader, atr):
+        ''' Append a snapshot: a card inserted into reader. '''
+        self.push(reader, atr)
+
+    def remove(self, reader):
+        ''' Append a snapshot: the card removed from reader. '''
+        self.push(reader, None)
+
+    def push(self, reader, atr):
+        with self.lock:
+            last = dict(self.snapshots[-1] if self.snapshots else self.current)
+            last[reader] = atr
+            self.snapshots.append(last)
+
+    def listreaders(self):
+        with self.lock:
+            return sorted(self.current.keys())
+
+    def getstatuschange(self, states, timeout):
+        time.sleep(self.delay)
+        with self.lock:
+            if self.snapshots:
+                self.current = self.snapshots.popleft()
+            current = dict(self.current)
+
+        changes = []
+        for reader, state in states:
+            if reader not in current:
+                eventstate = SCARD_STATE_UNAVAILABLE
+                atr = ''
+            elif current[reader] is None:
+                eventstate = SCARD_STATE_EMPTY
+                atr = ''
+            else:
+                eventstate = SCARD_STATE_PRESENT
+                atr = current[reader]
+            if state == SCARD_STATE_UNAWARE or eventstate != (state & (SCARD_STATE_UNAVAILABLE|SCARD_STATE_EMPTY|SCARD_STATE_PRESENT)):
+                changes.append((reader, eventstate|SCARD_STATE_CHANGED, atr))
+
+        if not changes:
+            time.sleep(timeout/1000.0)
+        return changes
+
+
+#-------------------------------------------------------------------------------
+class ReaderMonitor(threading.Thread):
+    ''' Keeps a live table of readers & cards in a background thread.
+
+        Events (see MonitorEvent) are put into the queue 'events', and passed to all observers
+        added by addobserver(). Observers are called in the monitor thread, keep them short.
+    '''
+
+    def __init__(self, backend=None, timeout=500):
+        ''' backend: PCSCBackend() if omitted
+            timeout: in milliseconds, the longest time of a getstatuschange() call
+        '''
+        threading.Thread.__init__(self, name='ReaderMonitor')
+        self.daemon = True
+        self.backend = backend if backend else PCSCBackend()
+        self.timeout = timeout
+        self.table = collections.OrderedDict() # {reader: atr}, atr is '' if no card
+        self.states = {} # {reader: the last event state}
+        self.events = Queue.Queue()
+        self.observers = []
+        self.lock = threading.Condition()
+        self.stopped = threading.Event()
+
+    def addobserver(self, observer):
+        ''' observer: a callable, observer(event) '''
+        self.observers.append(observer)
+
+    def removeobserver(self, observer):
+        if observer in self.observers:
+            self.observers.remove(observer)
+
+    def gettable(self):
+        ''' Returns a copy of the table, {reader: atr}. '''
+        with self.lock:
+            return collections.OrderedDict(self.table)
+
+    def getreaderswithcard(self):
+        ''' Returns a list of readers with a card inserted. '''
+        with self.lock:
+            return [r for r, atr in self.table.items() if atr]
+
+    def fire(self, kind, reader, atr=''):
+        event = MonitorEvent(kind, reader, atr, time.time())
+        Logger.debug('%s: %s %s' % (kind, reader, atr))
+        self.events.put(event)
+        for observer in list(self.observers):
+            try:
+                observer(event)
+            except Exception:
+                Logger.error('Observer %s failed:\n%s' % (observer, traceback.format_exc()))
+
+    def poll(self, timeout):
+        ''' Wait for one round of status change & update the table. Called by run().
+        '''
+        readers = self.backend.listreaders()
+
+        events = []
+        with self.lock:
+            for r in [r for r in self.table if r not in readers]:
+                atr = self.table.pop(r)
+                self.states.pop(r, None)
+                if atr:
+                    events.append((CARD_REMOVED, r, atr))
+                events.append((READER_REMOVED, r, ''))
+            for r in [r for r in readers if r not in self.table]:
+                self.table[r] = ''
+                events.append((READER_ADDED, r, ''))
+            self.lock.notify_all()
+        for kind, reader, atr in events:
+            self.fire(kind, reader, atr)
+
+        states = [(r, self.states.get(r, SCARD_STATE_UNAWARE)) for r in readers]
+        changes = self.backend.getstatuschange(states, timeout)
+
+        events = []
+        with self.lock:
+            for reader, eventstate, atr in changes:
+                if reader not in self.table:
+                    continue
+                self.states[reader] = eventstate & ~SCARD_STATE_CHANGED
+                old = self.table[reader]
+                new = atr if ispresent(eventstate) else ''
+                if old and old != new:
+                    events.append((CARD_REMOVED, reader, old))
+                if new and old != new:
+                    events.append((CARD_INSERTED, reader, new))
+                self.table[reader] = new
+            self.lock.notify_all()
+
+        for kind, reader, atr in events:
+            self.fire(kind, reader, atr)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll(self.timeout)
+            except Exception:
+                Logger.error(traceback.format_exc())
+                self.stopped.wait(1.0)
+
+    def stop(self):
+        ''' Stop monitoring, waits for the thread to exit. '''
+        self.stopped.set()
+        self.backend.cancel()
+        if self.is_alive():
+            self.join()
+
+    def waitforcard(self, reader=None, timeout=None):
+        ''' Blocks until a card is present, in reader or in any reader if omitted.
+
+            Returns (reader, atr), or None if timeout.
+        '''
+        t1 = (time.time() + timeout) if timeout is not None else None
+        with self.lock:
+            while True:
+                for r, atr in self.table.items():
+                    if atr and (reader is None or r == reader):
+                        return r, atr
+                if t1 is None:
+                    self.lock.wait(1.0)
+                else:
+                    remaining = t1 - time.time()
+                    if remaining <= 0:
+                        return None
+                    self.lock.wait(remaining)
+
+
+def connect(monitor, session=None, cold=True, timeout=None):
+    ''' Wait for a card seated in any reader known by monitor, then connect it directly.
+
+        session: a api_pcsc.ReaderSession, the session of the calling thread if omitted.
+
+        Returns (reader, atr)
+    '''
+    x = monitor.waitforcard(timeout=timeout)
+    if not x:
+        raise MonitorException('Timeout! No card inserted in %s seconds' % timeout)
+    reader, atr = x
+    session = session if session else api_pcsc.getsession()
+    session.connect(reader, cold)
+    return reader, atr
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def test_scripted_insertion(self):
+        ''' 用ScriptedBackend模拟读卡器插拔、卡片插拔 '''
+        backend = ScriptedBackend([
+            {},
+            {'Reader 0': None},
+            {'Reader 0': '3B00'},
+            {'Reader 0': '3B00', 'Reader 1': None},
+            {'Reader 0': None, 'Reader 1': '3B01'},
+            {'Reader 1': '3B01'},
+            ])
+        monitor = ReaderMonitor(backend, timeout=10)
+        lst = []
+        monitor.addobserver(lst.append)
+        for i in range(8):
+            monitor.poll(monitor.timeout)
+
+        kinds = [(x.kind, x.reader, x.atr) for x in lst]
+        self.assertEqual(kinds, [
+            (READER_ADDED, 'Reader 0', ''),
+            (CARD_INSERTED, 'Reader 0', '3B00'),
+            (READER_ADDED, 'Reader 1', ''),
+            (CARD_REMOVED, 'Reader 0', '3B00'),
+            (CARD_INSERTED, 'Reader 1', '3B01'),
+            (READER_REMOVED, 'Reader 0', ''),
+            ])
+        self.assertEqual(monitor.gettable(), {'Reader 1': '3B01'})
+        self.assertEqual(monitor.getreaderswithcard(), ['Reader 1'])
+        self.assertEqual(monitor.events.qsize(), len(lst))
+
+    def test_waitforcard(self):
+        backend = ScriptedBackend([{'Reader 0': None}], delay=0.005)
+        monitor = ReaderMonitor(backend, timeout=10)
+        monitor.start()
+        try:
+            self.assertTrue(monitor.waitforcard(timeout=0.1) is None)
+            backend.insert('Reader 0', '3B02')
+            self.assertEqual(monitor.waitforcard(timeout=5), ('Reader 0', '3B02'))
+            event = monitor.events.get(timeout=5)
+            while event.kind != CARD_INSERTED:
+                event = monitor.events.get(timeout=5)
+            self.assertEqual(event.atr, '3B02')
+        finally:
+            monitor.stop()
+        self.assertFalse(monitor.is_alive())
+
+    def test_pcscbackend(self):
+        ''' PnP不支持时才停止PnP通知；读卡器拔出、服务重启时继续监视 '''
+        results = [] # of SCardGetStatusChange, in order
+        calls = []
+        def getstatuschange(hcontext, timeout, states):
+            calls.append((hcontext, [r for r, state in states]))
+            return results.pop(0)
+        def establish(scope):
+            calls.append('establish')
+            return smartcard.scard.SCARD_S_SUCCESS, len(calls)
+        patches = {
+                'SCardEstablishContext' : establish,
+                'SCardReleaseContext' : lambda hcontext: smartcard.scard.SCARD_S_SUCCESS,
+                'SCardGetStatusChange' : getstatuschange,
+                'SCardGetErrorMessage' : lambda hresult: '%.8X' % hresult,
+                }
+        old = dict([(k, getattr(smartcard.scard, k, None)) for k in patches])
+        for k, v in patches.items():
+            setattr(smartcard.scard, k, v)
+        try:
+            backend = PCSCBackend()
+            states = [('Reader 0', SCARD_STATE_EMPTY)]
+
+            # a reader removed while waiting: PnP still watched
+            results[:] = [(SCARD_E_UNKNOWN_READER, []), (SCARD_E_TIMEOUT, [(PNP_NOTIFICATION, 0)])]
+            self.assertEqual(backend.getstatuschange(states, 10), [])
+            self.assertEqual(backend.pnp, SCARD_STATE_UNAWARE)
+
+            # the service stopped: the context established again
+            results[:] = [(SCARD_E_NO_SERVICE, [])]
+            self.assertRaises(MonitorException, backend.getstatuschange, states, 10)
+            self.assertEqual(backend.pnp, SCARD_STATE_UNAWARE)
+            results[:] = [(smartcard.scard.SCARD_S_SUCCESS, [('Reader 0', SCARD_STATE_PRESENT|SCARD_STATE_CHANGED, [0x3B, 0x00]),
+                    (PNP_NOTIFICATION, 0x10000)])]
+            self.assertEqual(backend.getstatuschange(states, 10), [('Reader 0', SCARD_STATE_PRESENT|SCARD_STATE_CHANGED, '3B00')])
+            self.assertEqual(calls[-2], 'establish')
+            self.assertEqual(backend.pnp, 0x10000)
+
+            results[:] = [(SCARD_E_CANCELLED, [])]
+            self.assertEqual(backend.getstatuschange(states, 10), [])
+            self.assertEqual(backend.pnp, 0x10000)
+
+            # PnP unknown to the system
+            results[:] = [(SCARD_E_UNKNOWN_READER, []), (SCARD_E_UNKNOWN_READER, [])]
+            self.assertEqual(backend.getstatuschange(states, 10), [])
+            self.assertEqual(backend.pnp, None)
+            results[:] = [(SCARD_E_TIMEOUT, [])]
+            backend.getstatuschange(states, 10)
+            self.assertEqual(calls[-1][1], ['Reader 0'])
+        finally:
+            for k, v in old.items():
+                if v is None:
+                    delattr(smartcard.scard, k)
+                else:
+                    setattr(smartcard.scard, k, v)
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
@@ -14,11 +14,12 @@ Copyright 2016 XH Smart Card Co,. Ltd
 Author: wg@china-xinghan.com
 """
 
-import binascii, time, logging, unittest
+import binascii, time, timeit, logging, unittest, threading, traceback, Queue, StringIO
 import smartcard
 import smartcard.scard
 import api_util
 import api_config
+import api_metrics
 
 #-------------------------------------------------------------------------------
 # import utility
@@ -40,8 +41,13 @@ def a2blist(lst) :
 def tohexstring(lst) :
     ''' Transfer a list of integer to a string, for example: tohexstring([0x3F, 0x00]) = '3F00'
     '''
-    s = ''.join(map(lambda x:'%.2X'%x, lst))
-    return s
+    return binascii.b2a_hex(bytearray(lst)).upper()
+
+
+def tobytes(apdu) :
+    ''' Transfer a hexdigits string, without spaces, to a list of integer. A faster toBytes().
+    '''
+    return list(bytearray(a2b(apdu)))
 
 #-------------------------------------------------------------------------------
 # define own Exception class
@@ -58,12 +64,15 @@ class PCSCException(Exception):
 # define global variable
 Logger = logging.getLogger(__name__)
 
+# default settings of new sessions
 autoGetResponse = api_config.CONFIG.getboolean(__name__, 'autogetresponse')
 stopOnError = api_config.CONFIG.getboolean(__name__, 'stoponerror')
+useMetrics = api_config.CONFIG.getboolean(__name__, 'metrics') if api_config.CONFIG.has_option(__name__, 'metrics') else True
+transportName = api_config.CONFIG.get(__name__, 'transport') if api_config.CONFIG.has_option(__name__, 'transport') else 'pcsc'
+keepConnection = api_config.CONFIG.getboolean(__name__, 'keepconnection') if api_config.CONFIG.has_option(__name__, 'keepconnection') else False
+warmReset = api_config.CONFIG.getboolean(__name__, 'warmreset') if api_config.CONFIG.has_option(__name__, 'warmreset') else False
 
-CONNECTION = None # the reader conncection, use for all operation on smartcard
-
-ditLastAPDU = {
+EMPTY_APDU = {
     'cla' : '',
     'ins' : '',
     'p1' : '',
@@ -82,21 +91,60 @@ ditLastAPDU = {
     'name' : '',
     'apdu' : '',
     'time' : 0,
+    'retrytime' : 0,
+    'hosttime' : 0,
         }
 
-def getconnection():
-    return CONNECTION
+# wall-clock timer, time.clock() is CPU time on Linux
+timer = timeit.default_timer
 
-def setconnection(x):
-    global CONNECTION
-    CONNECTION = x
 
-def setlastapdu(dit):
-    global ditLastAPDU
-    ditLastAPDU = dit
+#-------------------------------------------------------------------------------
+# define transport
+
+class PCSCTransport(object):
+    ''' Transport via PC/SC, the default one.
+
+        A transport provides readers(), each reader provides createConnection(). The connection
+        provides connect(disposition), disconnect(), getATR() & transmit(), like pyscard.
+        See api_virtualcard.VirtualTransport for a transport without any hardware.
+    '''
+
+    # exceptions raised by connect() when no card in the reader
+    NoCardErrors = (smartcard.Exceptions.NoCardException, smartcard.Exceptions.CardConnectionException)
+
+    def readers(self):
+        return smartcard.System.readers()
+
+    def __str__(self):
+        return 'PC/SC'
 
-def getlastapdu(dit):
-    return ditLastAPDU
+
+TRANSPORT = None # used by all sessions, created on first use, see gettransport()
+
+def gettransport():
+    ''' Returns the transport of all sessions. The first call creates the one named by
+        'transport' in config.ini, 'pcsc' (default) or 'virtual'.
+    '''
+    global TRANSPORT
+    if TRANSPORT is None:
+        if transportName == 'virtual':
+            import api_virtualcard # api_virtualcard imports this module, so import it here
+            TRANSPORT = api_virtualcard.createtransport()
+        else:
+            TRANSPORT = PCSCTransport()
+        Logger.debug('transport: %s' % TRANSPORT)
+    return TRANSPORT
+
+def settransport(transport):
+    ''' Replace the transport of all sessions, for example by api_virtualcard.VirtualTransport.
+
+        Returns the previous transport.
+    '''
+    global TRANSPORT
+    old, TRANSPORT = TRANSPORT, transport
+    Logger.debug('transport: %s' % transport)
+    return old
 
 
 #-------------------------------------------------------------------------------
@@ -107,89 +155,120 @@ def getreaderlist():
         Returns a list, for example, ['OMNIKEY CardMan 5x21 0', 'OMNIKEY CardMan 5x21-CL 0']
     '''
     try:
-        return smartcard.System.readers() # will raise exceptions if no reader attatched
+        return gettransport().readers() # will raise exceptions if no reader attatched
     except:
         return []
 
 
-def disconnect(cold=True):
-    ''' disconnect with the card
-    '''
-    disposition = smartcard.scard.SCARD_UNPOWER_CARD if cold else smartcard.scard.SCARD_RESET_CARD
+def getdisposition(cold=True):
+    return smartcard.scard.SCARD_UNPOWER_CARD if cold else smartcard.scard.SCARD_RESET_CARD
 
-    conn = getconnection()
-    if conn:
-        conn.disposition = disposition
-        conn.disconnect()
-        # Exception AttributeError: AttributeError("'NoneType' object has no attribute 'se
-        # tChanged'",) in <bound method PCSCCardConnection.__del__ of <smartcard.pcsc.PCSC
-        # CardConnection.PCSCCardConnection instance at 0x026369E0>> ignored
-        #conn = None
-        setconnection(None)
+
+def resetconnection(conn, disposition):
+    ''' Reset the card of an established connection. SCardReconnect if the connection supports
+        it (pyscard 2), keeping the handle, otherwise a 'disconnect' & a 'connect'.
+    '''
+    conn.disposition = disposition
+    reconnect = getattr(conn, 'reconnect', None)
+    if reconnect:
+        reconnect(disposition=disposition)
     else:
-        pass
+        conn.disconnect()
+        conn.connect(disposition=disposition)
 
-    return
 
+def getconnprotocol(conn):
+    ''' Returns the protocol negotiated, SCARD_PROTOCOL_T0/T1, None if unknown '''
+    getprotocol = getattr(conn, 'getProtocol', None)
+    return getprotocol() if getprotocol else None
 
-def getatr():
-    ''' returns ATR as hexdigits string '''
-    conn = getconnection()
-    if conn:
-        return ''.join(['%.2X'%x for x in conn.getATR()]) if conn else ''
-    else:
-        raise PCSCException('No existed connection! Please connect reader!')
 
+class CachedConnection(object):
+    ''' A connection kept open in the ConnectionCache, with its ATR & protocol negotiated. '''
 
-def connectreader(name='', cold=True):
-    ''' Connect the specific reader.
-        name:   string, reader name, example: 'OMNIKEY CardMan 5x21 0'. If not given, try to
-                connect anyone avaiable.
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection
+        self.session = None # the session using it, None if idle
+        self.atr = ''
+        self.protocol = None
+        self.connects = 1 # full connections, i.e. reader enumeration & createConnection
+        self.reuses = 0
+        self.update()
+
+    def __str__(self):
+        return '%s, ATR %s, protocol %s, reused %d times' % (self.name, self.atr, self.protocol, self.reuses)
+
+    def update(self):
+        ''' Record the ATR & protocol, after a connect or reset '''
+        self.atr = tohexstring(self.connection.getATR())
+        self.protocol = getconnprotocol(self.connection)
+
+
+class ConnectionCache(object):
+    ''' Connections kept open between connectreader() & disconnect(), keyed by reader name.
+
+        Test suites connect in setUpClass & disconnect in tearDownClass, with 'keepconnection' in
+        config.ini, the next connectreader() reuses the connection & only resets the card,
+        instead of enumerating readers & creating a connection again. Thread safe, a connection
+        is used by one session at a time.
     '''
-    name = name if name else api_config.get_default_pcsc_reader_name()
-    disposition = smartcard.scard.SCARD_UNPOWER_CARD if cold else smartcard.scard.SCARD_RESET_CARD
-    conn = None
-    if name:
-        for x in smartcard.System.readers():
-            if str(x) == name:
-                try:
-                    conn = x.createConnection()
-                    conn.connect(disposition=disposition)
-                except Exception as e:
-                    raise PCSCException(str(e))
-                break # if connected
-    else: # not specified, so instead we try to connect anyone avaiable
-        for x in smartcard.System.readers():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # reader name : CachedConnection
+
+    def acquire(self, name, session):
+        ''' Returns the idle CachedConnection of reader name, or of any reader if name is empty,
+            None if not any. It's in use by session until released.
+        '''
+        with self.lock:
+            for x in ([self.entries.get(name)] if name else self.entries.values()):
+                if x and x.session is None:
+                    x.session = session
+                    return x
+
+    def add(self, name, connection, session):
+        with self.lock:
+            x = self.entries[name] = CachedConnection(name, connection)
+            x.session = session
+            return x
+
+    def find(self, connection):
+        with self.lock:
+            for x in self.entries.values():
+                if x.connection is connection:
+                    return x
+
+    def release(self, connection):
+        ''' Make the connection idle, returns False if not cached '''
+        x = self.find(connection)
+        if x:
+            x.session = None
+        return bool(x)
+
+    def remove(self, connection):
+        with self.lock:
+            for k, x in self.entries.items():
+                if x.connection is connection:
+                    del self.entries[k]
+
+    def clear(self, cold=True):
+        ''' Disconnect & forget all connections '''
+        with self.lock:
+            lst, self.entries = self.entries.values(), {}
+        for x in lst:
             try:
-                conn = x.createConnection()
-                conn.connect(disposition=disposition)
-            except smartcard.Exceptions.NoCardException, e:
-                continue
-            except smartcard.Exceptions.CardConnectionException, e:
-                continue
+                x.connection.disposition = getdisposition(cold)
+                x.connection.disconnect()
             except Exception as e:
-                raise PCSCException(str(e))
-            break # if connected
+                Logger.debug('disconnect %s: %s' % (x.name, e))
 
-    setconnection( conn )
-    if not conn:
-        raise PCSCException('Smartcard not found! Please check if already inserted!')
+    def __len__(self):
+        return len(self.entries)
 
 
-def reset(cold=True):
-    ''' Reset the card, actually combines a 'disconnect' & a 'connect' operation.
-    '''
-    conn = getconnection()
-    disposition = smartcard.scard.SCARD_UNPOWER_CARD if cold else smartcard.scard.SCARD_RESET_CARD
-
-    if conn:
-        conn.disposition = disposition
-        conn.disconnect()
-        conn.connect(disposition=disposition)
-        Logger.debug('reset smart card reader, ' + getatr())
-    else:
-        raise PCSCException('No existed connection! Please connect reader!')
-    return getatr()
+CONNECTIONS = ConnectionCache() # used by sessions with 'keepConnection' set
 
 
 def is61xx(sw, expectSW):
@@ -204,108 +283,772 @@ def formatresponse(response, sw1, sw2, t):
     return '[%s](%.2X%.2X) ; %.3f ms' %(response, sw1, sw2, t)
 
 
-def send(apdu, expectData='', expectSW='', info='', name=''):
-    ''' A shortcut to 'send7816()', designed for user convinence.
+class APDUMessage(object):
+    ''' A command, or a response if response is not None, logged by send(). Formatted only when
+        a handler emits it, so logging costs nothing but this object if no handler does. Handlers
+        may also use the fields directly, see api_trace.TraceHandler.
 
-        apdu: string, like '0084000004'
-        expectData: string, like '01020304', can be empty
-        expectSW: string, like '9000', can be empty
-        info: string, just for display, can be empty
-        name: string, name of APDU
-
-        Returns response data as a string, may be empty(SW not included).
+        command & response are lists of integer.
     '''
-    lst = [apdu, expectData, expectSW]
-    b = a2blist( lst ) # check format
-    if len(apdu) < 10:
-        raise PCSCException( 'Invalid APDU length %d!\n %s' %(len(apdu), apdu) )
-    else:
-        header = apdu[:10]
-        tail = apdu[10:]
-        lgth = int(header[-2:],16) *2
-        if len(tail) != 0:
-            if(len(tail) != lgth) and(len(tail) !=(lgth+2)): # 'Le' may be existed
-                raise PCSCException( 'Invalid APDU length %d!\n %s' %(len(apdu), apdu) )
-
-
-    conn = getconnection()
-
-    Logger.debug(formatapdu(apdu, name, info))
-    t0 = time.clock()
-    res, sw1, sw2 = conn.transmit( toBytes(apdu) )
-
-    t1 = time.clock()
-    t =(t1-t0)*1000
+    __slots__ = ('command', 'response', 'sw1', 'sw2', 'time', 'name', 'info')
 
-    if autoGetResponse:
-        if sw1==0x61 and sw2 != 0x00:
-            apdu1 = '00C00000%.2X' % sw2
-            btes = toBytes(apdu1)
-            res, sw1, sw2 = conn.transmit( btes )
-        if sw1==0x6C and sw2 != 0x00:
-            apdu1 = '%s%.2X' %(apdu[:8], sw2)
-            btes = toBytes(apdu1)
-            res, sw1, sw2 = conn.transmit( btes )
+    def __init__(self, command, response=None, sw1=0, sw2=0, time=0, name='', info=''):
+        self.command = command
+        self.response = response
+        self.sw1 = sw1
+        self.sw2 = sw2
+        self.time = time
+        self.name = name
+        self.info = info
 
+    def __str__(self):
+        if self.response is None:
+            return formatapdu(tohexstring(self.command), self.name, self.info)
+        return formatresponse(tohexstring(self.response), self.sw1, self.sw2, self.time)
 
-    response = tohexstring( res )
-    sw = '%.2X%.2X'%(sw1, sw2)
-
-    Logger.debug(formatresponse(response, sw1, sw2, t))
 
-    dit = {
+def makelastapdu(apdu, response, sw1, sw2, expectData, expectSW, info, name, t, retry, host):
+    ''' Returns the record of an APDU as a dict, see EMPTY_APDU.
+    '''
+    lc, data, le = splitapdu(apdu)
+    return {
             'cla' : apdu[:2],
             'ins' : apdu[2:4],
             'p1' : apdu[4:6],
             'p2' : apdu[6:8],
             'p3' : apdu[8:10],
-            'data' : apdu[10:10+lgth],
-            'lc' : apdu[8:10],
-            'le' : apdu[10+lgth:],
+            'data' : data,
+            'lc' : lc,
+            'le' : le,
             'response' : response,
             'sw1' : '%.2X'%sw1,
             'sw2' : '%.2X'%sw2,
-            'sw' : sw,
+            'sw' : '%.2X%.2X'%(sw1, sw2),
             'expectData' : expectData,
             'expectSW' : expectSW,
             'info' : info,
             'name' : name,
             'apdu' : apdu,
             'time' : t,
+            'retrytime' : retry or 0,
+            'hosttime' : host,
             }
 
-    setlastapdu( dit )
 
-    # check sw
-    if expectSW:
-        if sw!=expectSW and stopOnError:
-            if not is61xx(sw, expectSW):
-                raise PCSCException('Error! Unexpected status words(%s) returned by card:\n%s, %s,(%s)' %(sw, name, info, expectSW))
+def splitapdu(apdu):
+    ''' Split an APDU, short or extended, into its Lc, Data & Le fields as hexdigits. For a short
+        APDU, P3 is taken as Lc. See ISO/IEC 7816-4, 5.1 Command-response pairs.
 
-    # check response
-    if expectData:
-        if response!=expectData and stopOnError:
-            raise PCSCException('Error! Unexpected response-data returned by card:\n%s\n%s, %s, [%s]' %(response, name, info, expectData))
+        splitapdu('00D60000031122330A') = ('03', '112233', '0A')
+        splitapdu('00B00000000200') = ('', '', '000200'), case 2E
+        splitapdu('00D6000000000311223301F4') = ('000003', '112233', '01F4'), case 4E
 
-    # log information
-    if info:
-        #LogMessage(info)
+        Returns None if malformed.
+    '''
+    p3, tail = apdu[8:10], apdu[10:]
+    if p3=='00' and len(tail)>=4: # extended
+        if len(tail)==4:
+            return '', '', apdu[8:]
+        lgth = int(tail[:4], 16)*2
+        if lgth and len(tail) in (4+lgth, 8+lgth):
+            return apdu[8:14], tail[4:4+lgth], tail[4+lgth:]
+        return None
+    lgth = int(p3, 16)*2
+    if tail and len(tail)!=lgth and len(tail)!=lgth+2: # 'Le' may be existed
+        return None
+    return p3, tail[:lgth], tail[lgth:]
+
+
+def checkapdu(apdu, expectData='', expectSW=''):
+    ''' Check the format of an APDU string & its expected values, short or extended.
+
+        Returns the length of 'Data' in hexdigits, as indicated by P3 (Lc if extended).
+    '''
+    lst = [apdu, expectData, expectSW]
+    b = a2blist( lst ) # check format
+    if len(apdu) < 10:
+        raise PCSCException( 'Invalid APDU length %d!\n %s' %(len(apdu), apdu) )
+    fields = splitapdu(apdu)
+    if fields is None:
+        raise PCSCException( 'Invalid APDU length %d!\n %s' %(len(apdu), apdu) )
+    lc, data, le = fields
+    return len(data) if len(lc)==6 else int(apdu[8:10],16) *2
+
+
+def buildapdu(cla, ins, p1, p2, data='', le=None, extended=False):
+    ''' Build an APDU as hexdigits, with extended Lc/Le if asked, or if data is longer than 255
+        bytes, or le bigger than 256.
+
+        cla, ins, p1, p2: string, like '00'
+        data: string, like '3F00'
+        le: integer, the number of bytes expected, 0 for the maximum (256 or 65536), None for no Le
+
+        buildapdu('00', 'B0', '00', '00', le=0x200) = '00B00000000200'
+    '''
+    n = len(data)/2
+    extended = extended or n>0xFF or (le is not None and le>0x100)
+    apdu = cla + ins + p1 + p2
+    if not extended:
+        if n:
+            apdu += '%.2X' % n + data
+        if le is not None:
+            apdu += '%.2X' % (le & 0xFF)
+        elif not n:
+            apdu += '00' # P3 of case 1
+        return apdu
+
+    if n:
+        apdu += '00%.4X' % n + data
+    if le is not None:
+        apdu += ('%.4X' if n else '00%.4X') % (le & 0xFFFF)
+    elif not n:
+        apdu += '00'
+    return apdu
+
+
+def getcapabilities(atr):
+    ''' Get the card capabilities from the historical bytes of ATR, see ISO/IEC 7816-4,
+        8.1.1.2.7 Card capabilities.
+
+        atr: hexdigits, or a list of integer
+
+        Returns a dict: {'chaining' : command chaining, 'extended' : extended Lc & Le}, each
+        True/False, or None if the ATR doesn't tell.
+    '''
+    b = bytearray(a2b(atr)) if isinstance(atr, basestring) else bytearray(atr)
+    caps = {'chaining' : None, 'extended' : None}
+    try:
+        y, k, i = b[1]>>4, b[1]&0x0F, 2
+        while y:
+            i += bin(y & 0x07).count('1')
+            if y & 0x08:
+                y = b[i]>>4
+                i += 1
+            else:
+                y = 0
+        hist = b[i:i+k]
+        if not hist or hist[0] not in (0x00, 0x80):
+            return caps
+        tlvs = hist[1:-3] if hist[0]==0x00 else hist[1:]
+        j = 0
+        while j<len(tlvs):
+            tag, l = tlvs[j]>>4, tlvs[j]&0x0F
+            if tag==7 and l>=3:
+                x = tlvs[j+3]
+                caps['chaining'] = bool(x & 0x80)
+                caps['extended'] = bool(x & 0x40)
+            j += 1+l
+    except IndexError:
         pass
+    return caps
+
+
+class APDUScript(object):
+    ''' A fixed list of APDUs, validated & encoded only once, to be sent by send_batch().
+
+        lst: a list, each element is an APDU string like '00B0000010', or a tuple like
+             (apdu, expectData, expectSW, name), the trailing elements may be omitted.
+    '''
+
+    def __init__(self, lst):
+        self.apdus = []
+        self.names = []
+        self.items = [] # (bytes of apdu, expected SW as integer or None, expected data as bytes or None)
+
+        for x in lst:
+            if isinstance(x, basestring):
+                x = (x,)
+            apdu, expectData, expectSW, name = (tuple(x) + ('', '', ''))[:4]
+            checkapdu(apdu, expectData, expectSW)
+
+            expectSW = int(expectSW, 16) if expectSW else None
+            expectData = tobytes(expectData) if expectData else None
+            self.apdus.append(apdu)
+            self.names.append(name)
+            self.items.append((tobytes(apdu), expectSW, expectData))
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BatchResult(list):
+    ''' Result of send_batch(), a list of (response, sw) tuples, one per APDU sent.
+
+        failed: index of the APDU which returned unexpected SW or data, None if all passed.
+    '''
+
+    def __init__(self, lst, failed=None):
+        list.__init__(self, lst)
+        self.failed = failed
 
-    return response, sw
+    def ok(self):
+        return self.failed is None
+
+
+def collectresponse(transmit, btes, res, sw1, sw2):
+    ''' Automatic 'GET RESPONSE' while '61XX', concatenating the responses, and resend the
+        command with the right Le on '6CXX'.
+
+        transmit: the transmit function of a connection
+        btes, res, sw1, sw2: the command, and what the card returned
+
+        Returns a tuple: (list of integer, sw1, sw2)
+    '''
+    data = []
+    while sw1==0x61:
+        data += res
+        res, sw1, sw2 = transmit( [0x00, 0xC0, 0x00, 0x00, sw2] )
+    if sw1==0x6C and sw2 != 0x00:
+        res, sw1, sw2 = transmit( btes[:4] + [sw2] )
+    return (data+res if data else res), sw1, sw2
+
+
+#-------------------------------------------------------------------------------
+class ReaderSession(object):
+    ''' A session with one reader: owns the reader connection, the record of the last APDU
+        and the 'autoGetResponse' & 'stopOnError' settings.
+
+        The module-level functions (connectreader, send, reset ...) act on the session bound
+        to the calling thread, see getsession(). So one process can drive many readers, one
+        session per reader.
+    '''
+
+    def __init__(self, name='', connection=None):
+        ''' name: reader name, example: 'OMNIKEY CardMan 5x21 0'. If not given, try to
+                  connect anyone avaiable.
+            connection: an established connection, if any.
+        '''
+        self.name = name
+        self.connection = connection
+        self.lastapdu = dict(EMPTY_APDU)
+        self.autoGetResponse = autoGetResponse
+        self.stopOnError = stopOnError
+        self.recorder = None
+        self.metrics = api_metrics.METRICS if useMetrics else None
+        self.capabilities = None # of the card connected, see getcapabilities()
+        self.keepConnection = keepConnection # keep the connection in CONNECTIONS on disconnect()
+        self.warmReset = warmReset # reset a kept connection warm, even if a cold one asked
+
+    def __str__(self):
+        return self.name if self.name else 'default reader'
+
+    @property
+    def lastapdu(self):
+        ''' The record of the last APDU, a dict like EMPTY_APDU. send() keeps the arguments only,
+            the dict is built on first access.
+        '''
+        x = self._lastapdu
+        if isinstance(x, tuple):
+            x = self._lastapdu = makelastapdu(*x)
+        return x
+
+    @lastapdu.setter
+    def lastapdu(self, dit):
+        self._lastapdu = dit
+
+    def connect(self, name='', cold=True):
+        ''' Connect the specific reader, see connectreader().
+
+            With 'keepConnection' set, a connection kept by a previous disconnect() is reused &
+            the card reset, warm if 'warmReset' set.
+        '''
+        name = name if name else self.name
+        name = name if name else api_config.get_default_pcsc_reader_name()
+        if self.connection and self.keepConnection:
+            self.disconnect(cold)
+        if self.keepConnection and self.reuse(name, cold and not self.warmReset):
+            return
+
+        disposition = getdisposition(cold)
+        transport = gettransport()
+        conn = None
+        if name:
+            for x in transport.readers():
+                if str(x) == name:
+                    try:
+                        conn = x.createConnection()
+                        conn.connect(disposition=disposition)
+                    except Exception as e:
+                        raise PCSCException(str(e))
+                    break # if connected
+        else: # not specified, so instead we try to connect anyone avaiable
+            for x in transport.readers():
+                try:
+                    conn = x.createConnection()
+                    conn.connect(disposition=disposition)
+                except transport.NoCardErrors, e:
+                    conn = None
+                    continue
+                except Exception as e:
+                    raise PCSCException(str(e))
+                break # if connected
+
+        self.connection = conn
+        self.capabilities = None
+        if not conn:
+            raise PCSCException('Smartcard not found! Please check if already inserted!')
+        if self.keepConnection:
+            entry = CONNECTIONS.add(str(x), conn, self)
+            Logger.debug('connected %s' % entry)
+        if self.recorder:
+            self.recorder.reset(conn.getATR())
+
+    def reuse(self, name, cold):
+        ''' Reset & use a connection kept in CONNECTIONS, returns False if not any.
+        '''
+        x = CONNECTIONS.acquire(name, self)
+        if x is None:
+            return False
+        try:
+            resetconnection(x.connection, getdisposition(cold))
+            x.update()
+        except Exception as e: # card removed, reader detached ...
+            Logger.debug('drop connection %s: %s' % (x.name, e))
+            CONNECTIONS.remove(x.connection)
+            try:
+                x.connection.disconnect()
+            except Exception:
+                pass
+            return False
+        x.reuses += 1
+        Logger.debug('reuse connection %s' % x)
+        self.connection = x.connection
+        self.capabilities = None
+        if self.recorder:
+            self.recorder.reset(x.connection.getATR())
+        return True
+
+    def disconnect(self, cold=True):
+        ''' disconnect with the card, the connection is kept if 'keepConnection' set.
+        '''
+        conn = self.connection
+        if conn and self.keepConnection and CONNECTIONS.release(conn):
+            self.connection = None
+        elif conn:
+            conn.disposition = getdisposition(cold)
+            conn.disconnect()
+            # Exception AttributeError: AttributeError("'NoneType' object has no attribute 'se
+            # tChanged'",) in <bound method PCSCCardConnection.__del__ of <smartcard.pcsc.PCSC
+            # CardConnection.PCSCCardConnection instance at 0x026369E0>> ignored
+            #conn = None
+            self.connection = None
+        else:
+            pass
+
+        return
+
+    def getatr(self):
+        ''' returns ATR as hexdigits string '''
+        conn = self.connection
+        if conn:
+            return ''.join(['%.2X'%x for x in conn.getATR()]) if conn else ''
+        else:
+            raise PCSCException('No existed connection! Please connect reader!')
+
+    def reset(self, cold=True):
+        ''' Reset the card, actually combines a 'disconnect' & a 'connect' operation.
+        '''
+        conn = self.connection
+        disposition = getdisposition(cold)
+
+        if conn:
+            resetconnection(conn, disposition)
+            self.capabilities = None
+            x = CONNECTIONS.find(conn) if self.keepConnection else None
+            if x:
+                x.update()
+            Logger.debug('reset smart card reader, ' + self.getatr())
+            if self.recorder:
+                self.recorder.reset(conn.getATR())
+        else:
+            raise PCSCException('No existed connection! Please connect reader!')
+        return self.getatr()
+
+    def send(self, apdu, expectData='', expectSW='', info='', name=''):
+        ''' See send().
+        '''
+        h0 = timer()
+        checkapdu(apdu, expectData, expectSW)
+
+        conn = self.connection
+        if not conn:
+            raise PCSCException('No existed connection! Please connect reader!')
+
+        transmit = self.transmit if self.recorder else conn.transmit
+        debug = Logger.isEnabledFor(logging.DEBUG)
+
+        btes = tobytes(apdu)
+        if debug:
+            Logger.debug(APDUMessage(btes, name=name, info=info))
+        t0 = timer()
+        res, sw1, sw2 = transmit( btes )
+
+        t1 = timer()
+        t =(t1-t0)*1000
+        retry = None
+
+        if self.autoGetResponse and (sw1==0x61 or sw1==0x6C):
+            res, sw1, sw2 = collectresponse(transmit, btes, res, sw1, sw2)
+            retry = (timer()-t1)*1000
+
+        if debug:
+            Logger.debug(APDUMessage(btes, res, sw1, sw2, t, name, info))
+
+        response = tohexstring( res )
+        sw = '%.2X%.2X'%(sw1, sw2)
+
+        host = (timer()-h0)*1000 - t - (retry or 0)
+        self.lastapdu = (apdu, response, sw1, sw2, expectData, expectSW, info, name, t, retry, host)
+        if self.metrics:
+            self.metrics.record(apdu[:4], name, t, retry, host)
+
+        self.check(response, sw, expectData, expectSW, info, name)
+        return response, sw
+
+    def check(self, response, sw, expectData='', expectSW='', info='', name=''):
+        ''' Raise PCSCException if response or sw is not the expected one, and 'stopOnError' set.
+        '''
+        # check sw
+        if expectSW:
+            if sw!=expectSW and self.stopOnError:
+                if not is61xx(sw, expectSW):
+                    raise PCSCException('Error! Unexpected status words(%s) returned by card:\n%s, %s,(%s)' %(sw, name, info, expectSW))
+
+        # check response
+        if expectData:
+            if response!=expectData and self.stopOnError:
+                raise PCSCException('Error! Unexpected response-data returned by card:\n%s\n%s, %s, [%s]' %(response, name, info, expectData))
+
+        # log information
+        if info:
+            #LogMessage(info)
+            pass
+
+    def getprotocol(self):
+        ''' Returns the protocol negotiated, SCARD_PROTOCOL_T0/T1, None if unknown '''
+        conn = self.connection
+        if not conn:
+            raise PCSCException('No existed connection! Please connect reader!')
+        return getconnprotocol(conn)
+
+    def getcapabilities(self):
+        ''' Returns the capabilities of the card connected: {'chaining' : ..., 'extended' : ...},
+            from its ATR, see getcapabilities(), unless set by setcapabilities(). Extended
+            Lc/Le is not supported under T=0.
+        '''
+        if self.capabilities is None:
+            conn = self.connection
+            if not conn:
+                raise PCSCException('No existed connection! Please connect reader!')
+            caps = getcapabilities(conn.getATR())
+            if getconnprotocol(conn)==smartcard.scard.SCARD_PROTOCOL_T0:
+                caps['extended'] = False
+            self.capabilities = caps
+        return self.capabilities
+
+    def setcapabilities(self, chaining=None, extended=None):
+        ''' Set the capabilities of the card connected, for cards whose ATR doesn't tell. Reset
+            by the next connect() or reset().
+        '''
+        self.capabilities = {'chaining' : chaining, 'extended' : extended}
+
+    def sendcommand(self, cla, ins, p1, p2, data='', le=None, expectData='', expectSW='', info='', name=''):
+        ''' Send a command of any length.
+
+            A short APDU if it fits. Otherwise an extended APDU if the card supports it, or ISO
+            command chaining (CLA b5 set on all but the last command) of short APDUs. If the
+            card rejects the extended APDU with '6700', it falls back to chaining & remembers.
+            A response longer than 256 bytes is collected by GET RESPONSE under T=0.
+
+            cla, ins, p1, p2: string, like '00'
+            data: string, like '3F00'
+            le: integer, the number of bytes expected, 0 for the maximum, None for no Le
+
+            Returns a tuple: (response, sw).
+        '''
+        n = len(data)/2
+        if n<=0xFF and (le is None or le<=0x100):
+            return self.send(buildapdu(cla, ins, p1, p2, data, le), expectData, expectSW, info, name)
+
+        caps = self.getcapabilities()
+        if caps['extended']:
+            response, sw = self.send(buildapdu(cla, ins, p1, p2, data, le, True), info=info, name=name)
+            if sw!='6700':
+                self.check(response, sw, expectData, expectSW, info, name)
+                return response, sw
+            Logger.debug('Extended APDU rejected, fall back to short APDUs')
+            caps['extended'] = False
+
+        le = le if le is None or le<=0x100 else 0 # GET RESPONSE for the rest
+        if n<=0xFF:
+            return self.send(buildapdu(cla, ins, p1, p2, data, le), expectData, expectSW, info, name)
+
+        if caps['chaining'] is False:
+            raise PCSCException('Card supports neither extended APDU nor command chaining! %d bytes of data' % n)
+
+        chained = '%.2X' % (int(cla, 16) | 0x10)
+        blocks = [data[i:i+0x1FE] for i in range(0, len(data), 0x1FE)]
+        for x in blocks[:-1]:
+            response, sw = self.send(buildapdu(chained, ins, p1, p2, x), info=info, name=name)
+            if sw!='9000':
+                self.check(response, sw, expectData, expectSW, info, name)
+                return response, sw
+        return self.send(buildapdu(cla, ins, p1, p2, blocks[-1], le), expectData, expectSW, info, name)
+
+    def send_batch(self, script):
+        ''' See send_batch().
+        '''
+        if not isinstance(script, APDUScript):
+            script = APDUScript(script)
+
+        conn = self.connection
+        if not conn:
+            raise PCSCException('No existed connection! Please connect reader!')
+
+        transmit = self.transmit if self.recorder else conn.transmit
+        getresponse = self.autoGetResponse
+        metrics = self.metrics
+        raw, failed = [], None
+
+        t0 = timer()
+        for i, (btes, expectSW, expectData) in enumerate(script.items):
+            c0 = timer()
+            res, sw1, sw2 = transmit(btes)
+            c1 = timer()
+            retried = False
+
+            if getresponse and (sw1==0x61 or sw1==0x6C):
+                res, sw1, sw2 = collectresponse(transmit, btes, res, sw1, sw2)
+                retried = True
+
+            if metrics:
+                metrics.record(script.apdus[i][:4], script.names[i], (c1-c0)*1000, (timer()-c1)*1000 if retried else None)
+
+            raw.append((res, sw1, sw2))
+
+            if expectSW is not None:
+                sw = (sw1<<8) | sw2
+                if sw!=expectSW and not (expectSW==0x9000 and sw1==0x61):
+                    failed = i
+                    break
+            if expectData is not None and res!=expectData:
+                failed = i
+                break
+        t =(timer()-t0)*1000
+
+        result = BatchResult([(tohexstring(res), '%.2X%.2X'%(sw1, sw2)) for res, sw1, sw2 in raw], failed)
+
+        i = len(raw)-1
+        if i>=0:
+            apdu = script.apdus[i]
+            response, sw = result[i]
+            dit = dict(EMPTY_APDU)
+            dit.update({
+                    'cla' : apdu[:2],
+                    'ins' : apdu[2:4],
+                    'p1' : apdu[4:6],
+                    'p2' : apdu[6:8],
+                    'p3' : apdu[8:10],
+                    'apdu' : apdu,
+                    'response' : response,
+                    'sw1' : sw[:2],
+                    'sw2' : sw[2:],
+                    'sw' : sw,
+                    'name' : script.names[i],
+                    'time' : t, # of the whole batch
+                    })
+            self.lastapdu = dit
+
+        if failed is None:
+            Logger.debug('Batch of %d APDUs finished ; %.3f ms', len(raw), t)
+        else:
+            Logger.debug('Batch stopped at APDU %d/%d, %s, [%s](%s) ; %.3f ms',
+                    failed+1, len(script), script.apdus[failed], result[failed][0], result[failed][1], t)
+
+        return result
+
+    def transmit(self, btes):
+        ''' Transmit a command as is, no GET RESPONSE, no check. The command & response are
+            recorded if a recorder is set, see setrecorder().
+
+            btes: a list of integer
+
+            Returns a tuple: (list of integer, sw1, sw2)
+        '''
+        conn = self.connection
+        if not conn:
+            raise PCSCException('No existed connection! Please connect reader!')
+
+        recorder = self.recorder
+        if recorder:
+            t0 = time.time()
+            c0 = timer()
+            res, sw1, sw2 = conn.transmit(btes)
+            recorder.apdu(btes, res, sw1, sw2, t0, timer()-c0)
+            return res, sw1, sw2
+        return conn.transmit(btes)
+
+    def setmetrics(self, metrics):
+        ''' Record the latency of all APDUs sent, see api_metrics.
+
+            metrics: api_metrics.Metrics, or None to stop recording
+
+            Returns the previous one.
+        '''
+        old, self.metrics = self.metrics, metrics
+        return old
+
+    def setrecorder(self, recorder):
+        ''' Record all commands & responses transmitted, for example by api_trace.TraceWriter.
+
+            recorder: an object with apdu(command, response, sw1, sw2, timestamp, duration) &
+                      reset(atr), or None to stop recording
+
+            Returns the previous recorder.
+        '''
+        old, self.recorder = self.recorder, recorder
+        return old
+
+    def getexectime(self):
+        ''' Get the execution time of last apdu.
+        '''
+        return self.lastapdu['time']
+
+    def setautogetresponse(self, flag):
+        ''' Set if auto 'Get Response' when '61XX' received.
+        '''
+        self.autoGetResponse = flag
+
+
+SESSION = ReaderSession() # the default session, used by threads not bound to any session
+
+LOCAL = threading.local()
+
+def getsession():
+    ''' Returns the session bound to the calling thread, or the default session.
+    '''
+    session = getattr(LOCAL, 'session', None)
+    return session if session else SESSION
+
+def bindsession(session):
+    ''' Bind a session to the calling thread, all module-level functions called from this
+        thread will act on it. None to un-bind.
+
+        Returns the previous bound session, may be None.
+    '''
+    old = getattr(LOCAL, 'session', None)
+    LOCAL.session = session
+    return old
+
+
+def getconnection():
+    return getsession().connection
+
+def setconnection(x):
+    getsession().connection = x
+
+def setlastapdu(dit):
+    getsession().lastapdu = dit
+
+def getlastapdu(dit=None):
+    return getsession().lastapdu
+
+
+def disconnect(cold=True):
+    ''' disconnect with the card
+    '''
+    return getsession().disconnect(cold)
+
+
+def getatr():
+    ''' returns ATR as hexdigits string '''
+    return getsession().getatr()
+
+
+def connectreader(name='', cold=True):
+    ''' Connect the specific reader.
+        name:   string, reader name, example: 'OMNIKEY CardMan 5x21 0'. If not given, try to
+                connect anyone avaiable.
+    '''
+    return getsession().connect(name, cold)
+
+
+def reset(cold=True):
+    ''' Reset the card, actually combines a 'disconnect' & a 'connect' operation.
+    '''
+    return getsession().reset(cold)
+
+
+def getprotocol():
+    ''' Returns the protocol negotiated with the card, SCARD_PROTOCOL_T0/T1 '''
+    return getsession().getprotocol()
+
+
+def setkeepconnection(flag, warm=None):
+    ''' Keep the connection on disconnect() & reuse it on the next connectreader(), see
+        ConnectionCache. warm: True to reset kept connections warm, None to leave as is.
+    '''
+    session = getsession()
+    session.keepConnection = flag
+    if warm is not None:
+        session.warmReset = warm
+
+
+def closeconnections(cold=True):
+    ''' Disconnect all the connections kept, see setkeepconnection().
+    '''
+    CONNECTIONS.clear(cold)
+
+
+def send(apdu, expectData='', expectSW='', info='', name=''):
+    ''' A shortcut to 'send7816()', designed for user convinence.
+
+        apdu: string, like '0084000004'
+        expectData: string, like '01020304', can be empty
+        expectSW: string, like '9000', can be empty
+        info: string, just for display, can be empty
+        name: string, name of APDU
+
+        Returns response data as a string, may be empty(SW not included).
+    '''
+    return getsession().send(apdu, expectData=expectData, expectSW=expectSW, info=info, name=name)
+
+
+def sendcommand(cla, ins, p1, p2, data='', le=None, expectData='', expectSW='', info='', name=''):
+    ''' Send a command of any length, as a short APDU, an extended APDU or chained short APDUs,
+        depending on the length & the capabilities of the card. See ReaderSession.sendcommand().
+
+        cla: string, like '00'
+        ins: string, like 'D6'
+        p1:  string, like '00'
+        p2:  string, like '00'
+        data: string, like '3F00', may be longer than 255 bytes.
+        le: integer, the number of bytes expected, 0 for the maximum, None for no Le
+        expectData: string, can be empty.
+        expectSW: string, can be empty.
+        info: string, just for display
+        name: string, APDU name
+
+        Returns a tuple: (response, sw).
+    '''
+    a2blist([cla, ins, p1, p2, data, expectData, expectSW]) # check format
+    if len(cla+ins+p1+p2) != 8:
+        raise PCSCException( 'Invalid APDU header %s! MUST be 8 hexdigits!' %(cla+ins+p1+p2) )
+    return getsession().sendcommand(cla, ins, p1, p2, data, le, expectData, expectSW, info, name)
 
 
 def send7816(cla, ins, p1, p2, p3, data='', le='', expectData='',  expectSW='', info='', name=''):
     ''' Send any apdu to smartcard connected via T0/T1 protocol.
-        P3 will be automaticlly caculated and appended.
+        If p3 is empty, P3 will be automaticlly caculated: Lc & Le are encoded as short or
+        extended, or data sent by command chaining, see sendcommand().
 
         cla: string, like 'A0'
         ins: string, like 'A4'
         p1:  string, like '00'
         p2:  string, like '00'
-        p3:  string, like '02'
+        p3:  string, like '02', or '' for automatic
         data: string, like '3F00', will be sent to smartcard.
-        le: string, like '00'
+        le: string, like '00', or '0200' for extended
         expectData: string, like '6F0E8408A000000333CDD000A5028800', can be empty.
         expectSW: string, like '9F17', can be empty.
         info: string, just for display
@@ -313,7 +1056,11 @@ def send7816(cla, ins, p1, p2, p3, data='', le='', expectData='',  expectSW='',
 
         Returns 'Data response' + SW, data may be an empty string.
     '''
-    
+    if not p3:
+        a2blist([le]) # check format
+        return sendcommand(cla, ins, p1, p2, data, int(le, 16) if le else None,
+                expectData=expectData, expectSW=expectSW, info=info, name=name)
+
     lst = [cla, ins, p1, p2, p3]
     b = a2blist( lst ) # check format
     apdu = ''.join( lst )
@@ -341,23 +1088,443 @@ def send7816(cla, ins, p1, p2, p3, data='', le='', expectData='',  expectSW='',
     return send(apdu, expectData=expectData, expectSW=expectSW, info=info, name=name)
 
 
+def send_batch(script, conn=None):
+    ''' Send a list of APDUs with minimal per-command overhead.
+
+        script: an APDUScript, or a list accepted by APDUScript(). Compile fixed scripts
+                once with APDUScript() and send them to as many cards as needed.
+        conn: the reader connection, the current connection if omitted. The settings, the
+              metrics & the recorder of the current session apply, & its last APDU is
+              updated, see getlastapdu().
+
+        Stops at the first APDU returning unexpected SW or data, no exception raised.
+        Returns a BatchResult, responses and SWs are formatted as in send().
+    '''
+    session = getsession()
+    if not conn:
+        return session.send_batch(script)
+    batch = ReaderSession(session.name, conn)
+    for x in ('autoGetResponse', 'stopOnError', 'recorder', 'metrics', 'keepConnection', 'warmReset'):
+        setattr(batch, x, getattr(session, x))
+    last = batch._lastapdu
+    try:
+        return batch.send_batch(script)
+    finally:
+        if batch._lastapdu is not last:
+            session.lastapdu = batch._lastapdu
+
+
+def transmit(btes):
+    ''' Transmit a command as is, see ReaderSession.transmit().
+    '''
+    return getsession().transmit(btes)
+
+
+def setrecorder(recorder):
+    ''' Record all commands & responses of the current session, see ReaderSession.setrecorder().
+    '''
+    return getsession().setrecorder(recorder)
+
+
+def setmetrics(metrics):
+    ''' Record the latency of all APDUs of the current session, see ReaderSession.setmetrics().
+    '''
+    return getsession().setmetrics(metrics)
+
+
 def getexectime():
     ''' Get the execution time of last apdu.
     '''
-    return ditLastAPDU['time']
+    return getsession().getexectime()
 
 
 def setautogetresponse(flag):
     ''' Set if auto 'Get Response' when '61XX' received.
     '''
-    global autoGetResponse
-    autoGetResponse = flag
+    getsession().setautogetresponse(flag)
     return
 
+
+#-------------------------------------------------------------------------------
+class Job(object):
+    ''' A function call to be run in a ReaderWorker, keeps its return value or exception.
+
+        Like a future: it can be waited for, cancelled before it starts, and calls back when done.
+    '''
+
+    def __init__(self, func, args, kwargs):
+        self.func, self.args, self.kwargs = func, args, kwargs
+        self.value, self.exception, self.traceback = None, None, ''
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+        self.callbacks = []
+
+    def run(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.started = True
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+            self.traceback = traceback.format_exc()
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.done.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                Logger.exception(e)
+
+    def cancel(self):
+        ''' Cancel the job if not started yet, a running PC/SC call can't be interrupted.
+
+            Returns True if cancelled.
+        '''
+        with self.lock:
+            if self.started or self.done.is_set():
+                return self.cancelled
+            self.cancelled = True
+            self.exception = PCSCException('Job %s cancelled' % self.func.__name__)
+        self.finish()
+        return True
+
+    def add_done_callback(self, func):
+        ''' Call func(job) once the job finished or cancelled, in the worker thread, or at once
+            if already finished.
+        '''
+        with self.lock:
+            if not self.done.is_set():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+    def wait(self, timeout=None):
+        ''' Returns True if the job finished within timeout.
+        '''
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def result(self, timeout=None):
+        ''' Returns the return value of the job, or raises its exception.
+        '''
+        if not self.wait(timeout):
+            raise PCSCException('Timeout! Job %s not finished in %s seconds' % (self.func.__name__, timeout))
+        if self.exception:
+            raise self.exception
+        return self.value
+
+
+class ReaderWorker(threading.Thread):
+    ''' A worker thread bound to one session, runs the submitted jobs one after another.
+    '''
+
+    def __init__(self, session):
+        threading.Thread.__init__(self, name='ReaderWorker-%s' % session)
+        self.daemon = True
+        self.session = session
+        self.jobs = Queue.Queue()
+
+    def run(self):
+        bindsession(self.session)
+        while True:
+            job = self.jobs.get()
+            if job is None: # stop
+                break
+            job.run()
+
+    def submit(self, func, *args, **kwargs):
+        ''' Run func(session, *args, **kwargs) in this thread, returns a Job.
+        '''
+        return self.call(func, self.session, *args, **kwargs)
+
+    def call(self, func, *args, **kwargs):
+        ''' Run func(*args, **kwargs) in this thread, returns a Job. The module-level functions
+            (api_pcsc.send, api_gp.upload ...) work on the session of this worker.
+        '''
+        job = Job(func, args, kwargs)
+        self.jobs.put(job)
+        return job
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+class SessionPool(object):
+    ''' Runs the same job, e.g. a test suite or a validator, on many readers at once.
+
+        One worker thread per reader, each thread bound to the session of its reader. So code
+        calling the module-level functions (api_pcsc.send, api_gp.upload ...) needs no change.
+    '''
+
+    def __init__(self, sessions):
+        ''' sessions: a list of ReaderSession or reader names.
+        '''
+        self.sessions = [x if isinstance(x, ReaderSession) else ReaderSession(str(x)) for x in sessions]
+        self.workers = [ReaderWorker(x) for x in self.sessions]
+        for x in self.workers:
+            x.start()
+
+    @classmethod
+    def fromreaders(cls, names=None):
+        ''' Create a pool of the readers in names, or all readers attached.
+        '''
+        names = names if names else [str(x) for x in getreaderlist()]
+        return cls(names)
+
+    def submit(self, func, *args, **kwargs):
+        ''' Submit func(session, *args, **kwargs) to all workers, returns a list of Job.
+        '''
+        return [x.submit(func, *args, **kwargs) for x in self.workers]
+
+    def run(self, func, *args, **kwargs):
+        ''' Run func(session, *args, **kwargs) on all readers & wait until all finished.
+
+            Returns a list of (session, return value, exception) tuples, in the order of sessions.
+        '''
+        jobs = self.submit(func, *args, **kwargs)
+        for job in jobs:
+            job.wait()
+            if job.exception:
+                Logger.error('%s failed:\n%s' % (job.args[0], job.traceback))
+        return [(job.args[0], job.value, job.exception) for job in jobs]
+
+    def close(self, disconnect=True):
+        ''' Stop all workers, disconnect the readers if disconnect is True.
+        '''
+        if disconnect:
+            self.run(lambda session: session.disconnect())
+        for x in self.workers:
+            x.stop()
+        for x in self.workers:
+            x.join()
+
+    def __len__(self):
+        return len(self.sessions)
+
+
 #----------------------------------------------------------------------------
+class FakeConnection(object):
+    ''' 模拟读卡器连接，不需要读卡器即可测试主机端的APDU处理开销 '''
+
+    def __init__(self, response=[0x00]*16, sw1=0x90, sw2=0x00, atr=[0x3B, 0x00]):
+        self.response, self.sw1, self.sw2, self.atr = response, sw1, sw2, atr
+        self.count = 0
+        self.disposition = None
+
+    def connect(self, disposition=None):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def getATR(self):
+        return self.atr
+
+    def transmit(self, btes):
+        self.count += 1
+        return list(self.response), self.sw1, self.sw2
+
+
 class TestModule(unittest.TestCase):
     ''' 本模块的单元测试 '''
 
+    def test_send_batch(self):
+        conn = FakeConnection()
+        script = APDUScript(['00B0000010', ('00B0001010', '00'*16, '9000', 'Read Binary'), ('00B0002010', '', '6A82')])
+        r = send_batch(script, conn)
+        self.assertTrue(r.failed==2 and not r.ok())
+        self.assertTrue(r[0]==('00'*16, '9000'))
+        self.assertTrue(conn.count==3)
+
+        r = send_batch(['00B0000010', '00B0001010'], conn)
+        self.assertTrue(r.ok() and len(r)==2)
+
+        # the settings, metrics, recorder & last APDU of the current session
+        class Recorder(object):
+            def __init__(self):
+                self.calls = []
+            def apdu(self, *args):
+                self.calls.append(args)
+            record = apdu
+        session = getsession()
+        old = session.recorder, session.metrics, session._lastapdu
+        session.recorder, session.metrics = Recorder(), Recorder()
+        try:
+            send_batch(['00B0000010', '00B0002010'], conn)
+            self.assertEqual((len(session.recorder.calls), len(session.metrics.calls)), (2, 2))
+            self.assertEqual(getlastapdu()['p1'] + getlastapdu()['p2'], '0020')
+        finally:
+            session.recorder, session.metrics, session._lastapdu = old
+        self.assertRaises(PCSCException, APDUScript, ['00B00000'])
+        self.assertRaises(PCSCException, APDUScript, [('00B0000010', 'XX')])
+
+    def test_buildapdu(self):
+        ''' 短APDU、扩展APDU的构造与拆分，从ATR历史字节获取卡片能力 '''
+        self.assertEqual(buildapdu('00', 'A4', '00', '0C', '3F00'), '00A4000C023F00')
+        self.assertEqual(buildapdu('00', 'B0', '00', '00', le=0), '00B0000000')
+        self.assertEqual(buildapdu('00', '70', '00', '00'), '0070000000')
+        self.assertEqual(buildapdu('00', 'B0', '00', '00', le=0x200), '00B00000000200')
+        data = '11'*300
+        apdu = buildapdu('00', 'D6', '00', '00', data, le=0x10000)
+        self.assertEqual(apdu, '00D6000000012C' + data + '0000')
+        self.assertEqual(splitapdu(apdu), ('00012C', data, '0000'))
+        self.assertEqual(checkapdu(apdu), 600)
+        self.assertEqual(splitapdu('00D60000031122330A'), ('03', '112233', '0A'))
+        self.assertEqual(splitapdu('00B00000000200'), ('', '', '000200'))
+        self.assertEqual(splitapdu('00D600000000031122'), None)
+        self.assertRaises(PCSCException, checkapdu, '00D6000003112233440A')
+
+        self.assertEqual(getcapabilities('3B9F96801FC78031A073BE21136743200718000001A5'), {'chaining' : False, 'extended' : False})
+        self.assertEqual(getcapabilities('3B850180730000C0B7'), {'chaining' : True, 'extended' : True})
+        self.assertEqual(getcapabilities('3B00'), {'chaining' : None, 'extended' : None})
+
+    def test_keepconnection(self):
+        ''' 20个测试类反复connectreader()/api_gp.card()/disconnect()：连接只建立一次，之后只热复位 '''
+        import api_virtualcard, api_gp
+        class Transport(api_virtualcard.VirtualTransport):
+            def readers(self):
+                self.enumerations += 1
+                return api_virtualcard.VirtualTransport.readers(self)
+        card = api_virtualcard.createusim()
+        transport = Transport([api_virtualcard.VirtualReader('Virtual Reader 0', card)])
+        transport.enumerations = 0
+        old = settransport(transport)
+        oldsession = bindsession(ReaderSession())
+        setkeepconnection(True, warm=True)
+        try:
+            for i in range(20): # setUpClass & tearDownClass
+                connectreader()
+                api_gp.card()
+                disconnect()
+            self.assertEqual(transport.enumerations, 1)
+            self.assertEqual((card.coldresets-1, card.warmresets), (1, 2*20-1))
+            x = CONNECTIONS.entries['Virtual Reader 0']
+            self.assertEqual((x.reuses, x.atr, x.protocol), (19, api_virtualcard.DEFAULT_ATR, smartcard.scard.SCARD_PROTOCOL_T0))
+
+            # a stale connection is dropped
+            card = api_virtualcard.createusim(atr='3B00')
+            transport.lst[0].insert(card)
+            self.assertEqual(connectreader(), None)
+            self.assertEqual((getatr(), getprotocol(), transport.enumerations), ('3B00', smartcard.scard.SCARD_PROTOCOL_T0, 2))
+        finally:
+            closeconnections()
+            bindsession(oldsession)
+            settransport(old)
+        self.assertEqual(len(CONNECTIONS), 0)
+        self.assertFalse(card.powered)
+
+    def test_sessionpool(self):
+        ''' 每个读卡器一个线程，模块级函数作用于本线程绑定的session '''
+        def job(session, n):
+            for i in range(n):
+                send('00B0000010', expectSW='9000')
+                time.sleep(0.001) # let other workers run
+            return getatr(), getconnection().count
+
+        conns = [FakeConnection(atr=[0x3B, i]) for i in range(8)]
+        sessions = [ReaderSession('Fake Reader %d' % i, x) for i, x in enumerate(conns)]
+        pool = SessionPool(sessions)
+        try:
+            results = pool.run(job, 20)
+        finally:
+            pool.close()
+
+        self.assertTrue(len(results)==8)
+        for i, (session, value, exception) in enumerate(results):
+            self.assertTrue(exception is None)
+            self.assertTrue(value==('3B%.2X' % i, 20))
+            self.assertTrue(session.lastapdu['sw']=='9000')
+            self.assertTrue(session.connection is None) # disconnected by close()
+        self.assertTrue(getsession() is SESSION)
+
+        pool = SessionPool([ReaderSession('Fake Reader', FakeConnection(sw1=0x6A, sw2=0x82))])
+        try:
+            session, value, exception = pool.run(lambda session: send('00A4000C023F00', expectSW='9000'))[0]
+        finally:
+            pool.close()
+        self.assertTrue(isinstance(exception, PCSCException))
+
+    def test_send_batch_benchmark(self):
+        ''' 比较send()与send_batch()每条APDU的主机端开销 '''
+        n = 2000
+        apdus = ['00D60000%.2X%s' % (16, '%.2X'%(i&0xFF)*16) for i in range(n)]
+        conn = FakeConnection([], 0x90, 0x00)
+
+        old = getconnection()
+        setconnection(conn)
+        try:
+            t0 = time.time()
+            for apdu in apdus:
+                send(apdu, expectSW='9000')
+            t1 = time.time()
+            script = APDUScript([(apdu, '', '9000') for apdu in apdus])
+            t2 = time.time()
+            r = send_batch(script)
+            t3 = time.time()
+        finally:
+            setconnection(old)
+
+        self.assertTrue(r.ok() and len(r)==n)
+        single, batch = (t1-t0)*1e6/n, (t3-t2)*1e6/n
+        Logger.info('send(): %.1f us/APDU, APDUScript(): %.1f us/APDU, send_batch(): %.1f us/APDU',
+                single, (t2-t1)*1e6/n, batch)
+
+    def test_logging_benchmark(self):
+        ''' 比较旧send()（每次格式化日志、构造dict）与当前send()在INFO、DEBUG级别下每条APDU的主机端开销 '''
+        def legacy(apdu, expectSW): # send() before lazy logging, for comparison only
+            checkapdu(apdu, '', expectSW)
+            conn = getconnection()
+            Logger.debug(formatapdu(apdu, '', ''))
+            t0 = time.clock()
+            res, sw1, sw2 = conn.transmit( toBytes(apdu) )
+            t = (time.clock()-t0)*1000
+            response = ''.join(map(lambda x:'%.2X'%x, res))
+            sw = '%.2X%.2X'%(sw1, sw2)
+            Logger.debug(formatresponse(response, sw1, sw2, t))
+            getsession().lastapdu = makelastapdu(apdu, response, sw1, sw2, '', expectSW, '', '', t, None, 0)
+            return response, sw
+
+        n = 2000
+        apdus = ['00B0%.4X10' % i for i in range(n)]
+        stream = StringIO.StringIO()
+        handler = logging.StreamHandler(stream)
+        level, propagate = Logger.level, Logger.propagate
+        Logger.addHandler(handler)
+        Logger.propagate = False
+        old = getconnection()
+        setconnection(FakeConnection())
+        results = {}
+        try:
+            for lvl in (logging.INFO, logging.DEBUG):
+                Logger.setLevel(lvl)
+                for f in (legacy, send):
+                    lst = []
+                    for i in range(3): # best of 3
+                        t0 = time.time()
+                        for apdu in apdus:
+                            f(apdu, expectSW='9000')
+                        lst.append((time.time()-t0)*1e6/n)
+                    results[(lvl, f)] = min(lst)
+        finally:
+            setconnection(old)
+            Logger.removeHandler(handler)
+            Logger.setLevel(level)
+            Logger.propagate = propagate
+
+        self.assertEqual(stream.getvalue().count('\n'), 3*4*n)
+        self.assertEqual(getlastapdu()['response'], '00'*16)
+        for lvl in (logging.INFO, logging.DEBUG):
+            Logger.info('%s, legacy send(): %.1f us/APDU, send(): %.1f us/APDU', logging.getLevelName(lvl),
+                    results[(lvl, legacy)], results[(lvl, send)])
+
     def test_00A4(self):
         for x in range(10):
             connectreader(cold=True)
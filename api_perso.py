@@ -0,0 +1,364 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with personalization by STORE DATA, see 11.11 of GP 2.2.
+
+The data record of a card, a dict like the ones checked by api_validators ({'ICCID' : ...,
+'IMSI' : ..., 'KI' : ...}), is turned into DGIs (Data Grouping Identifiers) as a profile tells,
+the sensitive ones encrypted with the DEK of the secure channel, then packed into STORE DATA
+commands, wrapped with C-MAC (& C-DECRYPTION) & sent as a batch:
+
+    channel = api_gp.SecureChannel(level='01')
+    channel.open()
+    api_perso.personalize(record, channel, aid='A0000000871002FF86FF0289060100FF')
+
+For a production line, Personalizer prepares the data of the next card, validation & DGIs, on
+a background thread while the current card is being written:
+
+    perso = api_perso.Personalizer(aid=...)
+    for record, result in perso.run(records, opencard):
+        ...
+
+The DGIs & their layout are the ones of the applet personalized, SIM_PROFILE is an example.
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import logging, unittest, threading, Queue
+import api_pcsc
+import api_gp
+import api_crypto
+import api_general
+import api_validators
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+a2b = api_pcsc.a2b
+lv = api_general.lv
+
+# P1 of STORE DATA, Table 11-89 of GP 2.2
+P1_LAST = 0x80
+P1_DGI = 0x20
+P1_ENCRYPTED = 0x18
+
+# DGI, keys of the data record concatenated in its value, sensitive or not
+SIM_PROFILE = (
+    ('0101', ('ICCID',), False),
+    ('0102', ('IMSI', 'ACC1'), False),
+    ('0201', ('PIN1', 'PUK1', 'PIN2', 'PUK2', 'ADM1'), True),
+    ('0202', ('KI', 'OPC'), True),
+    ('0203', ('KIC1', 'KID1', 'KIK1'), True),
+    )
+
+
+class PersoException(api_pcsc.PCSCException):
+    ''' A personalization error, a PCSCException like GPException.
+    '''
+    pass
+
+
+#-------------------------------------------------------------------------------
+# define API
+
+def dgi(tag, value):
+    ''' Returns a DGI, hexdigits: tag, length on 1 byte, or 'FF' & 2 bytes from 255 bytes, value.
+
+        dgi('0101', '98') = '01010198'
+    '''
+    n = len(value)/2
+    return tag + ('%.2X' % n if n<0xFF else 'FF%.4X' % n) + value
+
+
+def validate(record, validators=None):
+    ''' Check the data of the record with the validators of its keys, raise ValidatorException
+        if wrong.
+
+        validators: a dict of key & api_validators.Validator, api_validators.getdefault() if omitted
+    '''
+    validators = api_validators.getdefault() if validators is None else validators
+    for k in record:
+        if k in validators:
+            validators[k].test(record, Logger)
+
+
+def builddgis(record, profile=SIM_PROFILE):
+    ''' Returns the DGIs of the record, a list of (tag, value, sensitive), hexdigits. A DGI whose
+        keys are all missing from the record is left out, raise PersoException if some only.
+    '''
+    lst = []
+    for tag, keys, sensitive in profile:
+        values = [record.get(k, '').upper() for k in keys]
+        if not any(values):
+            continue
+        if not all(values):
+            raise PersoException('DGI %s: %s missing' % (tag, ', '.join([k for k, v in zip(keys, values) if not v])))
+        lst.append((tag, ''.join(values), sensitive))
+    return lst
+
+
+def storedata(dgis, channel=None, blocksize=0xFF, cla='80'):
+    ''' Returns the STORE DATA commands of the DGIs, hexdigits, to be wrapped by channel if any,
+        see send().
+
+        Whole DGIs are packed into each command, as many as fit in blocksize bytes of command
+        data once wrapped; a DGI too long is split over several. The value of a sensitive
+        DGI is padded ('80' & '00's) to the block if needed & encrypted with the DEK of channel,
+        see api_gp.SecureChannel.encrypt(); such DGIs are sent in commands of their own, P1
+        telling 'encrypted'.
+
+        dgis: a list of (tag, value, sensitive), like builddgis() returns
+    '''
+    room = channel.room(blocksize) if channel else blocksize
+    commands = [] # [P1, data]
+    for tag, value, sensitive in dgis:
+        p1 = P1_DGI
+        if sensitive:
+            if not channel:
+                raise PersoException('DGI %s: a secure channel needed to encrypt it' % tag)
+            size = 8 if channel.scp==0x02 else 16
+            data = a2b(value)
+            if len(data) % size:
+                data = api_crypto.padm2(data, size)
+            value = channel.encrypt(api_pcsc.b2a(data).upper())
+            p1 |= P1_ENCRYPTED
+        x = dgi(tag, value)
+        if commands and commands[-1][0]==p1 and len(commands[-1][1]+x)<=2*room:
+            commands[-1][1] += x
+            continue
+        for i in range(0, len(x), 2*room):
+            commands.append([p1, x[i:i+2*room]])
+
+    apdus = []
+    for i, (p1, data) in enumerate(commands):
+        if i==len(commands)-1:
+            p1 |= P1_LAST
+        apdus.append(cla + 'E2%.2X%.2X' % (p1, i & 0xFF) + lv(data))
+    return apdus
+
+
+def installforperso(aid, channel=None):
+    ''' INSTALL [for personalization], the following STORE DATA commands are for the application
+        aid, see 11.5.2.3.4 of GP 2.2.
+    '''
+    apdu = '80E62000' + lv('0000' + lv(aid) + '000000')
+    send = channel.send if channel else api_pcsc.send
+    return send(apdu, expectSW='9000', name='INSTALL for personalization')
+
+
+def send(apdus, channel=None):
+    ''' Send STORE DATA commands wrapped by channel if any, as a batch, unless channel asks R-MAC:
+        then one by one, each response checked before the next command is wrapped. Raise
+        PersoException if one fails.
+
+        Returns a list of (response, sw)
+    '''
+    if channel and channel.level & 0x10:
+        lst = []
+        for apdu in apdus:
+            lst.append(channel.send(apdu, expectSW='', name='STORE DATA'))
+            if lst[-1][1]!='9000':
+                raise PersoException('STORE DATA %d of %d failed: %s' % (len(lst), len(apdus), lst[-1][1]))
+        return lst
+
+    if channel:
+        apdus = [channel.wrap(x) for x in apdus]
+    result = api_pcsc.getsession().send_batch([(x, '', '9000', 'STORE DATA') for x in apdus])
+    if not result.ok():
+        raise PersoException('STORE DATA %d of %d failed: %s' % (result.failed+1, len(apdus), result[result.failed][1]))
+    return result
+
+
+def personalize(record, channel=None, aid='', profile=SIM_PROFILE, validators=None, blocksize=0xFF):
+    ''' Validate the record, INSTALL [for personalization] of aid if given, & STORE DATA of its
+        DGIs.
+
+        channel: the api_gp.SecureChannel opened on the card, needed for sensitive DGIs
+        validators: see validate(), {} for none
+
+        Returns a list of (response, sw) of STORE DATA
+    '''
+    validate(record, validators)
+    dgis = builddgis(record, profile)
+    if aid:
+        installforperso(aid, channel)
+    return send(storedata(dgis, channel, blocksize), channel)
+
+
+class Personalizer(object):
+    ''' Personalize card after card, the data of the next card prepared on a background thread
+        while the current card is being written.
+    '''
+
+    def __init__(self, aid='', profile=SIM_PROFILE, validators=None, blocksize=0xFF):
+        ''' aid: the application personalized, '' to send STORE DATA to the security domain
+            see personalize() for the others
+        '''
+        self.aid = aid
+        self.profile = profile
+        self.validators = validators
+        self.blocksize = blocksize
+
+    def prepare(self, record):
+        ''' Returns the DGIs of the record once validated, no card needed '''
+        validate(record, self.validators)
+        return builddgis(record, self.profile)
+
+    def write(self, dgis, channel):
+        ''' Write the DGIs prepared to the card of channel, returns a list of (response, sw) '''
+        if self.aid:
+            installforperso(self.aid, channel)
+        return send(storedata(dgis, channel, self.blocksize), channel)
+
+    def run(self, records, opencard):
+        ''' Personalize a card per record, yields (record, list of (response, sw)).
+
+            opencard: a function, opencard(record) returns the api_gp.SecureChannel opened on the
+                      card of record, e.g. after waiting for the card & connecting it
+
+            The next record is prepared while the current one is written, an exception of
+            preparation is raised when its record comes.
+        '''
+        queue, stop = Queue.Queue(1), threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, True, 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def prepare():
+            for record in records:
+                try:
+                    item = (record, self.prepare(record), None)
+                except Exception as e:
+                    item = (record, None, e)
+                if not put(item):
+                    return
+            put(None)
+
+        thread = threading.Thread(target=prepare, name='Personalizer')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                record, dgis, e = item
+                if e is not None:
+                    raise e
+                yield record, self.write(dgis, opencard(record))
+        finally:
+            stop.set()
+            thread.join()
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    RECORD = {
+            'ICCID' : '982520506196020013F3',
+            'IMSI' : '3943204046870774',
+            'ACC1' : '0002',
+            'PIN1' : '31313131FFFFFFFF',
+            'PUK1' : '3132333435363738',
+            'PIN2' : '32323232FFFFFFFF',
+            'PUK2' : '3837363534333231',
+            'ADM1' : '3838383838383838',
+            'KI' : 'F16D7A3F018D7C96B7E603FB6C14ACC8',
+            'OPC' : 'CAB9BB7F4002B468F39CB9EFE79C62D2',
+            }
+
+    def setUp(self):
+        import api_virtualcard
+        self.card = api_virtualcard.createusim()
+        self.cm = self.card.cardmanager
+        self.cm.applets['A0000000871002FF86FF0289060100FF'] = {'package' : 'A0000000871002', 'module' : 'A0000000871002FF86FF0289060100FF', 'privileges' : '00', 'selectable' : True}
+        self.old = api_pcsc.settransport(api_virtualcard.createtransport(self.card))
+        self.oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        api_pcsc.connectreader()
+
+    def tearDown(self):
+        api_pcsc.disconnect()
+        api_pcsc.bindsession(self.oldsession)
+        api_pcsc.settransport(self.old)
+
+    def open(self, level='03', scp=0x02):
+        self.cm.scp = scp
+        api_gp.card()
+        channel = api_gp.SecureChannel(level=level)
+        channel.open()
+        return channel
+
+    def test_dgi(self):
+        ''' DGI编码：长度1字节、255字节起为FF加2字节；按配置组织DGI，缺少部分数据时报错 '''
+        self.assertEqual(dgi('0101', '98'), '01010198')
+        self.assertEqual(dgi('8000', '00'*0xFF), '8000FF00FF' + '00'*0xFF)
+        dgis = builddgis(self.RECORD)
+        self.assertEqual([x[0] for x in dgis], ['0101', '0102', '0201', '0202']) # no OTA keys
+        self.assertEqual(dgis[1][1], '39432040468707740002')
+        record = dict(self.RECORD)
+        del record['OPC']
+        self.assertRaises(PersoException, builddgis, record)
+        record['IMSI'] = '1234'
+        self.assertRaises(api_validators.ValidatorException, validate, record)
+        self.assertRaises(PersoException, storedata, dgis) # sensitive, no channel
+
+    def test_storedata(self):
+        ''' 在虚拟卡上用STORE DATA个人化：SCP02与SCP03、C-MAC与C-DECRYPTION、敏感DGI加密、分块与批量发送 '''
+        aid = 'A0000000871002FF86FF0289060100FF'
+        dgis = builddgis(self.RECORD)
+        for scp, level, blocksize in ((0x02, '01', 0xFF), (0x02, '03', 0x20), (0x03, '03', 0xFF), (0x03, '33', 0x30)):
+            channel = self.open(level, scp)
+            personalize(self.RECORD, channel, aid, blocksize=blocksize)
+            stored = self.cm.applets[aid]['dgis']
+            self.assertEqual(stored.keys(), [x[0] for x in dgis])
+            for tag, value, sensitive in dgis:
+                self.assertEqual(stored[tag][:len(value)], value)
+            channel = self.open(level, scp)
+            apdus = [channel.wrap(x) for x in storedata(dgis, channel, blocksize)]
+            self.assertTrue(all(len(x)<=2*(5+blocksize) for x in apdus))
+            self.assertEqual([int(x[4:6], 16) & 0x98 for x in apdus][-1], P1_LAST | P1_ENCRYPTED)
+
+        self.assertRaises(api_pcsc.PCSCException, personalize, self.RECORD, self.open('01'), 'A000000087100201') # not installed
+
+    def test_personalizer(self):
+        ''' 多张卡个人化：后台线程准备下一张卡的数据，数据错误在轮到该卡时抛出 '''
+        aid = 'A0000000871002FF86FF0289060100FF'
+        records = []
+        for i in range(5):
+            x = dict(self.RECORD)
+            x['KI'] = '%.32X' % i
+            records.append(x)
+        written = []
+        def opencard(record):
+            written.append(record['KI'])
+            return self.open('03')
+        perso = Personalizer(aid)
+        for record, result in perso.run(records, opencard):
+            self.assertEqual(self.cm.applets[aid]['dgis']['0202'][:32], record['KI'])
+        self.assertEqual(written, [x['KI'] for x in records])
+
+        records[2]['IMSI'] = '1234'
+        results = perso.run(records, opencard)
+        self.assertEqual(len([next(results), next(results)]), 2)
+        self.assertRaises(api_validators.ValidatorException, next, results)
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
@@ -14,7 +14,9 @@ Copyright 2015 XH Smart Card Co,.Ltd
 Author: wg@china-xinghan.com
 """
 
-import re, struct, binascii, logging, unittest, collections
+import struct, binascii, time, logging, unittest, collections
+
+Logger = logging.getLogger(__name__)
 
 #----------------------------------------------------------------------------
 a2b = binascii.a2b_hex
@@ -32,87 +34,248 @@ class TLVException(Exception):
         return self.value
 
 #----------------------------------------------------------------------------
-RE_BERTLV = re.compile(r'([0-9A-F]{2})((?:81)?[0-9A-F]{2})([0-9A-F]*)')
+# BER-TLV, ISO/IEC 8825-1 & ISO/IEC 7816-4 5.2.2: tags of one or more bytes, length fields of one
+# to five bytes ('81' to '84' followed by 1 to 4 bytes). The TLVs are decoded from the bytes in
+# place: a value is a memoryview of the buffer, no copy made, turned to hexdigits only when asked.
+#
+#   for tag, value in iterate(data): # a single level, tag as hexdigits, value a memoryview
+#       ...
+#   fcp = decodeone(data) # a Node, the constructed TLVs decoded recursively
+#   fcp.find('A5').find('C0').value
+#   data = fcp.encode()
+
+def readtag(view, i):
+    ''' Returns (the tag at offset i as hexdigits, the offset following it), raise IndexError if too short.
+
+         ISO/IEC 8825-1 8.1.2: if the bits b5-b1 of the first byte are all 1, the tag goes on in
+         the next bytes while their bit b8 is 1.
+    '''
+    j = i+1
+    if ord(view[i]) & 0x1F == 0x1F:
+        while ord(view[j]) & 0x80:
+            j += 1
+        j += 1
+    return b2a(view[i:j].tobytes()), j
+
+def readlength(view, i, strict=False):
+    ''' Returns (the length at offset i, the offset following the length field), raise IndexError
+        if too short.
+
+         strict: True to reject the lengths not in the shortest form, e.g. '8105'
+    '''
+    b = ord(view[i])
+    if b < 0x80:
+        return b, i+1
+    n = b & 0x7F
+    if not 1 <= n <= 4:
+        raise TLVException('Invalid length field %.2X at %d' % (b, i))
+    if i+1+n > len(view):
+        raise IndexError
+    length = 0
+    for k in range(i+1, i+1+n):
+        length = length<<8 | ord(view[k])
+    if strict and length < (0x80 if n==1 else 1<<8*(n-1)):
+        raise TLVException('Length %d at %d not in the shortest form' % (length, i))
+    return length, i+1+n
+
+def iterate(data, offset=0, end=None, strict=False):
+    ''' Yields (tag, value) of the BER-TLVs of data from offset to end, a single level: the tag as
+        hexdigits, the value a memoryview of data. Raise TLVException if malformed.
+
+         data: binary, a string, a bytearray or a memoryview
+         strict: True to reject the lengths not in the shortest form
+    '''
+    view = memoryview(data)
+    end = len(view) if end is None else end
+    i = offset
+    try:
+        while i < end:
+            tag, j = readtag(view, i)
+            length, j = readlength(view, j, strict)
+            if j+length > end:
+                raise TLVException('Too short: %d bytes of value expected for tag %s at %d, %d left' % (length, tag, i, end-j))
+            yield tag, view[j:j+length]
+            i = j+length
+    except IndexError:
+        raise TLVException('Too short: No enough fields for the TLV at %d' % i)
+
+def iterfixed(data, tagsize=1, lengthsize=2, offset=0, end=None):
+    ''' Yields (tag, value) of simple TLVs, the tag & length fields of a fixed size, big-endian,
+        like the components of a CAP file (u1 tag, u2 size): the tag as an integer, the value a
+        memoryview of data. Raise TLVException if malformed.
+    '''
+    view = memoryview(data)
+    end = len(view) if end is None else end
+    i = offset
+    while i < end:
+        j = i+tagsize+lengthsize
+        if j > end:
+            raise TLVException('Too short: No enough fields for the TLV at %d' % i)
+        tag = length = 0
+        for k in range(i, i+tagsize):
+            tag = tag<<8 | ord(view[k])
+        for k in range(i+tagsize, j):
+            length = length<<8 | ord(view[k])
+        if j+length > end:
+            raise TLVException('Too short: %d bytes of value expected for tag %.2X at %d, %d left' % (length, tag, i, end-j))
+        yield tag, view[j:j+length]
+        i = j+length
+
+def isconstructed(tag):
+    ''' True if the tag, hexdigits, is the one of a constructed data object: bit b6 of the first byte '''
+    return bool(int(tag[:2], 16) & 0x20)
+
+
+class Node(object):
+    ''' A BER-TLV decoded: 'tag' as hexdigits, 'value' a memoryview, 'children' a list of Node for
+        a constructed one, None for a primitive one. The duplicate tags are all kept, in order.
+    '''
+
+    __slots__ = ('tag', 'value', 'children')
+
+    def __init__(self, tag, value, children=None):
+        self.tag = tag
+        self.value = value
+        self.children = children
+
+    def __iter__(self):
+        return iter(self.children or ())
+
+    def __len__(self):
+        return len(self.children or ())
+
+    def __repr__(self):
+        return 'Node(%s, %d bytes%s)' % (self.tag, len(self.value), ', %d children' % len(self.children) if self.children is not None else '')
+
+    def find(self, tag, default=None):
+        ''' Returns the first child of tag, default if none '''
+        for x in self.children or ():
+            if x.tag == tag:
+                return x
+        return default
+
+    def findall(self, tag):
+        ''' Returns the children of tag, a list '''
+        return [x for x in self.children or () if x.tag == tag]
+
+    def __getitem__(self, tag):
+        x = self.find(tag)
+        if x is None:
+            raise KeyError(tag)
+        return x
+
+    def __contains__(self, tag):
+        return self.find(tag) is not None
+
+    def hex(self):
+        ''' Returns the value as hexdigits '''
+        return b2a(self.value.tobytes())
+
+    def triple(self):
+        ''' Returns [t, l, v], hexdigits, like the items of unpacktlvs() '''
+        return [self.tag, toberlength(len(self.value)), self.hex()]
+
+    def encode(self):
+        ''' Returns the TLV, binary, the children encoded again if constructed '''
+        if self.children is None:
+            return encode(self.tag, self.value.tobytes())
+        return encode(self.tag, ''.join([x.encode() for x in self.children]))
 
+
+def decode(data, offset=0, end=None, strict=False):
+    ''' Returns the BER-TLVs of data, a list of Node, the constructed ones decoded recursively.
+        Raise TLVException if malformed.
+    '''
+    lst = []
+    for tag, value in iterate(data, offset, end, strict):
+        lst.append(Node(tag, value, decode(value, strict=strict) if isconstructed(tag) else None))
+    return lst
+
+def decodeone(data, strict=False):
+    ''' Returns the single BER-TLV of data, a Node, raise TLVException if there are more or none '''
+    lst = decode(data, strict=strict)
+    if len(lst) != 1:
+        raise TLVException('%d TLVs found, one expected' % len(lst))
+    return lst[0]
+
+def fromhex(tlvs, strict=False):
+    ''' decode() of hexdigits '''
+    try:
+        data = a2b(tlvs)
+    except TypeError:
+        raise TLVException('%s is not a valid TLVs string' % tlvs)
+    return decode(data, strict=strict)
+
+
+LENGTHS = [chr(i) for i in range(0x80)] + ['\x81'+chr(i) for i in range(0x80, 0x100)] # length : field, the short ones
+
+def berlength(length):
+    ''' Returns the BER-TLV length field of length, binary, in the shortest form '''
+    if 0 <= length < 0x100:
+        return LENGTHS[length]
+    elif 0x100 <= length < 0x10000:
+        return '\x82' + struct.pack('!H', length)
+    elif 0x10000 <= length < 0x1000000:
+        return '\x83' + struct.pack('!I', length)[1:]
+    elif 0x1000000 <= length < 0x100000000:
+        return '\x84' + struct.pack('!I', length)
+    raise TLVException('%d is not a valid TLV length' % length)
+
+def encode(tag, value):
+    ''' Returns the BER-TLV, binary: tag, hexdigits, the value binary '''
+    return a2b(tag) + berlength(len(value)) + value
+
+def encodeall(items):
+    ''' Returns the BER-TLVs of items, (tag, value) or Node, concatenated, binary '''
+    return ''.join([x.encode() if isinstance(x, Node) else encode(*x) for x in items])
+
+
+#----------------------------------------------------------------------------
 def unpacktlv(tlv):
     ''' 拆分TLV字符串，返回3个元素：t, l, v
-        目前仅支持L为0至255的TLV
+        tlv必须恰好是一个TLV，L须为最短的编码
 
         tlv: 例如 '61184F10A0000000871002FF86FF0289060100FF50045553494DFFFFFFFFFFFFFFFFFFFFFFFF'
     '''
-    t, l, v = '', '', ''
-
-    m = RE_BERTLV.match(tlv)
-    if m:
-        t, l, v = m.groups()
-        if len(l) == 2:
-            length = int(l, 16)
-            if length<0x80 and ((length+2)*2==len(tlv)):
-                return t, l, v
-        elif len(l) == 4:
-            if l[:2]=='81':
-                length = int(l[2:], 16)
-                if length>=0x80 and (length+3)*2==len(tlv):
-                    return t, l, v
-    raise TLVException('%s is not a valid TLV string' % tlv)
+    try:
+        lst = list(iterate(a2b(tlv), strict=True))
+    except (TypeError, TLVException):
+        lst = []
+    if len(lst) != 1:
+        raise TLVException('%s is not a valid TLV string' % tlv)
+    t, v = lst[0]
+    return t, toberlength(len(v)), b2a(v.tobytes())
 
 def toberlength(length):
-    if length <= 0x7F:
-        l = '%.2X' % length
-    elif length>=0x80 and length<=0xFF :
-        l = '81%.2X' % length
-    elif length>=0x100 and length<=0xFFFF :
-        l = '82%.4X' % length
-    else:
-        raise TLVException('%d is not a valid TLV length' % length)
-
-    return l
+    return b2a(berlength(length))
 
 def unpacktlvs(tlvs):
     ''' 将包含多个tlv的字符串拆分为若干个TLV
         
         返回值为若干个3元素的列表
     '''
-    tlvs = a2b(tlvs)
-    if len(tlvs)<2:
-        raise TLVException('%s is not a valid TLVs string' %s (b2a(tlvs)))
-    i, m, lst = 0, len(tlvs), []
-
-    while i<m:
-        t = tlvs[i+0]
-        t = tlvs[i+0:i+2] if (ord(t)&0x1F==0x1F) else t # 'T' needs 2 bytes or 1 bytes
-        i += len(t)
-        
-        l1 = ord(tlvs[i])
-        if l1>0x82: #
-            raise TLVException('%s is not a valid TLVs string' %s (b2a(tlvs)))
-        if l1==0x81:
-            length = ord(tlvs[i+1])
-            if length<=0x7F:
-                raise TLVException('%s is not a valid TLVs string' %s (b2a(tlvs)))
-            i += 2
-        elif l1==0x82:
-            length = struct.unpack('!H', tlvs[i+1:i+3])[0]
-            if length<=0x100:
-                raise TLVException('%s is not a valid TLVs string' %s (b2a(tlvs)))
-            i += 3
-        else:
-            i += 1
-            length = l1
-
-        v = tlvs[i:i+length]
-        if len(v)!=length:
-            raise TLVException('%s is not a valid TLVs string' %s (b2a(tlvs)))
-        i += length
-
-        lst.append([b2a(t), toberlength(len(v)), b2a(v)])
-    return lst
-
-def unpacktlvs2dict(tlvs):
-    lst = unpacktlvs(tlvs)
+    try:
+        data = a2b(tlvs)
+    except TypeError:
+        raise TLVException('%s is not a valid TLVs string' % tlvs)
+    if len(data)<2:
+        raise TLVException('%s is not a valid TLVs string' % tlvs)
+    try:
+        return [[t, toberlength(len(v)), b2a(v.tobytes())] for t, v in iterate(data, strict=True)]
+    except TLVException, e:
+        raise TLVException('%s is not a valid TLVs string: %s' % (tlvs, e))
+
+def unpacktlvs2dict(tlvs, multiple=False):
+    ''' 将包含多个tlv的字符串拆分为有序字典，tag : [t, l, v]
+
+        multiple: False，重复的tag取第一个；True，tag : 所有该tag的[t, l, v]的列表
+    '''
     dit = collections.OrderedDict() 
-    for x in lst:
-        dit[x[0]] = x
+    for x in unpacktlvs(tlvs):
+        if multiple:
+            dit.setdefault(x[0], []).append(x)
+        else:
+            dit.setdefault(x[0], x)
     return dit
 
 
@@ -122,18 +285,10 @@ def jointv(t, v):
     '''
     if len(t) < 2:
         raise TLVException("Too short T: %s , %d" % (t, len(t)))
-    t, v = a2b(t), a2b(v)
-    l = len(v)
-    if l >= 0x10000:
+    v = a2b(v)
+    if len(v) >= 0x10000:
         raise TLVException("Too long V: %s , %d" % (v, len(v)))
-
-    if l <= 0x7F:
-        tlv = t+chr(l)+v
-    elif l>=0x80 and l<=0xFF :
-        tlv = t+'\x81'+chr(l)+v
-    elif l>=0x100 and l<=0xFFFF :
-        tlv = t+'\x82'+ struct.pack('!H', l) +v
-    return b2a(tlv)
+    return b2a(encode(t, v))
 
 #-------------------------------------------------------------------------------
 class TestModule(unittest.TestCase):
@@ -168,6 +323,8 @@ class TestModule(unittest.TestCase):
 
     def test_unpacktlv(self):
         for i in range(0x80):
+            if i&0x1F==0x1F: # the first byte of a multi-byte tag, see test_iterate
+                continue
             t = '%.2X' % (i&0xFF)
             tlv = jointv(t,t*i)
             t1, l1, v1 = unpacktlv(tlv)
@@ -175,6 +332,8 @@ class TestModule(unittest.TestCase):
             self.assertEqual(t, l1)
             self.assertEqual(t*i, v1)
         for i in range(0x80, 0x100):
+            if i&0x1F==0x1F:
+                continue
             t = '%.2X' % (i&0xFF)
             tlv = jointv(t,t*i)
             t1, l1, v1 = unpacktlv(tlv)
@@ -212,7 +371,74 @@ class TestModule(unittest.TestCase):
         self.assertEqual('8B032F0602', ''.join(lst[4]))
         self.assertEqual('C60C90016083010183010A830181', ''.join(lst[5]))
 
-	
+        self.assertRaises(TLVException, unpacktlvs, '4F')
+        self.assertRaises(TLVException, unpacktlvs, '4F0')
+        self.assertRaises(TLVException, unpacktlvs, '4F05A000')
+        self.assertRaises(TLVException, unpacktlvs, '4F8105A000000003')
+        self.assertRaises(TLVException, unpacktlvs, '4F85')
+
+        dit = unpacktlvs2dict('84010184010250024142')
+        self.assertEqual(dit.keys(), ['84', '50'])
+        self.assertEqual(dit['84'], ['84', '01', '01'])
+        dit = unpacktlvs2dict('84010184010250024142', multiple=True)
+        self.assertEqual([x[2] for x in dit['84']], ['01', '02'])
+
+    def test_iterate(self):
+        ''' 多字节的T，1至4字节的L，值为memoryview '''
+        data = a2b('9F7001075F2D02656E' + '1F8101' + '00' + 'DF8F01' + '8180' + 'AA'*0x80)
+        lst = list(iterate(data))
+        self.assertEqual([t for t, v in lst], ['9F70', '5F2D', '1F8101', 'DF8F01'])
+        self.assertEqual([len(v) for t, v in lst], [1, 2, 0, 0x80])
+        self.assertTrue(isinstance(lst[0][1], memoryview))
+        self.assertEqual(lst[1][1].tobytes(), 'en')
+        self.assertEqual([(t, v.tobytes()) for t, v in iterate(data, 4, 9)], [('5F2D', 'en')])
+
+        for length, field in ((0, '00'), (0x7F, '7F'), (0x80, '8180'), (0xFF, '81FF'), (0x100, '820100'),
+                (0xFFFF, '82FFFF'), (0x10000, '83010000'), (0x1000000, '8401000000')):
+            self.assertEqual(toberlength(length), field)
+            self.assertEqual(readlength(a2b(field), 0, strict=True), (length, len(field)//2))
+        self.assertEqual(readlength(a2b('820005'), 0), (5, 3))
+        self.assertRaises(TLVException, readlength, a2b('820005'), 0, True)
+        self.assertRaises(TLVException, readlength, a2b('85'), 0)
+        self.assertRaises(TLVException, list, iterate(a2b('9F')))
+        self.assertRaises(TLVException, list, iterate(a2b('9F70')))
+        self.assertRaises(TLVException, list, iterate(a2b('9F7002AA')))
+        self.assertRaises(TLVException, list, iterate(a2b('4F83')))
+
+        self.assertEqual([(t, v.tobytes()) for t, v in iterfixed(a2b('0100020102030000'))], [(1, '\x01\x02'), (3, '')])
+        self.assertRaises(TLVException, list, iterfixed(a2b('010002')))
+
+    def test_tree(self):
+        ''' 构造型TLV递归解析为树，重复的tag均保留，编码后与原始数据相同 '''
+        fcp = '62268205422100260283022F00A50AC00100CD02FF00CA01848A01058B032F06018002004C8801F0'
+        root = decodeone(a2b(fcp))
+        self.assertEqual(root.tag, '62')
+        self.assertEqual([x.tag for x in root], ['82', '83', 'A5', '8A', '8B', '80', '88'])
+        self.assertEqual(root['A5'].find('CD').hex(), 'FF00')
+        self.assertEqual(root['83'].triple(), ['83', '02', '2F00'])
+        self.assertEqual(root['82'].children, None)
+        self.assertTrue('88' in root and 'C6' not in root)
+        self.assertEqual(b2a(root.encode()), fcp)
+        self.assertEqual(b2a(encodeall(root)), fcp[4:])
+
+        root = fromhex('E3124F07A0000001510000C50180' + '8401AA8401BB')[0]
+        self.assertEqual([x.hex() for x in root.findall('84')], ['AA', 'BB'])
+        self.assertEqual(b2a(encodeall([('4F', '\xA0\x00'), root.find('C5')])), '4F02A000C50180')
+        self.assertRaises(TLVException, decodeone, a2b('E1034F02A0'))
+        self.assertRaises(TLVException, decodeone, a2b('83023F0083023F00'))
+        self.assertRaises(TLVException, fromhex, '8302')
+
+        data = a2b('E1' + toberlength(4*0x1000) + '8002ABCD'*0x1000) * 0x10
+        t = time.time()
+        n = 0
+        for x in decode(data):
+            n += len(x)
+        Logger.info('%d TLVs decoded, %.0f TLVs/s', n, n/max(time.time()-t, 1e-6))
+        self.assertEqual(n, 0x10000)
+        t = time.time()
+        self.assertEqual(encodeall([('80', '\xAB\xCD')]*0x10000), data[4:0x4004]*0x10)
+        Logger.info('%d TLVs encoded, %.0f TLVs/s', 0x10000, 0x10000/max(time.time()-t, 1e-6))
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
@@ -0,0 +1,447 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with APDU traces.
+
+The module records every command, response, SW & timing transmitted by api_pcsc into a compact
+append-only binary file, and replays a recorded trace to a card (or a virtual card) comparing
+the responses. Replay transmits the recorded bytes as is, no key derivation, no CAP parsing,
+so a failure on the line can be reproduced & bisected quickly.
+
+    writer = api_trace.TraceWriter(r'.\\line.trace')
+    api_pcsc.setrecorder(writer)
+    ... # run tests
+    writer.close()
+
+    differences = api_trace.replay(r'.\\line.trace')
+
+Trace format, little endian:
+
+    header: magic 'SVSTRACE', version (2 bytes), reserved (2 bytes)
+    record: kind (1), flags (1), SW (2), command length (2), response length (2),
+            timestamp (double, seconds since epoch), duration (double, seconds),
+            command, response
+
+A RESET record has the ATR as response, a MARK record has a text as command. A record cut by a
+crash at the end of file is ignored. The reader maps the file into memory, so traces of hundreds
+of MB can be scanned without loading them.
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import os, mmap, struct, time, timeit, logging, unittest, threading, collections, tempfile
+import api_pcsc
+
+#-------------------------------------------------------------------------------
+# define own Exception class
+
+class TraceException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+MAGIC = 'SVSTRACE'
+VERSION = 1
+HEADER = struct.Struct('<8sHH') # magic, version, reserved
+RECORD = struct.Struct('<BBHHHdd') # kind, flags, sw, command length, response length, timestamp, duration
+
+APDU = 1
+RESET = 2
+MARK = 3
+
+# command & response are binary strings, offset is the position of the record in file
+TraceRecord = collections.namedtuple('TraceRecord', 'kind sw timestamp duration command response offset')
+
+# index: number of the APDU in trace, expected & actual: (response, sw) as hexdigits
+Difference = collections.namedtuple('Difference', 'index offset command expected actual')
+
+
+#-------------------------------------------------------------------------------
+# define API
+
+class TraceWriter(object):
+    ''' Append records to a trace file, can be set as the recorder of api_pcsc sessions.
+        Thread safe, one writer can be shared by all sessions of a SessionPool.
+    '''
+
+    def __init__(self, path, flush=False):
+        ''' path: the trace file, created if not existed, appended otherwise
+            flush: True to flush each record to disk, slower but nothing lost on crash
+        '''
+        self.path = path
+        self.autoflush = flush
+        self.lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path)==0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+
+    def write(self, kind, sw, command, response, timestamp, duration):
+        command, response = bytes(bytearray(command)), bytes(bytearray(response))
+        rec = RECORD.pack(kind, 0, sw, len(command), len(response), timestamp, duration)
+        with self.lock:
+            self.file.write(rec + command + response)
+            if self.autoflush:
+                self.file.flush()
+
+    def apdu(self, command, response, sw1, sw2, timestamp, duration):
+        ''' command & response: a list of integer '''
+        self.write(APDU, (sw1<<8)|sw2, command, response, timestamp, duration)
+
+    def reset(self, atr):
+        ''' atr: a list of integer '''
+        self.write(RESET, 0, '', atr, time.time(), 0.0)
+
+    def mark(self, text):
+        ''' Write a text, the name of a test for example, to find a part of the trace later '''
+        self.write(MARK, 0, text.encode('utf-8') if isinstance(text, unicode) else text, '', time.time(), 0.0)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TraceHandler(logging.Handler):
+    ''' A logging handler writing the APDUs logged by api_pcsc.send() to a trace, as binary
+        records, without any formatting. Unlike a recorder, one record per send(): the command as
+        given & the final response, after GET RESPONSE if any.
+
+        logging.getLogger('api_pcsc').addHandler(api_trace.TraceHandler(r'.\\send.trace'))
+    '''
+
+    def __init__(self, path, level=logging.DEBUG):
+        logging.Handler.__init__(self, level)
+        self.writer = TraceWriter(path)
+
+    def emit(self, record):
+        x = record.msg
+        if isinstance(x, api_pcsc.APDUMessage) and x.response is not None:
+            self.writer.apdu(x.command, x.response, x.sw1, x.sw2, record.created, x.time/1000.0)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        logging.Handler.close(self)
+
+
+class TraceReader(object):
+    ''' Read a trace file through mmap. Records are decoded one by one while iterating.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.path.getsize(path)
+        if size<HEADER.size:
+            self.file.close()
+            raise TraceException('Not a trace file: %s' % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, reserved = HEADER.unpack_from(self.map, 0)
+        if magic!=MAGIC or version!=VERSION:
+            self.close()
+            raise TraceException('Not a trace file, or unsupported version: %s' % path)
+
+    def read(self, offset):
+        ''' Returns the record at offset, or None if the record is cut '''
+        m, n = self.map, RECORD.size
+        if offset+n>len(m):
+            return None
+        kind, flags, sw, lc, lr, timestamp, duration = RECORD.unpack_from(m, offset)
+        a = offset+n
+        if a+lc+lr>len(m):
+            return None
+        return TraceRecord(kind, sw, timestamp, duration, m[a:a+lc], m[a+lc:a+lc+lr], offset)
+
+    def __iter__(self):
+        m, n, offset, size = self.map, RECORD.size, HEADER.size, len(self.map)
+        unpack = RECORD.unpack_from
+        while offset+n<=size:
+            kind, flags, sw, lc, lr, timestamp, duration = unpack(m, offset)
+            a = offset+n
+            b = a+lc+lr
+            if b>size:
+                break
+            yield TraceRecord(kind, sw, timestamp, duration, m[a:a+lc], m[a+lc:b], offset)
+            offset = b
+        if offset!=size:
+            Logger.warning('%s: %d bytes cut at the end of trace ignored' % (self.path, size-offset))
+
+    def apdus(self):
+        ''' Yields APDU records only '''
+        for x in self:
+            if x.kind==APDU:
+                yield x
+
+    def index(self):
+        ''' Returns the offsets of all records, to be read with read(), without decoding them '''
+        m, n, offset, size, lst = self.map, RECORD.size, HEADER.size, len(self.map), []
+        unpack = RECORD.unpack_from
+        while offset+n<=size:
+            lc, lr = unpack(m, offset)[3:5]
+            if offset+n+lc+lr>size:
+                break
+            lst.append(offset)
+            offset += n+lc+lr
+        return lst
+
+    def close(self):
+        if hasattr(self, 'map'):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ReplayResult(list):
+    ''' A list of Difference, with the number of APDUs replayed & the time used in ms. '''
+
+    def __init__(self, lst, apdus, time):
+        list.__init__(self, lst)
+        self.apdus = apdus
+        self.time = time
+
+    def ok(self):
+        return len(self)==0
+
+
+def markignored(records, ignore):
+    ''' Yields (record, ignored), ignored is True if the response data of the record is not to
+        be compared. The GET RESPONSE following an ignored command is ignored too.
+
+        ignore: INS whose response data is not compared, like 0x50 (INITIALIZE UPDATE) & 0x84
+                (GET CHALLENGE) with random response
+    '''
+    last = None
+    for x in records:
+        ins = ord(x.command[1]) if x.kind==APDU and len(x.command)>1 else None
+        if ins==0xC0:
+            yield x, last in ignore
+        else:
+            last = ins
+            yield x, ins in ignore
+
+
+def compare(record, response, sw, ignored=False):
+    ''' Returns True if the response & sw are the same as recorded, only sw if ignored.
+    '''
+    if sw!=record.sw:
+        return False
+    return ignored or response==record.response
+
+
+def formatrecord(command, response, sw):
+    return api_pcsc.b2a(command), (api_pcsc.b2a(response), '%.4X' % sw)
+
+
+def replay(trace, session=None, ignore=(), resets=True, stopOnDiff=False):
+    ''' Transmit the commands of a trace to the card of a session, compare the responses.
+
+        trace: path to the trace file, or a TraceReader
+        session: api_pcsc.ReaderSession, the one bound to the calling thread if not given
+        ignore: INS whose response data is not compared, see compare()
+        resets: True to reset the card where the trace has a RESET record
+        stopOnDiff: True to stop at the first difference
+
+        Returns a ReplayResult.
+    '''
+    session = session if session else api_pcsc.getsession()
+    if not session.connection:
+        raise api_pcsc.PCSCException('No existed connection! Please connect reader!')
+    reader = trace if isinstance(trace, TraceReader) else TraceReader(trace)
+    ignore = frozenset(ignore)
+    lst, count = [], 0
+
+    try:
+        t0 = timeit.default_timer()
+        for x, ignored in markignored(reader, ignore):
+            if x.kind==RESET:
+                if resets and count:
+                    session.reset()
+                continue
+            if x.kind!=APDU:
+                continue
+
+            res, sw1, sw2 = session.connection.transmit(list(bytearray(x.command)))
+            response, sw = bytes(bytearray(res)), (sw1<<8)|sw2
+            if not compare(x, response, sw, ignored):
+                command, expected = formatrecord(x.command, x.response, x.sw)
+                actual = formatrecord('', response, sw)[1]
+                lst.append(Difference(count, x.offset, command, expected, actual))
+                Logger.debug('Replay, APDU %d differs: %s, [%s](%s) != [%s](%s)' % ((count, command) + expected + actual))
+                if stopOnDiff:
+                    count += 1
+                    break
+            count += 1
+        t = (timeit.default_timer()-t0)*1000
+    finally:
+        if reader is not trace:
+            reader.close()
+
+    Logger.debug('Replay, %d APDUs, %d differences ; %.3f ms' % (count, len(lst), t))
+    return ReplayResult(lst, count, t)
+
+
+def diff(trace1, trace2, ignore=()):
+    ''' Compare the APDUs of 2 traces, for example a golden run & a failing run, without card.
+
+        Returns a list of Difference, expected from trace1, actual from trace2. The extra APDUs of
+        the longer trace are differences with an empty side.
+    '''
+    ignore = frozenset(ignore)
+    with TraceReader(trace1) as r1:
+        with TraceReader(trace2) as r2:
+            lst, count = [], 0
+            a, b = markignored(r1.apdus(), ignore), r2.apdus()
+            while True:
+                (x, ignored), y = next(a, (None, False)), next(b, None)
+                if x is None and y is None:
+                    break
+                if x is None or y is None or x.command!=y.command or not compare(x, y.response, y.sw, ignored):
+                    z = x if x else y
+                    command = api_pcsc.b2a(z.command)
+                    expected = formatrecord('', x.response, x.sw)[1] if x else ('', '')
+                    actual = formatrecord('', y.response, y.sw)[1] if y else ('', '')
+                    lst.append(Difference(count, z.offset, command, expected, actual))
+                count += 1
+    return lst
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def setUp(self):
+        import api_virtualcard
+        self.path = tempfile.mktemp(suffix='.trace')
+        self.card = api_virtualcard.createusim()
+        self.old = api_pcsc.settransport(api_virtualcard.createtransport(self.card))
+        self.session = api_pcsc.ReaderSession()
+        self.oldsession = api_pcsc.bindsession(self.session)
+
+    def tearDown(self):
+        api_pcsc.disconnect()
+        api_pcsc.bindsession(self.oldsession)
+        api_pcsc.settransport(self.old)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def record(self):
+        import api_incarddata, api_gp
+        writer = TraceWriter(self.path)
+        api_pcsc.setrecorder(writer)
+        api_pcsc.connectreader()
+        card = api_incarddata.Usim()
+        writer.mark('usim')
+        card.select('3F00')
+        card.select('2FE2')
+        card.readbinary(0, 10)
+        card.verifypin('31313131FFFFFFFF')
+        writer.mark(u'gp')
+        api_gp.card()
+        api_gp.auth()
+        api_pcsc.setrecorder(None)
+        writer.close()
+
+    def test_record(self):
+        ''' 录制、读取trace，被截断的记录应被忽略 '''
+        self.record()
+        with TraceReader(self.path) as r:
+            lst = list(r)
+            self.assertEqual([x.kind for x in lst].count(RESET), 2)
+            self.assertEqual([x.command for x in lst if x.kind==MARK], ['usim', 'gp'])
+            apdus = list(r.apdus())
+            self.assertEqual(apdus[0].command, '\x00\xA4\x00\x04\x02\x3F\x00')
+            self.assertEqual(apdus[-1].sw, 0x9000)
+            self.assertEqual(r.index(), [x.offset for x in lst])
+            self.assertEqual(r.read(apdus[2].offset), apdus[2])
+
+        with open(self.path, 'ab') as f:
+            f.write(RECORD.pack(APDU, 0, 0x9000, 5, 0, 0.0, 0.0) + '\x00\xB0')
+        with TraceReader(self.path) as r:
+            self.assertEqual(len(list(r)), len(lst))
+
+    def test_handler(self):
+        ''' 用TraceHandler把api_pcsc的DEBUG日志写成二进制trace '''
+        logger = logging.getLogger('api_pcsc')
+        handler = TraceHandler(self.path)
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            api_pcsc.connectreader()
+            api_pcsc.send('00A40004023F00')
+            api_pcsc.send('00A40004022FE2')
+            api_pcsc.send('00B000000A')
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+            handler.close()
+
+        with TraceReader(self.path) as r:
+            lst = list(r)
+        self.assertEqual([api_pcsc.b2a(x.command) for x in lst], ['00A40004023F00', '00A40004022FE2', '00B000000A'])
+        self.assertEqual((api_pcsc.b2a(lst[2].response), lst[2].sw), ('982520506196020013F3', 0x9000))
+
+    def test_replay(self):
+        ''' 将trace重放到虚拟卡，比对响应 '''
+        self.record()
+        self.assertRaises(api_pcsc.PCSCException, replay, self.path, api_pcsc.ReaderSession())
+
+        # the card challenge is random, so EXTERNAL AUTHENTICATE fails
+        api_pcsc.connectreader()
+        result = replay(self.path, ignore=(0x50,))
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].command[:4], '8482')
+
+        # another ICCID
+        self.card.mf.find('2FE2').data[9] = 0xF4
+        result = replay(self.path, ignore=(0x50,), stopOnDiff=True)
+        self.assertEqual(result[0].actual, ('982520506196020013F4', '9000'))
+        self.assertEqual(result.apdus, result[0].index+1)
+        self.assertEqual(result.count(result[0]), 1)
+
+        # 2 traces
+        path = self.path
+        self.path = tempfile.mktemp(suffix='.trace')
+        try:
+            self.record()
+            lst = diff(path, self.path, ignore=(0x50,))
+            self.assertEqual([x.command[:4] for x in lst], ['00B0', '8482'])
+        finally:
+            os.remove(path)
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
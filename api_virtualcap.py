@@ -13,7 +13,10 @@ Copyright 2015 XH Smart Card Co,.Ltd
 Author: atr@china-xinghan.com
 """
 
-import struct, binascii, zipfile, re, unittest
+import struct, binascii, zipfile, collections, multiprocessing, random, time, os, re, logging, unittest
+import api_cap
+
+Logger = logging.getLogger(__name__)
 
 
 #----------------------------------------------------------------------------
@@ -41,7 +44,7 @@ SEQUENCE = (
     'StaticField.cap',
     'Export.cap',
     'ConstantPool.cap',
-    'ReferenceLocation.cap',
+    'RefLocation.cap',
     'Descriptor.cap', # optional
     'Debug.cap', # optional
     )
@@ -54,13 +57,18 @@ class Component(object):
             u2 size
             u1 info[]
         }
+
+        'decoded' is the component decoded by api_cap, see decoder.
     '''
 
-    def __init__(self, tlv):
+    decoder = api_cap.Component
+
+    def __init__(self, tlv, *args):
         self.tag, self.size, self.info = tlv[0], getshort(tlv[1:3]), tlv[3:]
+        self.decoded = self.decoder.frombytes(tlv, *args)
 
     def __str__(self):
-        return self.tag + self.size + self.info
+        return self.tag + setshort(len(self.info)) + self.info
 
 
 #----------------------------------------------------------------------------
@@ -78,6 +86,8 @@ class Header(Component):
         }
     '''
 
+    decoder = api_cap.Header
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -95,6 +105,9 @@ class Directory(Component):
             custom_component_info custom_components[custom_count]
         }
     '''
+
+    decoder = api_cap.Directory
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -108,6 +121,9 @@ class Import(Component):
             package_info packages[count]
         }
     '''
+
+    decoder = api_cap.Import
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -124,6 +140,9 @@ class Applet(Component):
                 } applets[count]
         }
     '''
+
+    decoder = api_cap.Applet
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -138,8 +157,14 @@ class Clazz(Component):
             interface_info interfaces[]
         }
     '''
-    def __init__(self, tlv):
-        Component.__init__(self, tlv)
+
+    decoder = api_cap.Class
+
+    def __init__(self, tlv, minor=2):
+        ''' minor: minor_version of the CAP file, no signature_pool before 2.2 '''
+        Component.__init__(self, tlv, minor)
+        self.signature_pool = self.decoded.signature_pool
+        self.classes = self.decoded.classes # interface_info & class_info, dictionaries
 
 
 #----------------------------------------------------------------------------
@@ -180,6 +205,10 @@ class Exception_handler_info(object):
         # the exception caught by this exception_handlers array entry.
         self.catch_type_index = getshort(v[6:8])
 
+    def __str__(self):
+        bitfield = (0x8000 if self.stop_bit else 0) | (self.active_length & 0x7FFF)
+        return struct.pack('!4H', self.start_offset, bitfield, self.handler_offset, self.catch_type_index)
+
 class Methods(Component):
     '''
         method_component {
@@ -190,6 +219,9 @@ class Methods(Component):
             method_info methods[]
         }
     '''
+
+    decoder = api_cap.Method
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
         # The start_offset item and end_offset are byte offsets into the info item of
@@ -201,7 +233,7 @@ class Methods(Component):
         self.methods = self.info[1+getbyte(self.info[0])*8:]
 
     def __str__(self):
-        info = ord(len(self.exception_handlers)) + self.exception_handlers + self.methods
+        info = chr(len(self.exception_handlers)) + ''.join(map(str, self.exception_handlers)) + self.methods
         return self.tag + setshort(len(info)) + info
 
 #----------------------------------------------------------------------------
@@ -219,8 +251,12 @@ class StaticField(Component):
             u1 non_default_values[non_default_values_count]
         }
     '''
+
+    decoder = api_cap.StaticField
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
+        self.array_init = self.decoded.array_init # (type, values)
 
 #----------------------------------------------------------------------------
 class Export(Component):
@@ -238,6 +274,9 @@ class Export(Component):
             } class_exports[class_count]
         }
     '''
+
+    decoder = api_cap.Export
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -251,6 +290,9 @@ class ConstantPool(Component):
             cp_info constant_pool[count]
         }
     '''
+
+    decoder = api_cap.ConstantPool
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -266,6 +308,9 @@ class ReferenceLocation(Component):
             u1 offsets_to_byte2_indices[byte2_index_count]
         }
     '''
+
+    decoder = api_cap.RefLocation
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -280,6 +325,9 @@ class Descriptor(Component):
             type_descriptor_info types
         }
     '''
+
+    decoder = api_cap.Descriptor
+
     def __init__(self, tlv):
         Component.__init__(self, tlv)
 
@@ -301,10 +349,11 @@ class Class_debug_info(object):
         }
     '''
     def __init__(self, data):
-        pass
+        ''' data: a dictionary decoded by api_cap.Debug.classinfo() '''
+        self.__dict__.update(data)
 
     def __str__(self):
-        return
+        return self.name
 
 class Debug(Component):
     '''
@@ -318,45 +367,38 @@ class Debug(Component):
             class_debug_info classes[class_count]
         }
     '''
-    def __init__(self, tlv):
-        Component.__init__(self, tlv)
-
-        # strings_table
-        count = getshort(self.info[:2])
-        v = self.info[2:]
-        self.strings_table = []
-        j = 0
-        for i in range(count):
-            lgth = getshort(v[j:j+2])
-            utf8_info = v[j+2:j+2+lgth]
-            j += 2+lgth
-            self.strings_table.append(utf8_info)
 
-        # package name
-        v = v[j:]
-        self.package_name = self.strings_table[getshort(v[:2])]
-        j += 2
+    decoder = api_cap.Debug
 
-        # class
-        v = v[2:]
-        count = getshort(v[:2])
-        v = v[2:]
-
-        self.classes = []
-        for i in range(count):
-            pass
+    def __init__(self, tlv):
+        Component.__init__(self, tlv)
+        self.strings_table = self.decoded.strings
+        self.package_name = self.decoded.package_name
+        self.classes = [Class_debug_info(x) for x in self.decoded.classes]
 
 
 #----------------------------------------------------------------------------
 class CapEditor(object):
 
-    ''' <JavaCard222VMspec.pdf>, chapter 6, The CAP File Format '''
+    ''' <JavaCard222VMspec.pdf>, chapter 6, The CAP File Format
 
-    def __init__(self, path):
-        self.jar = zipfile.ZipFile(path, 'r') # a zipfile
-        self.parse()
+         The components are read once & edited as binary strings, keyed by their file names:
 
-    def parse(self):
+            editor = CapEditor(path)
+            editor['Method.cap'] = editor['Method.cap'][:-1] # truncated
+            editor.write(out) # the sizes of the components & Directory recomputed
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.locked = set() # the components of which the sizes are kept by fixsizes()
+        jar = zipfile.ZipFile(path, 'r') # a zipfile
+        try:
+            self.parse(jar)
+        finally:
+            jar.close()
+
+    def parse(self, jar):
         ''' 
             net/sourceforge/globalplatform/jc/helloworld/javacard/Header.cap
             net/sourceforge/globalplatform/jc/helloworld/javacard/Directory.cap
@@ -369,10 +411,18 @@ class CapEditor(object):
             net/sourceforge/globalplatform/jc/helloworld/javacard/RefLocation.cap
             net/sourceforge/globalplatform/jc/helloworld/javacard/Descriptor.cap
         '''
-        filenames = map(lambda x:x.filename, self.jar.infolist())
-        paths = filter(lambda x:x.endswith('.cap'), filenames) # we don't care other files
-        pattern = re.compile(r'^([0-9a-zA-Z//]+/)javacard/(\w+\.cap)')
-        self.components = dict([(pattern.match(path).group(1), self.jar.read(path)) for path in paths]) # a dictionary
+        self.infos = jar.infolist() # all the members, in order, written back by write()
+        self.members = dict([(x.filename, jar.read(x.filename)) for x in self.infos])
+        self.keys = {} # member name : component file name
+        self.components = {} # a dictionary, 'Header.cap' : binary
+        self.package = ''
+        pattern = re.compile(r'^(.*/)javacard/(\w+\.cap)$')
+        for x in self.infos:
+            m = pattern.match(x.filename)
+            if m: # we don't care other files
+                self.package = m.group(1)
+                self.keys[x.filename] = m.group(2)
+                self.components[m.group(2)] = self.members[x.filename]
  
     def __str__(self, descriptor=False, debug=False):
         ''' joins all cap files to form a binary string '''
@@ -389,6 +439,392 @@ class CapEditor(object):
     def __getitem__(self, key):
         return self.components.get(key, '')
 
+    def __setitem__(self, key, value):
+        self.components[key] = value
+
+    def copy(self):
+        ''' Returns a copy to be edited, the zip file not read again '''
+        x = CapEditor.__new__(CapEditor)
+        x.__dict__.update(self.__dict__)
+        x.components = dict(self.components)
+        x.locked = set(self.locked)
+        return x
+
+    def fixsizes(self):
+        ''' Recompute the 'size' item of the components & the 'component_sizes' of Directory, but
+            the ones of the components in self.locked.
+        '''
+        for key, data in self.components.items():
+            if key not in self.locked and len(data) >= 3:
+                self.components[key] = data[0] + setshort(len(data)-3) + data[3:]
+        data = self.components.get('Directory.cap', '')
+        if 'Directory.cap' not in self.locked and len(data) >= 3+24:
+            sizes = list(struct.unpack_from('!12H', data, 3))
+            for i, name in enumerate(api_cap.list_component):
+                key = name + '.cap'
+                if key in self.components and key not in self.locked:
+                    sizes[i] = max(len(self.components[key])-3, 0)
+            self.components['Directory.cap'] = data[:3] + struct.pack('!12H', *sizes) + data[27:]
+
+    def write(self, path, fix=True):
+        ''' Write a CAP file, the members in the order & with the names & dates of the original one
+            so that the same components give the same bytes.
+
+             path: a file name or a file object
+             fix: True to call fixsizes() first
+        '''
+        if fix:
+            self.fixsizes()
+        jar = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for x in self.infos:
+                key = self.keys.get(x.filename)
+                if key and key not in self.components: # removed
+                    continue
+                info = zipfile.ZipInfo(x.filename, x.date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = x.external_attr
+                jar.writestr(info, self.components[key] if key else self.members[x.filename])
+        finally:
+            jar.close()
+
+
+#----------------------------------------------------------------------------
+# Mutations of CAP files, to load malformed packages at high volume: a mutant is made of a seed,
+# deterministic, in worker processes, see generate() & campaign().
+
+KINDS = (
+    'overflow', # a count or length item of a component set out of range
+    'offset', # an offset into Method, Class component... beyond the end or into an instruction
+    'cpindex', # an index of constant pool in the bytecodes, at RefLocation, beyond the pool
+    'truncate', # a component cut, with its size kept or recomputed
+    'bytecode', # an undefined opcode, a type confused one, a branch out of its method
+    )
+
+Mutant = collections.namedtuple('Mutant', 'seed kind component offset before after description path')
+
+# type confusion: a reference instruction swapped for the short one & vice versa
+dit_confusion = {
+    0x15 : 0x16, 0x16 : 0x15, # aload, sload
+    0x18 : 0x19, 0x19 : 0x18, 0x1A : 0x1B, 0x1B : 0x1A, 0x1C : 0x1D, 0x1D : 0x1C, 0x1E : 0x1F, 0x1F : 0x1E, # aload_<n>, sload_<n>
+    0x28 : 0x29, 0x29 : 0x28, # astore, sstore
+    0x2B : 0x2C, 0x2C : 0x2B, 0x2D : 0x2E, 0x2E : 0x2D, 0x2F : 0x30, 0x30 : 0x2F, 0x31 : 0x32, 0x32 : 0x31, # astore_<n>, sstore_<n>
+    0x24 : 0x26, 0x26 : 0x24, 0x37 : 0x39, 0x39 : 0x37, # aaload, saload, aastore, sastore
+    0x77 : 0x78, 0x78 : 0x77, # areturn, sreturn
+    0x83 : 0x85, 0x85 : 0x83, 0x87 : 0x89, 0x89 : 0x87, # getfield_a, getfield_s, putfield_a, putfield_s
+    0xAD : 0xAF, 0xAF : 0xAD, 0xB5 : 0xB7, 0xB7 : 0xB5, # getfield_a_this, getfield_s_this, putfield_a_this, putfield_s_this
+    0x7B : 0x7D, 0x7D : 0x7B, 0x7F : 0x81, 0x81 : 0x7F, # getstatic_a, getstatic_s, putstatic_a, putstatic_s
+    }
+
+UNDEFINED_OPCODES = range(0xB9, 0xFE) # 0xFE & 0xFF are reserved, impdep1 & impdep2
+
+
+class Mutator(object):
+    ''' Make mutants of a CAP file, the targets of the mutations found once by api_cap:
+
+            mutator = Mutator(path)
+            editor, mutant = mutator.mutate(seed) # the same seed, the same mutant
+            editor.write(out)
+
+         Only the components of a Load File are mutated, Debug component excluded.
+    '''
+
+    def __init__(self, path, kinds=None):
+        ''' kinds: the kinds of mutation, a subset of KINDS, all if omitted '''
+        self.path = path
+        self.editor = CapEditor(path)
+        cap = api_cap.CAPFile(path)
+        self.pkg = cap.package()
+        c = self.pkg.components
+        self.targets = {
+                'overflow' : self.counts(c),
+                'offset' : self.offsets(c),
+                'cpindex' : self.cpindexes(c),
+                'truncate' : [x + '.cap' for x in api_cap.list_component if x in c and x != 'Debug'],
+                'bytecode' : self.instructions(),
+                }
+        self.kinds = [x for x in (kinds or KINDS) if self.targets[x]]
+        if not self.kinds:
+            raise api_cap.CAPException('Nothing to mutate in %s' % path)
+
+    def counts(self, c):
+        ''' Returns the count & length items, a list of (file name, offset into the component, size) '''
+        lst = [('Header.cap', 3+9, 1)] # AID_length of package_info
+        for i, name in enumerate(api_cap.list_component):
+            if name in c:
+                lst.append(('Directory.cap', 3+2*i, 2))
+        lst += [('Directory.cap', 3+24, 2), ('Directory.cap', 3+26, 2), ('Import.cap', 3, 1), ('ConstantPool.cap', 3, 2),
+                ('Method.cap', 3, 1), ('Descriptor.cap', 3, 1)]
+        if 'Applet' in c:
+            lst += [('Applet.cap', 3, 1), ('Applet.cap', 4, 1)]
+        if 'StaticField' in c:
+            lst += [('StaticField.cap', 3, 2), ('StaticField.cap', 5, 2), ('StaticField.cap', 7, 2)]
+        if 'RefLocation' in c:
+            lst += [('RefLocation.cap', 3, 2), ('RefLocation.cap', 3+c['RefLocation'].counts, 2)]
+        if c['Class'].minor >= 2:
+            lst.append(('Class.cap', 3, 2)) # signature_pool_length
+        for x in c['Class'].classes:
+            if not x['interface']: # declared_instance_size, reference_count, public_method_table_count
+                lst += [('Class.cap', 3+x['offset']+k, 1) for k in (3, 5, 7)]
+        for offset in self.pkg.offsets: # max_stack, nargs & max_locals
+            if not self.pkg.methods[offset]['header']['flags'] & api_cap.METHOD_EXTENDED:
+                lst += [('Method.cap', 3+offset, 1), ('Method.cap', 3+offset+1, 1)]
+        return lst
+
+    def offsets(self, c):
+        ''' Returns the offsets into components, a list of (file name, offset into the component,
+            size, name of the target component)
+        '''
+        lst = []
+        if 'Applet' in c: # install_method_offset
+            i = 1
+            for aid, offset in c['Applet'].applets():
+                i += 1+len(aid)//2
+                lst.append(('Applet.cap', 3+i, 2, 'Method'))
+                i += 2
+        cp = c['ConstantPool']
+        for k in range(cp.count):
+            tag, ref = cp.entry(k)
+            if tag == 6 and ref[0] == '\x00': # internal static method
+                lst.append(('ConstantPool.cap', 3+2+4*k+2, 2, 'Method'))
+            elif tag in (1, 2, 3, 4) and not ord(ref[0]) & 0x80: # internal class_ref
+                lst.append(('ConstantPool.cap', 3+2+4*k+1, 2, 'Class'))
+        for k in range(len(c['Method'].exception_handlers)): # start_offset, handler_offset
+            lst += [('Method.cap', 3+1+8*k, 2, 'Method'), ('Method.cap', 3+1+8*k+4, 2, 'Method')]
+        for x in c['Class'].classes:
+            if not x['interface']:
+                i = 3+x['offset']+10
+                lst += [('Class.cap', i+2*k, 2, 'Method') for k in range(len(x['public_virtual_method_table']))]
+        d, i = c['Descriptor'], 1
+        for x in d.classes: # method_offset
+            i += 9+2*len(x['interfaces'])+7*len(x['fields'])
+            lst += [('Descriptor.cap', 3+i+12*k+2, 2, 'Method') for k in range(len(x['methods'])) if x['methods'][k]['method_offset']]
+            i += 12*len(x['methods'])
+        return lst
+
+    def cpindexes(self, c):
+        ''' Returns the indexes of constant pool in the bytecodes, a list of (offset into Method component, size) '''
+        ref = c.get('RefLocation')
+        if ref is None:
+            return []
+        return sorted([(3+x, 1) for x in ref.byte_indices()] + [(3+x, 2) for x in ref.byte2_indices()])
+
+    def instructions(self):
+        ''' Returns the instructions, a list of (Instruction, method offset, method end) '''
+        lst = []
+        for offset in self.pkg.offsets:
+            end = self.pkg.methods[offset]['end']
+            lst += [(x, offset, end) for x in self.pkg.disassemble(offset)]
+        return lst
+
+    def mutate(self, seed):
+        ''' Returns (a CapEditor, the Mutant) of seed, an integer '''
+        rnd = random.Random(seed)
+        kind = rnd.choice(self.kinds)
+        editor = self.editor.copy()
+        key, offset, after, description = getattr(self, 'mutate_' + kind)(rnd, editor)
+        data = editor[key]
+        if after is not None: # a replacement
+            before = data[offset:offset+len(after)]
+            editor[key] = data[:offset] + after + data[offset+len(after):]
+        else: # a truncation
+            before, after = data[offset:], ''
+            editor[key] = data[:offset]
+        return editor, Mutant(seed, kind, key, offset, b2a(before).upper(), b2a(after).upper(), description, '')
+
+    def mutate_overflow(self, rnd, editor):
+        key, offset, size = rnd.choice(self.targets['overflow'])
+        mask = (1<<8*size)-1
+        old = int(b2a(editor[key][offset:offset+size]), 16)
+        value = rnd.choice([x for x in (mask, (old+1) & mask, 1<<(8*size-1), 0) if x != old] or [mask])
+        if key == 'Directory.cap':
+            editor.locked.add(key)
+        return key, offset, struct.pack('!B' if size == 1 else '!H', value), 'count %d -> %d' % (old, value)
+
+    def mutate_offset(self, rnd, editor):
+        key, offset, size, target = rnd.choice(self.targets['offset'])
+        n = len(editor[target + '.cap'])-3
+        values = [n + rnd.randrange(0, 16), 0xFFFF]
+        if target == 'Method':
+            inside = [x.offset+1 for x, start, end in self.targets['bytecode'] if x.operands]
+            if inside:
+                values.append(rnd.choice(inside))
+        value = rnd.choice(values)
+        return key, offset, setshort(value & 0xFFFF), 'offset into %s -> %.4X' % (target, value & 0xFFFF)
+
+    def mutate_cpindex(self, rnd, editor):
+        offset, size = rnd.choice(self.targets['cpindex'])
+        mask = (1<<8*size)-1
+        count = self.pkg.cp.count
+        value = rnd.choice([min(count + rnd.randrange(0, 8), mask), mask])
+        return 'Method.cap', offset, struct.pack('!B' if size == 1 else '!H', value), 'index of constant pool -> %d' % value
+
+    def mutate_truncate(self, rnd, editor):
+        key = rnd.choice(self.targets['truncate'])
+        offset = rnd.randrange(3, max(len(editor[key]), 4))
+        if rnd.random() < 0.5:
+            editor.locked.add(key) # the size claims more than there is
+            return key, offset, None, 'cut at %d, size kept' % offset
+        return key, offset, None, 'cut at %d, size fixed' % offset
+
+    def mutate_bytecode(self, rnd, editor):
+        x, start, end = rnd.choice(self.targets['bytecode'])
+        choices = ['undefined']
+        if x.opcode in dit_confusion:
+            choices.append('confusion')
+        if api_cap.dit_opcodes[x.opcode][1] in ('j', 'J'):
+            choices.append('branch')
+        choice = rnd.choice(choices)
+        offset = 3+x.offset
+        if choice == 'undefined':
+            opcode = rnd.choice(UNDEFINED_OPCODES)
+            return 'Method.cap', offset, chr(opcode), 'undefined opcode %.2X for %s' % (opcode, x.mnemonic)
+        if choice == 'confusion':
+            opcode = dit_confusion[x.opcode]
+            return 'Method.cap', offset, chr(opcode), '%s -> %s' % (x.mnemonic, api_cap.dit_opcodes[opcode][0])
+        if api_cap.dit_opcodes[x.opcode][1] == 'j':
+            value = rnd.choice([y for y in range(-128, 128) if not start <= x.offset+y < end])
+            branch = struct.pack('!b', value)
+        else:
+            value = end - x.offset + rnd.randrange(0, 0x100)
+            branch = struct.pack('!h', value)
+        return 'Method.cap', offset+1, branch, '%s out of its method, %+d' % (x.mnemonic, value)
+
+
+MUTATORS = {} # (path, kinds) : Mutator, of the current process
+
+def makemutant(args):
+    ''' Make the mutant of seed & write it to outdir, in a worker process: returns the Mutant.
+
+         args: (path, seed, outdir, kinds)
+    '''
+    path, seed, outdir, kinds = args
+    mutator = MUTATORS.get((path, kinds))
+    if mutator is None:
+        mutator = MUTATORS[(path, kinds)] = Mutator(path, kinds)
+    editor, mutant = mutator.mutate(seed)
+    out = os.path.join(outdir, '%s_%d.cap' % (os.path.splitext(os.path.basename(path))[0], seed))
+    editor.write(out)
+    return mutant._replace(path=out)
+
+
+def generate(path, seeds, outdir, kinds=None, processes=None, chunksize=16):
+    ''' Make the mutants of a CAP file in worker processes, one per seed, written to outdir as
+        <name>_<seed>.cap: yields the Mutants, in the order of the seeds.
+
+         seeds: integers, an iterable
+         kinds: a subset of KINDS, all if omitted
+         processes: the number of worker processes, one per CPU if None, 0 to make them in this process
+    '''
+    tasks = ((os.path.abspath(path), seed, outdir, tuple(kinds) if kinds else None) for seed in seeds)
+    if processes == 0:
+        for x in tasks:
+            yield makemutant(x)
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for x in pool.imap(makemutant, tasks, chunksize):
+            yield x
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def packageaid(path):
+    ''' Returns the package AID of a CAP file, hexdigits: the one of the manifest, or of the
+        Header component, like api_gp.deploy()
+    '''
+    cap = api_cap.CAPFile(path)
+    try:
+        return (cap.getPackageAID() or cap.component('Header').aid).upper()
+    finally:
+        cap.close()
+
+
+def campaign(path, aid, seeds, outdir, kinds=None, processes=None, loader=None, keep=False):
+    ''' Load the mutants of a CAP file on the card of the current session, made by generate()
+        while the previous ones are loaded: yields (Mutant, result), result a dictionary:
+
+            {'accepted' : True or False, 'sw' : '9000', 'error' : the message of the exception, 'seconds' : 0.01}
+
+         aid: the AID of the package, see packageaid() if '', an accepted mutant is deleted before the next one,
+            api_pcsc.PCSCException raised if it can't be: the next ones would be rejected for it
+         loader: loader(pathtocap, aid), raising api_pcsc.PCSCException if rejected, api_gp.upload if omitted
+         keep: True to keep the mutants in outdir
+    '''
+    import api_gp
+    api_pcsc = api_gp.api_pcsc
+    loader = loader or api_gp.upload
+    aid = aid or packageaid(path)
+    count, accepted, begin = 0, 0, time.time()
+    for mutant in generate(path, seeds, outdir, kinds, processes):
+        t = time.time()
+        try:
+            loader(mutant.path, aid)
+            result = {'accepted' : True, 'sw' : '9000', 'error' : ''}
+        except api_pcsc.PCSCException, e:
+            result = {'accepted' : False, 'sw' : (api_pcsc.getlastapdu() or {}).get('sw', ''), 'error' : str(e)}
+        result['seconds'] = time.time() - t
+        api_cap.REGISTRY.discard(mutant.path)
+        if not keep:
+            os.remove(mutant.path)
+        if result['accepted']:
+            response, sw = api_gp.deleteaid(aid, True, expectSW='')
+            if sw != '9000':
+                raise api_pcsc.PCSCException('Mutant %d accepted, DELETE %s failed: %s, the next ones would be rejected' % (mutant.seed, aid, sw))
+        count += 1
+        accepted += result['accepted']
+        Logger.debug('%d %s %s: %s, %s', mutant.seed, mutant.kind, mutant.component, mutant.description, result['sw'])
+        yield mutant, result
+    Logger.info('%d mutants of %s, %d accepted, %.1f mutants/s', count, path, accepted, count/max(time.time()-begin, 1e-6))
+
+
+def verifyloadfile(data):
+    ''' A structural verifier of Load Files, for api_virtualcard.CardManager(verifier=...): returns
+        False if the components, concatenated, binary, don't decode, their sizes differ from
+        Directory component, an offset or an index of constant pool is out of range. The types of
+        the bytecodes are not verified.
+    '''
+    try:
+        c = api_cap.loadfile(data)
+        if not all([x.check() for x in c.values()]):
+            return False
+        d = c.get('Directory')
+        if d is None or any([d.component_sizes[api_cap.list_component.index(name)] != x.length for name, x in c.items()]):
+            return False
+        pkg = api_cap.Package(c)
+        pkg.verify()
+        c['Import'].packages()
+        offsets = [x[1] for x in c['Applet'].applets()] if 'Applet' in c else []
+        for x in c['Class'].classes:
+            if not x['interface']:
+                if not x['super'] & 0x8000 and x['super'] not in c['Class'].offsets:
+                    return False
+                offsets += x['public_virtual_method_table']
+        for x in c['Method'].exception_handlers:
+            if not pkg.methodat(x['start_offset']) or not pkg.methodat(x['handler_offset']):
+                return False
+        if any([x not in pkg.methods for x in offsets]):
+            return False
+        cp = pkg.cp
+        for k in range(cp.count):
+            tag, ref = cp.entry(k)
+            if tag == 6 and ref[0] == '\x00' and api_cap.U2.unpack_from(ref, 1)[0] not in pkg.methods:
+                return False
+            if tag in (1, 2, 3, 4) and not ord(ref[0]) & 0x80 and api_cap.U2.unpack_from(ref, 0)[0] not in c['Class'].offsets:
+                return False
+        info = pkg.method.info
+        ref = c.get('RefLocation')
+        if ref:
+            if any([api_cap.U1.unpack_from(info, x)[0] >= cp.count for x in ref.byte_indices()]):
+                return False
+            if any([api_cap.U2.unpack_from(info, x)[0] >= cp.count for x in ref.byte2_indices()]):
+                return False
+    except (api_cap.CAPException, ValueError, struct.error, IndexError, KeyError), e:
+        Logger.debug('Load File rejected: %s', e)
+        return False
+    return True
+
 
 #----------------------------------------------------------------------------
 class TestModule(unittest.TestCase):
@@ -397,6 +833,124 @@ class TestModule(unittest.TestCase):
     def test_helloworld(self):
         pass
 
+    def test_components(self):
+        ''' 用cos_testsuites下的cap文件验证各组件的解析与重组 '''
+        import glob, os
+        paths = glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', '*.cap'))
+        classes = {
+                'Header' : Header, 'Directory' : Directory, 'Import' : Import, 'Applet' : Applet,
+                'ConstantPool' : ConstantPool, 'Method' : Methods, 'StaticField' : StaticField,
+                'RefLocation' : ReferenceLocation, 'Descriptor' : Descriptor, 'Debug' : Debug,
+                }
+        for path in paths:
+            jar = zipfile.ZipFile(path, 'r')
+            for name in jar.namelist():
+                key = name.split('/')[-1][:-4]
+                if key in classes:
+                    data = jar.read(name)
+                    x = classes[key](data)
+                    if key == 'Header':
+                        clazz = [y for y in jar.namelist() if y.endswith('/Class.cap')][0]
+                        self.assertTrue(Clazz(jar.read(clazz), x.decoded.minor).classes)
+                    self.assertEqual(str(x), data)
+                    self.assertTrue(x.decoded.selfcheck())
+                    if key == 'Debug':
+                        self.assertEqual(x.package_name, str(x.classes[0]).rsplit('/', 1)[0])
+            jar.close()
+
+    def test_editor(self):
+        ''' 组件的修改、长度的重新计算与CAP文件的重写 '''
+        import os, tempfile, shutil
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        editor = CapEditor(path)
+        self.assertEqual(editor.package, 'xh/perfomance/arrayCopy/')
+        self.assertTrue('RefLocation.cap' in editor.components)
+        d = tempfile.mkdtemp()
+        try:
+            out = os.path.join(d, 'same.cap')
+            editor.write(out)
+            self.assertEqual(CapEditor(out).components, editor.components)
+            self.assertEqual(CapEditor(out).__str__(True, True), editor.__str__(True, True))
+
+            x = editor.copy()
+            x['Method.cap'] = x['Method.cap'][:-2]
+            x.write(out)
+            y = api_cap.CAPFile(out)
+            self.assertEqual(y.component('Method').length, len(editor['Method.cap'])-5)
+            self.assertEqual(y.component('Directory').component_sizes[api_cap.list_component.index('Method')], len(editor['Method.cap'])-5)
+            self.assertEqual(editor['Method.cap'], CapEditor(path)['Method.cap']) # the copy only
+
+            x = editor.copy()
+            x.locked.add('Method.cap')
+            x['Method.cap'] = x['Method.cap'][:-2]
+            x.write(out)
+            self.assertEqual(CapEditor(out)['Method.cap'][:3], editor['Method.cap'][:3])
+            api_cap.REGISTRY.discard(out)
+        finally:
+            shutil.rmtree(d)
+
+    def test_mutants(self):
+        ''' 变异体：相同的种子在本进程与工作进程中生成相同的CAP文件 '''
+        import os, tempfile, shutil, hashlib
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        d = tempfile.mkdtemp()
+        try:
+            digests = []
+            for processes in (0, 2):
+                lst = []
+                for x in generate(path, range(60), d, processes=processes):
+                    self.assertEqual(os.path.basename(x.path), 'arrayCopy_%d.cap' % x.seed)
+                    jar = zipfile.ZipFile(x.path)
+                    self.assertEqual(jar.testzip(), None)
+                    jar.close()
+                    data = CapEditor(x.path)[x.component]
+                    if x.kind == 'truncate':
+                        self.assertEqual(len(data), x.offset)
+                    else:
+                        self.assertEqual(b2a(data[x.offset:x.offset+len(x.after)//2]).upper(), x.after)
+                    lst.append((x[:-1], hashlib.sha1(open(x.path, 'rb').read()).hexdigest()))
+                digests.append(lst)
+            self.assertEqual(digests[0], digests[1])
+            self.assertEqual(set([x[0][1] for x in digests[0]]), set(KINDS))
+            self.assertEqual(Mutator(path, ['cpindex']).kinds, ['cpindex'])
+        finally:
+            shutil.rmtree(d)
+
+    def test_campaign(self):
+        ''' 在虚拟卡上加载变异体：结构校验拒绝越界的常量池索引 '''
+        import os, tempfile, shutil, api_pcsc, api_virtualcard, api_gp
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        aid = packageaid(path)
+        self.assertEqual(aid, api_cap.CAPFile(path).component('Header').aid) # arrayCopy.cap has no manifest
+        card = api_virtualcard.VirtualCard(cardmanager=api_virtualcard.CardManager(verifier=verifyloadfile))
+        old = api_pcsc.settransport(api_virtualcard.createtransport(card))
+        oldsession = api_pcsc.bindsession(api_pcsc.ReaderSession())
+        d = tempfile.mkdtemp()
+        try:
+            api_pcsc.connectreader()
+            api_gp.card()
+            api_gp.auth()
+            results = list(campaign(path, aid, range(40), d, processes=2))
+            self.assertEqual(len(results), 40)
+            self.assertEqual(os.listdir(d), []) # removed
+            for mutant, result in results:
+                if mutant.kind == 'cpindex':
+                    self.assertFalse(result['accepted'])
+                    self.assertEqual(result['sw'], '6A80')
+            self.assertTrue(any([result['accepted'] for mutant, result in results]))
+            api_gp.upload(path, aid) # nothing left of the accepted ones
+            api_gp.deleteaid(aid, True)
+
+            # accepted but not loaded, the DELETE fails: stopped
+            results = campaign(path, aid, range(40), d, processes=0, loader=lambda pathtocap, aid: None)
+            self.assertRaises(api_pcsc.PCSCException, list, results)
+            self.assertEqual(os.listdir(d), [])
+        finally:
+            shutil.rmtree(d)
+            api_pcsc.disconnect()
+            api_pcsc.bindsession(oldsession)
+            api_pcsc.settransport(old)
+
 #-------------------------------------------------------------------------------
 if __name__ == '__main__':
     FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
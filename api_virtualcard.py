@@ -0,0 +1,1294 @@
+#!/usr/env python
+# -*- coding: utf-8 -*-
+
+""" API related with the virtual card.
+
+The module provides a pure-Python card, its readers and a transport for api_pcsc, so that
+api_gp, api_incarddata and testsuites can run & be benchmarked without any reader:
+
+    api_pcsc.settransport(api_virtualcard.createtransport())
+    api_pcsc.connectreader()
+
+or 'transport = virtual' in config.ini.
+
+The card supports:
+    1. ISO/IEC 7816-4 file system, SELECT by FID/AID, READ/UPDATE BINARY, READ/UPDATE RECORD
+    2. PIN, VERIFY/CHANGE/DISABLE/ENABLE
+    3. T=0 behaviour, 61xx & GET RESPONSE, 6Cxx
+    4. extended Lc/Le under T=1, and command chaining
+    5. GP card manager, SCP02 INITIALIZE UPDATE/EXTERNAL AUTHENTICATE, INSTALL, LOAD, DELETE
+
+__author__ = "XH Smart Card Co,.Ltd. http://www.china-xinghan.com/smartcard/en/"
+__date__ = "Aug 2016"
+__version__ = "0.1.0"
+
+Copyright 2016 XH Smart Card Co,. Ltd
+
+Author: wg@china-xinghan.com
+"""
+
+import os, logging, unittest, collections, hashlib
+import smartcard.scard
+import api_util
+import api_pcsc
+import api_alg
+import api_gp
+import api_general
+import api_crypto
+import api_tlv
+
+#-------------------------------------------------------------------------------
+# import utility
+a2b = api_util.a2b
+b2a = api_util.b2a
+lv = api_general.lv
+
+#-------------------------------------------------------------------------------
+# define own Exception class
+
+class VirtualCardException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+class NoCardException(VirtualCardException):
+    pass
+
+
+#-------------------------------------------------------------------------------
+# define global variable
+Logger = logging.getLogger(__name__)
+
+DEFAULT_ATR = '3B9F96801FC78031A073BE21136743200718000001A5'
+EXTENDED_ATR = '3B850180730000C0B7' # T=1, card capabilities: command chaining, extended Lc/Le
+USIM_AID = 'A0000000871002FF86FF0289060100FF'
+
+SW_NO_ERROR = '9000'
+SW_WRONG_LENGTH = '6700'
+SW_SECURITY_STATUS_NOT_SATISFIED = '6982'
+SW_AUTHENTICATION_METHOD_BLOCKED = '6983'
+SW_REFERENCED_DATA_INVALIDATED = '6984'
+SW_CONDITIONS_NOT_SATISFIED = '6985'
+SW_COMMAND_NOT_ALLOWED = '6986'
+SW_WRONG_DATA = '6A80'
+SW_FUNC_NOT_SUPPORTED = '6A81'
+SW_FILE_NOT_FOUND = '6A82'
+SW_RECORD_NOT_FOUND = '6A83'
+SW_INCORRECT_P1P2 = '6A86'
+SW_REFERENCED_DATA_NOT_FOUND = '6A88'
+SW_WRONG_P1P2 = '6B00'
+SW_INS_NOT_SUPPORTED = '6D00'
+SW_CLA_NOT_SUPPORTED = '6E00'
+SW_AUTHENTICATION_FAILED = '6300'
+SW_MORE_DATA = '6310'
+SW_UNKNOWN = '6F00'
+
+# a parsed command APDU. cla/ins/p1/p2 are integers, data is hexdigits, le is an integer or None
+# (no Le), header is CLA INS P1 P2 P3 as hexdigits, CLA INS P1 P2 00 Lc/Le if extended.
+Command = collections.namedtuple('Command', 'cla ins p1 p2 data le header')
+
+def parsecommand(btes):
+    ''' Parse a command APDU, short or extended, see ISO/IEC 7816-4, 5.1.
+
+        btes: a list of integer, like api_pcsc.toBytes('00A4000C023F00')
+
+        Returns a Command, or None if the APDU is malformed.
+    '''
+    n = len(btes)
+    if n<4:
+        return None
+    cla, ins, p1, p2 = btes[:4]
+    if n>=7 and btes[4]==0: # extended
+        x = (btes[5]<<8) | btes[6]
+        if n==7: # case 2E
+            return Command(cla, ins, p1, p2, '', x or 0x10000, api_pcsc.tohexstring(btes))
+        if n==7+x: # case 3E
+            le = None
+        elif n==9+x: # case 4E
+            le = ((btes[-2]<<8) | btes[-1]) or 0x10000
+        else:
+            return None
+        return Command(cla, ins, p1, p2, api_pcsc.tohexstring(btes[7:7+x]), le, api_pcsc.tohexstring(btes[:7]))
+    if n==4: # case 1
+        return Command(cla, ins, p1, p2, '', None, api_pcsc.tohexstring(btes))
+    if n==5: # case 2
+        return Command(cla, ins, p1, p2, '', btes[4] or 0x100, api_pcsc.tohexstring(btes))
+    lc = btes[4]
+    if n==5+lc: # case 3
+        le = None
+    elif n==6+lc: # case 4
+        le = btes[-1] or 0x100
+    else:
+        return None
+    return Command(cla, ins, p1, p2, api_pcsc.tohexstring(btes[5:5+lc]), le, api_pcsc.tohexstring(btes[:5]))
+
+
+def tlv(tag, value):
+    ''' tlv('83', '3F00') = '83023F00', one byte length only '''
+    return tag + lv(value)
+
+
+def splitlv(data):
+    ''' splitlv('02DF0001AA') = ['DF00', 'AA'] '''
+    lst, i = [], 0
+    while i<len(data):
+        l = int(data[i:i+2], 16)*2
+        lst.append(data[i+2:i+2+l])
+        i += 2+l
+    return lst
+
+
+#-------------------------------------------------------------------------------
+# file system
+
+class VirtualFile(object):
+    ''' A file of the virtual card, MF/DF/ADF or EF.
+    '''
+
+    def __init__(self, fid, readac=None, updateac=None):
+        ''' fid: file identifier, like '2FE2'
+            readac: key reference of the PIN needed to read the file, like 0x01 (PIN1), None for always
+            updateac: key reference of the PIN needed to update the file, like 0x0A (ADM1)
+        '''
+        self.fid = fid.upper()
+        self.parent = None
+        self.readac = readac
+        self.updateac = updateac
+
+    def isdf(self):
+        return False
+
+    def fcp(self):
+        ''' Returns FCP template as hexdigits, see ETSI TS 102 221, 11.1.1.3 '''
+        raise NotImplementedError
+
+
+class DedicatedFile(VirtualFile):
+    ''' MF, DF or ADF (if aid given). '''
+
+    def __init__(self, fid, aid='', children=()):
+        VirtualFile.__init__(self, fid)
+        self.aid = aid.upper()
+        self.children = collections.OrderedDict()
+        for x in children:
+            self.add(x)
+
+    def isdf(self):
+        return True
+
+    def add(self, f):
+        ''' Add a child file, returns the file '''
+        f.parent = self
+        self.children[f.fid] = f
+        return f
+
+    def find(self, fid):
+        return self.children.get(fid)
+
+    def walk(self):
+        ''' Yields all files below, this one included '''
+        yield self
+        for x in self.children.values():
+            if x.isdf():
+                for y in x.walk():
+                    yield y
+            else:
+                yield x
+
+    def fcp(self):
+        v = tlv('82', '7821') + tlv('83', self.fid)
+        if self.aid:
+            v += tlv('84', self.aid)
+        v += tlv('8A', '05')
+        return tlv('62', v)
+
+
+class TransparentFile(VirtualFile):
+
+    def __init__(self, fid, data='', size=0, readac=None, updateac=None):
+        ''' data: hexdigits
+            size: file size, the length of data if not given. Padded with 'FF'
+        '''
+        VirtualFile.__init__(self, fid, readac, updateac)
+        size = size if size else len(data)/2
+        self.data = bytearray(a2b(data.ljust(size*2, 'F')))
+
+    def fcp(self):
+        v = tlv('82', '4121') + tlv('83', self.fid) + tlv('8A', '05') + tlv('80', '%.4X' % len(self.data))
+        return tlv('62', v)
+
+
+class LinearFixedFile(VirtualFile):
+
+    def __init__(self, fid, records=(), recordlength=0, numberofrecords=0, readac=None, updateac=None):
+        ''' records: a list of hexdigits, each will be padded with 'FF' to recordlength
+            recordlength: the longest record if not given
+            numberofrecords: the number of records given if not given
+        '''
+        VirtualFile.__init__(self, fid, readac, updateac)
+        recordlength = recordlength if recordlength else max([len(x)/2 for x in records])
+        numberofrecords = numberofrecords if numberofrecords else len(records)
+        records = list(records) + ['']*(numberofrecords-len(records))
+        self.recordlength = recordlength
+        self.records = [bytearray(a2b(x.ljust(recordlength*2, 'F'))) for x in records]
+
+    def fcp(self):
+        n, l = len(self.records), self.recordlength
+        v = tlv('82', '4221%.4X%.2X' % (l, n)) + tlv('83', self.fid) + tlv('8A', '05') + tlv('80', '%.4X' % (l*n))
+        return tlv('62', v)
+
+
+#-------------------------------------------------------------------------------
+# PIN
+
+class Pin(object):
+    ''' A PIN of the virtual card. '''
+
+    def __init__(self, value, tries=3, enabled=True):
+        ''' value: hexdigits, like '31313131FFFFFFFF'
+            tries: the maximum number of tries
+        '''
+        self.value = value.upper()
+        self.maxtries = tries
+        self.tries = tries
+        self.enabled = enabled
+
+    def check(self, value):
+        ''' Returns SW of the comparison, and counts down the retry counter on failure '''
+        if self.tries==0:
+            return SW_AUTHENTICATION_METHOD_BLOCKED
+        if value.upper()==self.value:
+            self.tries = self.maxtries
+            return SW_NO_ERROR
+        self.tries -= 1
+        return '63C%X' % self.tries
+
+
+#-------------------------------------------------------------------------------
+# GP card manager
+
+class CardManager(object):
+    ''' GP card manager of the virtual card: SCP02 (i=15, ICV encryption) with one key set, C-MAC
+        & C-DECRYPTION, or SCP03 (i=60) with R-MAC & R-ENCRYPTION too, INSTALL, LOAD, DELETE, GET
+        STATUS, GET DATA of the CPLC, INSTALL [for personalization] & STORE DATA of DGIs, kept
+        in 'dgis' of the applet.
+
+        The registry (packages & applets) survives a reset, the secure channel doesn't.
+    '''
+
+    AID = api_gp.CardManagerAID
+
+    def __init__(self, enc=api_gp.KEY404F, mac=api_gp.KEY404F, dek=api_gp.KEY404F, kvn=0x20, seq=0x0001, kdiv='00'*10, scp=0x02, tlvstatus=True, cplc='', verifier=None):
+        ''' tlvstatus: False for a GP 2.1.1 card, GET STATUS in the legacy format only
+            cplc: hexdigits, 42 bytes, with a random IC serial number if omitted
+            verifier: a function, verifier(data) returns False to reject a Load File, its
+                      components concatenated, binary, with 6A80, see api_virtualcap.verifyloadfile()
+        '''
+        self.keys = (enc.upper(), mac.upper(), dek.upper())
+        self.scp = scp
+        self.tlvstatus = tlvstatus
+        self.cplc = cplc.upper() if cplc else '4790504047916182010061820000' + api_general.randhex(4) + '00'*24
+        self.kvn = kvn
+        self.seq = seq
+        self.kdiv = kdiv
+        self.verifier = verifier
+        self.packages = collections.OrderedDict() # load file aid : {'data', 'modules'}
+        self.applets = collections.OrderedDict() # instance aid : {'package', 'module', 'privileges', 'selectable'}
+        self.reset()
+
+    def reset(self):
+        self.session = None
+        self.loading = None
+        self.status = [] # GET STATUS entries left for the next occurrence
+        self.perso = None # INSTALL [for personalization]: {'aid', 'buffer', 'encrypted'}
+
+    def fci(self):
+        v = tlv('84', self.AID) + tlv('A5', tlv('9F65', 'FF'))
+        return tlv('6F', v)
+
+    def process(self, command):
+        ''' Returns a tuple: (response data, sw) '''
+        c = command
+        if (c.cla & 0xF0) != 0x80:
+            return '', SW_CLA_NOT_SUPPORTED
+
+        if c.ins == 0x50:
+            return self.initializeupdate(c)
+        if c.ins == 0x82:
+            return self.externalauthenticate(c)
+        if c.ins == 0xCA:
+            return self.getdata(c)
+
+        c, sw = self.unwrap(c)
+        if sw!=SW_NO_ERROR:
+            return '', sw
+
+        handler = {0xE6:self.install, 0xE8:self.load, 0xE4:self.delete, 0xF2:self.getstatus, 0xE2:self.storedata}.get(c.ins)
+        if handler is None:
+            data, sw = '', SW_INS_NOT_SUPPORTED
+        else:
+            data, sw = handler(c)
+        if self.scp==0x03:
+            data = self.wrap03(data, sw)
+        return data, sw
+
+    def initializeupdate(self, c):
+        if c.p1 not in (0x00, self.kvn):
+            return '', SW_REFERENCED_DATA_NOT_FOUND
+        if len(c.data)!=16:
+            return '', SW_WRONG_LENGTH
+        if self.scp==0x03:
+            return self.initializeupdate03(c)
+
+        enc, mac, dek = self.keys
+        seq = '%.4X' % self.seq
+        hostchallenge = c.data
+        cardchallenge = api_general.randhex(6)
+        skenc = api_gp.getEncryptSkey(enc, seq)
+        cryptogram = api_alg.TDES_Encrypt(hostchallenge + seq + cardchallenge + '80' + '00'*7, skenc, ecb_mode=False, icv='00'*8)[-16:]
+
+        self.session = {
+                'seq' : seq,
+                'hostchallenge' : hostchallenge,
+                'cardchallenge' : cardchallenge,
+                'skenc' : skenc,
+                'skcmac' : api_gp.getCMACSkey(mac, seq),
+                'skdek' : api_gp.getDataEncryptSkey(dek, seq),
+                'level' : 0,
+                'icv' : '00'*8,
+                'authenticated' : False,
+                }
+        return self.kdiv + '%.2X' % self.kvn + '02' + seq + cardchallenge + cryptogram, SW_NO_ERROR
+
+    def externalauthenticate(self, c):
+        s = self.session
+        if not s or s['authenticated']:
+            return '', SW_CONDITIONS_NOT_SATISFIED
+        if len(c.data)!=32:
+            return '', SW_WRONG_LENGTH
+        if self.scp==0x03:
+            return self.externalauthenticate03(c)
+
+        self.session = None # one try only
+        hostcryptogram, cmac = c.data[:16], c.data[16:]
+        expected = api_gp.computeHostCryptogram(s['skenc'], s['seq'], s['hostchallenge'], s['cardchallenge'])
+        if hostcryptogram!=expected or cmac!=api_gp.generateCMAC(c.header + hostcryptogram, s['skcmac']):
+            return '', SW_AUTHENTICATION_FAILED
+
+        s['authenticated'] = True
+        s['level'] = c.p1
+        s['icv'] = cmac
+        self.session = s
+        self.seq = (self.seq + 1) & 0xFFFF
+        return '', SW_NO_ERROR
+
+    def unwrap(self, c):
+        ''' Check the secure channel & C-MAC. Returns a tuple: (command without C-MAC, sw) '''
+        s = self.session
+        if not s or not s['authenticated']:
+            return c, SW_SECURITY_STATUS_NOT_SATISFIED
+        if self.scp==0x03:
+            return self.unwrap03(c)
+
+        if c.cla & 0x04:
+            if len(c.data)<16:
+                return c, SW_SECURITY_STATUS_NOT_SATISFIED
+            data, cmac = c.data[:-16], c.data[-16:]
+            if s['level'] & 0x02 and data:
+                try:
+                    data = api_crypto.decrypt(api_crypto.TDES, a2b(s['skenc']), a2b(data), api_crypto.MODE_CBC, api_crypto.ZERO_ICV)
+                    data = api_pcsc.b2a(api_crypto.unpadm2(data)).upper()
+                except api_crypto.CryptoException:
+                    self.session = None
+                    return c, SW_SECURITY_STATUS_NOT_SATISFIED
+            # the C-MAC is on the plain data, Lc of the plain data + 8
+            header = c.header[:8] + ('%.2X' if len(c.header)==10 else '00%.4X') % (len(data)/2+8)
+            icv = api_alg.DES_Encrypt(s['icv'], s['skcmac'][:16], True) # ICV encryption
+            if cmac!=api_gp.generateCMAC(header + data, s['skcmac'], icv):
+                self.session = None
+                return c, SW_SECURITY_STATUS_NOT_SATISFIED
+            s['icv'] = cmac
+            c = c._replace(cla=c.cla & 0xFB, data=data, header='%.2X%s%.2X' % (c.cla & 0xFB, c.header[2:8], len(data)/2))
+        elif s['level'] & 0x01:
+            return c, SW_SECURITY_STATUS_NOT_SATISFIED
+        return c, SW_NO_ERROR
+
+    def initializeupdate03(self, c):
+        enc, mac, dek = self.keys
+        context = a2b(c.data + api_general.randhex(8)) # host & card challenges
+        skeys = api_gp.scp03sessionkeys(a2b(enc), a2b(mac), context)
+        cryptogram = api_gp.scp03cryptogram(skeys['mac'], api_gp.SCP03_CARD_CRYPTOGRAM, context)
+        self.session = {
+                'context' : context,
+                'skeys' : skeys,
+                'level' : 0,
+                'chaining' : '\x00'*16, # MAC chaining value
+                'counter' : 1, # encryption counter
+                'authenticated' : False,
+                }
+        return self.kdiv + '%.2X' % self.kvn + '0360' + api_pcsc.b2a(context[8:] + cryptogram).upper(), SW_NO_ERROR
+
+    def externalauthenticate03(self, c):
+        s = self.session
+        self.session = None # one try only
+        hostcryptogram, cmac = a2b(c.data[:16]), a2b(c.data[16:])
+        mac = api_crypto.cmac(api_crypto.AES, s['skeys']['mac'], s['chaining'] + a2b(c.header) + hostcryptogram)
+        if hostcryptogram!=api_gp.scp03cryptogram(s['skeys']['mac'], api_gp.SCP03_HOST_CRYPTOGRAM, s['context']) or cmac!=mac[:8]:
+            return '', SW_AUTHENTICATION_FAILED
+        s['authenticated'] = True
+        s['level'] = c.p1
+        s['chaining'] = mac
+        self.session = s
+        return '', SW_NO_ERROR
+
+    def unwrap03(self, c):
+        ''' SCP03: check the C-MAC, decrypt the data. Returns a tuple: (command, sw) '''
+        s = self.session
+        if not c.cla & 0x04:
+            if s['level'] & 0x01:
+                return c, SW_SECURITY_STATUS_NOT_SATISFIED
+            return c, SW_NO_ERROR
+        if len(c.data)<16:
+            return c, SW_SECURITY_STATUS_NOT_SATISFIED
+        data, cmac = a2b(c.data[:-16]), a2b(c.data[-16:])
+        mac = api_crypto.cmac(api_crypto.AES, s['skeys']['mac'], s['chaining'] + a2b(c.header) + data)
+        if cmac!=mac[:8]:
+            self.session = None
+            return c, SW_SECURITY_STATUS_NOT_SATISFIED
+        s['chaining'] = mac
+        if s['level'] & 0x02:
+            s['used'] = s['counter']
+            s['counter'] += 1
+            if data:
+                key = s['skeys']['enc']
+                icv = api_crypto.encrypt(api_crypto.AES, key, api_gp.scp03counter(s['used']))
+                try:
+                    data = api_crypto.unpadm2(api_crypto.decrypt(api_crypto.AES, key, data, api_crypto.MODE_CBC, icv), 16)
+                except api_crypto.CryptoException:
+                    self.session = None
+                    return c, SW_SECURITY_STATUS_NOT_SATISFIED
+        data = api_pcsc.b2a(data).upper()
+        c = c._replace(cla=c.cla & 0xFB, data=data, header='%.2X%s%.2X' % (c.cla & 0xFB, c.header[2:8], len(data)/2))
+        return c, SW_NO_ERROR
+
+    def wrap03(self, data, sw):
+        ''' SCP03: encrypt the response data & add the R-MAC, as the security level asks. Not for
+            an error status word.
+        '''
+        s = self.session
+        if not s or not s['level'] & 0x10 or not (sw==SW_NO_ERROR or sw[:2] in ('62', '63')):
+            return data
+        data = a2b(data)
+        if s['level'] & 0x20 and data:
+            key = s['skeys']['enc']
+            icv = api_crypto.encrypt(api_crypto.AES, key, '\x80' + api_gp.scp03counter(s['used'])[1:])
+            data = api_crypto.encrypt(api_crypto.AES, key, api_crypto.padm2(data, 16), api_crypto.MODE_CBC, icv)
+        rmac = api_crypto.cmac(api_crypto.AES, s['skeys']['rmac'], s['chaining'] + data + a2b(sw))[:8]
+        return api_pcsc.b2a(data + rmac).upper()
+
+    def install(self, c):
+        lst = splitlv(c.data)
+        if c.p1 & 0x02: # for load
+            if len(lst)<5:
+                return '', SW_WRONG_DATA
+            aid = lst[0]
+            if aid in self.packages:
+                return '', SW_CONDITIONS_NOT_SATISFIED
+            self.loading = {'aid' : aid, 'blocks' : [], 'hash' : lst[2], }
+            return '00', SW_NO_ERROR
+
+        if c.p1 & 0x04: # for install
+            if len(lst)<6:
+                return '', SW_WRONG_DATA
+            pkg, module, aid, privileges = lst[:4]
+            if pkg not in self.packages:
+                return '', SW_REFERENCED_DATA_NOT_FOUND
+            modules = self.packages[pkg]['modules']
+            if modules and module not in modules:
+                return '', SW_REFERENCED_DATA_NOT_FOUND
+            if aid in self.applets or aid in self.packages:
+                return '', SW_CONDITIONS_NOT_SATISFIED
+            self.applets[aid] = {
+                    'package' : pkg,
+                    'module' : module,
+                    'privileges' : privileges,
+                    'selectable' : bool(c.p1 & 0x08),
+                    }
+            return '00', SW_NO_ERROR
+
+        if c.p1 & 0x20: # for personalization
+            aid = lst[2] if len(lst)>2 else ''
+            if aid not in self.applets:
+                return '', SW_REFERENCED_DATA_NOT_FOUND
+            self.perso = {'aid' : aid, 'buffer' : '', 'encrypted' : False, }
+            return '00', SW_NO_ERROR
+
+        if c.p1 & 0x08: # make selectable
+            aid = lst[2] if len(lst)>2 else ''
+            if aid not in self.applets:
+                return '', SW_REFERENCED_DATA_NOT_FOUND
+            self.applets[aid]['selectable'] = True
+            return '00', SW_NO_ERROR
+
+        return '', SW_INCORRECT_P1P2
+
+    def load(self, c):
+        x = self.loading
+        if not x:
+            return '', SW_CONDITIONS_NOT_SATISFIED
+        if c.p2!=len(x['blocks']) & 0xFF:
+            self.loading = None
+            return '', SW_INCORRECT_P1P2
+        x['blocks'].append(c.data)
+        if not c.p1 & 0x80:
+            return '', SW_NO_ERROR
+
+        self.loading = None
+        data = a2b(''.join(x['blocks']))
+        if data[:1]!='\xC4':
+            return '', SW_WRONG_DATA
+        n, i = ord(data[1]), 2
+        if n>0x80:
+            n, i = int(b2a(data[2:2+n-0x80]), 16), 2+n-0x80
+        if len(data)!=i+n:
+            return '', SW_WRONG_DATA
+        data = data[i:]
+        if x['hash'] and x['hash']!=b2a(hashlib.new({40:'sha1', 64:'sha256'}.get(len(x['hash']), 'sha1'), data).digest()).upper():
+            return '', SW_WRONG_DATA
+        if self.verifier and not self.verifier(data):
+            return '', SW_WRONG_DATA
+        self.packages[x['aid']] = {'data' : data, 'modules' : getmodules(data), }
+        return '00', SW_NO_ERROR
+
+    def delete(self, c):
+        if c.data[:2]!='4F':
+            return '', SW_WRONG_DATA
+        aid = c.data[4:4+int(c.data[2:4], 16)*2]
+        if aid in self.applets:
+            del self.applets[aid]
+            return '00', SW_NO_ERROR
+        if aid in self.packages:
+            related = [k for k, v in self.applets.items() if v['package']==aid]
+            if related and not c.p2 & 0x80:
+                return '', SW_CONDITIONS_NOT_SATISFIED
+            for k in related:
+                del self.applets[k]
+            del self.packages[aid]
+            return '00', SW_NO_ERROR
+        return '', SW_REFERENCED_DATA_NOT_FOUND
+
+    def storedata(self, c):
+        ''' STORE DATA of DGIs, a DGI may span several commands, GP 2.2 11.11 '''
+        x = self.perso
+        if not x or c.p1 & 0x60!=0x20:
+            return '', SW_CONDITIONS_NOT_SATISFIED
+        encrypted = c.p1 & 0x18==0x18
+        dgis = self.applets[x['aid']].setdefault('dgis', collections.OrderedDict())
+        b = x['buffer'] + c.data
+        carried = bool(x['buffer']) # the first DGI began in a previous command
+        while len(b)>=6:
+            tag, n, i = b[:4], int(b[4:6], 16), 6
+            if n==0xFF:
+                n, i = int(b[6:10], 16) if len(b)>=10 else -1, 10
+            if n<0 or len(b)<i+2*n:
+                break
+            value = b[i:i+2*n]
+            if x['encrypted'] if carried else encrypted:
+                if self.scp==0x02:
+                    value = b2a(api_crypto.decrypt(api_crypto.TDES, a2b(self.session['skdek']), a2b(value)))
+                else:
+                    value = b2a(api_crypto.decrypt(api_crypto.AES, a2b(self.keys[2]), a2b(value), api_crypto.MODE_CBC, '\x00'*16))
+            dgis[tag] = value
+            b, carried = b[i+2*n:], False
+        if not carried:
+            x['encrypted'] = encrypted
+        x['buffer'] = b
+        if c.p1 & 0x80:
+            self.perso = None
+            if b:
+                return '', SW_WRONG_DATA
+        return '', SW_NO_ERROR
+
+    def getdata(self, c):
+        if (c.p1, c.p2)!=(0x9F, 0x7F):
+            return '', SW_REFERENCED_DATA_NOT_FOUND
+        return tlv('9F7F', self.cplc), SW_NO_ERROR
+
+    def getstatus(self, c):
+        ''' GET STATUS, GP 2.2 11.4: 'E3' templates if P2 b2 set, the legacy format otherwise '''
+        if c.p2 & 0x01: # next occurrence
+            entries = self.status
+        else:
+            if c.data[:2]!='4F':
+                return '', SW_WRONG_DATA
+            if c.p2 & 0x02 and not self.tlvstatus:
+                return '', SW_INCORRECT_P1P2
+            prefix = c.data[4:4+int(c.data[2:4], 16)*2]
+            if c.p1==0x80:
+                lst = [(self.AID, '0F', '9E', [], '', '')]
+            elif c.p1==0x40:
+                lst = [(k, '07' if v['selectable'] else '03', v['privileges'], [], '', v['package']) for k, v in self.applets.items()]
+            elif c.p1 in (0x20, 0x10):
+                lst = [(k, '01', '00', v['modules'] if c.p1==0x10 else [], getversion(v['data']), '') for k, v in self.packages.items()]
+            else:
+                return '', SW_INCORRECT_P1P2
+            entries = []
+            for aid, lifecycle, privileges, modules, version, elf in lst:
+                if not aid.startswith(prefix):
+                    continue
+                if c.p2 & 0x02:
+                    v = tlv('4F', aid) + tlv('9F70', lifecycle) + tlv('C5', privileges)
+                    v += (tlv('C4', elf) if elf else '') + (tlv('CE', version) if version else '')
+                    entries.append(tlv('E3', v + ''.join([tlv('84', x) for x in modules])))
+                else:
+                    x = lv(aid) + lifecycle + privileges
+                    if c.p1==0x10:
+                        x += '%.2X' % len(modules) + ''.join(map(lv, modules))
+                    entries.append(x)
+            if not entries:
+                return '', SW_REFERENCED_DATA_NOT_FOUND
+
+        data = ''
+        while entries and len(data + entries[0])<=2*0x100:
+            data, entries = data + entries[0], entries[1:]
+        self.status = entries
+        return data, SW_MORE_DATA if entries else SW_NO_ERROR
+
+
+def getversion(data):
+    ''' Returns the package version, major & minor as hexdigits, from the Header component,
+        the first one of a load file, see JCVM 6.3.
+
+        data: binary, the concatenated components
+    '''
+    return b2a(data[11] + data[10]) if len(data)>11 and data[0]=='\x01' else ''
+
+
+def getmodules(data):
+    ''' Returns the applet AIDs found in the Applet component of a load file, see JCVM 6.5.
+
+        data: binary, the concatenated components
+    '''
+    try:
+        for tag, info in api_tlv.iterfixed(data, 1, 2):
+            if tag==3:
+                lst, j = [], 1
+                for k in range(ord(info[0])):
+                    l = ord(info[j])
+                    lst.append(b2a(info[j+1:j+1+l].tobytes()))
+                    j += 1+l+2
+                return lst
+    except api_tlv.TLVException:
+        pass
+    return []
+
+
+def echo(card, command):
+    ''' An applet handler which returns the command data, useful for throughput benchmark. '''
+    return command.data, SW_NO_ERROR
+
+
+#-------------------------------------------------------------------------------
+# card
+
+class VirtualCard(object):
+    ''' A pure-Python card.
+
+        Besides the commands supported, applets installed through the card manager can be
+        given a handler, see sethandler().
+    '''
+
+    def __init__(self, atr=DEFAULT_ATR, mf=None, pins=None, cardmanager=None, t0=True, extended=False):
+        ''' atr: hexdigits
+            mf: DedicatedFile, the file system
+            pins: a dict of key reference & Pin, like {0x01:Pin('31313131FFFFFFFF')}
+            cardmanager: CardManager
+            t0: True to behave like T=0, i.e. 61xx for case 4 commands, 6Cxx for wrong Le
+            extended: True to accept extended Lc/Le, never under T=0
+        '''
+        self.atr = atr.upper()
+        self.mf = mf if mf else DedicatedFile('3F00')
+        self.pins = pins if pins else {}
+        self.cardmanager = cardmanager if cardmanager else CardManager()
+        self.t0 = t0
+        self.extended = extended and not t0
+        self.handlers = {} # module or instance aid : handler
+        self.count = 0 # number of commands processed
+        self.coldresets = 0
+        self.warmresets = 0
+        self.power()
+
+    def __str__(self):
+        return 'virtual card %s' % self.atr
+
+    def power(self, cold=True):
+        ''' Power on or reset, volatile states are cleared '''
+        if cold or not self.powered:
+            self.coldresets += 1
+        else:
+            self.warmresets += 1
+        self.powered = True
+        self.df = self.mf
+        self.ef = None
+        self.recno = 0
+        self.verified = set()
+        self.pending = ''
+        self.chained = '' # data of the chained commands so far
+        self.selected = None # card manager, instance aid of an applet or None for the file system
+        self.cardmanager.reset()
+        return self.atr
+
+    def poweroff(self):
+        self.powered = False
+
+    def sethandler(self, aid, handler):
+        ''' Set the handler of an applet.
+
+            aid: module aid or instance aid
+            handler: a callable, handler(card, command) returns (response data, sw) as hexdigits
+        '''
+        self.handlers[aid.upper()] = handler
+
+    def transmit(self, btes):
+        ''' Process a command APDU.
+
+            btes: a list of integer
+
+            Returns a tuple: (list of integer, sw1, sw2), like a pyscard connection
+        '''
+        if not self.powered:
+            raise VirtualCardException('Card is not powered!')
+        self.count += 1
+
+        c = parsecommand(btes)
+        if c is not None and len(c.header)>10 and not self.extended:
+            c = None
+        if c is not None and c.cla & 0x10 and not c.cla & 0x80: # command chaining
+            self.chained += c.data
+            return [], 0x90, 0x00
+        if c is not None and self.chained:
+            c, self.chained = c._replace(data=self.chained+c.data), ''
+
+        if c is None:
+            data, sw = '', SW_WRONG_LENGTH
+        elif c.ins == 0xC0 and not c.cla & 0x80:
+            data, sw = self.getresponse(c)
+        else:
+            self.pending = ''
+            try:
+                data, sw = self.process(c)
+            except Exception as e:
+                Logger.exception(e)
+                data, sw = '', SW_UNKNOWN
+
+            if sw[:2] in ('90', '91') and data:
+                n = len(data)/2
+                if c.data and self.t0: # case 4 under T=0
+                    self.pending = data
+                    data, sw = '', '61%.2X' % (n & 0xFF)
+                elif c.le is not None and c.le!=n and self.t0:
+                    data, sw = '', '6C%.2X' % (n & 0xFF)
+            elif sw[:2] not in ('90', '91', '62', '63'):
+                data = ''
+
+        sw1, sw2 = int(sw[:2], 16), int(sw[2:], 16)
+        return api_util.toBytes(data) if data else [], sw1, sw2
+
+    def getresponse(self, c):
+        data = self.pending
+        if not data:
+            return '', SW_CONDITIONS_NOT_SATISFIED
+        n = len(data)/2
+        if c.le is not None and c.le>n:
+            return '', '6C%.2X' % (n & 0xFF)
+        le = c.le if c.le is not None else n
+        data, self.pending = data[:le*2], data[le*2:]
+        if self.pending:
+            return data, '61%.2X' % ((len(self.pending)/2) & 0xFF)
+        return data, SW_NO_ERROR
+
+    def process(self, c):
+        ''' Returns a tuple: (response data, sw) '''
+        if c.ins == 0xA4:
+            return self.select(c)
+
+        if self.selected is self.cardmanager:
+            return self.cardmanager.process(c)
+
+        if self.selected:
+            x = self.cardmanager.applets.get(self.selected)
+            handler = self.handlers.get(self.selected) or self.handlers.get(x['module'] if x else '')
+            return handler(self, c) if handler else ('', SW_INS_NOT_SUPPORTED)
+
+        if c.cla & 0x80:
+            return '', SW_CLA_NOT_SUPPORTED
+
+        handler = {
+                0xB0 : self.readbinary,
+                0xD6 : self.updatebinary,
+                0xB2 : self.readrecord,
+                0xDC : self.updaterecord,
+                0x20 : self.verify,
+                0x24 : self.changepin,
+                0x26 : self.disablepin,
+                0x28 : self.enablepin,
+                }.get(c.ins)
+        if handler is None:
+            return '', SW_INS_NOT_SUPPORTED
+        return handler(c)
+
+    #---------------------------------------------------------------------------
+    # select
+
+    def select(self, c):
+        if c.p1 == 0x04:
+            return self.selectbyaid(c)
+        if c.p1 == 0x00:
+            return self.selectbyfid(c)
+        return '', SW_INCORRECT_P1P2
+
+    def selectbyaid(self, c):
+        aid = c.data
+        if not aid:
+            return '', SW_WRONG_LENGTH
+
+        cm = self.cardmanager
+        if cm.AID.startswith(aid):
+            cm.reset()
+            self.selected = cm
+            return ('' if c.p2 & 0x0C == 0x0C else cm.fci()), SW_NO_ERROR
+
+        if aid in cm.applets and cm.applets[aid]['selectable']:
+            cm.reset()
+            self.selected = aid
+            return '', SW_NO_ERROR
+
+        for x in self.mf.walk():
+            if x.isdf() and x.aid and x.aid.startswith(aid):
+                return self.selectfile(c, x)
+        return '', SW_FILE_NOT_FOUND
+
+    def selectbyfid(self, c):
+        fid = c.data
+        if len(fid)!=4:
+            return '', SW_WRONG_LENGTH
+
+        df = self.df
+        if fid == self.mf.fid:
+            return self.selectfile(c, self.mf)
+        if fid == '7FFF':
+            x = df
+            while x.parent and not x.aid:
+                x = x.parent
+            return self.selectfile(c, x) if x.aid else ('', SW_FILE_NOT_FOUND)
+
+        for x in (df, df.find(fid), df.parent, df.parent.find(fid) if df.parent else None):
+            if x and x.fid == fid and (x.isdf() or x.parent is df):
+                return self.selectfile(c, x)
+        return '', SW_FILE_NOT_FOUND
+
+    def selectfile(self, c, x):
+        self.selected = None
+        if x.isdf():
+            self.df, self.ef = x, None
+        else:
+            self.df, self.ef = x.parent, x
+        self.recno = 0
+        return ('' if c.p2 & 0x0C == 0x0C else x.fcp()), SW_NO_ERROR
+
+    #---------------------------------------------------------------------------
+    # EF
+
+    def checkac(self, ac):
+        if ac is None or ac in self.verified:
+            return True
+        pin = self.pins.get(ac)
+        return pin is not None and not pin.enabled
+
+    def getef(self, kind, ac):
+        ''' Returns a tuple: (current EF, sw) '''
+        ef = self.ef
+        if ef is None:
+            return None, SW_COMMAND_NOT_ALLOWED
+        if not isinstance(ef, kind):
+            return None, SW_COMMAND_NOT_ALLOWED
+        if not self.checkac(getattr(ef, ac)):
+            return None, SW_SECURITY_STATUS_NOT_SATISFIED
+        return ef, SW_NO_ERROR
+
+    def readbinary(self, c):
+        if c.p1 & 0x80:
+            return '', SW_FUNC_NOT_SUPPORTED # SFI
+        ef, sw = self.getef(TransparentFile, 'readac')
+        if ef is None:
+            return '', sw
+        offset = (c.p1<<8) | c.p2
+        if offset>=len(ef.data):
+            return '', SW_WRONG_P1P2
+        le = c.le if c.le else 0x100
+        return b2a(bytes(ef.data[offset:offset+le])), SW_NO_ERROR
+
+    def updatebinary(self, c):
+        if c.p1 & 0x80:
+            return '', SW_FUNC_NOT_SUPPORTED # SFI
+        ef, sw = self.getef(TransparentFile, 'updateac')
+        if ef is None:
+            return '', sw
+        offset, data = (c.p1<<8) | c.p2, a2b(c.data)
+        if offset>=len(ef.data):
+            return '', SW_WRONG_P1P2
+        if offset+len(data)>len(ef.data):
+            return '', SW_WRONG_LENGTH
+        ef.data[offset:offset+len(data)] = data
+        return '', SW_NO_ERROR
+
+    def getrecno(self, c, ef):
+        ''' Returns the record number of absolute/next/previous mode, 0 if not found '''
+        mode, n = c.p2 & 0x07, len(ef.records)
+        if mode == 0x04:
+            recno = c.p1
+        elif mode == 0x02:
+            recno = self.recno+1
+        elif mode == 0x03:
+            recno = self.recno-1 if self.recno else n
+        else:
+            return 0
+        return recno if 0<recno<=n else 0
+
+    def readrecord(self, c):
+        ef, sw = self.getef(LinearFixedFile, 'readac')
+        if ef is None:
+            return '', sw
+        recno = self.getrecno(c, ef)
+        if not recno:
+            return '', SW_RECORD_NOT_FOUND
+        self.recno = recno
+        return b2a(bytes(ef.records[recno-1])), SW_NO_ERROR
+
+    def updaterecord(self, c):
+        ef, sw = self.getef(LinearFixedFile, 'updateac')
+        if ef is None:
+            return '', sw
+        recno = self.getrecno(c, ef)
+        if not recno:
+            return '', SW_RECORD_NOT_FOUND
+        if len(c.data)/2!=ef.recordlength:
+            return '', SW_WRONG_LENGTH
+        self.recno = recno
+        ef.records[recno-1] = bytearray(a2b(c.data))
+        return '', SW_NO_ERROR
+
+    #---------------------------------------------------------------------------
+    # PIN
+
+    def getpin(self, c):
+        pin = self.pins.get(c.p2)
+        if pin is None:
+            return None, SW_REFERENCED_DATA_NOT_FOUND
+        return pin, SW_NO_ERROR
+
+    def verify(self, c):
+        pin, sw = self.getpin(c)
+        if pin is None:
+            return '', sw
+        if not pin.enabled:
+            return '', SW_REFERENCED_DATA_INVALIDATED
+        if not c.data: # retry counter
+            return '', SW_NO_ERROR if c.p2 in self.verified else '63C%X' % pin.tries
+        sw = pin.check(c.data)
+        if sw==SW_NO_ERROR:
+            self.verified.add(c.p2)
+        else:
+            self.verified.discard(c.p2)
+        return '', sw
+
+    def changepin(self, c):
+        pin, sw = self.getpin(c)
+        if pin is None:
+            return '', sw
+        if len(c.data)!=len(pin.value)*2:
+            return '', SW_WRONG_LENGTH
+        if not pin.enabled:
+            return '', SW_REFERENCED_DATA_INVALIDATED
+        n = len(pin.value)
+        sw = pin.check(c.data[:n])
+        if sw==SW_NO_ERROR:
+            pin.value = c.data[n:]
+            self.verified.add(c.p2)
+        return '', sw
+
+    def disablepin(self, c):
+        pin, sw = self.getpin(c)
+        if pin is None:
+            return '', sw
+        if not pin.enabled:
+            return '', SW_REFERENCED_DATA_INVALIDATED
+        sw = pin.check(c.data)
+        if sw==SW_NO_ERROR:
+            pin.enabled = False
+        return '', sw
+
+    def enablepin(self, c):
+        pin, sw = self.getpin(c)
+        if pin is None:
+            return '', sw
+        if pin.enabled:
+            return '', SW_CONDITIONS_NOT_SATISFIED
+        sw = pin.check(c.data)
+        if sw==SW_NO_ERROR:
+            pin.enabled = True
+            self.verified.add(c.p2)
+        return '', sw
+
+
+def createusim(iccid='982520506196020013F3', imsi='083943204035762283', acc='0002', pin1='31313131FFFFFFFF', adm1='3838383838383838', atr=DEFAULT_ATR):
+    ''' Returns a VirtualCard with a USIM file system:
+
+        MF/EF_DIR, MF/EF_ICCID, MF/DF_GSM/EF_IMSI & EF_ACC, ADF_USIM/EF_IMSI & EF_ACC
+
+        imsi: hexdigits of EF_IMSI without the length byte '08', like api_incarddata.IMSIValidator
+    '''
+    def elementary():
+        return (TransparentFile('6F07', '08'+imsi, readac=0x01, updateac=0x0A),
+                TransparentFile('6F78', acc, readac=0x01, updateac=0x0A),)
+
+    application = tlv('61', tlv('4F', USIM_AID) + tlv('50', b2a('USIM')))
+    mf = DedicatedFile('3F00', children=(
+            LinearFixedFile('2F00', [application], recordlength=0x20, numberofrecords=2, updateac=0x0A),
+            TransparentFile('2FE2', iccid, updateac=0x0A),
+            DedicatedFile('7F20', children=elementary()),
+            DedicatedFile('7FF0', aid=USIM_AID, children=elementary()),
+            ))
+    pins = {0x01 : Pin(pin1), 0x0A : Pin(adm1, tries=10)}
+    return VirtualCard(atr, mf, pins)
+
+
+#-------------------------------------------------------------------------------
+# transport, see api_pcsc.PCSCTransport
+
+class VirtualConnection(object):
+    ''' Connection to a virtual reader, like a pyscard connection. '''
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.card = None
+        self.disposition = smartcard.scard.SCARD_UNPOWER_CARD
+
+    def connect(self, protocol=None, mode=None, disposition=None):
+        card = self.reader.card
+        if card is None:
+            raise NoCardException('No card in %s!' % self.reader)
+        card.power(disposition!=smartcard.scard.SCARD_RESET_CARD) # only counted, states cleared anyway
+        self.card = card
+
+    def reconnect(self, protocol=None, mode=None, disposition=None):
+        ''' Reset the card, like pyscard 2 SCardReconnect '''
+        if self.card is None or self.card is not self.reader.card:
+            raise NoCardException('Card removed from %s!' % self.reader)
+        self.card.power(disposition!=smartcard.scard.SCARD_RESET_CARD)
+
+    def disconnect(self):
+        if self.card and self.disposition==smartcard.scard.SCARD_UNPOWER_CARD:
+            self.card.poweroff()
+        self.card = None
+
+    def getATR(self):
+        if self.card is None:
+            raise VirtualCardException('Card is not connected!')
+        return api_util.toBytes(self.card.atr)
+
+    def getProtocol(self):
+        return smartcard.scard.SCARD_PROTOCOL_T0 if self.card.t0 else smartcard.scard.SCARD_PROTOCOL_T1
+
+    def transmit(self, btes, protocol=None):
+        if self.card is None:
+            raise VirtualCardException('Card is not connected!')
+        if self.card is not self.reader.card:
+            raise VirtualCardException('Card removed from %s!' % self.reader)
+        return self.card.transmit(btes)
+
+
+class VirtualReader(object):
+
+    def __init__(self, name, card=None):
+        self.name = name
+        self.card = card
+
+    def __str__(self):
+        return self.name
+
+    def insert(self, card):
+        self.card = card
+
+    def remove(self):
+        self.card = None
+
+    def createConnection(self):
+        return VirtualConnection(self)
+
+
+class VirtualTransport(object):
+    ''' Transport of virtual readers, see api_pcsc.settransport(). '''
+
+    NoCardErrors = (NoCardException,)
+
+    def __init__(self, readers=()):
+        self.lst = list(readers)
+
+    def __str__(self):
+        return 'virtual, %s' % ', '.join(map(str, self.lst))
+
+    def readers(self):
+        return list(self.lst)
+
+    def addreader(self, reader):
+        self.lst.append(reader)
+        return reader
+
+    def getreader(self, name):
+        for x in self.lst:
+            if x.name == name:
+                return x
+
+
+def createtransport(*cards):
+    ''' Returns a VirtualTransport with one reader per card, 'Virtual Reader 0', 'Virtual Reader 1',
+        ... A USIM is created if no card given, see createusim().
+    '''
+    cards = cards if cards else (createusim(),)
+    return VirtualTransport([VirtualReader('Virtual Reader %d' % i, x) for i, x in enumerate(cards)])
+
+
+#-------------------------------------------------------------------------------
+class TestModule(unittest.TestCase):
+    ''' 本模块的单元测试 '''
+
+    def setUp(self):
+        self.card = createusim()
+        self.transport = createtransport(self.card)
+        self.old = api_pcsc.settransport(self.transport)
+        self.session = api_pcsc.ReaderSession()
+        self.oldsession = api_pcsc.bindsession(self.session)
+        api_pcsc.connectreader()
+
+    def tearDown(self):
+        api_pcsc.disconnect()
+        api_pcsc.bindsession(self.oldsession)
+        api_pcsc.settransport(self.old)
+
+    def test_usim(self):
+        ''' 用api_incarddata.Usim读取虚拟卡的ICCID、IMSI，校验PIN '''
+        import api_incarddata
+        card = api_incarddata.Usim()
+        self.assertEqual(card.reset(), DEFAULT_ATR)
+        card.select('3F00')
+        card.select('2FE2')
+        self.assertEqual(card.readbinary(0, 10)[0], '982520506196020013F3')
+
+        aid = card.getusimaid()
+        self.assertEqual(aid, USIM_AID)
+        card.selectbyaid(aid)
+        fci = api_incarddata.FileControlInformation(card.select('6F07')[0])
+        self.assertEqual(card.readbinary(0, fci.filesize, expectSW='6982')[1], '6982')
+        card.verifypin('31313131FFFFFFFF')
+        self.assertEqual(card.readbinary(0, fci.filesize)[0], '08083943204035762283')
+
+        # 6Cxx & wrong PIN
+        api_pcsc.setautogetresponse(False)
+        self.assertEqual(card.readbinary(0, 0x20, expectSW='')[1], '6C0A')
+        api_pcsc.setautogetresponse(True)
+        self.assertEqual(card.verifypin('32323232FFFFFFFF', expectSW='')[1], '63C2')
+        card.disablepin('31313131FFFFFFFF')
+        self.assertEqual(card.verifypin('31313131FFFFFFFF', expectSW='')[1], api_incarddata.SW_PIN1_DISABLED)
+
+    def test_getresponse(self):
+        ''' 验证T=0下的61xx、GET RESPONSE '''
+        api_pcsc.setautogetresponse(False)
+        r, sw = api_pcsc.send('00A40004023F00')
+        self.assertEqual((r, sw[:2]), ('', '61'))
+        r, sw = api_pcsc.send('00C0000005')
+        self.assertEqual(r, '620B820278')
+        self.assertEqual(sw[:2], '61')
+        r, sw = api_pcsc.send('00C00000' + sw[2:])
+        self.assertEqual(sw, '9000')
+        api_pcsc.send('00C0000001', expectSW='6985')
+
+    def test_gp(self):
+        ''' 用api_gp在虚拟卡上执行认证、下载、安装、删除 '''
+        cap = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cos_testsuites', 'arrayCopy.cap')
+        pkg = api_gp.api_cap.CAPFile(cap).getPackageAID()
+        instance = pkg + '01'
+        cm = self.card.cardmanager
+
+        api_gp.card()
+        api_gp.auth()
+        api_gp.deleteaid(pkg, True, expectSW='6A88')
+        api_gp.upload(cap, pkg)
+        modules = cm.packages[pkg]['modules']
+        self.assertTrue(modules)
+        api_gp.install(instance, pkg, modules[0])
+        self.assertEqual(cm.applets[instance]['module'], modules[0])
+
+        self.card.sethandler(modules[0], echo)
+        api_gp.select(instance)
+        self.assertEqual(api_pcsc.send('8001000003112233')[0], '112233')
+
+        api_gp.card()
+        api_gp.auth()
+        api_gp.deleteaid(pkg, expectSW='6985')
+        api_gp.deleteaid(pkg, True)
+        self.assertFalse(cm.packages or cm.applets)
+
+        # C-MAC required, wrong key
+        api_gp.card()
+        api_gp.auth(level='01')
+        api_gp.deleteaid(pkg, expectSW='6982')
+        api_gp.card()
+        self.assertRaises(api_pcsc.PCSCException, api_gp.auth, s_enc='00'*16)
+
+    def test_benchmark(self):
+        ''' 统计虚拟卡上api_pcsc.send、send_batch的吞吐量 '''
+        import time
+        api_pcsc.send('00A40004022FE2')
+        n = 2000
+        t0 = time.time()
+        for i in range(n):
+            api_pcsc.send('00B000000A', expectSW='9000')
+        t1 = time.time()
+        api_pcsc.send_batch(['00B000000A']*n)
+        t2 = time.time()
+        Logger.info('virtual card, send: %d APDU/s, send_batch: %d APDU/s' % (n/(t1-t0), n/(t2-t1)))
+        self.assertEqual(self.card.count, 2*n+2)
+
+    def test_extended(self):
+        ''' 用sendcommand读写600字节的EF：支持扩展长度的卡、命令链、扩展APDU被拒绝后回退 '''
+        data = ''.join(['%.2X' % (i & 0xFF) for i in range(600)])
+        chaining = '3B85018073000080F7' # command chaining only
+        for atr, extended, count in ((EXTENDED_ATR, True, 2), (chaining, False, 4), (EXTENDED_ATR, False, 5)):
+            mf = DedicatedFile('3F00', children=[TransparentFile('0001', size=1024)])
+            card = VirtualCard(atr, mf, t0=False, extended=extended)
+            api_pcsc.settransport(createtransport(card))
+            api_pcsc.connectreader()
+            self.assertEqual(api_pcsc.getsession().getcapabilities()['extended'] or False, atr==EXTENDED_ATR)
+
+            api_pcsc.sendcommand('00', 'A4', '00', '0C', '0001', expectSW='9000')
+            api_pcsc.sendcommand('00', 'D6', '00', '00', data, expectSW='9000')
+            self.assertEqual(card.count, count)
+            self.assertEqual(b2a(bytes(mf.find('0001').data[:600])), data)
+            if extended:
+                r, sw = api_pcsc.sendcommand('00', 'B0', '00', '00', le=600, expectSW='9000')
+                self.assertEqual(r, data)
+                self.assertEqual(api_pcsc.getlastapdu()['le'], '000258')
+            else:
+                r, sw = api_pcsc.send7816('00', 'B0', '01', '00', '', le='00', expectSW='9000')
+                self.assertEqual(r, data[0x200:0x400])
+
+
+#-------------------------------------------------------------------------------
+if __name__ == '__main__':
+    FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+    logging.basicConfig(level=logging.DEBUG, format=FORMAT)
+    unittest.main()
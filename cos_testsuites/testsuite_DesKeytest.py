@@ -86,19 +86,13 @@ class TestCase_DESKEY(api_unittest.TestCase):
         api_pcsc.connectreader()
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(des.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(des.getcappath(), instance, pkg, applet) # unless deployed already
 
         cls.des = des
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.des.getaids()
-        api_pcsc.connectreader()
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         cls.des = None
         api_pcsc.disconnect()
 
@@ -14,9 +14,8 @@ Author: wg@china-xinghan.com
 
 import logging, os, webbrowser, unittest, random
 
-from Crypto.Cipher import DES
-
 import api_pcsc
+import api_crypto
 import api_util
 import api_unittest
 
@@ -55,8 +54,7 @@ class Bootloader(object):
         return api_pcsc.send('BF24000010'+old+new, info='Change PIN')
 
     def changekey(self, old, new):
-        des = DES.new(a2b(old), DES.MODE_ECB, None)
-        cipher = des.encrypt(a2b(new+'80'+'00'*7))
+        cipher = api_crypto.encrypt(api_crypto.DES, a2b(old), a2b(new+'80'+'00'*7))
         return api_pcsc.send('BF24010010'+b2a(cipher), info='Change Key, new key ' + new)
 
     def erasepage(self, start, end, erasevector=False):
@@ -83,8 +81,7 @@ class Bootloader(object):
             if len(data1)%8:
                 padding = '\xFF' * (8-len(data1)%8)
                 data1 = data1 + padding
-            des = DES.new(a2b(key), DES.MODE_ECB, None)
-            cipher = b2a( des.encrypt(a2b(data1)) )
+            cipher = b2a( api_crypto.encrypt(api_crypto.DES, a2b(key), a2b(data1)) )
 
             apdu = 'B'+cipher[-2] + 'B'+cipher[-1] + '%.4X'%(start&0xFFFF) + '%.2X'%(len(cipher)-1) + cipher[:-2]
             return api_pcsc.send(apdu, info='Write Flash, %d bytes, %s' % (lgth/2, data))
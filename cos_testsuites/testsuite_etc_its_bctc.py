@@ -185,9 +185,7 @@ class TestCase_ETC_ITS_BCTC(api_unittest.TestCase):
         api_pcsc.connectreader(Cloud4700.READER_NAME) # 指明读卡器名字，因为目前只有4700可以通过APDU方式设定各类电压是否支持
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(etc.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(etc.getcappath(), instance, pkg, applet) # unless deployed already
 
         cloud = Cloud4700()
         cloud.enable_all_classes()
@@ -199,11 +197,8 @@ class TestCase_ETC_ITS_BCTC(api_unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.etc.getaids()
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         api_pcsc.connectreader(Cloud4700.READER_NAME)
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
         cls.etc = None
 
         cls.cloud.enable_all_classes()
@@ -64,19 +64,13 @@ class TestCase_ALG_PSEUDO_RANDOM(api_unittest.TestCase):
         api_pcsc.connectreader()
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(alg.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(alg.getcappath(), instance, pkg, applet) # unless deployed already
 
         cls.alg = alg
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.alg.getaids()
-        api_pcsc.connectreader()
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         cls.alg = None
         api_pcsc.disconnect()
 
@@ -161,20 +155,14 @@ class TestCase_ALG_SECURE_RANDOM(api_unittest.TestCase):
         api_pcsc.connectreader()
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(alg.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(alg.getcappath(), instance, pkg, applet) # unless deployed already
 
         cls.alg = alg
         api_pcsc.disconnect()
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.alg.getaids()
-        api_pcsc.connectreader()
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         cls.alg = None
         api_pcsc.disconnect()
 
@@ -318,19 +306,13 @@ class TestCase_JCSystem(api_unittest.TestCase):
         api_pcsc.connectreader()
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(jcs.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(jcs.getcappath(), instance, pkg, applet) # unless deployed already
 
         cls.jcs = jcs
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.jcs.getaids()
-        api_pcsc.connectreader()
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         cls.jcs = None
         api_pcsc.disconnect()
 
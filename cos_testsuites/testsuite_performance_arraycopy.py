@@ -76,20 +76,14 @@ class TestCase_Performance_ArrayCopy(api_unittest.TestCase):
         api_pcsc.connectreader()
         api_gp.card()
         api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='') # omit delete result
-        api_gp.upload(app.getcappath(), pkg)
-        api_gp.install(instance, pkg, applet)
+        api_gp.deploy(app.getcappath(), instance, pkg, applet) # unless deployed already
 
         api_pcsc.reset()
         cls.app = app
 
     @classmethod
     def tearDownClass(cls):
-        instance, pkg, applet = cls.app.getaids()
-        api_pcsc.connectreader()
-        api_gp.card()
-        api_gp.auth()
-        api_gp.deleteaid(pkg, True, expectSW='9000')
+        # the applet is kept on the card for the next run, see api_gp.deploy()
         cls.app = None
 
         api_pcsc.disconnect()